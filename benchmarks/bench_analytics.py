@@ -0,0 +1,108 @@
+# Latency of /analytics/query style aggregations over a synthetic payments
+# snapshot: executed inline and through the worker pool (which adds the
+# round trip to the process).
+#
+#   python -m benchmarks.bench_analytics --rows 50000000 --days 90
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from nuAPI import analytics
+from nuAPI.analytics import execute_query, run_query, write_snapshot
+
+CURRENCIES = ["NGN", "KES", "GHS", "ZAR", "UGX", "TZS", "USD"]
+STATUSES = ["confirmed", "pending", "failed", "refunded"]
+CHANNELS = ["card", "bank_transfer", "mpesa", "airtel_money", "mtn_mobile_money", "ussd", "apple_pay", "google_pay"]
+
+
+def build(directory, rows, days, merchants, seed=3):
+    rng = np.random.default_rng(seed)
+    end = int(datetime.utcnow().timestamp())
+    chunk = 10_000_000
+    times, amounts, codes = [], [], {"currency": [], "payment_status": [], "channel": [], "merchant_id": []}
+    for start in range(0, rows, chunk):
+        n = min(chunk, rows - start)
+        # Each chunk covers its own stretch of the period, so the whole column comes out sorted
+        low = end - days * 86400 + days * 86400 * start // rows
+        times.append(np.sort(rng.integers(low, low + days * 86400 * n // rows + 1, n)))
+        amounts.append(np.round(rng.lognormal(7, 1.5, n), 2))
+        codes["currency"].append(rng.integers(0, len(CURRENCIES), n, dtype=np.uint8))
+        codes["payment_status"].append(rng.choice(len(STATUSES), n, p=[0.8, 0.1, 0.08, 0.02]).astype(np.uint8))
+        codes["channel"].append(rng.integers(0, len(CHANNELS), n, dtype=np.uint8))
+        codes["merchant_id"].append(rng.integers(0, merchants, n, dtype=np.uint16))
+    labels = {"currency": CURRENCIES, "payment_status": STATUSES, "channel": CHANNELS, "merchant_id": [f"merchant-{n}" for n in range(merchants)]}
+    return write_snapshot(
+        directory, "payments", rows, np.concatenate(times), {"amount": np.concatenate(amounts)},
+        {column: (np.concatenate(parts), labels[column]) for column, parts in codes.items()},
+    )
+
+
+def queries(now):
+    week = [(now - timedelta(days=7)).isoformat(), now.isoformat()]
+    month = [(now - timedelta(days=30)).isoformat(), now.isoformat()]
+    return {
+        "failed mobile money by hour, KES, last week": {
+            "table": "payments", "group_by": [], "bucket": "hour", "limit": 1000,
+            "filters": [{"column": "currency", "op": "eq", "value": "KES"}, {"column": "payment_status", "op": "eq", "value": "failed"},
+                        {"column": "channel", "op": "in", "value": ["mpesa", "airtel_money", "mtn_mobile_money"]},
+                        {"column": "timestamp", "op": "between", "value": week}],
+            "aggregates": [{"fn": "count"}, {"fn": "sum", "column": "amount"}],
+        },
+        "top 20 merchants by volume, last 30 days": {
+            "table": "payments", "group_by": ["merchant_id"], "bucket": None, "order_by": "sum_amount", "descending": True, "limit": 20,
+            "filters": [{"column": "payment_status", "op": "eq", "value": "confirmed"}, {"column": "timestamp", "op": "between", "value": month}],
+            "aggregates": [{"fn": "sum", "column": "amount"}, {"fn": "count"}],
+        },
+        "p50/p95 amount by currency and channel, all time": {
+            "table": "payments", "group_by": ["currency", "channel"], "bucket": None, "limit": 1000, "filters": [],
+            "aggregates": [{"fn": "count"}, {"fn": "percentile", "column": "amount", "q": 0.5}, {"fn": "percentile", "column": "amount", "q": 0.95}],
+        },
+        "daily volume by currency, all time": {
+            "table": "payments", "group_by": ["currency"], "bucket": "day", "limit": 100_000, "filters": [],
+            "aggregates": [{"fn": "sum", "column": "amount"}],
+        },
+    }
+
+
+async def pooled(query, directory, repeat):
+    await run_query(query, directory)  # the worker maps the snapshot on its first query
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        await run_query(query, directory)
+        timings.append(time.perf_counter() - t)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000_000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--merchants", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    t = time.perf_counter()
+    path = build(directory, args.rows, args.days, args.merchants)
+    print(f"snapshot of {args.rows:,} rows written in {time.perf_counter() - t:.1f}s")
+    analytics.ANALYTICS_WORKERS = 1
+    for name, query in queries(datetime.utcnow()).items():
+        execute_query(path, "payments", query)
+        timings = []
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            result = execute_query(path, "payments", query)
+            timings.append(time.perf_counter() - t)
+        print(f"{name}: {result['matched_rows']:,} rows matched, {len(result['rows'])} groups, "
+              f"inline {statistics.median(timings) * 1e3:.0f}ms, pooled {asyncio.run(pooled(query, directory, args.repeat)) * 1e3:.0f}ms")
+    analytics.analytics_executor().shutdown()
+
+
+if __name__ == "__main__":
+    main()
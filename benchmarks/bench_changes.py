@@ -0,0 +1,60 @@
+# Change-feed read cost: fetching the newest page of changes stays flat as the
+# payments table grows, and a full catch-up pages through at a steady rate.
+#
+#   python -m benchmarks.bench_changes --rows 100000 1000000 --limit 1000
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.changes import next_cursor, read_changes
+from nuAPI.models import Base, ChangeTombstone, Payments, PaymentStatus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+        Base.metadata.create_all(bind=engine, tables=[Payments.__table__, ChangeTombstone.__table__])
+        now = datetime.utcnow()
+        with engine.begin() as conn:
+            for start in range(0, rows, 50_000):
+                conn.execute(Payments.__table__.insert(), [
+                    {"id": str(uuid4()), "user_id": f"user-{n % 5000}", "amount": 125, "currency": "NGN",
+                     "payment_status": PaymentStatus.confirmed, "change_seq": n + 1, "timestamp": now}
+                    for n in range(start, min(start + 50_000, rows))
+                ])
+        db = sessionmaker(bind=engine)()
+        t = time.perf_counter()
+        for _ in range(args.repeat):
+            page = read_changes(db, {"payments": rows - args.limit}, ["payments"], args.limit)
+        tail_time = (time.perf_counter() - t) / args.repeat
+        assert len(page) == args.limit and page[-1]["seq"] == rows
+
+        t = time.perf_counter()
+        since, seen = {"payments": 0}, 0
+        while True:
+            page = read_changes(db, since, ["payments"], args.limit)
+            if not page:
+                break
+            seen += len(page)
+            since = next_cursor(since, page)
+        catch_up = time.perf_counter() - t
+        assert seen == rows
+        print(f"{rows:>10,} rows: newest {args.limit} changes in {tail_time * 1e3:.1f}ms, "
+              f"full catch-up in {catch_up:.1f}s ({rows / catch_up:,.0f} changes/s)")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Latency the duplicate check adds to each payment create, for the in-memory
+# index alone and with the database fallback over a populated payments table.
+#
+#   python -m benchmarks.bench_dedup --payments 200000 --checks 50000
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI import dedup
+from nuAPI.dedup import FingerprintIndex, find_duplicate
+from nuAPI.models import Base, Payments, PaymentStatus
+
+CHANNELS = ["card", "bank_transfer", "mpesa", "mtn_mobile_money", "airtel_money"]
+
+
+def _payments(count: int, users: int, rng: random.Random):
+    start = datetime.utcnow() - timedelta(days=30)
+    for n in range(count):
+        yield {
+            "id": str(uuid4()),
+            "user_id": f"user-{rng.randrange(users)}",
+            "amount": Decimal(rng.randrange(100, 100_000)) / 100,
+            "currency": "NGN",
+            "payment_status": PaymentStatus.confirmed,
+            "channel": rng.choice(CHANNELS),
+            "transaction_reference": str(uuid4()),
+            "timestamp": start + timedelta(seconds=n * 30 * 86400 // count),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payments", type=int, default=200_000)
+    parser.add_argument("--checks", type=int, default=50_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--double-tap-share", type=float, default=0.02)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[Payments.__table__])
+    rows = list(_payments(args.payments, args.users, random.Random(7)))
+    with engine.begin() as conn:
+        for start in range(0, len(rows), 50_000):
+            conn.execute(Payments.__table__.insert(), rows[start:start + 50_000])
+
+    rng = random.Random(11)
+    checks = []
+    for _ in range(args.checks):
+        if checks and rng.random() < args.double_tap_share:
+            checks.append(checks[-1])
+        else:
+            checks.append((f"user-{rng.randrange(args.users)}", Decimal(rng.randrange(100, 100_000)) / 100, "NGN", rng.choice(CHANNELS)))
+
+    db = sessionmaker(bind=engine)()
+    for backend in ("memory", "database"):
+        dedup.DUPLICATE_BACKEND = backend
+        dedup.duplicate_index = FingerprintIndex()
+        flagged = 0
+        t = time.perf_counter()
+        for user_id, amount, currency, channel in checks:
+            flagged += find_duplicate(db, user_id, amount, currency, channel, str(uuid4())) is not None
+        elapsed = time.perf_counter() - t
+        print(f"{backend}: {args.checks:,} checks in {elapsed:.2f}s, {elapsed / args.checks * 1e6:.1f}us per create, "
+              f"{flagged:,} duplicates, {len(dedup.duplicate_index):,} fingerprints held")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
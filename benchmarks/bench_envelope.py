@@ -0,0 +1,77 @@
+# Per-field envelope encryption cost with and without the data-key cache,
+# and re-encryption throughput after every tenant's key is rotated.
+#
+#   python -m benchmarks.bench_envelope --tenants 1000 --fields 100000
+import argparse
+import base64
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI import envelope
+from nuAPI.envelope import EnvelopeService, KeyCache
+from nuAPI.models import Base, Encryption, KeyRotationJob, Payments, PaymentStatus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, default=1000)
+    parser.add_argument("--fields", type=int, default=100_000)
+    parser.add_argument("--uncached", type=int, default=5000, help="fields to time with the cache off")
+    args = parser.parse_args()
+
+    envelope.MASTER_KEYS["bench-1"] = os.urandom(32)
+    envelope.ACTIVE_MASTER_KEY = "bench-1"
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[Encryption.__table__, KeyRotationJob.__table__, Payments.__table__])
+    db = sessionmaker(bind=engine)()
+    rng = random.Random(7)
+    tenants = [str(uuid4()) for _ in range(args.tenants)]
+    fields = [(rng.choice(tenants), base64.b32encode(os.urandom(15)).decode()) for _ in range(args.fields)]
+
+    cached = EnvelopeService(KeyCache())
+    for tenant in tenants:
+        cached.current_key(db, tenant)
+    t = time.perf_counter()
+    sealed = [cached.encrypt(db, tenant, value) for tenant, value in fields]
+    encrypt_time = (time.perf_counter() - t) / len(fields)
+    t = time.perf_counter()
+    assert [cached.decrypt(db, tenant, value) for (tenant, _), value in zip(fields, sealed)] == [value for _, value in fields]
+    decrypt_time = (time.perf_counter() - t) / len(fields)
+    print(f"cached:   encrypt {encrypt_time * 1e6:.1f}us, decrypt {decrypt_time * 1e6:.1f}us per field")
+
+    uncached = EnvelopeService(None)
+    sample = fields[:args.uncached]
+    t = time.perf_counter()
+    sample_sealed = [uncached.encrypt(db, tenant, value) for tenant, value in sample]
+    encrypt_time = (time.perf_counter() - t) / len(sample)
+    t = time.perf_counter()
+    for (tenant, _), value in zip(sample, sample_sealed):
+        uncached.decrypt(db, tenant, value)
+    decrypt_time = (time.perf_counter() - t) / len(sample)
+    print(f"uncached: encrypt {encrypt_time * 1e6:.1f}us, decrypt {decrypt_time * 1e6:.1f}us per field")
+
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(Payments.__table__.insert(), [
+            {"id": str(uuid4()), "user_id": tenant, "amount": 1, "currency": "NGN", "payment_status": PaymentStatus.confirmed,
+             "description": value, "timestamp": now}
+            for (tenant, _), value in zip(fields, sealed)
+        ])
+    for tenant in tenants:
+        cached.rotate_tenant_key(db, tenant)
+    t = time.perf_counter()
+    count = cached.reencrypt_column(db, Payments.description, Payments.user_id)
+    elapsed = time.perf_counter() - t
+    print(f"re-encrypted {count:,} fields after rotating {len(tenants):,} keys in {elapsed:.2f}s, {count / elapsed:,.0f}/s")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
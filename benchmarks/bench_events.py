@@ -0,0 +1,78 @@
+# Outbox relay throughput: a backlog of payment events delivered to the
+# in-process, file-log and local-broker sinks, each with its own offset.
+#
+#   python -m benchmarks.bench_events --events 200000 --batch-size 500
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.events import FileLogSink, LocalBroker, OutboxRelay, SubscriberSink
+from nuAPI.models import Base, ConsumerOffset, PaymentEvent
+
+
+class FlakySink(SubscriberSink):
+    # Fails every fiftieth batch, to show redelivery loses no events
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.seen = set()
+
+    def deliver(self, events):
+        self.calls += 1
+        if self.calls % 50 == 0:
+            raise RuntimeError("downstream unavailable")
+        self.seen.update(event["seq"] for event in events)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    engine = create_engine("sqlite:///" + os.path.join(directory, "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[PaymentEvent.__table__, ConsumerOffset.__table__])
+    now = datetime.utcnow()
+    rows = []
+    for n in range(args.events):
+        user_id = f"user-{n % 5000}"
+        rows.append({
+            "event_type": "payment.created", "payment_id": str(uuid4()), "user_id": user_id, "created_at": now,
+            "payload": {"user_id": user_id, "amount": "125.50", "currency": "NGN", "status": "pending", "channel": "card"},
+        })
+    with engine.begin() as conn:
+        for start in range(0, len(rows), 50_000):
+            conn.execute(PaymentEvent.__table__.insert(), rows[start:start + 50_000])
+
+    subscribers = SubscriberSink()
+    received = []
+    subscribers.subscribe(received.append)
+    broker = LocalBroker()
+    flaky = FlakySink()
+    sinks = {"subscribers": subscribers, "file-log": FileLogSink(os.path.join(directory, "events.ndjson")), "broker": broker, "flaky": flaky}
+    relay = OutboxRelay(sessionmaker(bind=engine), sinks, batch_size=args.batch_size, retry_backoff=0.0)
+
+    t = time.perf_counter()
+    idle = 0
+    while idle < 2:  # A sink that just failed is retried on the next pass
+        idle = 0 if relay.relay_once() else idle + 1
+    elapsed = time.perf_counter() - t
+    db = sessionmaker(bind=engine)()
+    offsets = dict(db.query(ConsumerOffset.consumer, ConsumerOffset.last_seq))
+    assert all(offset == db.query(func.max(PaymentEvent.seq)).scalar() for offset in offsets.values())
+    assert len(flaky.seen) == args.events
+    print(f"relayed {args.events:,} events to {len(sinks)} sinks in {elapsed:.2f}s, {args.events / elapsed:,.0f} events/s "
+          f"({args.events * len(sinks) / elapsed:,.0f} deliveries/s), {flaky.calls // 50} flaky-sink failures redelivered")
+    print(f"  broker partitions: {[len(partition) for partition in broker.partitions]}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
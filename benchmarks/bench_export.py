@@ -0,0 +1,80 @@
+# Parquet export of payments (partitioned by date and currency) against a
+# plain CSV export of the same rows: time and size on disk, then a small
+# incremental export from the watermark.
+#
+#   python -m benchmarks.bench_export --rows 1000000 --days 90
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.export import export_csv, export_parquet
+from nuAPI.models import Base, ExportWatermark, Payments, PaymentStatus
+
+CURRENCIES = ["NGN", "KES", "GHS", "ZAR", "USD"]
+CHANNELS = ["card", "bank_transfer", "mpesa", "airtel_money", "ussd", "apple_pay"]
+
+
+def payment_rows(rng, start, count, days):
+    base = datetime.utcnow() - timedelta(days=days)
+    statuses = list(PaymentStatus)
+    return [
+        {"id": str(uuid4()), "user_id": f"user-{rng.randrange(50_000)}", "amount": round(rng.uniform(1, 50_000), 2),
+         "currency": rng.choice(CURRENCIES), "payment_status": rng.choice(statuses), "channel": rng.choice(CHANNELS),
+         "description": None, "change_seq": start + n + 1, "timestamp": base + timedelta(seconds=rng.randrange(days * 86400))}
+        for n in range(count)
+    ]
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--increment", type=int, default=10_000)
+    args = parser.parse_args()
+
+    rng = random.Random(11)
+    directory = tempfile.mkdtemp()
+    engine = create_engine("sqlite:///" + os.path.join(directory, "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[Payments.__table__, ExportWatermark.__table__])
+    with engine.begin() as conn:
+        for start in range(0, args.rows, 50_000):
+            conn.execute(Payments.__table__.insert(), payment_rows(rng, start, min(50_000, args.rows - start), args.days))
+    db = sessionmaker(bind=engine)()
+
+    out = os.path.join(directory, "exports")
+    t = time.perf_counter()
+    result = export_parquet(db, "payments", out)
+    parquet_time = time.perf_counter() - t
+    parquet_size = directory_size(out)
+    csv_path = os.path.join(directory, "payments.csv")
+    t = time.perf_counter()
+    assert export_csv(db, "payments", csv_path) == result.rows == args.rows
+    csv_time = time.perf_counter() - t
+    csv_size = os.path.getsize(csv_path)
+    print(f"parquet: {result.rows:,} rows, {len(result.files)} files, {parquet_size / 1e6:.1f}MB in {parquet_time:.2f}s "
+          f"({result.rows / parquet_time:,.0f} rows/s)")
+    print(f"csv:     {args.rows:,} rows, 1 file, {csv_size / 1e6:.1f}MB in {csv_time:.2f}s ({args.rows / csv_time:,.0f} rows/s), "
+          f"{csv_size / parquet_size:.1f}x the Parquet size")
+
+    with engine.begin() as conn:
+        conn.execute(Payments.__table__.insert(), payment_rows(rng, args.rows, args.increment, 1))
+    t = time.perf_counter()
+    increment = export_parquet(db, "payments", out)
+    assert increment.rows == args.increment
+    print(f"incremental: {increment.rows:,} rows after watermark {result.position} in {time.perf_counter() - t:.2f}s")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Batched FX conversion throughput over a column of minor-unit amounts.
+#
+#   python -m benchmarks.bench_fx_conversion --count 10000000
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from nuAPI.fx import convert_amounts, convert_minor, normalise_minor, rate_cache
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10_000_000)
+    parser.add_argument("--history", type=int, default=10_000, help="rate versions per pair")
+    args = parser.parse_args()
+
+    start = datetime(2024, 1, 1)
+    for n in range(args.history):
+        at = start + timedelta(minutes=n)
+        rate_cache.add("USD", "NGN", Decimal("1500.25") + Decimal(n % 97) / 100, at)
+        rate_cache.add("USD", "KES", Decimal("129.4375") + Decimal(n % 13) / 100, at)
+        rate_cache.add("USD", "EUR", Decimal("0.9134"), at)
+    as_of = start + timedelta(minutes=args.history // 2, seconds=30)
+
+    rng = random.Random(7)
+    amounts = [rng.randrange(1, 10_000_000_00) for _ in range(args.count)]
+    currencies = [rng.choice(("NGN", "KES", "EUR", "USD")) for _ in range(args.count)]
+
+    t = time.perf_counter()
+    for _ in range(100_000):
+        rate_cache.rate("NGN", "KES", as_of)
+    print(f"as-of cross-rate lookup: {(time.perf_counter() - t) / 100_000 * 1e6:.2f} us")
+
+    t = time.perf_counter()
+    convert_minor(amounts, "NGN", "USD", as_of)
+    elapsed = time.perf_counter() - t
+    print(f"convert_minor {args.count:,} amounts: {elapsed:.2f}s ({args.count / elapsed / 1e6:.2f}M/s)")
+
+    t = time.perf_counter()
+    normalise_minor(amounts, currencies, "USD", as_of)
+    elapsed = time.perf_counter() - t
+    print(f"normalise_minor {args.count:,} mixed amounts: {elapsed:.2f}s ({args.count / elapsed / 1e6:.2f}M/s)")
+
+    sample = min(args.count, 1_000_000)
+    decimals = [Decimal(a).scaleb(-2) for a in amounts[:sample]]
+    t = time.perf_counter()
+    convert_amounts(decimals, "NGN", "USD", as_of)
+    elapsed = time.perf_counter() - t
+    print(f"convert_amounts {sample:,} Decimals: {elapsed:.2f}s ({sample / elapsed / 1e6:.2f}M/s)")
+
+    t = time.perf_counter()
+    rate = Decimal(1) / Decimal("1500.25")
+    [(d * rate).quantize(Decimal("0.01")) for d in decimals]
+    elapsed = time.perf_counter() - t
+    print(f"naive per-item Decimal {sample:,}: {elapsed:.2f}s ({sample / elapsed / 1e6:.2f}M/s)")
+
+
+if __name__ == "__main__":
+    main()
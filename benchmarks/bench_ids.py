@@ -0,0 +1,88 @@
+# Primary-key layouts for the payments table on SQLite: random uuid4 text
+# (the old default), UUIDv7 text and UUIDv7 as 16 bytes (UUIDKey). Reports
+# id generation cost, insert throughput as the table grows and the size of
+# the primary-key index at the end.
+#
+#   python -m benchmarks.bench_ids --rows 5000000
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from uuid import UUID, uuid4
+
+from nuAPI.ids import new_id, uuid7
+
+BATCH = 50_000
+
+LAYOUTS = {
+    "uuid4 text": ("TEXT", lambda: str(uuid4())),
+    "uuid7 text": ("TEXT", new_id),
+    "uuid7 binary": ("BLOB", lambda: uuid7().bytes),
+}
+
+
+def timed(fn, repeat: int) -> float:
+    t = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t) / repeat
+
+
+def run(path: str, column_type: str, make_id, rows: int, cache_mb: int, report_every: int):
+    connection = sqlite3.connect(path)
+    connection.execute(f"PRAGMA cache_size = -{cache_mb * 1024}")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"CREATE TABLE payments (id {column_type} PRIMARY KEY, user_id TEXT NOT NULL, amount NUMERIC NOT NULL)")
+    started = time.perf_counter()
+    window_start, window_rows = started, 0
+    done = 0
+    while done < rows:
+        batch = min(BATCH, rows - done)
+        with connection:
+            connection.executemany("INSERT INTO payments VALUES (?, ?, ?)",
+                                   [(make_id(), f"user-{(done + n) % 50_000}", 1250) for n in range(batch)])
+        done += batch
+        window_rows += batch
+        if done % report_every == 0 or done == rows:
+            now = time.perf_counter()
+            print(f"  {done:>12,} rows  {window_rows / (now - window_start):>9,.0f} rows/s")
+            window_start, window_rows = now, 0
+    elapsed = time.perf_counter() - started
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    sizes = dict(connection.execute("SELECT name, sum(pgsize) FROM dbstat GROUP BY name"))
+    index = sum(size for name, size in sizes.items() if name.startswith("sqlite_autoindex_payments"))
+    pages = connection.execute(
+        "SELECT sum(ncell), sum(unused), sum(pgsize) FROM dbstat WHERE name LIKE 'sqlite_autoindex_payments%' AND pagetype = 'leaf'"
+    ).fetchone()
+    connection.close()
+    return rows / elapsed, index, sizes.get("payments", 0), 1 - pages[1] / pages[2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--cache-mb", type=int, default=64, help="SQLite page cache per connection")
+    parser.add_argument("--layouts", nargs="+", default=list(LAYOUTS), choices=list(LAYOUTS))
+    args = parser.parse_args()
+
+    print(f"uuid4 text:   {timed(lambda: str(uuid4()), 200_000) * 1e6:.2f}us per id")
+    print(f"uuid7 text:   {timed(new_id, 200_000) * 1e6:.2f}us per id")
+    print(f"uuid7 binary: {timed(lambda: uuid7().bytes, 200_000) * 1e6:.2f}us per id")
+    ids = [new_id() for _ in range(100_000)]
+    assert ids == sorted(ids) and all(UUID(value).version == 7 for value in ids[:100])
+
+    directory = tempfile.mkdtemp()
+    for name in args.layouts:
+        column_type, make_id = LAYOUTS[name]
+        path = os.path.join(directory, name.replace(" ", "-") + ".db")
+        print(f"{name} ({column_type} primary key), {args.rows:,} rows:")
+        rate, index, table, fill = run(path, column_type, make_id, args.rows, args.cache_mb, max(args.rows // 10, BATCH))
+        print(f"  overall {rate:,.0f} rows/s; primary-key index {index / 1e6:,.0f}MB (leaf pages {fill:.0%} full), "
+              f"table {table / 1e6:,.0f}MB, file {os.path.getsize(path) / 1e6:,.0f}MB")
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
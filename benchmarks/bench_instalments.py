@@ -0,0 +1,68 @@
+# Rolling-window instalment materialisation and due-date lookup over many
+# active plans.
+#
+#   python -m benchmarks.bench_instalments --plans 1000000
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.ids import new_id
+from nuAPI.instalments import due_instalments, materialise_instalments
+from nuAPI.models import Base, PaymentPlan, PaymentPlanInstalment, PaymentStatus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plans", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=3, help="days of rolling to simulate")
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[PaymentPlan.__table__, PaymentPlanInstalment.__table__])
+    Session = sessionmaker(bind=engine)
+    today = date(2024, 6, 1)
+    rng = random.Random(5)
+    t = time.perf_counter()
+    with engine.begin() as conn:
+        batch = []
+        for n in range(args.plans):
+            start = today + timedelta(days=rng.randrange(-60, 60))
+            batch.append({
+                "paymentplan_id": new_id(), "user_id": "u", "amount": Decimal(rng.randrange(1000, 1_000_000)), "currency": "NGN",
+                "payment_method": "card", "payment_gateway_response": "internal", "status": PaymentStatus.pending.value,
+                "instalment_count": rng.choice((3, 6, 12, 24)), "instalment_frequency": rng.choice(("weekly", "monthly")),
+                "instalment_start_date": start, "instalments_materialised": 0, "next_instalment_date": start,
+            })
+            if len(batch) == 50_000:
+                conn.execute(PaymentPlan.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(PaymentPlan.__table__.insert(), batch)
+    print(f"setup {args.plans:,} plans: {time.perf_counter() - t:.1f}s")
+
+    db = Session()
+    t = time.perf_counter()
+    created = materialise_instalments(db, today)
+    print(f"initial catch-up: {created:,} instalments in {time.perf_counter() - t:.1f}s")
+    for day in range(1, args.days + 1):
+        t = time.perf_counter()
+        created = materialise_instalments(db, today + timedelta(days=day))
+        print(f"roll day {day}: {created:,} instalments in {time.perf_counter() - t:.2f}s")
+
+    t = time.perf_counter()
+    due = due_instalments(db, today, limit=1000)
+    print(f"due_instalments (first 1000 due): {len(due)} rows in {(time.perf_counter() - t) * 1000:.1f} ms")
+    stored = db.query(func.count(PaymentPlanInstalment.instalment_id)).scalar()
+    expanded = db.query(func.sum(PaymentPlan.instalment_count)).scalar()
+    print(f"instalment rows stored: {stored:,} (vs {expanded:,} if every schedule were expanded)")
+
+
+if __name__ == "__main__":
+    main()
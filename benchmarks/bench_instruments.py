@@ -0,0 +1,150 @@
+# Cross-channel instrument queries on SQLite, before and after the move to
+# payment_instruments: the old per-channel tables as they were (no user_id
+# index), the same tables with a (user_id, date) index each, and the unified
+# table with its (channel, user_id, date) index.
+#
+#   python -m benchmarks.bench_instruments --instruments 1000000 --users 100000
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.ids import uuid7
+from nuAPI.instruments import CHANNELS, LEGACY_TABLES, channel_of, legacy_columns, user_instruments
+from nuAPI.models import Base, PaymentInstrument
+
+REPEAT = 200
+
+
+def timed(fn, repeat: int = REPEAT) -> float:
+    t = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t) / repeat
+
+
+def legacy_ddl(name: str, cls) -> str:
+    columns = [f"{column} {'BLOB PRIMARY KEY' if target == 'id' else 'DATETIME NOT NULL' if target == 'date' else 'VARCHAR'}"
+               for column, target in legacy_columns(cls)]
+    return f"CREATE TABLE {name} ({', '.join(columns)})"
+
+
+def generate(count: int, users: int):
+    start = datetime(2024, 1, 1)
+    for _ in range(count):
+        channel = random.choice(CHANNELS)
+        details = None
+        if channel == "card":
+            details = {"card_name": "A N Other", "card_expiry": "12/27", "card_type": random.choice(["visa", "mastercard", "verve"])}
+        elif channel == "bank":
+            details = {"bank_name": random.choice(["GTB", "Access", "Zenith"]), "bank_branch": "Lekki"}
+        yield (uuid7().bytes, channel, f"user-{random.randrange(users)}", f"{random.randrange(10 ** 12):012d}",
+               random.choice(["active", "active", "active", "blocked"]), start + timedelta(seconds=random.randrange(365 * 86400)), None, details)
+
+
+def load_legacy(connection, rows):
+    by_channel = {channel_of(cls): (name, cls) for name, cls in LEGACY_TABLES.items()}
+    for name, cls in LEGACY_TABLES.items():
+        connection.execute(legacy_ddl(name, cls))
+    batches = {channel: [] for channel in CHANNELS}
+    for id_, channel, user_id, number, status, date, message, details in rows:
+        name, cls = by_channel[channel]
+        values = {"id": id_, "user_id": user_id, "number": number, "status": status, "date": date, "message": message}
+        batches[channel].append([values[target] if isinstance(target, str) else (details or {}).get(column) if target else None
+                                 for column, target in legacy_columns(cls)])
+    for channel, batch in batches.items():
+        name, cls = by_channel[channel]
+        connection.executemany(f"INSERT INTO {name} VALUES ({', '.join('?' * len(legacy_columns(cls)))})", batch)
+    connection.commit()
+
+
+def legacy_user_query() -> str:
+    selects = []
+    for name, cls in LEGACY_TABLES.items():
+        columns = dict((target, column) for column, target in legacy_columns(cls) if isinstance(target, str))
+        selects.append(f"SELECT {columns['id']} AS id, '{channel_of(cls)}' AS channel, {columns['number']} AS number, "
+                       f"{columns['status']} AS status, {columns['date']} AS date FROM {name} WHERE user_id = ?")
+    return " UNION ALL ".join(selects) + " ORDER BY date DESC LIMIT 100"
+
+
+def legacy_summary_query() -> str:
+    selects = []
+    for name, cls in LEGACY_TABLES.items():
+        columns = dict((target, column) for column, target in legacy_columns(cls) if isinstance(target, str))
+        selects.append(f"SELECT '{channel_of(cls)}' AS channel, {columns['status']} AS status FROM {name} "
+                       f"WHERE {columns['date']} >= ? AND {columns['date']} < ?")
+    return f"SELECT channel, status, count(*) FROM ({' UNION ALL '.join(selects)}) GROUP BY channel, status"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instruments", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    rows = list(generate(args.instruments, args.users))
+    users = [f"user-{random.randrange(args.users)}" for _ in range(REPEAT)]
+    month = (datetime(2024, 3, 1), datetime(2024, 4, 1))
+
+    legacy = sqlite3.connect(os.path.join(directory, "legacy.db"))
+    t = time.perf_counter()
+    load_legacy(legacy, rows)
+    print(f"loaded {args.instruments:,} instruments into {len(LEGACY_TABLES)} tables in {time.perf_counter() - t:.2f}s")
+
+    engine = create_engine("sqlite:///" + os.path.join(directory, "unified.db"))
+    Base.metadata.create_all(bind=engine, tables=[PaymentInstrument.__table__])
+    unified = sqlite3.connect(os.path.join(directory, "unified.db"))
+    t = time.perf_counter()
+    unified.executemany("INSERT INTO payment_instruments VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [row[:7] + (json.dumps(row[7]) if row[7] else None,) for row in rows])
+    unified.commit()
+    print(f"loaded them into payment_instruments in {time.perf_counter() - t:.2f}s")
+
+    user_query, summary_query = legacy_user_query(), legacy_summary_query()
+    unified_user = ("SELECT id, channel, number, status, date FROM payment_instruments "
+                    f"WHERE channel IN ({', '.join('?' * len(CHANNELS))}) AND user_id = ? ORDER BY date DESC LIMIT 100")
+    unified_summary = "SELECT channel, status, count(*) FROM payment_instruments WHERE date >= ? AND date < ? GROUP BY channel, status"
+    turn = iter(range(10 ** 9))
+
+    def next_user():
+        return users[next(turn) % len(users)]
+
+    print("one user's instruments, all channels, newest first:")
+    print(f"  old tables as they were:        {timed(lambda: legacy.execute(user_query, [next_user()] * len(LEGACY_TABLES)).fetchall(), 5) * 1e3:8.2f}ms")
+    for name in LEGACY_TABLES:
+        date_column = dict((target, column) for column, target in legacy_columns(LEGACY_TABLES[name]) if isinstance(target, str))["date"]
+        legacy.execute(f"CREATE INDEX ix_{name}_user_date ON {name} (user_id, {date_column})")
+    print(f"  old tables + user_id indexes:   {timed(lambda: legacy.execute(user_query, [next_user()] * len(LEGACY_TABLES)).fetchall()) * 1e3:8.2f}ms")
+    print(f"  payment_instruments:            {timed(lambda: unified.execute(unified_user, [*CHANNELS, next_user()]).fetchall()) * 1e3:8.2f}ms")
+    Session = sessionmaker(bind=engine)
+
+    def through_orm():
+        db = Session()
+        try:
+            return user_instruments(db, next_user())
+        finally:
+            db.close()
+
+    print(f"  payment_instruments via ORM:    {timed(through_orm) * 1e3:8.2f}ms")
+
+    print("counts by channel and status for one month:")
+    low, high = (value.isoformat(" ") for value in month)
+    legacy_counts = sorted(legacy.execute(summary_query, [low, high] * len(LEGACY_TABLES)).fetchall())
+    unified_counts = sorted(unified.execute(unified_summary, (low, high)).fetchall())
+    assert legacy_counts == unified_counts
+    print(f"  UNION ALL over old tables:      {timed(lambda: legacy.execute(summary_query, [low, high] * len(LEGACY_TABLES)).fetchall(), 10) * 1e3:8.2f}ms")
+    print(f"  payment_instruments:            {timed(lambda: unified.execute(unified_summary, (low, high)).fetchall(), 10) * 1e3:8.2f}ms")
+    print(f"file sizes: old tables {os.path.getsize(os.path.join(directory, 'legacy.db')) / 1e6:,.0f}MB (with indexes), "
+          f"payment_instruments {os.path.getsize(os.path.join(directory, 'unified.db')) / 1e6:,.0f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Screening throughput for an onboarding-campaign sized drop of pending KYC
+# records, once per worker count so the per-core scaling is visible.
+#
+#   python -m benchmarks.bench_kyc --records 100000 --workers 1 2 4
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.ids import new_id
+from nuAPI.kyc import process_pending_kyc
+from nuAPI.models import Base, KYCModel, KYCStatus
+
+DOCUMENTS = [("Passport", "A{:08d}"), ("National ID", "{:011d}"), ("Driver's License", "DL-{:07d}")]
+
+
+def _records(count: int, rng: random.Random):
+    today = date(2024, 6, 1)
+    for n in range(count):
+        document_type, number_format = DOCUMENTS[n % len(DOCUMENTS)]
+        number = rng.randrange(count * 9 // 10)  # about 10% duplicate documents
+        yield {
+            "id": new_id(),
+            "first_name": "Ada", "last_name": "Obi", "address": "1 Marina, Lagos",
+            "date_of_birth": today - timedelta(days=rng.randrange(15 * 365, 70 * 365)),
+            "document_type": document_type,
+            "document_number": number_format.format(number) if rng.random() > 0.02 else "??",
+            "issued_by": "NG",
+            "document_expiry": today + timedelta(days=rng.randrange(-200, 3000)),
+            "phone_number": f"+23480{n:08d}",
+            "email": f"user{n}@example.com",
+            "status": KYCStatus.pending,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+        Base.metadata.create_all(bind=engine, tables=[KYCModel.__table__])
+        records = list(_records(args.records, random.Random(7)))
+        with engine.begin() as conn:
+            for start in range(0, len(records), 50_000):
+                conn.execute(KYCModel.__table__.insert(), records[start:start + 50_000])
+
+        db = sessionmaker(bind=engine)()
+        t = time.perf_counter()
+        counts = process_pending_kyc(db, workers=workers, chunk_size=args.chunk_size, today=date(2024, 6, 1))
+        elapsed = time.perf_counter() - t
+        reasons = dict(db.query(KYCModel.rejection_reason, func.count()).filter(KYCModel.status == KYCStatus.rejected).group_by(KYCModel.rejection_reason).all())
+        db.close()
+        print(f"workers={workers}: {args.records:,} records in {elapsed:.2f}s, {args.records / elapsed:,.0f}/s, {args.records / elapsed / workers:,.0f}/s per core")
+        print(f"  {counts} {reasons}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Merchant cache: full load, incremental refresh after a small share of rows
+# change, and a cached check against the per-payment query it replaces.
+#
+#   python -m benchmarks.bench_merchants --merchants 200000 --changed 0.01
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.ids import new_id
+from nuAPI.merchants import MerchantCache
+from nuAPI.models import Base, Merchant
+
+
+def _merchants(merchant_ids, rng: random.Random, stamp: datetime):
+    for n, merchant_id in enumerate(merchant_ids):
+        yield {
+            "merchant_id": merchant_id,
+            "merchant_name": f"Shop {n}",
+            "merchant_email": f"shop{n}@example.com",
+            "merchant_phone": f"+23480{n:08d}",
+            "merchant_address": "1 Marina, Lagos",
+            "merchant_website": f"https://shop{n}.example.com",
+            "merchant_category": rng.choice(["retail", "food", "transport", "utilities"]),
+            "merchant_status": "active" if rng.random() < 0.9 else "suspended",
+            "merchant_account": f"{rng.randrange(10 ** 10):010d}",
+            "updated_at": stamp,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--merchants", type=int, default=200_000)
+    parser.add_argument("--changed", type=float, default=0.01)
+    parser.add_argument("--lookups", type=int, default=200_000)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[Merchant.__table__])
+    rng = random.Random(7)
+    merchant_ids = [new_id() for _ in range(args.merchants)]
+    loaded_at = datetime.utcnow() - timedelta(hours=1)
+    with engine.begin() as conn:
+        conn.execute(Merchant.__table__.insert(), list(_merchants(merchant_ids, rng, loaded_at)))
+
+    db = sessionmaker(bind=engine)()
+    cache = MerchantCache()
+    t = time.perf_counter()
+    cache.load(db)
+    print(f"load: {len(cache):,} active merchants in {time.perf_counter() - t:.2f}s")
+
+    t = time.perf_counter()
+    cache.refresh(db)
+    print(f"refresh with nothing changed: {(time.perf_counter() - t) * 1000:.2f}ms")
+
+    changed = rng.sample(range(args.merchants), int(args.merchants * args.changed))
+    now = datetime.utcnow()
+    db.bulk_update_mappings(Merchant, [
+        {"merchant_id": merchant_ids[n], "merchant_status": rng.choice(["active", "suspended"]), "updated_at": now}
+        for n in changed
+    ])
+    db.commit()
+    t = time.perf_counter()
+    applied = cache.refresh(db)
+    print(f"refresh after {len(changed):,} changes: {applied:,} rows applied in {(time.perf_counter() - t) * 1000:.1f}ms")
+
+    ids = [merchant_ids[rng.randrange(args.merchants)] for _ in range(args.lookups)]
+    t = time.perf_counter()
+    for merchant_id in ids:
+        cache.get(merchant_id)
+    cached = (time.perf_counter() - t) / len(ids)
+    sample = ids[:args.lookups // 20]
+    t = time.perf_counter()
+    for merchant_id in sample:
+        db.query(Merchant.merchant_status).filter(Merchant.merchant_id == merchant_id).first()
+    queried = (time.perf_counter() - t) / len(sample)
+    print(f"check per payment: {cached * 1e6:.2f}us cached vs {queried * 1e6:.0f}us per query")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Money (int minor units) vs Decimal: sum, compare and serialise.
+#
+#   python -m benchmarks.bench_money --count 1000000
+import argparse
+import json
+import random
+import time
+from decimal import Decimal
+from typing import List
+
+from pydantic import TypeAdapter
+
+from nuAPI.money import Money, format_minor, sum_money
+
+
+def timed(label: str, fn, count: int):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:8.1f} ms  {count / elapsed / 1e6:6.2f}M/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    rng = random.Random(11)
+    minor = [rng.randrange(1, 50_000_000_00) for _ in range(args.count)]
+    decimals = [Decimal(m).scaleb(-2) for m in minor]
+    money = [Money(m, "NGN") for m in minor]
+    shifted_decimals = decimals[1:] + decimals[:1]
+    shifted_money = money[1:] + money[:1]
+
+    timed("sum Decimal", lambda: sum(decimals, Decimal(0)), args.count)
+    timed("sum Money (sum_money)", lambda: sum_money(money, "NGN"), args.count)
+    timed("sum minor ints", lambda: sum(minor), args.count)
+
+    timed("compare Decimal", lambda: [a < b for a, b in zip(decimals, shifted_decimals)], args.count)
+    timed("compare Money", lambda: [a < b for a, b in zip(money, shifted_money)], args.count)
+    shifted_minor = minor[1:] + minor[:1]
+    timed("compare minor ints", lambda: [a < b for a, b in zip(minor, shifted_minor)], args.count)
+
+    timed("str Decimal", lambda: [str(d) for d in decimals], args.count)
+    timed("format_minor", lambda: [format_minor(m, 2) for m in minor], args.count)
+
+    timed("json.dumps Decimal as str", lambda: json.dumps([str(d) for d in decimals]), args.count)
+    decimal_adapter = TypeAdapter(List[Decimal])
+    money_adapter = TypeAdapter(List[Money])
+    timed("pydantic dump_json List[Decimal]", lambda: decimal_adapter.dump_json(decimals), args.count)
+    timed("pydantic dump_json List[Money]", lambda: money_adapter.dump_json(money), args.count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Drain a backlog of payment SMS from the outbox through the local stub
+# provider: coalescing, batching and retries of failed sends.
+#
+#   python -m benchmarks.bench_notifications --messages 200000 --recipients 50000 --failure-rate 0.02
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.ids import new_id
+from nuAPI.models import Base, Customer, SmsOutbox, SmsStatus
+from nuAPI.notifications import HttpSmsProvider, NotificationDispatcher
+from nuAPI.sms_stub import start_stub_server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--recipients", type=int, default=50_000)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1_000_000, help="provider messages/s allowed")
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[Customer.__table__, SmsOutbox.__table__])
+    Session = sessionmaker(bind=engine)
+    rng = random.Random(3)
+    now = datetime.utcnow()
+    customers = [new_id() for _ in range(args.recipients)]
+    with engine.begin() as conn:
+        conn.execute(Customer.__table__.insert(), [
+            {"customer_id": customers[n], "customer_name": "c", "email": "e", "password": "p",
+             "phone_number": f"+23480{n:08d}", "billing_address": "a", "access_token": "t"}
+            for n in range(args.recipients)
+        ])
+        for start in range(0, args.messages, 50_000):
+            conn.execute(SmsOutbox.__table__.insert(), [
+                {"id": new_id(), "user_id": customers[rng.randrange(args.recipients)],
+                 "message": f"PlayerOne: payment {n} of 1500.00 NGN is confirmed.", "status": SmsStatus.pending.value,
+                 "attempts": 0, "next_attempt_at": now, "created_at": now}
+                for n in range(start, min(start + 50_000, args.messages))
+            ])
+
+    server = start_stub_server(failure_rate=args.failure_rate)
+    dispatcher = NotificationDispatcher(
+        Session, HttpSmsProvider(server.url, batch_size=args.batch_size),
+        rate=args.rate, claim_size=10_000, retry_backoff=timedelta(0),
+    )
+
+    async def drain():
+        passes = 0
+        while await dispatcher.dispatch_once():
+            passes += 1
+        return passes
+
+    t = time.perf_counter()
+    passes = asyncio.run(drain())
+    elapsed = time.perf_counter() - t
+
+    db = Session()
+    counts = dict(db.query(SmsOutbox.status, func.count()).group_by(SmsOutbox.status).all())
+    retried = db.query(func.count()).filter(SmsOutbox.attempts > 1).scalar()
+    db.close()
+    server.shutdown()
+    print(f"{args.messages:,} outbox rows in {elapsed:.2f}s ({args.messages / elapsed:,.0f}/s) over {passes} passes")
+    print(f"{len(server.received):,} SMS delivered in {server.requests:,} provider requests")
+    print(f"outbox: {counts}, {retried:,} needed a retry")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# OTP verify throughput under brute-force-style load: most attempts are
+# wrong guesses spread over many phones, so lockouts kick in constantly.
+# Memory only first, then against a SQLite shared store as the API runs it.
+#
+#   python -m benchmarks.bench_otp --phones 100000 --verifies 1000000 --shared-verifies 20000
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.models import Base, OtpAttempt, OtpCode
+from nuAPI.otp import OtpLocked, OtpStore
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--phones", type=int, default=100_000)
+    parser.add_argument("--verifies", type=int, default=1_000_000)
+    parser.add_argument("--honest", type=float, default=0.05, help="share of attempts using the right code")
+    parser.add_argument("--shared-verifies", type=int, default=20_000)
+    args = parser.parse_args()
+
+    store = OtpStore(secret=b"bench-secret")
+    rng = random.Random(11)
+    phones = [f"+23480{n:08d}" for n in range(args.phones)]
+    codes = {phone: store.issue(phone)[0] for phone in phones}
+
+    attempts = []
+    for _ in range(args.verifies):
+        phone = rng.choice(phones)
+        code = codes[phone] if rng.random() < args.honest else str(rng.randrange(10 ** 6)).zfill(6)
+        attempts.append((phone, code))
+
+    run("memory", store.verify, attempts)
+
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[OtpCode.__table__, OtpAttempt.__table__])
+    db = sessionmaker(bind=engine)()
+    shared = OtpStore(secret=b"bench-secret")
+    phones = phones[:max(1, args.shared_verifies // 10)]
+    codes = {phone: shared.issue(phone, db)[0] for phone in phones}
+    db.commit()
+    attempts = []
+    for _ in range(args.shared_verifies):
+        phone = rng.choice(phones)
+        attempts.append((phone, codes[phone] if rng.random() < args.honest else str(rng.randrange(10 ** 6)).zfill(6)))
+    run("shared", lambda phone, code: shared.verify(phone, code, db), attempts)
+
+
+def run(label: str, verify, attempts):
+    outcomes = {"verified": 0, "rejected": 0, "locked": 0}
+    t = time.perf_counter()
+    for phone, code in attempts:
+        try:
+            outcomes["verified" if verify(phone, code) else "rejected"] += 1
+        except OtpLocked:
+            outcomes["locked"] += 1
+    elapsed = time.perf_counter() - t
+    print(f"{label}: {len(attempts):,} verifies in {elapsed:.2f}s: {len(attempts) / elapsed:,.0f}/s, {elapsed / len(attempts) * 1e6:.2f}us each")
+    print(f"  {outcomes}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Cost of a rate-limit decision (user + merchant + IP buckets) for the
+# in-process table and the shared sqlite backend, and the CPU it would take
+# at a given request rate.
+#
+#   python -m benchmarks.bench_ratelimit --decisions 200000 --target 50000
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from nuAPI.auth import create_access_token
+from nuAPI.ratelimit import MERCHANT_CLAIM, LocalBackend, RateLimiter, SqliteBackend
+
+PATHS = ["/card-payments/", "/mpesa-payments/", "/bank-transfers/", "/ussd/", "/2fa/send"]
+
+
+def _scopes(count: int, users: int, merchants: int, rng: random.Random):
+    # Half the callers act for a merchant, named in their token
+    tokens = [
+        create_access_token(
+            {"sub": f"user-{n}", MERCHANT_CLAIM: f"merchant-{rng.randrange(merchants)}"} if n % 2 else {"sub": f"user-{n}"},
+            timedelta(hours=1),
+        ).encode()
+        for n in range(users)
+    ]
+    for _ in range(count):
+        headers = [(b"authorization", b"Bearer " + rng.choice(tokens))]
+        yield {
+            "type": "http",
+            "path": rng.choice(PATHS),
+            "client": (f"10.{rng.randrange(256)}.{rng.randrange(256)}.1", 50000),
+            "headers": headers,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--decisions", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--merchants", type=int, default=500)
+    parser.add_argument("--target", type=int, default=50_000, help="decisions per second to cost out")
+    args = parser.parse_args()
+
+    scopes = list(_scopes(args.decisions, args.users, args.merchants, random.Random(7)))
+    backends = [
+        ("local", LocalBackend(), args.decisions),
+        ("sqlite", SqliteBackend(os.path.join(tempfile.mkdtemp(), "buckets.db")), args.decisions // 10),
+    ]
+    for name, backend, count in backends:
+        limiter = RateLimiter(backend)
+        # Simulated clock at the target rate, so buckets refill as they would in production
+        start = time.time()
+        for n, scope in enumerate(scopes[:count // 10]):
+            limiter.check(scope, start + n / args.target)
+        denied = 0
+        t = time.perf_counter()
+        for n, scope in enumerate(scopes[:count]):
+            denied += limiter.check(scope, start + n / args.target) > 0
+        elapsed = time.perf_counter() - t
+        per_decision = elapsed / count
+        print(f"{name}: {count:,} decisions in {elapsed:.2f}s, {count / elapsed:,.0f}/s, {per_decision * 1e6:.1f}us each, "
+              f"{per_decision * args.target:.0%} of a core at {args.target:,}/s, {denied:,} denied")
+
+
+if __name__ == "__main__":
+    main()
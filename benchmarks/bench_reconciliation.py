@@ -0,0 +1,77 @@
+# Reconcile a generated settlement file against a day of payments, with both
+# the in-memory hash index and the sort-merge fallback.
+#
+#   python -m benchmarks.bench_reconciliation --rows 5000000
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.ids import new_id
+from nuAPI.models import Base, Payments, PaymentStatus, ReconciliationResult, ReconciliationRun, Transaction
+from nuAPI.reconciliation import reconcile_settlement_file
+
+DAY = date(2024, 3, 1)
+
+
+def setup(directory: str, rows: int):
+    engine = create_engine("sqlite:///" + os.path.join(directory, "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[t.__table__ for t in (Payments, Transaction, ReconciliationRun, ReconciliationResult)])
+    rng = random.Random(3)
+    start = datetime.combine(DAY, datetime.min.time())
+    settlement = os.path.join(directory, "settlement.csv")
+    with engine.begin() as conn, open(settlement, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["reference", "amount", "currency", "settled_at"])
+        batch = []
+        for n in range(rows):
+            reference = f"TX{n:012d}"
+            minor = rng.randrange(100, 10_000_000)
+            batch.append({
+                "id": new_id(), "user_id": "u", "amount": Decimal(minor).scaleb(-2), "currency": "NGN",
+                "payment_id": f"P{n}", "payment_reference": f"PR{n:012d}", "payment_status": PaymentStatus.confirmed,
+                "transaction_reference": reference, "timestamp": start + timedelta(microseconds=n),
+            })
+            roll = rng.random()
+            if roll < 0.01:
+                continue  # missing on their side
+            if roll < 0.02:
+                minor += 1  # amount mismatch
+            writer.writerow([reference, f"{minor // 100}.{minor % 100:02d}", "NGN", "2024-03-01"])
+            if roll > 0.99:
+                writer.writerow([f"XX{n:012d}", "10.00", "NGN", "2024-03-01"])  # missing on our side
+            if len(batch) == 50_000:
+                conn.execute(Payments.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(Payments.__table__.insert(), batch)
+    return sessionmaker(bind=engine), settlement
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    t = time.perf_counter()
+    Session, settlement = setup(directory, args.rows)
+    print(f"setup {args.rows:,} payments: {time.perf_counter() - t:.1f}s")
+
+    for label, max_index_entries in (("hash", 10 ** 9), ("sort-merge", 0)):
+        db = Session()
+        t = time.perf_counter()
+        run = reconcile_settlement_file(db, settlement, DAY, "bench", max_index_entries=max_index_entries)
+        elapsed = time.perf_counter() - t
+        print(f"{label:<10} {elapsed:6.1f}s  {args.rows / elapsed:,.0f} lines/s  {run.counts}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
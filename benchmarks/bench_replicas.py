@@ -0,0 +1,76 @@
+# Replica routing with SQLite files as stand-in replicas: cost of a routing
+# decision, where reads land, and how many read-after-write lookups miss
+# their own write with and without the freshness check.
+#
+#   python -m benchmarks.bench_replicas --replicas 2 --writes 300
+import argparse
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.models import Base, Payments, PaymentStatus, ReplicationHeartbeat
+from nuAPI.replicas import Replica, ReplicaRouter, follow_sqlite
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--writes", type=int, default=300)
+    parser.add_argument("--copy-interval", type=float, default=0.5, help="seconds between replica refreshes")
+    parser.add_argument("--policy", default="least_latency")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    primary_path = os.path.join(directory, "primary.db")
+    engine = create_engine("sqlite:///" + primary_path, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine, tables=[Payments.__table__, ReplicationHeartbeat.__table__])
+    replica_paths = [os.path.join(directory, f"replica{n}.db") for n in range(args.replicas)]
+    router = ReplicaRouter(sessionmaker(bind=engine), [Replica.from_url("sqlite:///" + path) for path in replica_paths], policy=args.policy)
+    router.heartbeat()
+    threading.Thread(target=follow_sqlite, args=(primary_path, replica_paths, args.copy_interval), daemon=True).start()
+    threading.Thread(target=router.run, args=(0.1,), daemon=True).start()
+    time.sleep(args.copy_interval * 3)
+
+    t = time.perf_counter()
+    for _ in range(100_000):
+        router.choose(None)
+    print(f"routing decision: {(time.perf_counter() - t) / 100_000 * 1e6:.2f}us")
+
+    landed = Counter()
+    missed_fresh = missed_any = 0
+    primary = sessionmaker(bind=engine)
+    for _ in range(args.writes):
+        db = primary()
+        payment_id = str(uuid4())
+        db.add(Payments(id=payment_id, user_id="bench", amount=10, currency="NGN", payment_status=PaymentStatus.pending))
+        db.commit()
+        db.close()
+        written_at = time.time()
+
+        replica = router.choose(written_at)
+        landed[replica.name.rsplit("/", 1)[-1] if replica else "primary"] += 1
+        db = router.read_session(written_at)
+        missed_fresh += db.get(Payments, payment_id) is None
+        db.close()
+        # The same read routed on lag alone, ignoring the caller's write
+        db = router.read_session(None)
+        missed_any += db.get(Payments, payment_id) is None
+        db.close()
+        time.sleep(0.01)
+    print(f"{args.writes} write-then-read pairs: reads served by {dict(landed)}")
+    print(f"  own write missing: {missed_fresh} with the freshness check, {missed_any} routed on lag alone")
+    idle = Counter()
+    for _ in range(1000):
+        replica = router.choose(None)
+        idle[replica.name.rsplit("/", 1)[-1] if replica else "primary"] += 1
+    print(f"1000 reads from callers with no recent write ({args.policy}): {dict(idle)}")
+
+
+if __name__ == "__main__":
+    main()
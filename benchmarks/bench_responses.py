@@ -0,0 +1,126 @@
+# Channel GET responses: the old handler (whole ORM row, response model built
+# and then validated again by FastAPI, encoded with the stdlib) against the
+# current one (projected columns encoded once by FastJSONResponse), through
+# the HTTP stack and for the encoding step alone.
+#
+#   python -m benchmarks.bench_responses --payments 10000 --requests 5000
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from fastapi import FastAPI, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI import responses
+from nuAPI.ids import new_id
+from nuAPI.models import Base, PaymentStatus, Payments
+from nuAPI.responses import FastJSONResponse, dumps
+from nuAPI.schemas import CardPaymentResponse
+
+
+def _payments(count: int, rng: random.Random):
+    start = datetime(2024, 1, 1)
+    for n in range(count):
+        yield {
+            "id": new_id(),
+            "user_id": f"user-{rng.randrange(count // 10 + 1)}",
+            "amount": Decimal(rng.randrange(100, 100_000)) / 100,
+            "currency": "NGN",
+            "payment_status": rng.choice(list(PaymentStatus)),
+            "channel": "card",
+            "card_token": f"tok_{n:012d}",
+            "timestamp": start + timedelta(seconds=rng.randrange(365 * 86400), microseconds=rng.randrange(10 ** 6)),
+        }
+
+
+def build_app(Session) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/old/{payment_id}", response_model=CardPaymentResponse)
+    def old(payment_id: str):
+        db = Session()
+        try:
+            payment = db.query(Payments).filter(Payments.id == payment_id).first()
+            if payment is None:
+                raise HTTPException(status_code=404, detail="Payment not found")
+            return CardPaymentResponse(card_payment_id=payment.payment_id, status=payment.payment_status,
+                                       timestamp=payment.timestamp, card_token=payment.card_token)
+        finally:
+            db.close()
+
+    @app.get("/new/{payment_id}", response_model=CardPaymentResponse)
+    def new(payment_id: str):
+        db = Session()
+        try:
+            row = db.query(Payments.payment_id, Payments.payment_status, Payments.timestamp, Payments.card_token).filter(
+                Payments.id == payment_id
+            ).first()
+        finally:
+            db.close()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Payment not found")
+        return FastJSONResponse({"card_payment_id": row.payment_id, "status": row.payment_status,
+                                 "timestamp": row.timestamp, "card_token": row.card_token})
+
+    return app
+
+
+def per_call(fn, calls: int):
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - wall) / calls, (time.process_time() - cpu) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payments", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=5_000)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    Base.metadata.create_all(bind=engine, tables=[Payments.__table__])
+    rng = random.Random(7)
+    rows = list(_payments(args.payments, rng))
+    with engine.begin() as conn:
+        conn.execute(Payments.__table__.insert(), rows)
+    Session = sessionmaker(bind=engine)
+    client = TestClient(build_app(Session))
+    ids = [rng.choice(rows)["id"] for _ in range(args.requests)]
+
+    for payment_id in ids[:50]:
+        assert client.get(f"/old/{payment_id}").json() == client.get(f"/new/{payment_id}").json()
+    print(f"GET one card payment, {args.requests:,} requests over {args.payments:,} rows:")
+    for name in ("old", "new"):
+        turn = iter(ids)
+        wall, cpu = per_call(lambda: client.get(f"/{name}/{next(turn)}"), len(ids))
+        print(f"  {name}: {1 / wall:7,.0f} requests/s, {cpu * 1e6:6.0f}us CPU per request")
+
+    with Session() as db:
+        row = db.query(Payments.payment_id, Payments.payment_status, Payments.timestamp, Payments.card_token).first()
+    body = {"card_payment_id": row.payment_id, "status": row.payment_status, "timestamp": row.timestamp, "card_token": row.card_token}
+    calls = args.requests * 20
+
+    def through_model():
+        model = CardPaymentResponse(**body)
+        validated = CardPaymentResponse.model_validate(model.model_dump())
+        return json.dumps(jsonable_encoder(validated), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+    print("encoding one response body:")
+    print(f"  model, validate, jsonable_encoder, json: {per_call(through_model, calls)[1] * 1e6:6.2f}us")
+    if responses.orjson is not None:
+        print(f"  dumps with orjson:                       {per_call(lambda: dumps(body), calls)[1] * 1e6:6.2f}us")
+        responses.orjson = None
+    print(f"  dumps with json:                         {per_call(lambda: dumps(body), calls)[1] * 1e6:6.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Screening a large customer base against a large watchlist, plus an
+# incremental reload that changes a small part of the list.
+#
+#   python -m benchmarks.bench_screening --watchlist 500000 --names 1000000 --workers 4
+import argparse
+import random
+import time
+
+from nuAPI.screening import ScreeningIndex, screen_parallel
+
+SYLLABLES = [c + v for c in "bcdfghjklmnprstvwyz" for v in "aeiou"] + ["chi", "ngo", "ola", "ade", "el", "an", "os", "ur", "im"]
+
+
+def _word_pool(rng: random.Random, size: int):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize())
+    return sorted(words)
+
+
+def _typo(name: str, rng: random.Random) -> str:
+    position = rng.randrange(1, len(name))
+    return name[:position] + rng.choice("aeioubdkmnrst") + name[position + 1:]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watchlist", type=int, default=500_000)
+    parser.add_argument("--names", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--listed-share", type=float, default=0.001, help="share of names that are misspelt watchlist entries")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    first_names = _word_pool(rng, 20_000)
+    last_names = _word_pool(rng, 200_000)
+
+    def person(skew: float = 2.0):
+        # Skewed picks, so some customer names are very common as in real populations
+        words = [first_names[int(len(first_names) * rng.random() ** skew)] for _ in range(rng.choice((1, 1, 2)))]
+        return " ".join(words + [last_names[int(len(last_names) * rng.random() ** skew)]])
+
+    # Listed people are not concentrated on the most common names
+    watchlist = {f"W{n}": person(skew=1.0) for n in range(args.watchlist)}
+    listed = list(watchlist.values())
+
+    t = time.perf_counter()
+    index = ScreeningIndex()
+    index.reload(watchlist)
+    print(f"indexed {len(index):,} entries in {time.perf_counter() - t:.1f}s, {len(index.postings):,} blocking keys")
+
+    names = [
+        (f"C{n}", _typo(rng.choice(listed), rng) if rng.random() < args.listed_share else person())
+        for n in range(args.names)
+    ]
+    t = time.perf_counter()
+    hits = 0
+    subjects_hit = set()
+    for subject_id, _ in screen_parallel(index, names, workers=args.workers):
+        hits += 1
+        subjects_hit.add(subject_id)
+    elapsed = time.perf_counter() - t
+    print(f"screened {args.names:,} names on {args.workers} worker(s) in {elapsed:.1f}s ({args.names / elapsed:,.0f}/s): {hits:,} hits on {len(subjects_hit):,} names")
+
+    changed = dict(watchlist)
+    for n in rng.sample(range(args.watchlist), args.watchlist // 100):
+        del changed[f"W{n}"]
+    for n in range(args.watchlist // 100):
+        changed[f"N{n}"] = person(skew=1.0)
+    t = time.perf_counter()
+    added, updated, removed = index.reload(changed)
+    print(f"incremental reload (+{added:,} ~{updated:,} -{removed:,}) in {time.perf_counter() - t:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
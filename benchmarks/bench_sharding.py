@@ -0,0 +1,121 @@
+# Payment sharding with SQLite files as stand-in shards: cost of routing a
+# user or a payment id, a single-shard user listing against a scatter-gather
+# listing over every shard, and an online slot move with writes running.
+#
+#   python -m benchmarks.bench_sharding --shards 4 --users 2000 --payments 100000
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import nuAPI.changes  # noqa: F401  change_seq, which the move's catch-up passes read
+from nuAPI.models import Base, Payments, PaymentStatus, ShardSlotRange
+from nuAPI.sharding import ShardRouter, SLOTS, move_slots, new_payment_id, payment_slot, shard_engine, user_slot
+
+
+def timed(fn, repeat: int) -> float:
+    t = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t) / repeat
+
+
+def new_payment(user_id: str) -> dict:
+    slot = user_slot(user_id)
+    return {"id": new_payment_id(slot), "shard_slot": slot, "user_id": user_id, "amount": Decimal(random.randint(100, 100_000)),
+            "currency": "NGN", "payment_status": PaymentStatus.pending, "payment_id": new_payment_id(slot),
+            "payment_reference": new_payment_id(slot), "transaction_reference": new_payment_id(slot)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--payments", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    directory_engine = create_engine("sqlite:///" + os.path.join(directory, "primary.db"), connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=directory_engine, tables=[ShardSlotRange.__table__])
+    factories = [sessionmaker(bind=shard_engine("sqlite:///" + os.path.join(directory, f"shard{n}.db"))) for n in range(args.shards + 1)]
+    # The last shard starts empty and receives the move
+    router = ShardRouter(sessionmaker(bind=directory_engine), factories[:args.shards])
+    router.load_map()
+    router.shard_factories = factories
+
+    users = [f"user-{n}" for n in range(args.users)]
+    t = time.perf_counter()
+    rows = [[] for _ in range(args.shards)]
+    for _ in range(args.payments):
+        payment = new_payment(random.choice(users))
+        rows[router.shard_for_slot(payment["shard_slot"])].append(payment)
+    for shard, shard_rows in enumerate(rows):
+        db = router.session(shard)
+        db.execute(Payments.__table__.insert(), shard_rows)
+        db.commit()
+        db.close()
+    print(f"loaded {args.payments:,} payments over {args.shards} shards in {time.perf_counter() - t:.2f}s: "
+          f"{', '.join(f'{len(shard_rows):,}' for shard_rows in rows)}")
+
+    user = users[0]
+    payment_id = new_payment(user)["id"]
+    print(f"route a user:       {timed(lambda: router.shard_for_slot(user_slot(user), True), 100_000) * 1e6:.2f}us")
+    print(f"route a payment id: {timed(lambda: router.map.shards[payment_slot(payment_id)], 100_000) * 1e6:.2f}us")
+
+    def one_user():
+        db = router.session(router.shard_for_slot(user_slot(user)))
+        try:
+            return db.query(Payments).filter(Payments.user_id == user).order_by(Payments.timestamp.desc()).limit(50).all()
+        finally:
+            db.close()
+
+    def everyone():
+        return router.gather(lambda db: db.query(Payments).order_by(Payments.timestamp.desc()).limit(50).all(),
+                             key=lambda payment: payment.timestamp, limit=50, reverse=True)
+
+    print(f"newest 50 for one user (one shard):   {timed(one_user, 200) * 1e3:.2f}ms")
+    print(f"newest 50 overall (scatter-gather):   {timed(everyone, 200) * 1e3:.2f}ms")
+
+    # Move the first shard's range to the empty shard while users keep paying
+    first, last, source, _ = router.map.ranges[0]
+    moving = [u for u in users if first <= user_slot(u) <= last]
+    stop = threading.Event()
+    written = {"ok": 0, "refused": 0}
+
+    def writer():
+        while not stop.is_set():
+            payment = new_payment(random.choice(moving))
+            try:
+                shard = router.shard_for_slot(payment["shard_slot"], writing=True)
+            except Exception:
+                written["refused"] += 1
+                time.sleep(0.01)
+                continue
+            db = router.session(shard)
+            db.add(Payments(**payment))
+            db.commit()
+            db.close()
+            written["ok"] += 1
+
+    before = sum(router.scatter(lambda db: db.query(func.count(Payments.id)).scalar()))
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    t = time.perf_counter()
+    move_slots(router, first, last, args.shards, args.batch_size, grace=0.5, log=lambda line: print("  " + line))
+    elapsed = time.perf_counter() - t
+    stop.set()
+    thread.join()
+    after = sum(router.scatter(lambda db: db.query(func.count(Payments.id)).scalar()))
+    print(f"moved slots {first}-{last} of {SLOTS} in {elapsed:.2f}s; {written['ok']:,} writes went through, "
+          f"{written['refused']:,} refused while frozen; payments before {before:,} + written {written['ok']:,} = after {after:,}")
+
+
+if __name__ == "__main__":
+    main()
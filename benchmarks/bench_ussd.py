@@ -0,0 +1,52 @@
+# USSD hop latency with many interleaved sessions, replaying an arrival rate
+# of --rate new sessions per second as fast as the engine can take them.
+#
+#   python -m benchmarks.bench_ussd --rate 5000 --seconds 10
+#   python -m benchmarks.bench_ussd --rate 5000 --seconds 10 --shared
+import argparse
+import os
+import tempfile
+import time
+
+from nuAPI.ussd import DEFAULT_ACTIONS, DEFAULT_MENU, SessionStore, SqliteSessionStore, UssdEngine, UssdMenu
+
+# Navigate the whole send-money flow and cancel at the end, so no hop needs the database
+JOURNEY = ["", "2", "2*0803{n:07d}", "2*0803{n:07d}*1500", "2*0803{n:07d}*1500*2"]
+THINK_TIME = 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=int, default=5000, help="new sessions per second")
+    parser.add_argument("--seconds", type=int, default=10)
+    parser.add_argument("--shared", action="store_true", help="use the local sqlite session backend")
+    args = parser.parse_args()
+
+    store = SqliteSessionStore(os.path.join(tempfile.mkdtemp(), "ussd.db")) if args.shared else SessionStore()
+    engine = UssdEngine(UssdMenu(DEFAULT_MENU, DEFAULT_ACTIONS), store)
+
+    # (arrival time, session number, hop); hops of concurrent sessions interleave
+    sessions = args.rate * args.seconds
+    events = sorted(
+        (n / args.rate + hop * THINK_TIME, n, hop)
+        for n in range(sessions)
+        for hop in range(len(JOURNEY))
+    )
+    latencies = []
+    clock = time.perf_counter
+    started = clock()
+    for _, n, hop in events:
+        t = clock()
+        engine.handle(f"session-{n}", "+2348030000000", JOURNEY[hop].format(n=n))
+        latencies.append(clock() - t)
+    elapsed = clock() - started
+
+    latencies.sort()
+    print(f"{len(events):,} hops over {sessions:,} sessions in {elapsed:.2f}s")
+    print(f"capacity: {sessions / elapsed:,.0f} sessions/s, {len(events) / elapsed:,.0f} hops/s (target {args.rate:,} sessions/s)")
+    for label, q in (("p50", 0.5), ("p99", 0.99), ("p99.9", 0.999)):
+        print(f"{label}: {latencies[int(q * (len(latencies) - 1))] * 1e6:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
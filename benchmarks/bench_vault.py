@@ -0,0 +1,69 @@
+# Bulk tokenisation and detokenisation through the card vault, in batches
+# as a bulk-charge job would send them.
+#
+#   python -m benchmarks.bench_vault --cards 200000 --batch 5000 --workers 1 4
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.models import Base, CardVault
+from nuAPI.vault import TokenVault, luhn_valid
+
+BINS = ["411111", "539983", "506099", "520020", "376000", "601100"]
+
+
+def _pan(rng: random.Random) -> str:
+    bin_ = rng.choice(BINS)
+    body = bin_ + "".join(rng.choice("0123456789") for _ in range(8 if bin_.startswith("37") else 9))
+    for check in "0123456789":
+        if luhn_valid(body + check):
+            return body + check
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cards", type=int, default=200_000)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--repeat-share", type=float, default=0.2, help="share of PANs already in the vault")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    pans = [_pan(rng) for _ in range(args.cards)]
+    for n in range(int(args.cards * args.repeat_share)):
+        pans[rng.randrange(args.cards)] = pans[n]
+
+    for workers in args.workers:
+        engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+        Base.metadata.create_all(bind=engine, tables=[CardVault.__table__])
+        db = sessionmaker(bind=engine)()
+        executor = ProcessPoolExecutor(workers) if workers > 1 else None
+        vault = TokenVault(os.urandom(32), executor, workers)
+
+        t = time.perf_counter()
+        tokens = []
+        for start in range(0, len(pans), args.batch):
+            tokens += vault.tokenise_many(db, pans[start:start + args.batch])
+            db.commit()
+        elapsed = time.perf_counter() - t
+        stored = db.query(CardVault).count()
+        print(f"workers={workers}: tokenised {len(pans):,} PANs ({stored:,} new) in {elapsed:.2f}s, {len(pans) / elapsed:,.0f}/s")
+
+        t = time.perf_counter()
+        for start in range(0, len(tokens), args.batch):
+            assert vault.detokenise_many(db, tokens[start:start + args.batch]) == pans[start:start + args.batch]
+        elapsed = time.perf_counter() - t
+        print(f"  detokenised {len(tokens):,} in {elapsed:.2f}s, {len(tokens) / elapsed:,.0f}/s")
+        if executor is not None:
+            executor.shutdown()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
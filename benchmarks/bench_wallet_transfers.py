@@ -0,0 +1,84 @@
+# Contention benchmark for the wallet transfer engine: many payers sending to
+# one hot merchant collection wallet.
+#
+#   python -m benchmarks.bench_wallet_transfers --transfers 20000 --threads 8
+import argparse
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.ids import new_id
+from nuAPI.models import Base, Wallet
+from nuAPI.transfers import TransferError, transfer_funds
+
+
+def setup(url: str, payers: int):
+    engine = create_engine(url, connect_args={"check_same_thread": False} if url.startswith("sqlite") else {})
+    Base.metadata.create_all(bind=engine, tables=[Wallet.__table__, Base.metadata.tables["wallet_transfers"]])
+    Session = sessionmaker(bind=engine, autoflush=False)
+    db = Session()
+    merchant, payer_ids = new_id(), [new_id() for _ in range(payers)]
+    db.add(Wallet(wallet_id=merchant, user_id="merchant", wallet_name="collections", wallet_number="0000000000", wallet_status="active", wallet_balance=0, wallet_currency="NGN"))
+    db.add_all(
+        Wallet(wallet_id=wallet_id, user_id=f"user-{i}", wallet_name="payer", wallet_number=f"{i:010d}", wallet_status="active", wallet_balance=Decimal("1000000"), wallet_currency="NGN")
+        for i, wallet_id in enumerate(payer_ids)
+    )
+    db.commit()
+    db.close()
+    return Session, merchant, payer_ids
+
+
+def run(Session, merchant: str, payer_ids, transfers: int, threads: int):
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def worker(offset: int):
+        db = Session()
+        local = []
+        for n in range(offset, transfers, threads):
+            start = time.perf_counter()
+            try:
+                transfer_funds(db, payer_ids[n % len(payer_ids)], merchant, Decimal("10.50"), "NGN")
+            except TransferError:
+                with lock:
+                    failures[0] += 1
+            local.append(time.perf_counter() - start)
+        db.close()
+        with lock:
+            latencies.extend(local)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{transfers} transfers, {threads} threads: {transfers / elapsed:,.0f} transfers/sec")
+    print(f"p50 {latencies[len(latencies) // 2] * 1000:.2f} ms  p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms  failures {failures[0]}")
+    db = Session()
+    balance = db.query(Wallet.wallet_balance).filter(Wallet.wallet_id == merchant).scalar()
+    print(f"merchant balance {balance} (expected {Decimal('10.50') * (transfers - failures[0])})")
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None, help="database URL, defaults to a temporary SQLite file")
+    parser.add_argument("--transfers", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--payers", type=int, default=1000)
+    args = parser.parse_args()
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    run(*setup(url, args.payers), args.transfers, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+# Ad-hoc aggregation over columnar snapshots of payments and transactions.
+# A background job copies the few columns reports use into NumPy arrays on
+# disk; queries memory-map the latest snapshot in a process pool and never
+# touch the database. After the first build, each build reads only the rows
+# written since the last one (by change_seq) and merges them in.
+#
+#   python -m nuAPI.analytics build
+#   python -m nuAPI.analytics build --full
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from enum import Enum
+from multiprocessing import get_context
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from nuAPI.changes import SHARDED_TABLES, last_seq, source_name
+from nuAPI.models import ChangeTombstone, Payments, Transaction
+
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_INTERVAL = 300  # seconds between builds
+# Rows written outside the ORM get no change_seq, so incremental builds
+# miss them; a full rebuild this often picks them up
+FULL_REBUILD_INTERVAL = 86400  # seconds
+SNAPSHOT_KEEP = 2  # older snapshots are removed; queries already running keep their mapping
+SNAPSHOT_CHUNK_SIZE = 100_000
+ANALYTICS_WORKERS = 2
+MAX_GROUPS = 100_000
+# Group keys spanning fewer values than this are counted with bincount instead of sorted
+DENSE_GROUPS = 4_000_000
+DEFAULT_LIMIT = 1000
+
+# Fixed-width buckets, aligned to the Unix epoch (so days and weeks are UTC)
+BUCKET_SECONDS = {"minute": 60, "hour": 3600, "day": 86400, "week": 7 * 86400}
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotTable(NamedTuple):
+    table: object
+    time_column: str
+    numeric_columns: Tuple[str, ...]
+    category_columns: Tuple[str, ...]
+
+
+SNAPSHOT_TABLES = {
+    "payments": SnapshotTable(Payments.__table__, "timestamp", ("amount",), ("currency", "payment_status", "channel", "merchant_id")),
+    "transactions": SnapshotTable(Transaction.__table__, "date", ("amount",), ("currency", "status", "payment_method")),
+}
+
+
+class AnalyticsError(Exception):
+    pass
+
+
+class SnapshotMissing(AnalyticsError):
+    pass
+
+
+# Snapshot building
+
+def _code_dtype(size: int):
+    return np.uint8 if size <= 0xFF else np.uint16 if size <= 0xFFFF else np.uint32
+
+
+# ids (16-byte UUIDs) and seqs, the change_seq the snapshot is complete up
+# to in each source (the table, or each shard's part of it), let the next
+# build merge in later changes; snapshots without them are only ever
+# replaced by a full build
+def write_snapshot(directory: str, name: str, rows: int, times: np.ndarray, numbers: Dict[str, np.ndarray],
+                   categories: Dict[str, Tuple[np.ndarray, List]], ids: Optional[np.ndarray] = None,
+                   seqs: Optional[Dict[str, int]] = None, full_at: Optional[str] = None) -> str:
+    # Arrays go into a new directory; CURRENT is swapped to it last, so a
+    # reader sees either the previous snapshot or the complete new one
+    # Rows are stored in time order, so a time filter is a binary search
+    # that narrows every other column to one contiguous slice
+    if len(times) and not np.all(times[:-1] <= times[1:]):
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+        numbers = {column: values[order] for column, values in numbers.items()}
+        categories = {column: (codes[order], labels) for column, (codes, labels) in categories.items()}
+        ids = ids[order] if ids is not None else None
+    root = os.path.join(directory, name)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    path = os.path.join(root, stamp)
+    os.makedirs(path)
+    np.save(os.path.join(path, "_time.npy"), times)
+    if ids is not None:
+        np.save(os.path.join(path, "_id.npy"), ids)
+    for column, values in numbers.items():
+        np.save(os.path.join(path, f"{column}.npy"), values)
+    for column, (codes, labels) in categories.items():
+        np.save(os.path.join(path, f"{column}.npy"), codes.astype(_code_dtype(len(labels)), copy=False))
+    built_at = datetime.utcnow().isoformat()
+    meta = {"rows": rows, "built_at": built_at, "categories": {column: labels for column, (_, labels) in categories.items()}}
+    if ids is not None:
+        meta.update(seqs=seqs, full_at=full_at or built_at)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    pointer = os.path.join(root, "CURRENT")
+    with open(pointer + ".tmp", "w") as f:
+        f.write(stamp)
+    os.replace(pointer + ".tmp", pointer)
+    for old in sorted(entry for entry in os.listdir(root) if entry != "CURRENT" and not entry.endswith(".tmp"))[:-SNAPSHOT_KEEP]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return path
+
+
+def _id_bytes(value) -> bytes:
+    return (value if isinstance(value, UUID) else UUID(str(value))).bytes
+
+
+class _Columns(NamedTuple):
+    ids: np.ndarray
+    times: np.ndarray
+    numbers: Dict[str, np.ndarray]
+    codes: Dict[str, np.ndarray]
+
+
+# Reads the snapshot columns of `statement`'s rows (id first) in chunks.
+# Category labels are numbered in `labels`, which may already hold those of
+# a previous snapshot so its codes stay valid.
+def _read_columns(db: Session, spec: "SnapshotTable", statement, labels: Dict[str, Dict[object, int]]) -> _Columns:
+    ids, times, numbers = [], [], {column: [] for column in spec.numeric_columns}
+    codes = {column: [] for column in spec.category_columns}
+    result = db.connection().execute(statement.execution_options(yield_per=SNAPSHOT_CHUNK_SIZE))
+    try:
+        for chunk in result.partitions(SNAPSHOT_CHUNK_SIZE):
+            values = list(zip(*chunk))
+            ids.append(np.array([_id_bytes(value) for value in values[0]], dtype="S16"))
+            times.append(np.array(values[1], dtype="datetime64[s]").astype(np.int64))
+            for column, column_values in zip(spec.numeric_columns, values[2:]):
+                numbers[column].append(np.array([float(value) for value in column_values], dtype=np.float64))
+            for column, column_values in zip(spec.category_columns, values[2 + len(spec.numeric_columns):]):
+                index = labels[column]
+                codes[column].append(np.fromiter(
+                    (index.setdefault(getattr(value, "value", value), len(index)) for value in column_values), dtype=np.uint32, count=len(chunk)
+                ))
+    finally:
+        result.close()
+
+    def joined(parts, dtype):
+        return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+    return _Columns(
+        joined(ids, "S16"), joined(times, np.int64),
+        {column: joined(parts, np.float64) for column, parts in numbers.items()},
+        {column: joined(parts, np.uint32) for column, parts in codes.items()},
+    )
+
+
+def _concat(parts: List[_Columns]) -> _Columns:
+    if len(parts) == 1:
+        return parts[0]
+    return _Columns(
+        np.concatenate([part.ids for part in parts]), np.concatenate([part.times for part in parts]),
+        {column: np.concatenate([part.numbers[column] for part in parts]) for column in parts[0].numbers},
+        {column: np.concatenate([part.codes[column] for part in parts]) for column in parts[0].codes},
+    )
+
+
+# Mid-move, a row is on both shards; the copy read last is kept
+def _unique_ids(read: _Columns) -> _Columns:
+    _, last = np.unique(read.ids[::-1], return_index=True)
+    if len(last) == len(read.ids):
+        return read
+    keep = np.sort(len(read.ids) - 1 - last)
+    return _Columns(read.ids[keep], read.times[keep], {column: values[keep] for column, values in read.numbers.items()},
+                    {column: codes[keep] for column, codes in read.codes.items()})
+
+
+# The current snapshot if the next build can merge into it, else None
+def _mergeable_snapshot(name: str, directory: str, sources) -> Optional["Snapshot"]:
+    try:
+        snapshot = Snapshot(current_snapshot(name, directory))
+    except SnapshotMissing:
+        return None
+    # Built before sharding was switched on or off, or shards were added
+    if snapshot.seqs is None or set(snapshot.seqs) != set(sources) or snapshot.full_at is None:
+        return None
+    if (datetime.utcnow() - datetime.fromisoformat(snapshot.full_at)).total_seconds() > FULL_REBUILD_INTERVAL:
+        return None
+    return snapshot
+
+
+# With shard_factories, a sharded table is read from every shard
+def build_snapshot(db: Session, name: str, directory: str = SNAPSHOT_DIR, full: bool = False,
+                   shard_factories: Optional[Sequence] = None) -> str:
+    if not shard_factories or name not in SHARDED_TABLES:
+        return _build_snapshot({name: db}, name, directory, full)
+    sessions = {source_name(name, shard): factory() for shard, factory in enumerate(shard_factories)}
+    try:
+        return _build_snapshot(sessions, name, directory, full)
+    finally:
+        for session in sessions.values():
+            session.close()
+
+
+def _build_snapshot(sessions: Dict[str, Session], name: str, directory: str, full: bool) -> str:
+    spec = SNAPSHOT_TABLES[name]
+    table = spec.table
+    primary_key = table.primary_key.columns.values()[0]
+    statement = select(primary_key, *(table.c[column] for column in (spec.time_column, *spec.numeric_columns, *spec.category_columns)))
+    # Read before the rows: a write committed meanwhile is above it and is
+    # read again next time, which the merge by id makes harmless
+    seqs = {source: last_seq(db, name) for source, db in sessions.items()}
+    previous = None if full else _mergeable_snapshot(name, directory, sessions)
+    if previous is None:
+        labels: Dict[str, Dict[object, int]] = {column: {} for column in spec.category_columns}
+        read = _concat([_read_columns(db, spec, statement, labels) for db in sessions.values()])
+        if len(sessions) > 1:
+            read = _unique_ids(read)
+        return write_snapshot(
+            directory, name, len(read.ids), read.times, read.numbers,
+            {column: (read.codes[column], list(labels[column])) for column in spec.category_columns}, read.ids, seqs,
+        )
+
+    labels = {column: {label: code for code, label in enumerate(previous.labels[column])} for column in spec.category_columns}
+    changed = _concat([
+        _read_columns(db, spec, statement.where(table.c.change_seq > previous.seqs[source]), labels) for source, db in sessions.items()
+    ])
+    if len(sessions) > 1:
+        changed = _unique_ids(changed)
+    deleted = [
+        _id_bytes(row_id) for source, db in sessions.items() for row_id in db.execute(select(ChangeTombstone.row_id).where(
+            ChangeTombstone.table_name == name, ChangeTombstone.change_seq > previous.seqs[source],
+        )).scalars()
+    ]
+    if not len(changed.ids) and not deleted:
+        return previous.path
+    # Rows changed or deleted since are dropped from the previous snapshot,
+    # and the changed ones appended as they are now. A row moved between
+    # shards shows up as changed on its new shard, which replaces it too.
+    keep = ~np.isin(previous.column("_id"), np.concatenate([changed.ids, np.array(deleted, dtype="S16")]))
+
+    def merged(column, new):
+        return np.concatenate([previous.column(column)[keep], new])
+
+    return write_snapshot(
+        directory, name, int(keep.sum()) + len(changed.ids), merged("_time", changed.times),
+        {column: merged(column, values) for column, values in changed.numbers.items()},
+        {column: (merged(column, changed.codes[column].astype(np.uint32)), list(labels[column])) for column in spec.category_columns},
+        merged("_id", changed.ids), seqs, previous.full_at,
+    )
+
+
+# One build at a time per snapshot directory: processes sharing it skip the
+# build while another holds the lock, rather than each rebuilding. Returns
+# False if the build was skipped.
+def build_snapshots(session_factory, directory: str = SNAPSHOT_DIR, full: bool = False, shard_factories: Optional[Sequence] = None) -> bool:
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".build.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        db = session_factory()
+        try:
+            for name in SNAPSHOT_TABLES:
+                build_snapshot(db, name, directory, full, shard_factories)
+        finally:
+            db.close()
+    return True
+
+
+def _run_snapshot_worker(session_factory, directory: str, shard_factories: Optional[Sequence]):
+    while True:
+        try:
+            build_snapshots(session_factory, directory, shard_factories=shard_factories)
+        except Exception:
+            logger.exception("Analytics snapshot build failed")
+        time.sleep(SNAPSHOT_INTERVAL)
+
+
+# Builds read from session_factory, which should be a replica's (see
+# nuAPI.replicas.read_router) so the primary never serves the scans, and
+# sharded tables from every one of shard_factories
+def start_snapshot_worker(session_factory, directory: str = SNAPSHOT_DIR, shard_factories: Optional[Sequence] = None) -> threading.Thread:
+    worker = threading.Thread(target=_run_snapshot_worker, args=(session_factory, directory, shard_factories), name="analytics-snapshots",
+                              daemon=True)
+    worker.start()
+    return worker
+
+
+def current_snapshot(name: str, directory: str = SNAPSHOT_DIR) -> str:
+    root = os.path.join(directory, name)
+    try:
+        with open(os.path.join(root, "CURRENT")) as f:
+            return os.path.join(root, f.read().strip())
+    except FileNotFoundError:
+        raise SnapshotMissing(f"No {name} snapshot has been built yet")
+
+
+# Query execution; everything below runs in the worker processes
+
+class Snapshot:
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.rows = meta["rows"]
+        self.built_at = meta["built_at"]
+        self.seqs: Optional[Dict[str, int]] = meta.get("seqs")
+        self.full_at: Optional[str] = meta.get("full_at")
+        self.labels: Dict[str, List] = meta["categories"]
+        self.codes = {column: {label: code for code, label in enumerate(labels)} for column, labels in self.labels.items()}
+        self.path = path
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    def column(self, name: str) -> np.ndarray:
+        array = self._arrays.get(name)
+        if array is None:
+            array = self._arrays[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return array
+
+
+# The snapshot each worker has mapped, per table
+_snapshots: Dict[str, Snapshot] = {}
+
+
+def _snapshot(table: str, path: str) -> Snapshot:
+    snapshot = _snapshots.get(table)
+    if snapshot is None or snapshot.path != path:
+        snapshot = _snapshots[table] = Snapshot(path)
+    return snapshot
+
+
+def _value(value):
+    return value.value if isinstance(value, Enum) else value
+
+
+def _epoch(value) -> int:
+    try:
+        return int(np.datetime64(str(value).rstrip("Z"), "s").astype(np.int64))
+    except ValueError:
+        raise AnalyticsError(f"Not a timestamp: {value!r}")
+
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise AnalyticsError(f"Not a number: {value!r}")
+
+
+def _compare(array: np.ndarray, op: str, value) -> np.ndarray:
+    if op == "between":
+        low, high = value
+        return (array >= low) & (array < high)
+    if op in ("in", "not_in"):
+        matched = np.isin(array, value)
+        return matched if op == "in" else ~matched
+    return {
+        "eq": np.equal, "ne": np.not_equal, "lt": np.less, "lte": np.less_equal, "gt": np.greater, "gte": np.greater_equal,
+    }[op](array, value)
+
+
+def _time_range(times: np.ndarray, op: str, value, start: int, stop: int) -> Tuple[int, int]:
+    if op == "between":
+        return max(start, int(np.searchsorted(times, value[0], "left"))), min(stop, int(np.searchsorted(times, value[1], "left")))
+    if op in ("gt", "gte", "eq"):
+        start = max(start, int(np.searchsorted(times, value, "right" if op == "gt" else "left")))
+    if op in ("lt", "lte", "eq"):
+        stop = min(stop, int(np.searchsorted(times, value, "right" if op in ("lte", "eq") else "left")))
+    return start, stop
+
+
+# The matching rows as a [start, stop) range of the time-ordered snapshot,
+# plus a mask over that range for the filters a range cannot express
+def _filter_rows(snapshot: Snapshot, spec: SnapshotTable, filters: List[dict]) -> Tuple[int, int, Optional[np.ndarray]]:
+    start, stop = 0, snapshot.rows
+    masked = []
+    for condition in filters:
+        column, op, value = condition["column"], _value(condition["op"]), condition["value"]
+        many = op in ("in", "not_in", "between")
+        if many and (not isinstance(value, list) or (op == "between" and len(value) != 2)):
+            raise AnalyticsError(f"{op} on {column} takes a list of {'two values' if op == 'between' else 'values'}")
+        values = value if many else [value]
+        if column in spec.category_columns:
+            if op not in ("eq", "ne", "in", "not_in"):
+                raise AnalyticsError(f"{column} only supports eq, ne, in and not_in")
+            codes = snapshot.codes[column]
+            # A label absent from the snapshot matches nothing
+            converted = [codes[label] for label in values if label in codes]
+            if not converted and op in ("eq", "in"):
+                return 0, 0, None
+            if not converted:
+                continue
+            masked.append((column, op, converted if many else converted[0]))
+        elif column == spec.time_column:
+            converted = [_epoch(item) for item in values]
+            if op in ("ne", "in", "not_in"):
+                masked.append(("_time", op, converted if many else converted[0]))
+            else:
+                start, stop = _time_range(snapshot.column("_time"), op, converted if many else converted[0], start, stop)
+        elif column in spec.numeric_columns:
+            converted = [_number(item) for item in values]
+            masked.append((column, op, converted if many else converted[0]))
+        else:
+            raise AnalyticsError(f"Unknown column {column}")
+    stop = max(start, stop)
+    mask = None
+    for column, op, value in masked:
+        matched = _compare(snapshot.column(column)[start:stop], op, value)
+        mask = matched if mask is None else np.logical_and(mask, matched, out=mask)
+    return start, stop, mask
+
+
+def _group(keys: np.ndarray, space: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (group keys, group number of every row, rows per group)
+    if space > DENSE_GROUPS:
+        return np.unique(keys, return_inverse=True, return_counts=True)
+    counts = np.bincount(keys, minlength=space)
+    unique = np.flatnonzero(counts)
+    if len(unique) == space:
+        return unique, keys, counts
+    number = np.zeros(space, dtype=np.int64)
+    number[unique] = np.arange(len(unique))
+    return unique, number[keys], counts[unique]
+
+
+def _grouped_values(values: np.ndarray, inverse: np.ndarray, counts: np.ndarray, cache: dict) -> Tuple[np.ndarray, np.ndarray]:
+    # Values laid out group by group, shared by min, max and percentiles of
+    # one column. Group numbers are small integers, so the stable sort is a
+    # radix sort rather than a comparison sort over the values.
+    key = id(values)
+    if key not in cache:
+        groups = inverse.astype(np.uint16 if len(counts) <= 0xFFFF else np.uint32)
+        starts = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=starts[1:])
+        cache[key] = (values[np.argsort(groups, kind="stable")], starts)
+    return cache[key]
+
+
+def _aggregate(fn: str, values: Optional[np.ndarray], inverse: np.ndarray, counts: np.ndarray, q: Optional[float], cache: dict) -> np.ndarray:
+    groups = len(counts)
+    if fn == "count":
+        return counts
+    if fn == "sum":
+        return np.bincount(inverse, weights=values, minlength=groups)
+    if fn == "avg":
+        return np.bincount(inverse, weights=values, minlength=groups) / counts
+    if not groups:
+        return np.empty(0)
+    grouped, starts = _grouped_values(values, inverse, counts, cache)
+    if fn == "min":
+        return np.minimum.reduceat(grouped, starts)
+    if fn == "max":
+        return np.maximum.reduceat(grouped, starts)
+    # Linear interpolation between the closest ranks, as numpy.percentile
+    # does; a partial sort per group finds just those two ranks
+    result = np.empty(groups)
+    for group, (begin, count) in enumerate(zip(starts.tolist(), counts.tolist())):
+        position = (count - 1) * q
+        below = int(position)
+        above = min(below + 1, count - 1)
+        segment = np.partition(grouped[begin:begin + count], (below, above))
+        result[group] = segment[below] + (segment[above] - segment[below]) * (position - below)
+    return result
+
+
+def _aggregate_name(aggregate: dict) -> str:
+    fn = _value(aggregate["fn"])
+    if fn == "count":
+        return "count"
+    if fn == "percentile":
+        return f"p{aggregate['q'] * 100:g}_{aggregate['column']}"
+    return f"{fn}_{aggregate['column']}"
+
+
+def execute_query(path: str, table: str, query: dict) -> dict:
+    started = time.perf_counter()
+    spec = SNAPSHOT_TABLES[table]
+    snapshot = _snapshot(table, path)
+    for aggregate in query["aggregates"]:
+        fn, q = _value(aggregate["fn"]), aggregate.get("q")
+        if fn != "count" and aggregate.get("column") not in spec.numeric_columns:
+            raise AnalyticsError(f"{fn} needs one of {', '.join(spec.numeric_columns)}")
+        if fn == "percentile" and (q is None or not 0 <= q <= 1):
+            raise AnalyticsError("percentile needs q between 0 and 1")
+    for column in query["group_by"]:
+        if column not in spec.category_columns:
+            raise AnalyticsError(f"Can only group by {', '.join(spec.category_columns)}")
+
+    start, stop, mask = _filter_rows(snapshot, spec, query["filters"])
+    selected = np.flatnonzero(mask) if mask is not None else None
+
+    def take(name):
+        array = snapshot.column(name)[start:stop]
+        return np.asarray(array) if selected is None else array[selected]
+
+    matched = stop - start if selected is None else len(selected)
+    # Every group becomes one int64 key: group codes and the bucket number in
+    # mixed radix, bucket most significant so results come out in time order
+    keys = np.zeros(matched, dtype=np.int64)
+    radix = 1
+    parts = []
+    for column in query["group_by"]:
+        size = max(len(snapshot.labels[column]), 1)
+        keys += take(column).astype(np.int64) * radix
+        parts.append((column, radix, size))
+        radix *= size
+    bucket = query.get("bucket")
+    if bucket:
+        width = BUCKET_SECONDS[_value(bucket)]
+        origin, size = 0, 1
+        if matched:
+            buckets = take("_time") // width
+            origin = int(buckets.min())
+            size = int(buckets.max()) - origin + 1
+            if radix * size >= 2 ** 62:
+                raise AnalyticsError("Too many groups; filter the time range or group by fewer columns")
+            keys += (buckets - origin) * radix
+        parts.append(("bucket", radix, size))
+
+    unique, inverse, counts = _group(keys, radix * size if bucket else radix)
+    if len(unique) > MAX_GROUPS:
+        raise AnalyticsError(f"Query makes {len(unique):,} groups, more than {MAX_GROUPS:,}")
+    output: Dict[str, list] = {}
+    for column, place, size in parts:
+        component = (unique // place) % size
+        if column == "bucket":
+            output["bucket"] = [datetime.utcfromtimestamp(int(n + origin) * width).isoformat() for n in component]
+        else:
+            labels = snapshot.labels[column]
+            output[column] = [labels[code] for code in component]
+    cache = {}
+    loaded = {}
+    for aggregate in query["aggregates"]:
+        fn = _value(aggregate["fn"])
+        column = aggregate.get("column")
+        if not parts and not matched:
+            # An ungrouped query over no rows still answers with one row, as SQL does
+            output[_aggregate_name(aggregate)] = [0 if fn in ("count", "sum") else None]
+            continue
+        if fn != "count" and column not in loaded:
+            loaded[column] = take(column)
+        output[_aggregate_name(aggregate)] = _aggregate(fn, loaded.get(column), inverse, counts, aggregate.get("q"), cache).tolist()
+
+    columns = list(output)
+    rows = [list(row) for row in zip(*output.values())]
+    order_by = query.get("order_by")
+    if order_by:
+        if order_by not in output:
+            raise AnalyticsError(f"Can only order by {', '.join(columns)}")
+        position = columns.index(order_by)
+        rows.sort(key=lambda row: row[position], reverse=query.get("descending", True))
+    return {
+        "columns": columns,
+        "rows": rows[:query.get("limit") or DEFAULT_LIMIT],
+        "matched_rows": matched,
+        "snapshot_at": snapshot.built_at,
+        "elapsed_ms": (time.perf_counter() - started) * 1000,
+    }
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def analytics_executor() -> ProcessPoolExecutor:
+    # Started on first use; spawned rather than forked, as the API process has threads running
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=ANALYTICS_WORKERS, mp_context=get_context("spawn"))
+        return _executor
+
+
+async def run_query(query: dict, directory: str = SNAPSHOT_DIR) -> dict:
+    path = current_snapshot(query["table"], directory)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(analytics_executor(), execute_query, path, query["table"], query)
+
+
+def main():
+    from nuAPI.replicas import read_router
+    from nuAPI.sharding import shard_router
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build")
+    build.add_argument("--dir", default=SNAPSHOT_DIR)
+    build.add_argument("--full", action="store_true", help="rebuild from every row rather than merge in changes")
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    shard_factories = shard_router.shard_factories if shard_router else None
+    if not build_snapshots(read_router.read_session, args.dir, args.full, shard_factories):
+        raise SystemExit(f"Another build of {args.dir} is running")
+    for name in SNAPSHOT_TABLES:
+        with open(os.path.join(current_snapshot(name, args.dir), "meta.json")) as f:
+            print(f"{name}: {json.load(f)['rows']:,} rows")
+    print(f"in {time.perf_counter() - t:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
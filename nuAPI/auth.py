@@ -1,10 +1,10 @@
 import jwt
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import List, Optional
 from uuid import UUID
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 
 # Secret key to encode and decode JWT tokens
@@ -20,6 +20,7 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     user_id: Optional[UUID] = None
+    scopes: List[str] = []
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -37,8 +38,8 @@ def verify_token(token: str, credentials_exception):
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
-        token_data = TokenData(user_id=user_id)
-    except jwt.PyJWTError:
+        token_data = TokenData(user_id=user_id, scopes=str(payload.get("scope", "")).split())
+    except (jwt.PyJWTError, ValidationError):
         raise credentials_exception
     return token_data
 
@@ -48,4 +49,13 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    return verify_token(token, credentials_exception)
\ No newline at end of file
+    return verify_token(token, credentials_exception)
+
+# Dependency for routes only service accounts may call: the token must carry
+# `scope` in its space-separated "scope" claim
+def require_scope(scope: str):
+    async def check(token_data: TokenData = Depends(get_current_user)):
+        if scope not in token_data.scopes:
+            raise HTTPException(status_code=403, detail=f"Token lacks the {scope} scope")
+        return token_data
+    return check
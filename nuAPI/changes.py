@@ -0,0 +1,269 @@
+import asyncio
+import json
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from enum import Enum
+from itertools import chain
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from nuAPI.models import ChangeCounter, ChangeTombstone, Payments, Transaction
+
+# Tables whose writes get a change_seq, by the name clients ask for
+TRACKED_TABLES = {"payments": Payments, "transactions": Transaction}
+# Tables nuAPI.sharding spreads over the shards. Each shard has its own
+# sequences, so each shard's part of the table is a feed source of its own.
+SHARDED_TABLES = ("payments",)
+# The columns a change carries. Anything not listed (card tokens, gateway
+# responses, shard bookkeeping) never leaves through the feed.
+FEED_COLUMNS = {
+    "payments": ("id", "user_id", "amount", "currency", "payment_id", "payment_reference", "payment_status",
+                 "transaction_reference", "description", "channel", "merchant_id", "change_seq", "timestamp"),
+    "transactions": ("transaction_id", "amount", "currency", "date", "account_reference", "payment_reference",
+                     "payment_method", "status", "message", "change_seq"),
+}
+# Token scope needed to read the feed (see nuAPI.auth.require_scope)
+CHANGE_FEED_SCOPE = "changes:read"
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10_000
+MAX_WAIT = 30.0  # seconds a caught-up client is held before an empty reply
+# Commits in this process wake waiters at once; other processes' are seen on this poll
+POLL_INTERVAL = 1.0  # seconds
+
+# Counter the tables shared before each had its own; a table's counter starts
+# above it so no sequence is handed out twice
+_LEGACY_COUNTER = "changes"
+_TABLE_NAMES = {model: name for name, model in TRACKED_TABLES.items()}
+
+Change = Dict[str, object]
+# Where a feed source is read: (session factory, table, shard or None)
+Source = Tuple[Callable[[], Session], str, Optional[int]]
+
+
+class ChangeFeedError(Exception):
+    pass
+
+
+def next_seqs(session: Session, table: str, count: int) -> int:
+    # Each table has its own counter row, so payments and transactions
+    # writers never wait on each other. The row stays locked until the
+    # transaction ends, so a table's sequences become visible in the order
+    # they were handed out and a reader that has seen seq n never later
+    # finds a committed change below it.
+    connection = session.connection()
+    counter = ChangeCounter.__table__
+    updated = connection.execute(update(counter).where(counter.c.name == table).values(value=counter.c.value + count))
+    if updated.rowcount == 0:
+        start = connection.execute(select(counter.c.value).where(counter.c.name == _LEGACY_COUNTER)).scalar() or 0
+        connection.execute(counter.insert().values(name=table, value=start + count))
+        return start + 1
+    return connection.execute(select(counter.c.value).where(counter.c.name == table)).scalar() - count + 1
+
+
+# Highest sequence handed out for a table; every change at or below it has committed
+def last_seq(db: Session, table: str) -> int:
+    counter = ChangeCounter.__table__
+    return db.execute(select(counter.c.value).where(counter.c.name == table)).scalar() or 0
+
+
+# Every flush of a tracked row takes the next sequence numbers. Bulk and Core
+# writes skip ORM events, so tracked tables must be written through the ORM.
+@event.listens_for(Session, "before_flush")
+def _assign_change_seqs(session: Session, flush_context, instances):
+    changed = [
+        obj for obj in chain(session.new, session.dirty)
+        if type(obj) in _TABLE_NAMES and (obj in session.new or session.is_modified(obj, include_collections=False))
+    ]
+    deleted = [obj for obj in session.deleted if type(obj) in _TABLE_NAMES]
+    if not changed and not deleted:
+        return
+    for name in TRACKED_TABLES:
+        table_changed = [obj for obj in changed if _TABLE_NAMES[type(obj)] == name]
+        table_deleted = [obj for obj in deleted if _TABLE_NAMES[type(obj)] == name]
+        if not table_changed and not table_deleted:
+            continue
+        seq = next_seqs(session, name, len(table_changed) + len(table_deleted))
+        for obj in table_changed:
+            obj.change_seq = seq
+            seq += 1
+        for obj in table_deleted:
+            row_id = inspect(obj).identity[0]
+            session.add(ChangeTombstone(change_seq=seq, table_name=name, row_id=str(row_id)))
+            seq += 1
+    session.info["changes_pending"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_tailers(session: Session):
+    if session.info.pop("changes_pending", False):
+        change_notifier.notify()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changes(session: Session):
+    session.info.pop("changes_pending", None)
+
+
+class ChangeNotifier:
+    # Long-polling requests park on an asyncio.Event in their own loop; a
+    # commit from any thread sets them all
+    def __init__(self):
+        self._waiters = set()
+        self._lock = threading.Lock()
+
+    def notify(self):
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, woken in waiters:
+            loop.call_soon_threadsafe(woken.set)
+
+    async def wait(self, timeout: float):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+
+change_notifier = ChangeNotifier()
+
+
+def parse_tables(tables: str) -> List[str]:
+    names = [name.strip() for name in tables.split(",") if name.strip()]
+    unknown = [name for name in names if name not in TRACKED_TABLES]
+    if unknown or not names:
+        raise ChangeFeedError(f"Unknown tables {', '.join(unknown)}; choose from {', '.join(TRACKED_TABLES)}")
+    return names
+
+
+# "payments" for an unsharded table, "payments@2" for shard 2's part of it
+def source_name(table: str, shard: Optional[int] = None) -> str:
+    return table if shard is None else f"{table}@{shard}"
+
+
+def change_sources(tables: Sequence[str], primary_factory, shard_factories: Optional[Sequence] = None) -> Dict[str, Source]:
+    sources: Dict[str, Source] = {}
+    for name in tables:
+        if shard_factories and name in SHARDED_TABLES:
+            for shard, factory in enumerate(shard_factories):
+                sources[source_name(name, shard)] = (factory, name, shard)
+        else:
+            sources[name] = (primary_factory, name, None)
+    return sources
+
+
+# A cursor holds the last seq read from each source, as "payments:12,transactions:40"
+# (or "payments@0:12,payments@1:9,..." when payments are sharded). A bare
+# number, as older clients send, applies to every source.
+def parse_cursor(since: str, sources: Sequence[str]) -> Dict[str, int]:
+    since = since.strip() or "0"
+    try:
+        if ":" not in since:
+            return dict.fromkeys(sources, int(since))
+        cursor = dict.fromkeys(sources, 0)
+        for part in since.split(","):
+            name, _, seq = part.partition(":")
+            if name.strip() in cursor:
+                cursor[name.strip()] = int(seq)
+        return cursor
+    except ValueError:
+        raise ChangeFeedError(f"Malformed cursor {since!r}")
+
+
+def format_cursor(cursor: Mapping[str, int]) -> str:
+    return ",".join(f"{name}:{seq}" for name, seq in cursor.items())
+
+
+# The cursor to pass back after reading `changes` from `since`
+def next_cursor(since: Mapping[str, int], changes: Iterable[Change]) -> Dict[str, int]:
+    cursor = dict(since)
+    for change in changes:
+        name = source_name(change["table"], change.get("shard"))
+        cursor[name] = max(cursor.get(name, 0), change["seq"])
+    return cursor
+
+
+# Changes after each table's position in `since`, in seq order within a
+# table. Each source is a range scan on its change_seq index, so the cost
+# follows the changes returned, not table size. Rows carry FEED_COLUMNS only.
+# `shard` says which shard `db` is, for tables read from one.
+def read_changes(db: Session, since: Mapping[str, int], tables: Sequence[str], limit: int = DEFAULT_LIMIT,
+                 shard: Optional[int] = None) -> List[Change]:
+    changes: List[Change] = []
+    for name in tables:
+        after = since.get(source_name(name, shard), 0)
+        table = TRACKED_TABLES[name].__table__
+        primary_key = table.primary_key.columns.values()[0].name
+        columns = [table.c[column] for column in FEED_COLUMNS[name]]
+        table_changes = []
+        for row in db.execute(select(*columns).where(table.c.change_seq > after).order_by(table.c.change_seq).limit(limit)):
+            values = row._asdict()
+            table_changes.append({"seq": values["change_seq"], "table": name, "op": "upsert", "id": values[primary_key], "row": values})
+        tombstones = db.execute(select(ChangeTombstone.change_seq, ChangeTombstone.row_id).where(
+            ChangeTombstone.table_name == name, ChangeTombstone.change_seq > after,
+        ).order_by(ChangeTombstone.change_seq).limit(limit))
+        table_changes.extend({"seq": seq, "table": name, "op": "delete", "id": row_id, "row": None} for seq, row_id in tombstones)
+        table_changes.sort(key=lambda change: change["seq"])
+        if shard is not None:
+            for change in table_changes:
+                change["shard"] = shard
+        changes.extend(table_changes[:limit])
+    return _first(changes, limit)
+
+
+# Cutting the seq-ordered list keeps a prefix of every source's changes, so
+# the next cursor skips nothing
+def _first(changes: List[Change], limit: int) -> List[Change]:
+    changes.sort(key=lambda change: (change["seq"], source_name(change["table"], change.get("shard"))))
+    return changes[:limit]
+
+
+# One session per database the sources live in
+def _read(sources: Mapping[str, Source], since: Mapping[str, int], limit: int) -> List[Change]:
+    databases: Dict[Tuple[object, Optional[int]], List[str]] = {}
+    for factory, table, shard in sources.values():
+        databases.setdefault((factory, shard), []).append(table)
+    changes: List[Change] = []
+    for (factory, shard), tables in databases.items():
+        db = factory()
+        try:
+            changes.extend(read_changes(db, since, tables, limit, shard))
+        finally:
+            db.close()
+    return _first(changes, limit)
+
+
+# Return as soon as there is anything after `since`, or empty after `wait` seconds
+async def wait_for_changes(sources: Mapping[str, Source], since: Mapping[str, int], limit: int, wait: float) -> List[Change]:
+    deadline = time.monotonic() + min(wait, MAX_WAIT)
+    while True:
+        changes = await run_in_threadpool(_read, sources, since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        await change_notifier.wait(min(POLL_INTERVAL, remaining))
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"{type(value).__name__} is not JSON serialisable")
+
+
+def ndjson(changes: Iterable[Change]) -> Iterator[str]:
+    for change in changes:
+        yield json.dumps(change, default=_json_default, separators=(",", ":")) + "\n"
@@ -0,0 +1,98 @@
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Hashable, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from nuAPI.models import Payments
+
+# Identical payments closer together than this are treated as double taps
+DUPLICATE_WINDOW = 10.0  # seconds
+# "block" rejects the repeat, "flag" accepts it but marks it in the description
+DUPLICATE_MODE = "block"
+# "memory" checks this process only; "database" also sees payments made by other workers
+DUPLICATE_BACKEND = "memory"
+
+_CAMEL_BOUNDARY = re.compile(r"(?<!^)(?=[A-Z][a-z])")
+
+
+# CardPaymentRequest -> "card", MTNMobileMoneyPaymentRequest -> "mtn_mobile_money"
+def payment_channel(payment_request) -> str:
+    name = type(payment_request).__name__
+    for suffix in ("PaymentRequest", "Request"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return _CAMEL_BOUNDARY.sub("_", name).lower()
+
+
+def payment_fingerprint(user_id: str, amount: Decimal, currency: str, channel: str) -> Tuple[str, Decimal, str, str]:
+    # normalize() so 10, 10.0 and 10.00 fingerprint the same
+    return (user_id, Decimal(amount).normalize(), currency, channel)
+
+
+class FingerprintIndex:
+    # Fingerprints filed under time buckets one window wide. Anything within
+    # the window of now sits in the current or previous bucket, so a check is
+    # two dict lookups, and older buckets are dropped whole.
+    def __init__(self, window: float = DUPLICATE_WINDOW):
+        self.window = window
+        self.buckets: Dict[int, Dict[Hashable, Tuple[float, str]]] = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, current: int):
+        for bucket in [bucket for bucket in self.buckets if bucket < current - 1]:
+            del self.buckets[bucket]
+
+    # Record the fingerprint unless it was seen within the window; returns the earlier payment id if so
+    def check_and_record(self, fingerprint: Hashable, payment_id: str, now: Optional[float] = None) -> Optional[str]:
+        now = now or time.time()
+        current = int(now // self.window)
+        with self._lock:
+            if self.buckets and min(self.buckets) < current - 1:
+                self._evict(current)
+            for bucket in (current, current - 1):
+                seen = self.buckets.get(bucket, {}).get(fingerprint)
+                if seen is not None and now - seen[0] < self.window:
+                    return seen[1]
+            self.buckets.setdefault(current, {})[fingerprint] = (now, payment_id)
+        return None
+
+    # Undo a record whose payment was never committed, so a retry is not blocked
+    def discard(self, fingerprint: Hashable, payment_id: str):
+        with self._lock:
+            for entries in self.buckets.values():
+                if entries.get(fingerprint, (None, None))[1] == payment_id:
+                    del entries[fingerprint]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.buckets.values())
+
+
+duplicate_index = FingerprintIndex()
+
+
+def _recent_payment(db: Session, user_id: str, amount: Decimal, currency: str, channel: str, window: float) -> Optional[str]:
+    row = db.query(Payments.payment_id).filter(
+        Payments.user_id == user_id,
+        Payments.timestamp >= datetime.utcnow() - timedelta(seconds=window),
+        Payments.channel == channel,
+        Payments.currency == currency,
+        Payments.amount == amount,
+    ).first()
+    return row.payment_id if row else None
+
+
+# Returns the payment_id of an earlier identical payment inside the window, or None.
+# A None also records this payment, so the next identical one is caught.
+def find_duplicate(db: Session, user_id: str, amount: Decimal, currency: str, channel: str, payment_id: str) -> Optional[str]:
+    fingerprint = payment_fingerprint(user_id, amount, currency, channel)
+    earlier = duplicate_index.check_and_record(fingerprint, payment_id)
+    if earlier is None and DUPLICATE_BACKEND == "database":
+        earlier = _recent_payment(db, user_id, amount, currency, channel, duplicate_index.window)
+        if earlier is not None:
+            duplicate_index.discard(fingerprint, payment_id)
+    return earlier
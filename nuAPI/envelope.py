@@ -0,0 +1,310 @@
+# Envelope encryption: one data key per tenant (user_id) stored in the
+# encryption table wrapped by a master key from local configuration, so the
+# database alone never holds a usable key.
+#
+#   python -m nuAPI.envelope rotate --tenant <user_id>
+#   python -m nuAPI.envelope reencrypt <table>.<column> --tenant-column user_id
+#   python -m nuAPI.envelope rewrap
+#   python -m nuAPI.envelope wrap-legacy
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from nuAPI.models import Base, Encryption, KeyRotationJob
+
+# JSON file with {"active": "<key id>", "keys": {"<key id>": "<base64 32 bytes>"}}
+MASTER_KEY_FILE = None
+MASTER_KEYS: Dict[str, bytes] = {}
+ACTIVE_MASTER_KEY: Optional[str] = None
+# Unwrapped data keys are kept this long; a rotation reaches other processes within it
+KEY_CACHE_TTL = 300.0  # seconds
+KEY_CACHE_SIZE = 10_000
+REENCRYPT_BATCH_SIZE = 1000
+
+_NONCE_SIZE = 12
+
+
+class KeyManagementError(Exception):
+    pass
+
+
+def load_master_keys(path: str):
+    global ACTIVE_MASTER_KEY
+    with open(path) as f:
+        config = json.load(f)
+    MASTER_KEYS.update({key_id: base64.b64decode(key) for key_id, key in config["keys"].items()})
+    ACTIVE_MASTER_KEY = config["active"]
+
+
+def _master(key_id: Optional[str] = None) -> Tuple[str, AESGCM]:
+    if not MASTER_KEYS and MASTER_KEY_FILE:
+        load_master_keys(MASTER_KEY_FILE)
+    key_id = key_id or ACTIVE_MASTER_KEY
+    key = MASTER_KEYS.get(key_id) if key_id else None
+    if key is None:
+        raise KeyManagementError(f"Master key {key_id} is not configured")
+    return key_id, AESGCM(key)
+
+
+def _seal(aead: AESGCM, plaintext: bytes, context: bytes) -> str:
+    nonce = os.urandom(_NONCE_SIZE)
+    return base64.b64encode(nonce + aead.encrypt(nonce, plaintext, context)).decode()
+
+
+def _open(aead: AESGCM, sealed: str, context: bytes) -> bytes:
+    blob = base64.b64decode(sealed)
+    return aead.decrypt(blob[:_NONCE_SIZE], blob[_NONCE_SIZE:], context)
+
+
+# The tenant and version are bound in as associated data, so a wrapped key or
+# a field cannot be moved to another tenant or version and still decrypt
+def _context(tenant: str, version: int) -> bytes:
+    return f"{tenant}:{version}".encode()
+
+
+def wrap_key(data_key: bytes, tenant: str, version: int, master_key_id: Optional[str] = None) -> Tuple[str, str]:
+    master_key_id, master = _master(master_key_id)
+    return master_key_id, _seal(master, data_key, _context(tenant, version))
+
+
+def unwrap_key(wrapped: str, tenant: str, version: int, master_key_id: str) -> bytes:
+    return _open(_master(master_key_id)[1], wrapped, _context(tenant, version))
+
+
+class KeyCache:
+    # Bounded LRU of unwrapped data keys with a TTL, so hot paths skip the
+    # database read and the unwrap on every field
+    def __init__(self, max_entries: int = KEY_CACHE_SIZE, ttl: float = KEY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, now: float):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value, now: float):
+        with self._lock:
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard_tenant(self, tenant: str):
+        with self._lock:
+            for key in [key for key in self.entries if key[0] == tenant]:
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class EnvelopeService:
+    def __init__(self, cache: Optional[KeyCache] = None):
+        # None disables caching: every field reads and unwraps its key
+        self.cache = cache
+
+    def _cached(self, key: Tuple[str, Optional[int]], now: float):
+        return self.cache.get(key, now) if self.cache is not None else None
+
+    def _remember(self, key: Tuple[str, Optional[int]], value, now: float):
+        if self.cache is not None:
+            self.cache.put(key, value, now)
+
+    # Committed on its own connection, so a key is never lost to the caller
+    # rolling back after data was encrypted under it. None if another
+    # process created this version first.
+    def _create_key(self, db: Session, tenant: str, version: int) -> Optional[AESGCM]:
+        data_key = AESGCM.generate_key(bit_length=256)
+        master_key_id, wrapped = wrap_key(data_key, tenant, version)
+        with Session(bind=db.get_bind()) as key_db:
+            key_db.add(Encryption(
+                user_id=tenant, encryption_key=wrapped, key_version=version, master_key_id=master_key_id,
+                encryption_status="active",
+            ))
+            try:
+                key_db.commit()
+            except IntegrityError:
+                return None
+        return AESGCM(data_key)
+
+    def _active_row(self, db: Session, tenant: str):
+        return db.query(Encryption.encryption_key, Encryption.key_version, Encryption.master_key_id).filter(
+            Encryption.user_id == tenant, Encryption.encryption_status == "active", Encryption.key_version > 0,
+            Encryption.master_key_id.isnot(None),
+        ).order_by(Encryption.key_version.desc()).first()
+
+    # The tenant's active data key, created on first use
+    def current_key(self, db: Session, tenant: str, now: Optional[float] = None) -> Tuple[int, AESGCM]:
+        now = now or time.time()
+        current = self._cached((tenant, None), now)
+        if current is not None:
+            return current
+        row = self._active_row(db, tenant)
+        if row is None:
+            created = self._create_key(db, tenant, 1)
+            row = self._active_row(db, tenant) if created is None else None
+        current = (1, created) if row is None else (row.key_version, AESGCM(unwrap_key(row.encryption_key, tenant, row.key_version, row.master_key_id)))
+        self._remember((tenant, None), current, now)
+        self._remember((tenant, current[0]), current[1], now)
+        return current
+
+    def key(self, db: Session, tenant: str, version: int, now: Optional[float] = None) -> AESGCM:
+        now = now or time.time()
+        aead = self._cached((tenant, version), now)
+        if aead is None:
+            row = db.query(Encryption.encryption_key, Encryption.master_key_id).filter(
+                Encryption.user_id == tenant, Encryption.key_version == version, Encryption.master_key_id.isnot(None),
+            ).first()
+            if row is None:
+                raise KeyManagementError(f"No version {version} data key for {tenant}")
+            aead = AESGCM(unwrap_key(row.encryption_key, tenant, version, row.master_key_id))
+            self._remember((tenant, version), aead, now)
+        return aead
+
+    # Field values are "<key version>:<base64 nonce + ciphertext>"
+    def encrypt(self, db: Session, tenant: str, plaintext: str) -> str:
+        version, aead = self.current_key(db, tenant)
+        return f"{version}:{_seal(aead, plaintext.encode(), _context(tenant, version))}"
+
+    def decrypt(self, db: Session, tenant: str, value: str) -> str:
+        version, _, sealed = value.partition(":")
+        version = int(version)
+        return _open(self.key(db, tenant, version), sealed, _context(tenant, version)).decode()
+
+    # New data key for the tenant; the old one is kept, retired, until its data is re-encrypted
+    def rotate_tenant_key(self, db: Session, tenant: str) -> int:
+        version = (db.query(Encryption.key_version).filter(Encryption.user_id == tenant).order_by(Encryption.key_version.desc()).limit(1).scalar() or 0) + 1
+        if self._create_key(db, tenant, version) is None:
+            raise KeyManagementError(f"Key for {tenant} was rotated concurrently")
+        db.query(Encryption).filter(
+            Encryption.user_id == tenant, Encryption.encryption_status == "active", Encryption.key_version < version,
+        ).update({Encryption.encryption_status: "retired"}, synchronize_session=False)
+        db.commit()
+        if self.cache is not None:
+            self.cache.discard_tenant(tenant)
+        return version
+
+    # Re-encrypt every value of a column not under its tenant's current key.
+    # Rows are read in primary-key order a batch at a time and the checkpoint
+    # commits with each batch, so an interrupted run resumes where it stopped.
+    def reencrypt_column(self, db: Session, column, tenant_column, batch_size: int = REENCRYPT_BATCH_SIZE) -> int:
+        model = column.class_
+        primary_key = inspect(model).primary_key[0]
+        job_id = f"{model.__tablename__}.{column.key}"
+        job = db.get(KeyRotationJob, job_id)
+        if job is None:
+            job = KeyRotationJob(id=job_id, rows_done=0, status="running")
+            db.add(job)
+        elif job.status == "done":
+            job.last_id, job.rows_done, job.status = None, 0, "running"
+        db.commit()
+
+        reencrypted = 0
+        while True:
+            query = db.query(primary_key, tenant_column, column).filter(column.isnot(None))
+            if job.last_id is not None:
+                query = query.filter(primary_key > job.last_id)
+            rows = query.order_by(primary_key).limit(batch_size).all()
+            if not rows:
+                job.status = "done"
+                db.commit()
+                return reencrypted
+            updates = []
+            for row_id, tenant, value in rows:
+                version, _ = self.current_key(db, tenant)
+                if int(value.partition(":")[0]) != version:
+                    updates.append({primary_key.key: row_id, column.key: self.encrypt(db, tenant, self.decrypt(db, tenant, value))})
+            db.bulk_update_mappings(model, updates)
+            job.last_id = str(rows[-1][0])
+            job.rows_done += len(rows)
+            db.commit()
+            reencrypted += len(updates)
+
+    # Re-wrap data keys under the active master key; the data itself is untouched
+    def rewrap_data_keys(self, db: Session, batch_size: int = REENCRYPT_BATCH_SIZE) -> int:
+        active, _ = _master()
+        rewrapped = 0
+        while True:
+            rows = db.query(Encryption).filter(Encryption.master_key_id.isnot(None), Encryption.master_key_id != active).limit(batch_size).all()
+            if not rows:
+                return rewrapped
+            for row in rows:
+                data_key = unwrap_key(row.encryption_key, row.user_id, row.key_version, row.master_key_id)
+                row.master_key_id, row.encryption_key = wrap_key(data_key, row.user_id, row.key_version, active)
+            db.commit()
+            rewrapped += len(rows)
+
+
+# Wrap keys stored in plain text before envelope encryption existed. They
+# become version 0 and are never used for new data.
+def wrap_legacy_keys(db: Session, batch_size: int = REENCRYPT_BATCH_SIZE) -> int:
+    wrapped = 0
+    while True:
+        rows = db.query(Encryption).filter(Encryption.master_key_id.is_(None)).limit(batch_size).all()
+        if not rows:
+            return wrapped
+        for row in rows:
+            row.key_version = 0
+            row.master_key_id, row.encryption_key = wrap_key(row.encryption_key.encode(), row.user_id, 0)
+            row.encryption_status = "legacy"
+        db.commit()
+        wrapped += len(rows)
+
+
+envelope = EnvelopeService(KeyCache())
+
+
+def main():
+    from nuAPI.database import SessionLocal
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rotate").add_argument("--tenant", required=True)
+    reencrypt = commands.add_parser("reencrypt")
+    reencrypt.add_argument("column", help="table.column")
+    reencrypt.add_argument("--tenant-column", default="user_id")
+    reencrypt.add_argument("--batch-size", type=int, default=REENCRYPT_BATCH_SIZE)
+    commands.add_parser("rewrap")
+    commands.add_parser("wrap-legacy")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        t = time.perf_counter()
+        if args.command == "rotate":
+            print("version", envelope.rotate_tenant_key(db, args.tenant))
+        elif args.command == "reencrypt":
+            table_name, column_name = args.column.split(".")
+            model = next(mapper.class_ for mapper in Base.registry.mappers if mapper.class_.__tablename__ == table_name)
+            count = envelope.reencrypt_column(db, getattr(model, column_name), getattr(model, args.tenant_column), args.batch_size)
+            print(count, "values re-encrypted")
+        elif args.command == "rewrap":
+            print(envelope.rewrap_data_keys(db), "data keys re-wrapped")
+        else:
+            print(wrap_legacy_keys(db), "legacy keys wrapped")
+        print(f"in {time.perf_counter() - t:.2f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
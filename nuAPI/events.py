@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from nuAPI.models import ConsumerOffset, PaymentEvent, Payments
+
+# NDJSON file every payment event is appended to; None leaves the file sink off
+EVENT_LOG_PATH = None
+RELAY_BATCH_SIZE = 500
+RELAY_INTERVAL = 1.0  # seconds between polls when idle
+RETRY_BACKOFF = 5.0  # seconds before a failing sink is tried again
+# A sequence gap younger than this may be a transaction still committing, so
+# delivery waits for it; an older one was rolled back and is skipped
+GAP_TIMEOUT = timedelta(seconds=5)
+EVENT_RETENTION = timedelta(days=7)
+PRUNE_INTERVAL = 3600.0  # seconds between prunes of delivered events
+
+logger = logging.getLogger(__name__)
+
+Event = Dict[str, object]
+
+
+def payment_payload(payment: Payments) -> Dict[str, object]:
+    status = getattr(payment.payment_status, "value", payment.payment_status)
+    return {
+        "id": payment.id,
+        "payment_id": payment.payment_id,
+        "user_id": payment.user_id,
+        "amount": str(payment.amount),
+        "currency": payment.currency,
+        "status": status,
+        "channel": payment.channel,
+        "merchant_id": payment.merchant_id,
+        "transaction_reference": payment.transaction_reference,
+        "timestamp": payment.timestamp.isoformat() if payment.timestamp else None,
+    }
+
+
+# Add an event to the outbox inside the caller's transaction, so it commits
+# (or rolls back) with the payment change it describes
+def record_payment_event(db: Session, event_type: str, payment: Payments) -> PaymentEvent:
+    db.flush()  # Column defaults such as id and timestamp are filled in by the flush
+    event = PaymentEvent(event_type=event_type, payment_id=payment.id, user_id=payment.user_id, payload=payment_payload(payment))
+    db.add(event)
+    return event
+
+
+class EventSink:
+    # Raising from deliver leaves the batch undelivered; it is retried, so
+    # sinks must tolerate seeing an event more than once. A shared sink is
+    # one consumer whichever process delivers to it; one that lives in the
+    # process (subscribers, the local broker) is a consumer per process, so
+    # every process's copy gets every event.
+    shared = True
+
+    def deliver(self, events: List[Event]):
+        raise NotImplementedError
+
+
+class SubscriberSink(EventSink):
+    shared = False
+
+    def __init__(self):
+        self.subscribers: List[Callable[[Event], None]] = []
+
+    def subscribe(self, subscriber: Callable[[Event], None]):
+        self.subscribers.append(subscriber)
+
+    def deliver(self, events: List[Event]):
+        for event in events:
+            for subscriber in self.subscribers:
+                subscriber(event)
+
+
+class FileLogSink(EventSink):
+    def __init__(self, path: str):
+        self.path = path
+
+    def deliver(self, events: List[Event]):
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(event, separators=(",", ":")) + "\n" for event in events))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class LocalBroker(EventSink):
+    # Stand-in for a partitioned log broker: events are keyed by user_id, so
+    # one user's events stay in order within a partition
+    shared = False
+
+    def __init__(self, partitions: int = 8):
+        self.partitions: List[List[Event]] = [[] for _ in range(partitions)]
+        self._lock = threading.Lock()
+
+    def partition_for(self, key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=4).digest(), "big") % len(self.partitions)
+
+    def deliver(self, events: List[Event]):
+        with self._lock:
+            for event in events:
+                self.partitions[self.partition_for(event["user_id"])].append(event)
+
+    def read(self, partition: int, offset: int, limit: int = 500) -> List[Event]:
+        return self.partitions[partition][offset:offset + limit]
+
+
+_EVENT_COLUMNS = (PaymentEvent.seq, PaymentEvent.event_type, PaymentEvent.payment_id, PaymentEvent.user_id, PaymentEvent.payload, PaymentEvent.created_at)
+
+
+def _event(row) -> Event:
+    return {
+        "seq": row.seq,
+        "type": row.event_type,
+        "payment_id": row.payment_id,
+        "user_id": row.user_id,
+        "payload": row.payload,
+        "created_at": row.created_at.isoformat(),
+    }
+
+
+def _is_process_consumer(consumer: str) -> bool:
+    return "@" in consumer
+
+
+class OutboxRelay:
+    # Reads payment_events in seq order and hands batches to each sink. Every
+    # sink is a consumer with its own offset in consumer_offsets, advanced only
+    # after its delivery succeeds: at-least-once, and a failing sink holds up
+    # no one else. A sink that is not shared is consumer "name@host:pid";
+    # it starts where that sink's consumers have got to, and its row is
+    # dropped once the process has been gone for EVENT_RETENTION.
+    def __init__(self, session_factory, sinks: Dict[str, EventSink], batch_size: int = RELAY_BATCH_SIZE,
+                 interval: float = RELAY_INTERVAL, retry_backoff: float = RETRY_BACKOFF):
+        self.session_factory = session_factory
+        self.sinks = sinks
+        process = f"{socket.gethostname()}:{os.getpid()}"
+        self.consumers = {name: name if sink.shared else f"{name}@{process}" for name, sink in sinks.items()}
+        self._started = False
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_backoff = retry_backoff
+        self._retry_at: Dict[str, float] = {}
+        self._next_prune = 0.0
+        self._wake = threading.Event()
+
+    # This process's consumers start where others of the same sink have got
+    # to; the row of one that ran before under the same pid is taken over
+    def _start(self, db: Session):
+        now = datetime.utcnow()
+        for name, consumer in self.consumers.items():
+            if consumer == name:
+                continue
+            reached = db.query(func.max(ConsumerOffset.last_seq)).filter(
+                (ConsumerOffset.consumer == name) | ConsumerOffset.consumer.like(f"{name}@%")
+            ).scalar() or 0
+            # The row from when this sink was one consumer for every process
+            db.query(ConsumerOffset).filter(ConsumerOffset.consumer.in_([name, consumer])).delete(synchronize_session=False)
+            db.add(ConsumerOffset(consumer=consumer, last_seq=reached, updated_at=now))
+        db.commit()
+        self._started = True
+
+    def _offsets(self, db: Session) -> Dict[str, int]:
+        if not self._started:
+            self._start(db)
+        consumers = list(self.consumers.values())
+        offsets = dict(db.query(ConsumerOffset.consumer, ConsumerOffset.last_seq).filter(ConsumerOffset.consumer.in_(consumers)))
+        missing = [consumer for consumer in consumers if consumer not in offsets]
+        if missing:
+            try:
+                db.execute(ConsumerOffset.__table__.insert(), [{"consumer": consumer, "last_seq": 0, "updated_at": datetime.utcnow()} for consumer in missing])
+                db.commit()
+            except IntegrityError:
+                db.rollback()  # another process added it first
+                return self._offsets(db)
+            offsets.update(dict.fromkeys(missing, 0))
+        return offsets
+
+    # Events after `after` up to the first gap that may still fill
+    def _batch(self, db: Session, after: int, now: datetime) -> List[Event]:
+        rows = db.query(*_EVENT_COLUMNS).filter(PaymentEvent.seq > after).order_by(PaymentEvent.seq).limit(self.batch_size).all()
+        events = []
+        expected = after + 1
+        for row in rows:
+            if row.seq != expected and row.created_at > now - GAP_TIMEOUT:
+                break
+            events.append(_event(row))
+            expected = row.seq + 1
+        return events
+
+    # One batch per sink; sinks at the same offset share the read
+    def relay_once(self) -> int:
+        db = self.session_factory()
+        try:
+            offsets = self._offsets(db)
+            now = datetime.utcnow()
+            clock = time.monotonic()
+            batches: Dict[int, List[Event]] = {}
+            busiest = 0
+            for name, sink in self.sinks.items():
+                consumer = self.consumers[name]
+                if self._retry_at.get(consumer, 0.0) > clock:
+                    continue
+                offset = offsets[consumer]
+                events = batches.get(offset)
+                if events is None:
+                    events = batches[offset] = self._batch(db, offset, now)
+                if not events:
+                    continue
+                try:
+                    sink.deliver(events)
+                except Exception:
+                    logger.exception("Event sink %s failed", name)
+                    self._retry_at[consumer] = clock + self.retry_backoff
+                    continue
+                # Another process delivering to a shared sink may have moved it further
+                db.query(ConsumerOffset).filter(ConsumerOffset.consumer == consumer, ConsumerOffset.last_seq < events[-1]["seq"]).update(
+                    {ConsumerOffset.last_seq: events[-1]["seq"], ConsumerOffset.updated_at: datetime.utcnow()}, synchronize_session=False
+                )
+                db.commit()
+                busiest = max(busiest, len(events))
+            return busiest
+        finally:
+            db.close()
+
+    # Drop events every consumer has had, once past the retention period,
+    # along with the consumers of processes gone that long
+    def prune(self, db: Session) -> int:
+        self._offsets(db)
+        cutoff = datetime.utcnow() - EVENT_RETENTION
+        mine = [consumer for consumer in self.consumers.values() if _is_process_consumer(consumer)]
+        if mine:
+            db.query(ConsumerOffset).filter(ConsumerOffset.consumer.in_(mine)).update(
+                {ConsumerOffset.updated_at: datetime.utcnow()}, synchronize_session=False
+            )
+        offsets = dict(db.query(ConsumerOffset.consumer, ConsumerOffset.updated_at))
+        gone = [consumer for consumer, updated_at in offsets.items() if _is_process_consumer(consumer) and updated_at < cutoff]
+        if gone:
+            db.query(ConsumerOffset).filter(ConsumerOffset.consumer.in_(gone)).delete(synchronize_session=False)
+        reached = db.query(func.min(ConsumerOffset.last_seq)).scalar() or 0
+        deleted = db.query(PaymentEvent).filter(
+            PaymentEvent.seq <= reached,
+            PaymentEvent.created_at < cutoff,
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+    # Called from the relay loop; prunes at most once per PRUNE_INTERVAL
+    def prune_due(self) -> int:
+        clock = time.monotonic()
+        if clock < self._next_prune:
+            return 0
+        self._next_prune = clock + PRUNE_INTERVAL
+        db = self.session_factory()
+        try:
+            return self.prune(db)
+        finally:
+            db.close()
+
+    def run(self):
+        while True:
+            self._wake.clear()
+            try:
+                relayed = self.relay_once()
+            except Exception:
+                logger.exception("Event relay failed")
+                relayed = 0
+            try:
+                self.prune_due()
+            except Exception:
+                logger.exception("Event prune failed")
+            if relayed < self.batch_size:
+                self._wake.wait(self.interval)
+
+    def notify(self):
+        self._wake.set()
+
+
+event_subscribers = SubscriberSink()
+# One relay per database holding an outbox: the primary, or each shard
+event_relays: List[OutboxRelay] = []
+
+
+def start_event_relay(session_factory, sinks: Optional[Dict[str, EventSink]] = None) -> threading.Thread:
+    if sinks is None:
+        sinks = {"subscribers": event_subscribers}
+        if EVENT_LOG_PATH:
+            sinks["file-log"] = FileLogSink(EVENT_LOG_PATH)
+    relay = OutboxRelay(session_factory, sinks)
+    event_relays.append(relay)
+    worker = threading.Thread(target=relay.run, name=f"event-relay-{len(event_relays)}", daemon=True)
+    worker.start()
+    return worker
+
+
+def notify_relay():
+    for relay in event_relays:
+        relay.notify()
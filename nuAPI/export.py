@@ -0,0 +1,334 @@
+# Columnar export of payment history for analytics: rows are streamed from a
+# server-side cursor in chunks into Arrow record batches and written as
+# Parquet partitioned by date and currency, picking up from a watermark.
+#
+#   python -m nuAPI.export payments transactions --dir exports
+#   python -m nuAPI.export refunds --full --csv
+import argparse
+import csv
+import json
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
+from enum import Enum
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+from sqlalchemy import JSON, Boolean, Date, DateTime, Integer, LargeBinary, Numeric, func, or_, select
+from sqlalchemy import Enum as SQLAlchemyEnum
+from sqlalchemy.orm import Session
+
+from nuAPI.changes import SHARDED_TABLES, source_name
+from nuAPI.models import Charge, ExportWatermark, Payments, Refund, Transaction
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: pip install nuAPI[analytics]
+    pa = pq = None
+
+EXPORT_DIR = "exports"
+CHUNK_SIZE = 50_000  # rows fetched from the cursor at a time
+ROW_GROUP_SIZE = 128_000  # rows buffered per partition before a row group is written
+MAX_BUFFERED_ROWS = 1_000_000  # across all partitions; past this every buffer is flushed
+MAX_OPEN_FILES = 64  # least recently written partition files are closed past this
+COMPRESSION = "zstd"
+# Rows stamped by time only are exported once they are this old, so a
+# transaction still committing with an earlier timestamp is not skipped
+SETTLE_TIME = timedelta(minutes=5)
+
+
+class ExportSource(NamedTuple):
+    table: object
+    # change_seq re-exports a row after every write; a creation date exports it once
+    watermark_column: str
+    date_column: str
+    dictionary_columns: Tuple[str, ...]
+
+
+# Files sit under <source>/day=YYYY-MM-DD/currency=XXX/, the layout Arrow,
+# Spark and DuckDB read as hive partitions. The currency column is carried by
+# the directory name rather than repeated inside every file.
+PARTITION_COLUMN = "currency"
+EXPORT_SOURCES = {
+    "payments": ExportSource(Payments.__table__, "change_seq", "timestamp", ("payment_status", "channel")),
+    "transactions": ExportSource(Transaction.__table__, "change_seq", "date", ("status", "payment_method")),
+    "refunds": ExportSource(Refund.__table__, "date", "date", ("status", "refund_method")),
+    "charges": ExportSource(Charge.__table__, "date", "date", ("status", "payment_method")),
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+class ExportResult(NamedTuple):
+    source: str
+    rows: int
+    files: List[str]
+    position: Optional[str]
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ExportError("Parquet export needs pyarrow: pip install nuAPI[analytics]")
+
+
+def _arrow_type(column, dictionary: bool):
+    if dictionary:
+        return pa.dictionary(pa.int32(), pa.string())
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Numeric):
+        return pa.decimal128(38, 10)
+    if isinstance(column.type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(column.type, Date):
+        return pa.date32()
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    if isinstance(column.type, LargeBinary):
+        return pa.binary()
+    return pa.string()
+
+
+def _converter(column):
+    # Values the driver hands back that Arrow does not take as they are
+    if isinstance(column.type, SQLAlchemyEnum):
+        return lambda values: [value.value if isinstance(value, Enum) else value for value in values]
+    if isinstance(column.type, JSON):
+        return lambda values: [None if value is None else json.dumps(value, separators=(",", ":")) for value in values]
+    return None
+
+
+_UNSAFE_PATH = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class PartitionedWriter:
+    # One open Parquet file per date/currency partition, written to a .tmp
+    # name and only renamed into place by commit, so a failed run leaves
+    # nothing a reader would pick up
+    def __init__(self, root: str, source: ExportSource, run_id: str):
+        self.root = root
+        self.run_id = run_id
+        self.columns = [column for column in source.table.columns if column.name != PARTITION_COLUMN]
+        self.indexes = [index for index, column in enumerate(source.table.columns) if column.name != PARTITION_COLUMN]
+        dictionary = set(source.dictionary_columns)
+        self.schema = pa.schema([pa.field(column.name, _arrow_type(column, column.name in dictionary)) for column in self.columns])
+        self.converters = [_converter(column) for column in self.columns]
+        self.dictionary_columns = list(source.dictionary_columns)
+        self._buffers: Dict[Tuple[date, str], List[tuple]] = defaultdict(list)
+        self._buffered = 0
+        self._open: "OrderedDict[Tuple[date, str], pq.ParquetWriter]" = OrderedDict()
+        self._parts: Dict[Tuple[date, str], int] = defaultdict(int)
+        self._written: List[str] = []
+
+    def add(self, key: Tuple[date, str], rows: List[tuple]):
+        buffer = self._buffers[key]
+        buffer.extend(rows)
+        self._buffered += len(rows)
+        if len(buffer) >= ROW_GROUP_SIZE:
+            self._flush(key)
+        if self._buffered >= MAX_BUFFERED_ROWS:
+            for key in list(self._buffers):
+                self._flush(key)
+
+    def _batch(self, rows: List[tuple]):
+        arrays = []
+        columns = list(zip(*rows))
+        for values, field, convert in zip((columns[index] for index in self.indexes), self.schema, self.converters):
+            arrays.append(pa.array(convert(values) if convert else values, type=field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def _writer(self, key: Tuple[date, str]):
+        writer = self._open.get(key)
+        if writer is not None:
+            self._open.move_to_end(key)
+            return writer
+        if len(self._open) >= MAX_OPEN_FILES:
+            _, oldest = self._open.popitem(last=False)
+            oldest.close()
+        day, currency = key
+        directory = os.path.join(self.root, f"day={day.isoformat()}", f"{PARTITION_COLUMN}={_UNSAFE_PATH.sub('_', currency)}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{self.run_id}-{self._parts[key]:04d}.parquet.tmp")
+        self._parts[key] += 1
+        self._written.append(path)
+        writer = self._open[key] = pq.ParquetWriter(path, self.schema, compression=COMPRESSION, use_dictionary=self.dictionary_columns)
+        return writer
+
+    def _flush(self, key: Tuple[date, str]):
+        rows = self._buffers.pop(key, None)
+        if rows:
+            self._buffered -= len(rows)
+            self._writer(key).write_batch(self._batch(rows))
+
+    def _close(self):
+        for key in list(self._buffers):
+            self._flush(key)
+        while self._open:
+            self._open.popitem()[1].close()
+
+    def commit(self) -> List[str]:
+        self._close()
+        files = []
+        for path in self._written:
+            final = path[:-len(".tmp")]
+            os.replace(path, final)
+            files.append(final)
+        return files
+
+    def abort(self):
+        try:
+            self._close()
+        finally:
+            for path in self._written:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def _parse_position(source: ExportSource, position: str):
+    if isinstance(source.table.c[source.watermark_column].type, DateTime):
+        return datetime.fromisoformat(position)
+    return int(position)
+
+
+def load_watermark(db: Session, name: str) -> Optional[str]:
+    return db.query(ExportWatermark.position).filter(ExportWatermark.source == name).scalar()
+
+
+def save_watermark(db: Session, name: str, position: str):
+    updated = db.query(ExportWatermark).filter(ExportWatermark.source == name).update(
+        {ExportWatermark.position: position, ExportWatermark.updated_at: datetime.utcnow()}, synchronize_session=False
+    )
+    if not updated:
+        db.add(ExportWatermark(source=name, position=position))
+    db.commit()
+
+
+def _high_mark(db: Session, source: ExportSource):
+    column = source.table.c[source.watermark_column]
+    if isinstance(column.type, DateTime):
+        return datetime.utcnow() - SETTLE_TIME
+    return db.execute(select(func.max(column))).scalar()
+
+
+# Chunks of row tuples for everything after `low` up to `high`, read through
+# a server-side cursor so the table is never held in memory. A full export
+# (no low mark) also takes rows written before the watermark column existed.
+def stream_rows(db: Session, source: ExportSource, low, high, chunk_size: int = CHUNK_SIZE) -> Iterator[List[tuple]]:
+    column = source.table.c[source.watermark_column]
+    statement = select(source.table)
+    if low is not None:
+        statement = statement.where(column > low, column <= high)
+    elif high is not None:
+        statement = statement.where(or_(column <= high, column.is_(None)))
+    result = db.connection().execute(statement.execution_options(yield_per=chunk_size))
+    try:
+        for rows in result.partitions(chunk_size):
+            yield rows
+    finally:
+        result.close()
+
+
+# Rows are read from `rows_db` (default `db`) and the watermark, kept in
+# `db` under `watermark`, defaults to the source name; a shard's part of a
+# sharded table has its own, see main
+def export_parquet(db: Session, name: str, directory: str = EXPORT_DIR, full: bool = False, chunk_size: int = CHUNK_SIZE,
+                   rows_db: Optional[Session] = None, watermark: Optional[str] = None) -> ExportResult:
+    _require_pyarrow()
+    source = EXPORT_SOURCES[name]
+    rows_db = rows_db or db
+    watermark = watermark or name
+    position = None if full else load_watermark(db, watermark)
+    low = _parse_position(source, position) if position is not None else None
+    high = _high_mark(rows_db, source)
+    if low is not None and (high is None or high <= low):
+        return ExportResult(watermark, 0, [], position)
+    writer = PartitionedWriter(os.path.join(directory, name), source, datetime.utcnow().strftime("%Y%m%dT%H%M%S") + "-" + uuid4().hex[:8])
+    date_index = list(source.table.columns.keys()).index(source.date_column)
+    currency_index = list(source.table.columns.keys()).index(PARTITION_COLUMN)
+    count = 0
+    try:
+        for rows in stream_rows(rows_db, source, low, high, chunk_size):
+            partitions: Dict[Tuple[date, str], List[tuple]] = defaultdict(list)
+            for row in rows:
+                partitions[(row[date_index].date(), row[currency_index])].append(row)
+            for key, partition_rows in partitions.items():
+                writer.add(key, partition_rows)
+            count += len(rows)
+        files = writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    # Files are in place before the watermark moves: a crash in between
+    # exports those rows again rather than losing them
+    if high is not None:
+        position = high.isoformat() if isinstance(high, datetime) else str(high)
+        save_watermark(db, watermark, position)
+    return ExportResult(watermark, count, files, position)
+
+
+# Plain CSV of the same rows, kept for comparison with the Parquet export
+def export_csv(db: Session, name: str, path: str, chunk_size: int = CHUNK_SIZE) -> int:
+    source = EXPORT_SOURCES[name]
+    converters = [_converter(column) for column in source.table.columns]
+    count = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(source.table.columns.keys())
+        for rows in stream_rows(db, source, None, None, chunk_size):
+            if any(converters):
+                columns = [convert(values) if convert else values for values, convert in zip(zip(*rows), converters)]
+                rows = list(zip(*columns))
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def main():
+    from nuAPI.database import SessionLocal
+    from nuAPI.sharding import shard_router
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+", choices=sorted(EXPORT_SOURCES))
+    parser.add_argument("--dir", default=EXPORT_DIR)
+    parser.add_argument("--full", action="store_true", help="ignore the watermark and export everything")
+    parser.add_argument("--csv", action="store_true", help="also write <source>.csv for comparison")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        for name in args.sources:
+            # (watermark, session the rows are in) per part of the source. A
+            # sharded table goes one shard after another into the same
+            # directory, each shard with a watermark of its own since each has
+            # its own change_seq. A row moved between shards is restamped on
+            # the new one and so exported again, like any other update.
+            parts = [(name, db)]
+            if shard_router is not None and name in SHARDED_TABLES:
+                parts = [(source_name(name, shard), shard_router.session(shard)) for shard in range(len(shard_router.shard_factories))]
+            for part, rows_db in parts:
+                try:
+                    t = time.perf_counter()
+                    result = export_parquet(db, name, args.dir, args.full, args.chunk_size, rows_db, part)
+                    size = sum(os.path.getsize(path) for path in result.files)
+                    print(f"{part}: {result.rows:,} rows to {len(result.files)} Parquet files, {size / 1e6:.1f}MB "
+                          f"in {time.perf_counter() - t:.2f}s, watermark {result.position}")
+                    if args.csv:
+                        path = os.path.join(args.dir, f"{part}.csv")
+                        t = time.perf_counter()
+                        rows = export_csv(rows_db, name, path, args.chunk_size)
+                        print(f"{part}: {rows:,} rows to CSV, {os.path.getsize(path) / 1e6:.1f}MB in {time.perf_counter() - t:.2f}s")
+                finally:
+                    if rows_db is not db:
+                        rows_db.close()
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
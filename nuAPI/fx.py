@@ -0,0 +1,128 @@
+import threading
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from fractions import Fraction
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy.orm import Session
+
+from nuAPI.models import Currency, FxRate
+from nuAPI.money import currency_exponent
+
+BASE_CURRENCY = Currency.USD.value
+
+
+class RateNotFound(Exception):
+    pass
+
+
+Pairs = Dict[Tuple[str, str], Tuple[Tuple[datetime, ...], Tuple[Fraction, ...]]]
+
+
+class RateCache:
+    # Per-pair history kept as two parallel tuples sorted by effective_at, so
+    # an as-of lookup is a single bisect over the timestamps. Nothing is
+    # changed in place: add builds new tuples and a new map under the lock
+    # and swaps it in, so a reader takes one reference and sees either the
+    # old history or the new one, never the two halves of an insert.
+    def __init__(self):
+        self._pairs: Pairs = {}
+        self._lock = threading.Lock()
+
+    def load(self, db: Session):
+        rows = db.query(FxRate.base_currency, FxRate.quote_currency, FxRate.rate, FxRate.effective_at).order_by(FxRate.effective_at)
+        history = defaultdict(lambda: ([], []))
+        for base, quote, rate, effective_at in rows:
+            times, rates = history[(base, quote)]
+            times.append(effective_at)
+            rates.append(Fraction(rate))
+        with self._lock:
+            self._pairs = {pair: (tuple(times), tuple(rates)) for pair, (times, rates) in history.items()}
+
+    def add(self, base: str, quote: str, rate: Decimal, effective_at: datetime):
+        with self._lock:
+            pairs = dict(self._pairs)
+            times, rates = pairs.get((base, quote), ((), ()))
+            index = bisect_right(times, effective_at)
+            pairs[(base, quote)] = (times[:index] + (effective_at,) + times[index:], rates[:index] + (Fraction(rate),) + rates[index:])
+            self._pairs = pairs
+
+    @staticmethod
+    def _as_of(pairs: Pairs, base: str, quote: str, as_of: datetime) -> Optional[Fraction]:
+        pair = pairs.get((base, quote))
+        if pair is not None:
+            index = bisect_right(pair[0], as_of) - 1
+            if index >= 0:
+                return pair[1][index]
+        pair = pairs.get((quote, base))
+        if pair is not None:
+            index = bisect_right(pair[0], as_of) - 1
+            if index >= 0:
+                return 1 / pair[1][index]
+        return None
+
+    def rate(self, from_currency: str, to_currency: str, as_of: Optional[datetime] = None) -> Fraction:
+        if from_currency == to_currency:
+            return Fraction(1)
+        as_of = as_of or datetime.utcnow()
+        pairs = self._pairs
+        rate = self._as_of(pairs, from_currency, to_currency, as_of)
+        if rate is not None:
+            return rate
+        # Cross through the base currency
+        from_base = self._as_of(pairs, BASE_CURRENCY, from_currency, as_of)
+        to_base = self._as_of(pairs, BASE_CURRENCY, to_currency, as_of)
+        if from_base is None or to_base is None:
+            raise RateNotFound(f"No {from_currency}/{to_currency} rate as of {as_of.isoformat()}")
+        return to_base / from_base
+
+
+rate_cache = RateCache()
+
+
+def convert_minor(amounts: Sequence[int], from_currency: str, to_currency: str, as_of: Optional[datetime] = None) -> List[int]:
+    # One exact rational rate per column: every element is a multiply and a
+    # floor division on ints, rounded half up, with no per-item Decimal context.
+    rate = rate_cache.rate(from_currency, to_currency, as_of)
+    numerator = 2 * rate.numerator * 10 ** currency_exponent(to_currency)
+    denominator = rate.denominator * 10 ** currency_exponent(from_currency)
+    twice = 2 * denominator
+    return [(amount * numerator + denominator) // twice for amount in amounts]
+
+
+def convert_amounts(amounts: Sequence[Decimal], from_currency: str, to_currency: str, as_of: Optional[datetime] = None) -> List[Decimal]:
+    scale = Decimal(10) ** currency_exponent(from_currency)
+    minor = [int((amount * scale).to_integral_value(ROUND_HALF_UP)) for amount in amounts]
+    exponent = -currency_exponent(to_currency)
+    return [Decimal(amount).scaleb(exponent) for amount in convert_minor(minor, from_currency, to_currency, as_of)]
+
+
+# Normalise a mixed-currency column to one currency, converting each currency group in a single batch
+def normalise_minor(amounts: Sequence[int], currencies: Sequence[str], to_currency: str = BASE_CURRENCY, as_of: Optional[datetime] = None) -> List[int]:
+    groups: Dict[str, List[int]] = defaultdict(list)
+    for index, currency in enumerate(currencies):
+        groups[currency].append(index)
+    result = [0] * len(amounts)
+    for currency, indexes in groups.items():
+        converted = convert_minor([amounts[i] for i in indexes], currency, to_currency, as_of)
+        for i, value in zip(indexes, converted):
+            result[i] = value
+    return result
+
+
+# Record a new rate version and make it visible to the cache
+def record_rate(db: Session, base_currency: str, quote_currency: str, rate: Decimal, effective_at: Optional[datetime] = None, source: Optional[str] = None):
+    fx_rate = FxRate(
+        base_currency=base_currency,
+        quote_currency=quote_currency,
+        rate=rate,
+        effective_at=effective_at or datetime.utcnow(),
+        source=source,
+    )
+    db.add(fx_rate)
+    db.commit()
+    db.refresh(fx_rate)
+    rate_cache.add(base_currency, quote_currency, Decimal(rate), fx_rate.effective_at)
+    return fx_rate
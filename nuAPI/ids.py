@@ -0,0 +1,213 @@
+# Time-ordered ids: UUIDv7 (RFC 9562), a 48-bit millisecond timestamp then
+# a 12-bit per-millisecond counter and 62 random bits. New rows land at the
+# right-hand edge of a primary-key index instead of on a random page, and
+# UUIDKey stores them in 16 bytes (native uuid on PostgreSQL) rather than
+# 36 characters. Ids stay strings in Python, so callers do not change.
+#
+#   python -m nuAPI.ids migrate --vacuum
+import argparse
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from sqlalchemy import LargeBinary, false, inspect, text, true
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.types import TypeDecorator
+
+MIGRATE_BATCH_SIZE = 10_000
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+class IdError(Exception):
+    pass
+
+
+def _uuid7_int() -> int:
+    global _last_ms, _counter
+    with _lock:
+        ms = time.time_ns() // 1_000_000
+        if ms > _last_ms:
+            _last_ms, _counter = ms, 0
+        else:
+            # Same millisecond, or the clock went back: count on from the last
+            # id so ids from this process never sort before an earlier one
+            _counter += 1
+            if _counter > 0xFFF:
+                _last_ms, _counter = _last_ms + 1, 0
+            ms = _last_ms
+        counter = _counter
+    random_bits = int.from_bytes(os.urandom(8), "big") >> 2
+    return (ms << 80) | (0x7 << 76) | (counter << 64) | (0b10 << 62) | random_bits
+
+
+def uuid7() -> UUID:
+    return UUID(int=_uuid7_int())
+
+
+# str(uuid7()) without building the UUID object
+def new_id() -> str:
+    digits = f"{_uuid7_int():032x}"
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+
+# The creation time a UUIDv7 carries, in milliseconds since the epoch
+def id_time_ms(value: str) -> Optional[int]:
+    try:
+        parsed = UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return None
+    return parsed.int >> 80 if parsed.version == 7 else None
+
+
+# A literal compared against a UUIDKey column that can never equal a stored
+# key (ids arriving in URLs and request bodies, mostly)
+def _malformed(value) -> bool:
+    # Columns and mapped attributes compare as themselves
+    if value is None or isinstance(value, (UUID, ClauseElement)) or hasattr(value, "__clause_element__"):
+        return False
+    try:
+        UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return True
+    return False
+
+
+class UUIDKey(TypeDecorator):
+    # Binds the canonical string form and reads it back. Binding a value
+    # that is not a UUID raises ValueError, so a bad id is never written;
+    # filters comparing the column with one (==, !=, in_, not_in) compile
+    # to a constant instead, so lookups by a malformed id find nothing.
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    class comparator_factory(TypeDecorator.Comparator):
+        def operate(self, op, *other, **kwargs):
+            if op in (operators.eq, operators.ne) and _malformed(other[0]):
+                return false() if op is operators.eq else self.expr.is_not(None)
+            if op in (operators.in_op, operators.not_in_op) and isinstance(other[0], (list, tuple, set, frozenset)):
+                values = [value for value in other[0] if not _malformed(value)]
+                if not values and op is operators.in_op:
+                    return false()
+                if not values:
+                    return true()
+                other = (values,) + other[1:]
+            return super().operate(op, *other, **kwargs)
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+        return dialect.type_descriptor(LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            parsed = value if isinstance(value, UUID) else UUID(value)
+        except (TypeError, ValueError, AttributeError):
+            raise ValueError(f"Not a UUID: {value!r}") from None
+        return str(parsed) if dialect.name == "postgresql" else parsed.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return str(UUID(bytes=bytes(value)))
+
+
+def uuid_key_columns(metadata) -> Dict[str, List[str]]:
+    return {
+        table.name: [column.name for column in table.columns if isinstance(column.type, UUIDKey)]
+        for table in metadata.sorted_tables
+        if any(isinstance(column.type, UUIDKey) for column in table.columns)
+    }
+
+
+# Existing databases hold ids as text. On SQLite each text id is rewritten
+# in place as its 16 bytes (a TEXT column stores blobs as they are); on
+# PostgreSQL the column is altered to uuid. Safe to re-run; run it with the
+# API stopped, since text ids no longer match lookups by the new type.
+def migrate_ids(engine, metadata, batch_size: int = MIGRATE_BATCH_SIZE, vacuum: bool = False, log=print) -> Dict[str, int]:
+    existing = set(inspect(engine).get_table_names())
+    converted: Dict[str, int] = {}
+    for table, columns in uuid_key_columns(metadata).items():
+        if table not in existing:
+            continue
+        for column in columns:
+            if engine.dialect.name == "sqlite":
+                count, skipped = _migrate_sqlite(engine, table, column, batch_size)
+            elif engine.dialect.name == "postgresql":
+                count, skipped = _migrate_postgresql(engine, table, column), 0
+            else:
+                raise IdError(f"No id migration for {engine.dialect.name}")
+            converted[f"{table}.{column}"] = count
+            if count or skipped:
+                log(f"{table}.{column}: {count:,} converted" + (f", {skipped:,} not UUIDs left as text" if skipped else ""))
+    if vacuum and engine.dialect.name == "sqlite":
+        # Rewritten keys leave the old index pages half empty
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    return converted
+
+
+def _migrate_sqlite(engine, table: str, column: str, batch_size: int):
+    count = skipped = 0
+    last_rowid = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(f'SELECT rowid, "{column}" FROM "{table}" WHERE rowid > :last AND typeof("{column}") = \'text\' ORDER BY rowid LIMIT :n'),
+                {"last": last_rowid, "n": batch_size},
+            ).all()
+            if not rows:
+                return count, skipped
+            updates = []
+            for rowid, value in rows:
+                try:
+                    updates.append({"rowid": rowid, "value": UUID(value).bytes})
+                except ValueError:
+                    skipped += 1
+            if updates:
+                connection.execute(text(f'UPDATE "{table}" SET "{column}" = :value WHERE rowid = :rowid'), updates)
+            count += len(updates)
+            last_rowid = rows[-1][0]
+
+
+def _migrate_postgresql(engine, table: str, column: str) -> int:
+    with engine.begin() as connection:
+        data_type = connection.execute(
+            text("SELECT data_type FROM information_schema.columns WHERE table_name = :t AND column_name = :c"), {"t": table, "c": column}
+        ).scalar()
+        if data_type == "uuid":
+            return 0
+        connection.execute(text(f'ALTER TABLE "{table}" ALTER COLUMN "{column}" TYPE uuid USING "{column}"::uuid'))
+        return connection.execute(text(f'SELECT count(*) FROM "{table}"')).scalar()
+
+
+def main():
+    from nuAPI.database import engine
+    from nuAPI.models import Base
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate")
+    migrate.add_argument("--batch-size", type=int, default=MIGRATE_BATCH_SIZE)
+    migrate.add_argument("--vacuum", action="store_true", help="rebuild the SQLite file afterwards to reclaim index space")
+    commands.add_parser("new")
+    args = parser.parse_args()
+
+    if args.command == "new":
+        print(new_id())
+        return
+    t = time.perf_counter()
+    converted = migrate_ids(engine, Base.metadata, args.batch_size, args.vacuum)
+    print(f"{sum(converted.values()):,} ids in {len(converted)} columns in {time.perf_counter() - t:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+from calendar import monthrange
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Iterator, List, NamedTuple, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from nuAPI.models import InstalmentFrequency, PaymentPlan, PaymentPlanInstalment, PaymentStatus
+from nuAPI.money import to_minor
+
+# How far ahead instalments are materialised as rows
+INSTALMENT_WINDOW = timedelta(days=7)
+
+
+class Instalment(NamedTuple):
+    sequence: int
+    due_date: date
+    amount: int  # minor units
+
+
+def _add_months(start: date, months: int) -> date:
+    month = start.month - 1 + months
+    year = start.year + month // 12
+    month = month % 12 + 1
+    return date(year, month, min(start.day, monthrange(year, month)[1]))
+
+
+class InstalmentSchedule:
+    # The whole schedule derived from (principal, count, frequency, start):
+    # any instalment is O(1) to compute, so nothing needs to be stored up front.
+    def __init__(self, principal: int, count: int, frequency: str, start: date):
+        self.principal = principal
+        self.count = count
+        self.frequency = InstalmentFrequency(frequency)
+        self.start = start
+        # Leftover minor units go to the earliest instalments
+        self._base, self._extra = divmod(principal, count)
+
+    @classmethod
+    def for_plan(cls, plan) -> "InstalmentSchedule":
+        return cls(to_minor(plan.amount, plan.currency), plan.instalment_count, plan.instalment_frequency, plan.instalment_start_date)
+
+    def __len__(self):
+        return self.count
+
+    def due_date(self, sequence: int) -> date:
+        if self.frequency is InstalmentFrequency.daily:
+            return self.start + timedelta(days=sequence)
+        if self.frequency is InstalmentFrequency.weekly:
+            return self.start + timedelta(weeks=sequence)
+        return _add_months(self.start, sequence)
+
+    def __getitem__(self, sequence: int) -> Instalment:
+        if not 0 <= sequence < self.count:
+            raise IndexError(sequence)
+        return Instalment(sequence, self.due_date(sequence), self._base + (sequence < self._extra))
+
+    def __iter__(self) -> Iterator[Instalment]:
+        return (self[sequence] for sequence in range(self.count))
+
+
+# Create a plan from its schedule parameters; only the first window is materialised
+def create_instalment_plan(db: Session, user_id: str, amount: Decimal, currency: str, instalment_count: int, frequency: str, start_date: date, payment_method: str, today: Optional[date] = None):
+    plan = PaymentPlan(
+        user_id=user_id,
+        amount=amount,
+        currency=currency,
+        payment_method=payment_method,
+        payment_gateway_response="internal",
+        status=PaymentStatus.pending.value,
+        instalment_count=instalment_count,
+        instalment_frequency=InstalmentFrequency(frequency).value,
+        instalment_start_date=start_date,
+        instalments_materialised=0,
+        next_instalment_date=start_date,
+    )
+    db.add(plan)
+    db.flush()
+    rows, update = _materialise_plan(plan.paymentplan_id, InstalmentSchedule.for_plan(plan), 0, currency, (today or date.today()) + INSTALMENT_WINDOW)
+    if rows:
+        db.execute(PaymentPlanInstalment.__table__.insert(), rows)
+    plan.instalments_materialised = update["instalments_materialised"]
+    plan.next_instalment_date = update["next_instalment_date"]
+    db.commit()
+    db.refresh(plan)
+    return plan
+
+
+def _materialise_plan(paymentplan_id: str, schedule: InstalmentSchedule, materialised: int, currency: str, horizon: date):
+    rows = []
+    sequence = materialised
+    while sequence < schedule.count:
+        instalment = schedule[sequence]
+        if instalment.due_date > horizon:
+            break
+        rows.append({
+            "paymentplan_id": paymentplan_id,
+            "sequence": instalment.sequence,
+            "due_date": instalment.due_date,
+            "amount": instalment.amount,
+            "currency": currency,
+            "status": PaymentStatus.pending.value,
+        })
+        sequence += 1
+    next_date = schedule.due_date(sequence) if sequence < schedule.count else None
+    return rows, {"paymentplan_id": paymentplan_id, "instalments_materialised": sequence, "next_instalment_date": next_date}
+
+
+def _write_batch(db: Session, rows: List[dict], updates: List[dict]):
+    if rows:
+        db.execute(PaymentPlanInstalment.__table__.insert(), rows)
+    db.bulk_update_mappings(PaymentPlan, updates)
+    db.commit()
+
+
+# Roll the window forward: only plans whose next instalment falls inside it
+# are touched. Safe to run from several workers at once: when a batch hits
+# instalments another worker has already written, those count as
+# materialised and only the rest are inserted.
+def materialise_instalments(db: Session, today: Optional[date] = None, window: timedelta = INSTALMENT_WINDOW, batch_size: int = 10_000) -> int:
+    horizon = (today or date.today()) + window
+    created = 0
+    while True:
+        plans = db.query(
+            PaymentPlan.paymentplan_id, PaymentPlan.amount, PaymentPlan.currency,
+            PaymentPlan.instalment_count, PaymentPlan.instalment_frequency,
+            PaymentPlan.instalment_start_date, PaymentPlan.instalments_materialised,
+        ).filter(PaymentPlan.next_instalment_date <= horizon).order_by(PaymentPlan.next_instalment_date).limit(batch_size).all()
+        if not plans:
+            return created
+        rows: List[dict] = []
+        updates: List[dict] = []
+        for plan in plans:
+            plan_rows, update = _materialise_plan(plan.paymentplan_id, InstalmentSchedule.for_plan(plan), plan.instalments_materialised, plan.currency, horizon)
+            rows.extend(plan_rows)
+            updates.append(update)
+        try:
+            _write_batch(db, rows, updates)
+        except IntegrityError:
+            db.rollback()
+            existing = set(db.query(PaymentPlanInstalment.paymentplan_id, PaymentPlanInstalment.sequence).filter(
+                PaymentPlanInstalment.paymentplan_id.in_([plan.paymentplan_id for plan in plans])
+            ).all())
+            rows = [row for row in rows if (row["paymentplan_id"], row["sequence"]) not in existing]
+            _write_batch(db, rows, updates)
+        created += len(rows)
+
+
+# Instalments due on or before a day, straight off the (status, due_date) index
+def due_instalments(db: Session, day: Optional[date] = None, limit: int = 1000):
+    return db.query(PaymentPlanInstalment).filter(
+        PaymentPlanInstalment.status == PaymentStatus.pending.value,
+        PaymentPlanInstalment.due_date <= (day or date.today()),
+    ).order_by(PaymentPlanInstalment.due_date).limit(limit).all()
@@ -0,0 +1,230 @@
+# Saved payment instruments of every channel live in payment_instruments
+# (nuAPI.models.PaymentInstrument). The per-channel tables it replaced stay
+# usable: the ORM classes map onto it under their old names, and each old
+# table name is a view, writable through triggers (SQLite) or rules
+# (PostgreSQL). migrate moves rows out of the old tables and puts the views
+# in their place; the old tables are kept as <name>_legacy.
+#
+#   python -m nuAPI.instruments migrate
+#   python -m nuAPI.instruments views
+import argparse
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from sqlalchemy import MetaData, Table, event, inspect, null, select, text
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
+
+from nuAPI.ids import new_id
+from nuAPI.models import ApplePay, Bank, Card, CashPayments, GooglePay, PaymentInstrument, Pos, Qr, SamsungPay, SnapScan, Ussd
+
+LEGACY_TABLES = {
+    "cards": Card,
+    "banks": Bank,
+    "ussd": Ussd,
+    "qr": Qr,
+    "pos": Pos,
+    "cashpayment": CashPayments,
+    "snapscan": SnapScan,
+    "applepay": ApplePay,
+    "googlepay": GooglePay,
+    "samsungpay": SamsungPay,
+}
+CHANNELS = tuple(cls.__mapper__.polymorphic_identity for cls in LEGACY_TABLES.values())
+MAX_INSTRUMENTS = 1000  # per listing request
+
+
+class InstrumentError(Exception):
+    pass
+
+
+def channel_of(cls) -> str:
+    return cls.__mapper__.polymorphic_identity
+
+
+# The old columns of a channel class, in their old order, with where each
+# lives now: a payment_instruments column, ("details", key) for a field only
+# that channel has, or None for one that is no longer stored
+def legacy_columns(cls) -> List[Tuple[str, object]]:
+    shared = set(PaymentInstrument.__table__.columns.keys())
+    columns = []
+    for name, value in vars(cls).items():
+        if name.startswith("_") or name in shared:
+            continue
+        if name in cls.__mapper__.synonyms:
+            columns.append((name, cls.__mapper__.synonyms[name].name))
+        elif isinstance(value, hybrid_property):
+            columns.append((name, ("details", name)))
+        else:
+            columns.append((name, None))
+    return columns[:1] + [("user_id", "user_id")] + columns[1:]
+
+
+def _view_select(cls):
+    table = PaymentInstrument.__table__
+    expressions = []
+    for name, target in legacy_columns(cls):
+        if target is None:
+            expression = null()
+        elif isinstance(target, tuple):
+            expression = table.c.details[target[1]].as_string()
+        else:
+            expression = table.c[target]
+        expressions.append(expression.label(name))
+    return select(*expressions).where(table.c.channel == channel_of(cls))
+
+
+def _write_ddl(dialect: str, view: str, cls) -> List[str]:
+    columns = dict((target, name) for name, target in legacy_columns(cls) if isinstance(target, str))
+    details = [name for name, target in legacy_columns(cls) if isinstance(target, tuple)]
+    key = columns["id"]
+    if dialect == "sqlite":
+        build, now = "json_object", "CURRENT_TIMESTAMP"
+    else:
+        build, now = "json_build_object", "(now() AT TIME ZONE 'utc')"
+    values = {
+        "id": f"NEW.{key}",
+        "channel": f"'{channel_of(cls)}'",
+        "user_id": "NEW.user_id",
+        "number": f"NEW.{columns['number']}",
+        "status": f"NEW.{columns['status']}",
+        "date": f"COALESCE(NEW.{columns['date']}, {now})",
+        "message": f"NEW.{columns['message']}",
+        "details": build + "(" + ", ".join(f"'{name}', NEW.{name}" for name in details) + ")" if details else "NULL",
+    }
+    insert = f"INSERT INTO payment_instruments ({', '.join(values)}) VALUES ({', '.join(values.values())})"
+    update = (f"UPDATE payment_instruments SET {', '.join(f'{column} = {value}' for column, value in values.items() if column != 'channel')} "
+              f"WHERE id = OLD.{key}")
+    delete = f"DELETE FROM payment_instruments WHERE id = OLD.{key}"
+    if dialect == "sqlite":
+        return [f"CREATE TRIGGER {view}_{verb.lower()} INSTEAD OF {verb} ON {view} BEGIN {statement}; END"
+                for verb, statement in (("INSERT", insert), ("UPDATE", update), ("DELETE", delete))]
+    return [f"CREATE RULE {view}_{verb.lower()} AS ON {verb} TO {view} DO INSTEAD {statement}"
+            for verb, statement in (("INSERT", insert), ("UPDATE", update), ("DELETE", delete))]
+
+
+# A view (and its write triggers or rules) under every old table name that
+# is free; names still held by an unmigrated table are left alone
+def create_views(connection) -> List[str]:
+    dialect = connection.dialect.name
+    if dialect not in ("sqlite", "postgresql"):
+        raise InstrumentError(f"No compatibility views for {dialect}")
+    inspector = inspect(connection)
+    tables, views = set(inspector.get_table_names()), set(inspector.get_view_names())
+    created = []
+    for view, cls in LEGACY_TABLES.items():
+        if view in tables:
+            continue
+        if view in views:
+            connection.execute(text(f"DROP VIEW {view}"))
+        query = _view_select(cls).compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+        connection.execute(text(f"CREATE VIEW {view} AS {query}"))
+        for statement in _write_ddl(dialect, view, cls):
+            connection.execute(text(statement))
+        created.append(view)
+    return created
+
+
+@event.listens_for(PaymentInstrument.__table__, "after_create")
+def _create_views_with_table(target, connection, **kw):
+    create_views(connection)
+
+
+def _legacy_id(value) -> Optional[str]:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return str(UUID(bytes=bytes(value)))
+    try:
+        return str(UUID(value))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def _legacy_rows(rows, cls) -> Tuple[List[dict], int]:
+    columns = legacy_columns(cls)
+    converted, reissued = [], 0
+    for row in rows:
+        instrument = {"channel": channel_of(cls), "details": None, "message": None}
+        for name, target in columns:
+            value = row.get(name)
+            if isinstance(target, tuple):
+                if value is not None:
+                    instrument["details"] = {**(instrument["details"] or {}), target[1]: value}
+            elif target is not None:
+                instrument[target] = value
+        instrument["id"] = _legacy_id(instrument["id"])
+        if instrument["id"] is None:
+            instrument["id"] = new_id()
+            reissued += 1
+        if instrument.get("date") is None:
+            instrument["date"] = datetime.utcnow()
+        converted.append(instrument)
+    return converted, reissued
+
+
+# Copies each old table into payment_instruments and swaps it for its view,
+# one table per transaction, so a re-run picks up where a failed one stopped
+def migrate_instruments(engine, batch_size: int = 10_000, log=print) -> Dict[str, int]:
+    PaymentInstrument.__table__.create(engine, checkfirst=True)
+    moved = {}
+    for name, cls in LEGACY_TABLES.items():
+        with engine.begin() as connection:
+            if name not in inspect(connection).get_table_names():
+                continue
+            legacy = Table(name, MetaData(), autoload_with=connection)
+            result = connection.execute(select(legacy).execution_options(yield_per=batch_size))
+            count = reissued = 0
+            for rows in result.partitions(batch_size):
+                instruments, batch_reissued = _legacy_rows([row._asdict() for row in rows], cls)
+                connection.execute(PaymentInstrument.__table__.insert(), instruments)
+                count += len(instruments)
+                reissued += batch_reissued
+            connection.execute(text(f"ALTER TABLE {name} RENAME TO {name}_legacy"))
+            create_views(connection)
+        moved[name] = count
+        log(f"{name}: {count:,} rows moved" + (f", {reissued:,} given new ids (not UUIDs)" if reissued else "") + f"; old table kept as {name}_legacy")
+    return moved
+
+
+def parse_channels(channels: Optional[str]) -> Tuple[str, ...]:
+    if not channels:
+        return CHANNELS
+    requested = tuple(channel.strip() for channel in channels.split(",") if channel.strip())
+    unknown = [channel for channel in requested if channel not in CHANNELS]
+    if unknown:
+        raise InstrumentError(f"Unknown channels {', '.join(unknown)}; choose from {', '.join(CHANNELS)}")
+    return requested
+
+
+# A user's instruments across channels, newest first. Naming the channels
+# (all of them by default) lets the (channel, user_id, date) index serve it.
+def user_instruments(db: Session, user_id: str, channels: Sequence[str] = CHANNELS, since: Optional[datetime] = None,
+                     limit: int = 100) -> List[PaymentInstrument]:
+    query = db.query(PaymentInstrument).filter(PaymentInstrument.channel.in_(channels), PaymentInstrument.user_id == user_id)
+    if since is not None:
+        query = query.filter(PaymentInstrument.date >= since)
+    return query.order_by(PaymentInstrument.date.desc()).limit(limit).all()
+
+
+def main():
+    from nuAPI.database import engine
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate")
+    migrate.add_argument("--batch-size", type=int, default=10_000)
+    commands.add_parser("views")
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    if args.command == "migrate":
+        moved = migrate_instruments(engine, args.batch_size)
+        print(f"{sum(moved.values()):,} instruments from {len(moved)} tables in {time.perf_counter() - t:.2f}s")
+    else:
+        with engine.begin() as connection:
+            print("views:", ", ".join(create_views(connection)) or "none free")
+
+
+if __name__ == "__main__":
+    main()
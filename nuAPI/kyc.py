@@ -0,0 +1,209 @@
+# Batch KYC screening: claims pending kyc rows in chunks, validates documents
+# on a process pool and writes statuses back in bulk.
+#
+#   python -m nuAPI.kyc --workers 4 --chunk-size 5000
+import argparse
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from itertools import repeat
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from uuid import uuid4
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from nuAPI.models import KYCModel, KYCStatus
+
+DEFAULT_CHUNK_SIZE = 5000
+# A claim older than this is assumed abandoned and can be taken again
+CLAIM_LEASE = timedelta(minutes=10)
+MINIMUM_AGE = 18
+
+# Keyed by document_type lower-cased with non-letters removed
+DOCUMENT_FORMATS = {
+    "passport": re.compile(r"[A-Z0-9]{6,9}"),
+    "nationalid": re.compile(r"\d{8,14}"),
+    "driverslicense": re.compile(r"[A-Z0-9]{5,20}"),
+    "driverslicence": re.compile(r"[A-Z0-9]{5,20}"),
+    "votersid": re.compile(r"[A-Z0-9]{9,20}"),
+}
+EMAIL_FORMAT = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+_NOT_LETTERS = re.compile(r"[^a-z]")
+_SEPARATORS = re.compile(r"[\s\-/.]")
+
+# (id, document_type, document_number, issued_by, document_expiry, date_of_birth, email)
+KycRow = Tuple[str, str, str, str, date, date, str]
+# (id, approved, rejection reason, document hash)
+KycCheck = Tuple[str, bool, Optional[str], Optional[str]]
+
+
+def normalise_document_type(document_type: str) -> str:
+    return _NOT_LETTERS.sub("", document_type.lower())
+
+
+def normalise_document_number(document_number: str) -> str:
+    return _SEPARATORS.sub("", document_number).upper()
+
+
+def _digest(kind: str, issued_by: str, number: str) -> str:
+    return hashlib.sha256(f"{kind}|{issued_by.strip().upper()}|{number}".encode()).hexdigest()
+
+
+def document_hash(document_type: str, issued_by: str, document_number: str) -> str:
+    return _digest(normalise_document_type(document_type), issued_by, normalise_document_number(document_number))
+
+
+def _age_on(birth: date, day: date) -> int:
+    return day.year - birth.year - ((day.month, day.day) < (birth.month, birth.day))
+
+
+# Runs in the worker processes, so it only takes and returns plain tuples
+def validate_batch(rows: Sequence[KycRow], today: date) -> List[KycCheck]:
+    results = []
+    for kyc_id, document_type, document_number, issued_by, expiry, birth, email in rows:
+        kind = normalise_document_type(document_type)
+        number = normalise_document_number(document_number)
+        digest = _digest(kind, issued_by, number)
+        pattern = DOCUMENT_FORMATS.get(kind)
+        if pattern is None:
+            reason = f"Unsupported document type {document_type}"
+        elif not pattern.fullmatch(number):
+            reason = "Invalid document number format"
+        elif expiry < today:
+            reason = "Document expired"
+        elif _age_on(birth, today) < MINIMUM_AGE:
+            reason = "Applicant under minimum age"
+        elif not EMAIL_FORMAT.fullmatch(email):
+            reason = "Invalid email address"
+        else:
+            reason = None
+        results.append((kyc_id, reason is None, reason, digest))
+    return results
+
+
+def claim_pending(db: Session, worker_id: str, chunk_size: int = DEFAULT_CHUNK_SIZE, now: Optional[datetime] = None) -> List[KycRow]:
+    now = now or datetime.utcnow()
+    claimable = or_(KYCModel.claimed_at.is_(None), KYCModel.claimed_at < now - CLAIM_LEASE)
+    ids = [kyc_id for (kyc_id,) in db.query(KYCModel.id).filter(KYCModel.status == KYCStatus.pending, claimable).order_by(KYCModel.id).limit(chunk_size)]
+    if not ids:
+        return []
+    # Conditional update, so two processors never check the same row
+    db.query(KYCModel).filter(KYCModel.id.in_(ids), KYCModel.status == KYCStatus.pending, claimable).update(
+        {KYCModel.claimed_by: worker_id, KYCModel.claimed_at: now}, synchronize_session=False
+    )
+    db.commit()
+    return [tuple(row) for row in db.query(
+        KYCModel.id, KYCModel.document_type, KYCModel.document_number, KYCModel.issued_by,
+        KYCModel.document_expiry, KYCModel.date_of_birth, KYCModel.email,
+    ).filter(KYCModel.id.in_(ids), KYCModel.claimed_by == worker_id, KYCModel.status == KYCStatus.pending)]
+
+
+def _duplicates(db: Session, candidates: Dict[str, str]) -> Set[str]:
+    # One indexed IN query per 500 hashes finds every live row sharing a
+    # document; an approved holder wins, otherwise the lowest id does.
+    owners: Dict[str, Tuple[int, str]] = {}
+    for kyc_id, digest in candidates.items():
+        rank = (1, kyc_id)
+        if digest not in owners or rank < owners[digest]:
+            owners[digest] = rank
+    hashes = list(owners)
+    for start in range(0, len(hashes), 500):
+        for digest, kyc_id, status in db.query(KYCModel.document_hash, KYCModel.id, KYCModel.status).filter(
+            KYCModel.document_hash.in_(hashes[start:start + 500]),
+            KYCModel.status != KYCStatus.rejected,
+        ):
+            rank = (0 if status == KYCStatus.approved else 1, kyc_id)
+            if rank < owners[digest]:
+                owners[digest] = rank
+    return {kyc_id for kyc_id, digest in candidates.items() if owners[digest][1] != kyc_id}
+
+
+# Hash documents screened before document_hash existed so duplicates are caught against them
+def backfill_document_hashes(db: Session, batch_size: int = 10_000) -> int:
+    filled = 0
+    while True:
+        rows = db.query(KYCModel.id, KYCModel.document_type, KYCModel.issued_by, KYCModel.document_number).filter(
+            KYCModel.document_hash.is_(None), KYCModel.status != KYCStatus.pending,
+        ).limit(batch_size).all()
+        if not rows:
+            return filled
+        db.bulk_update_mappings(KYCModel, [
+            {"id": row.id, "document_hash": document_hash(row.document_type, row.issued_by, row.document_number)}
+            for row in rows
+        ])
+        db.commit()
+        filled += len(rows)
+
+
+def _screen_chunk(db: Session, rows: List[KycRow], executor: Optional[Executor], workers: int, today: date) -> Tuple[int, int]:
+    if executor is None:
+        checks = validate_batch(rows, today)
+    else:
+        size = -(-len(rows) // workers)
+        checks = [check for part in executor.map(validate_batch, [rows[i:i + size] for i in range(0, len(rows), size)], repeat(today)) for check in part]
+
+    duplicates = _duplicates(db, {kyc_id: digest for kyc_id, approved, _, digest in checks if approved})
+    now = datetime.utcnow()
+    updates = []
+    approved_count = 0
+    for kyc_id, approved, reason, digest in checks:
+        if approved and kyc_id in duplicates:
+            approved, reason = False, "Duplicate document number"
+        approved_count += approved
+        updates.append({
+            "id": kyc_id,
+            "status": KYCStatus.approved if approved else KYCStatus.rejected,
+            "rejection_reason": reason,
+            "document_hash": digest,
+            "checked_at": now,
+            "claimed_by": None,
+            "claimed_at": None,
+        })
+    db.bulk_update_mappings(KYCModel, updates)
+    db.commit()
+    return approved_count, len(updates) - approved_count
+
+
+# Screen every pending record; returns approved/rejected counts
+def process_pending_kyc(db: Session, workers: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE, today: Optional[date] = None) -> Dict[str, int]:
+    workers = workers or os.cpu_count() or 1
+    today = today or date.today()
+    worker_id = f"{os.getpid()}-{uuid4()}"
+    counts = {KYCStatus.approved.value: 0, KYCStatus.rejected.value: 0}
+    backfill_document_hashes(db)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        while True:
+            rows = claim_pending(db, worker_id, chunk_size)
+            if not rows:
+                return counts
+            approved, rejected = _screen_chunk(db, rows, executor, workers, today)
+            counts[KYCStatus.approved.value] += approved
+            counts[KYCStatus.rejected.value] += rejected
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def main():
+    from nuAPI.database import SessionLocal
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+    db = SessionLocal()
+    try:
+        t = time.perf_counter()
+        counts = process_pending_kyc(db, args.workers, args.chunk_size)
+        print(counts, f"in {time.perf_counter() - t:.2f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,40 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from uuid import uuid4
-from nuAPI.models import Payments, RecurringPayment, Base
+from contextlib import contextmanager
+from typing import List, Optional
+from nuAPI import models
+from nuAPI.models import Payments, PaymentPlan, RecurringPayment, Base
 from nuAPI.database import SessionLocal, engine
+from nuAPI import dedup
+from nuAPI.dedup import duplicate_index, find_duplicate, payment_channel, payment_fingerprint
+from nuAPI.ids import new_id
+from nuAPI.instruments import MAX_INSTRUMENTS, InstrumentError, parse_channels, user_instruments
+from nuAPI.fx import RateNotFound, convert_amounts, rate_cache, record_rate
+from nuAPI.money import Money, UnsupportedCurrency
+from nuAPI.ratelimit import RateLimitMiddleware
+from nuAPI.auth import TokenData, get_current_user, require_scope
+from nuAPI.responses import FastJSONResponse
+from nuAPI.replicas import ReadYourWritesMiddleware, read_router, start_replica_monitor
+from nuAPI.sharding import ShardMoving, new_payment_id, payment_session, shard_router, start_shard_router, user_slot
+from nuAPI.analytics import AnalyticsError, SnapshotMissing, run_query, start_snapshot_worker
+from nuAPI.changes import (
+    CHANGE_FEED_SCOPE, MAX_LIMIT, ChangeFeedError, change_sources, format_cursor, ndjson, next_cursor, parse_cursor, parse_tables,
+    wait_for_changes,
+)
+from nuAPI.events import notify_relay, record_payment_event, start_event_relay
+from nuAPI.vault import VaultError, card_vault
+from nuAPI.migrations import upgrade as upgrade_schema
+from nuAPI.merchants import MerchantError, merchant_cache, start_refresh_worker
+from nuAPI.otp import OtpLocked, otp_store, start_sweep_worker
+from nuAPI.notifications import enqueue_sms, notify_dispatcher, start_notification_dispatcher
+from nuAPI.instalments import InstalmentSchedule, create_instalment_plan
+from nuAPI.splits import SplitError, execute_split
+from nuAPI.ussd import (
+    DEFAULT_ACTIONS, DEFAULT_MENU, SIGNATURE_HEADER, UssdEngine, UssdError, UssdMenu, authorise_aggregator, link_wallet, normalise_msisdn,
+    session_store,
+)
+from nuAPI.transfers import TransferError, create_wallet_transfer, execute_wallet_transfer, start_expiry_worker
 from nuAPI.schemas import (
     CardPaymentRequest, CardPaymentResponse,
     BankTransferRequest, BankTransferResponse,
@@ -21,6 +53,16 @@ from nuAPI.schemas import (
     SamsungPayPaymentRequest, SamsungPayPaymentResponse,
     MTNMobileMoneyPaymentRequest, MTNMobileMoneyPaymentResponse,
     BankAccountRequest, BankAccountResponse,
+    WalletTransferRequest, WalletTransferResponse,
+    FxRateRequest, FxRateResponse,
+    FxConvertRequest, FxConvertResponse,
+    SplitPaymentRequest, SplitPaymentResponse, SplitAllocationResponse,
+    InstalmentPlanRequest, InstalmentPlanResponse, InstalmentResponse,
+    UssdRequest, UssdLinkRequest, UssdLinkResponse,
+    TwoFASendRequest, TwoFASendResponse, TwoFAVerifyRequest, TwoFAVerifyResponse,
+    AnalyticsQuery, AnalyticsQueryResponse,
+    PaymentSummaryResponse,
+    InstrumentResponse,
 )
 
 from sqlalchemy import Column, String, DateTime, Numeric, Integer, Boolean, JSON, Enum as SQLAlchemyEnum
@@ -41,7 +83,7 @@ class PaymentStatus(str, Enum):
 class BankAccount(Base):
     __tablename__ = 'bank_accounts'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(String, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     account_number = Column(String, nullable=False)
     bank_name = Column(String, nullable=False)
@@ -49,10 +91,44 @@ class BankAccount(Base):
     account_status = Column(String, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
 
-# Create the database tables
+# Create the database tables, and the columns added since to existing ones
+models.Base.metadata.create_all(bind=engine)
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
 
 app = FastAPI()
+# Token buckets per user, merchant (the token's merchant_id claim) and client IP, see nuAPI.ratelimit
+app.add_middleware(RateLimitMiddleware)
+# GETs go to replicas that have the caller's own writes, see nuAPI.replicas
+app.add_middleware(ReadYourWritesMiddleware)
+
+@app.on_event("startup")
+def start_background_workers():
+    # Refuse to start rather than vault PANs under a key lost on restart
+    card_vault.require_key()
+    db = SessionLocal()
+    try:
+        rate_cache.load(db)
+    finally:
+        db.close()
+    start_expiry_worker(SessionLocal)
+    start_sweep_worker(SessionLocal)
+    start_refresh_worker(SessionLocal)
+    start_event_relay(SessionLocal)
+    start_snapshot_worker(read_router.read_session, shard_factories=shard_router.shard_factories if shard_router else None)
+    start_replica_monitor()
+    # Each shard has its own outboxes, drained by its own relay and dispatcher
+    if shard_router is not None:
+        start_shard_router()
+        for shard_factory in shard_router.shard_factories:
+            start_event_relay(shard_factory)
+
+@app.on_event("startup")
+async def start_sms_dispatcher():
+    start_notification_dispatcher(SessionLocal)
+    if shard_router is not None:
+        for shard_factory in shard_router.shard_factories:
+            start_notification_dispatcher(shard_factory)
 
 @app.get("/")
 def read_root():
@@ -68,63 +144,159 @@ def get_db():
     finally:
         db.close()
 
+# Read-only endpoints: a replica when one is fresh enough, otherwise the primary
+def get_read_db(request: Request):
+    db = read_router.read_session(getattr(request.state, "fresh_after", None))
+    try:
+        yield db
+    finally:
+        db.close()
+
+# SMS text for a payment; queued in the outbox, never sent inline
+def payment_message(payment: Payments) -> str:
+    status = getattr(payment.payment_status, "value", payment.payment_status)
+    return f"PlayerOne: payment {payment.transaction_reference} of {payment.amount} {payment.currency} is {status}."
+
+# payment_session from nuAPI.sharding, with a range mid-move reported as 503
+@contextmanager
+def payments_db(db: Session, **route):
+    try:
+        with payment_session(db, **route) as session:
+            yield session
+    except ShardMoving as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
 # Create a payment
 def create_payment(db: Session, payment_request):
+    # Checked against the in-process merchant cache, not the database
+    if payment_request.merchant_id is not None:
+        try:
+            merchant_cache.require_active(payment_request.merchant_id)
+        except MerchantError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    user_id = str(payment_request.user_id)
+    slot = user_slot(user_id)
+    # The slot-bearing id is also the one clients get back and look up by
+    payment_id = new_payment_id(slot)
     payment = Payments(
-        user_id=str(payment_request.user_id),
+        id=payment_id,
+        payment_id=payment_id,
+        shard_slot=slot,
+        user_id=user_id,
         amount=payment_request.amount,
         currency=payment_request.currency,
         payment_status=payment_request.status,
-        transaction_reference=str(uuid4())
-    )
-    db.add(payment)
-    db.commit()
-    db.refresh(payment)
+        channel=payment_channel(payment_request),
+        merchant_id=payment_request.merchant_id,
+        card_token=getattr(payment_request, "card_token", None),
+        transaction_reference=new_id()
+    )
+    with payments_db(db, user_id=user_id) as shard_db:
+        if shard_db is not db:
+            db.commit()  # Rows the caller added on the primary, such as a vault token, go in first
+        # Double taps: the same user, amount, currency and channel inside the duplicate window
+        earlier = find_duplicate(shard_db, payment.user_id, payment.amount, payment.currency, payment.channel, payment.payment_id)
+        if earlier is not None:
+            if dedup.DUPLICATE_MODE == "block":
+                raise HTTPException(status_code=409, detail=f"Duplicate of payment {earlier}")
+            payment.description = f"Possible duplicate of {earlier}"
+        shard_db.add(payment)
+        enqueue_sms(shard_db, payment_message(payment), user_id=payment.user_id)
+        try:
+            record_payment_event(shard_db, "payment.created", payment)
+            shard_db.commit()
+        except Exception:
+            shard_db.rollback()
+            duplicate_index.discard(payment_fingerprint(payment.user_id, payment.amount, payment.currency, payment.channel), payment.payment_id)
+            raise
+        notify_dispatcher()
+        notify_relay()
+        shard_db.refresh(payment)
     return payment
 
-# Read payment by ID
-def get_payment(db: Session, payment_id: str):
-    return db.query(Payments).filter(Payments.id == payment_id).first()
-
 # Update payment
 def update_payment(db: Session, payment_id: str, payment_request):
-    payment = db.query(Payments).filter(Payments.id == payment_id).first()
-    if payment:
-        payment.amount = payment_request.amount
-        payment.currency = payment_request.currency
-        payment.payment_status = payment_request.status
-        db.commit()
-        db.refresh(payment)
-    return payment
+    with payments_db(db, payment_id=payment_id) as shard_db:
+        if shard_db is None:
+            return None
+        payment = shard_db.query(Payments).filter(Payments.payment_id == payment_id).first()
+        if payment:
+            payment.amount = payment_request.amount
+            payment.currency = payment_request.currency
+            status_changed = payment.payment_status != payment_request.status
+            payment.payment_status = payment_request.status
+            if status_changed:
+                enqueue_sms(shard_db, payment_message(payment), user_id=payment.user_id)
+            record_payment_event(shard_db, "payment.updated", payment)
+            shard_db.commit()
+            if status_changed:
+                notify_dispatcher()
+            notify_relay()
+            shard_db.refresh(payment)
+        return payment
 
 # Delete payment
 def delete_payment(db: Session, payment_id: str):
-    payment = db.query(Payments).filter(Payments.id == payment_id).first()
-    if payment:
-        db.delete(payment)
-        db.commit()
-    return payment
+    with payments_db(db, payment_id=payment_id) as shard_db:
+        if shard_db is None:
+            return None
+        payment = shard_db.query(Payments).filter(Payments.payment_id == payment_id).first()
+        if payment:
+            record_payment_event(shard_db, "payment.deleted", payment)
+            shard_db.delete(payment)
+            shard_db.commit()
+            notify_relay()
+        return payment
+
+# GETs of the channel endpoints: only the columns the response needs are
+# read, and they are encoded to JSON directly instead of going through the
+# response model twice (once built here, once validated by FastAPI)
+def payment_json(db: Session, payment_id: str, id_field: str, *extra_columns) -> FastJSONResponse:
+    with payments_db(db, payment_id=payment_id, writing=False) as shard_db:
+        row = None
+        if shard_db is not None:
+            row = shard_db.query(Payments.payment_id, Payments.payment_status, Payments.timestamp, *extra_columns).filter(
+                Payments.payment_id == payment_id
+            ).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    body = {id_field: row.payment_id, "status": row.payment_status, "timestamp": row.timestamp}
+    for column in extra_columns:
+        body[column.key] = getattr(row, column.key)
+    return FastJSONResponse(body)
+
+# Newest payments first, optionally for one user or status
+def recent_payments(db: Session, user_id: Optional[str], status: Optional[models.PaymentStatus], limit: int) -> List[Payments]:
+    query = db.query(Payments)
+    if user_id is not None:
+        query = query.filter(Payments.user_id == user_id)
+    if status is not None:
+        query = query.filter(Payments.payment_status == status)
+    return query.order_by(Payments.timestamp.desc()).limit(limit).all()
 
 # Card Payments Endpoints
 @app.post("/card-payments/", response_model=CardPaymentResponse)
 def create_card_payment(payment_request: CardPaymentRequest, db: Session = Depends(get_db)):
+    # The PAN goes into the vault in the payment's transaction and only the token is kept
+    if payment_request.card_number is not None:
+        try:
+            payment_request.card_token = card_vault.tokenise(db, payment_request.card_number)
+        except VaultError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        payment_request.card_number = None
+    elif card_vault.card_info(db, payment_request.card_token) is None:
+        raise HTTPException(status_code=400, detail="Unknown card token")
     payment = create_payment(db=db, payment_request=payment_request)
     return CardPaymentResponse(
         card_payment_id=payment.payment_id,
         status=payment.payment_status,
-        timestamp=payment.timestamp
+        timestamp=payment.timestamp,
+        card_token=payment.card_token
     )
 
 @app.get("/card-payments/{payment_id}", response_model=CardPaymentResponse)
-def read_card_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return CardPaymentResponse(
-        card_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_card_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "card_payment_id", Payments.card_token)
 
 @app.put("/card-payments/{payment_id}", response_model=CardPaymentResponse)
 def update_card_payment(payment_id: str, payment_request: CardPaymentRequest, db: Session = Depends(get_db)):
@@ -134,7 +306,8 @@ def update_card_payment(payment_id: str, payment_request: CardPaymentRequest, db
     return CardPaymentResponse(
         card_payment_id=payment.payment_id,
         status=payment.payment_status,
-        timestamp=payment.timestamp
+        timestamp=payment.timestamp,
+        card_token=payment.card_token
     )
 
 @app.delete("/card-payments/{payment_id}", response_model=CardPaymentResponse)
@@ -145,7 +318,8 @@ def delete_card_payment(payment_id: str, db: Session = Depends(get_db)):
     return CardPaymentResponse(
         card_payment_id=payment.payment_id,
         status=payment.payment_status,
-        timestamp=payment.timestamp
+        timestamp=payment.timestamp,
+        card_token=payment.card_token
     )
 
 # Bank Transfer Payments Endpoints
@@ -159,15 +333,8 @@ def create_bank_transfer(payment_request: BankTransferRequest, db: Session = Dep
     )
 
 @app.get("/bank-transfers/{payment_id}", response_model=BankTransferResponse)
-def read_bank_transfer(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return BankTransferResponse(
-        transfer_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_bank_transfer(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "transfer_id")
 
 @app.put("/bank-transfers/{payment_id}", response_model=BankTransferResponse)
 def update_bank_transfer(payment_id: str, payment_request: BankTransferRequest, db: Session = Depends(get_db)):
@@ -202,15 +369,8 @@ def create_bank_payment(payment_request: BankPaymentRequest, db: Session = Depen
     )
 
 @app.get("/bank-payments/{payment_id}", response_model=BankPaymentResponse)
-def read_bank_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return BankPaymentResponse(
-        bank_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_bank_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "bank_payment_id")
 
 @app.put("/bank-payments/{payment_id}", response_model=BankPaymentResponse)
 def update_bank_payment(payment_id: str, payment_request: BankPaymentRequest, db: Session = Depends(get_db)):
@@ -245,15 +405,8 @@ def create_cash_payment(payment_request: CashPaymentRequest, db: Session = Depen
     )
 
 @app.get("/cash-payments/{payment_id}", response_model=CashPaymentResponse)
-def read_cash_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return CashPaymentResponse(
-        cash_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_cash_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "cash_payment_id")
 
 @app.put("/cash-payments/{payment_id}", response_model=CashPaymentResponse)
 def update_cash_payment(payment_id: str, payment_request: CashPaymentRequest, db: Session = Depends(get_db)):
@@ -288,15 +441,8 @@ def create_link_payment(payment_request: LinkPaymentRequest, db: Session = Depen
     )
 
 @app.get("/link-payments/{payment_id}", response_model=LinkPaymentResponse)
-def read_link_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return LinkPaymentResponse(
-        link_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_link_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "link_payment_id")
 
 @app.put("/link-payments/{payment_id}", response_model=LinkPaymentResponse)
 def update_link_payment(payment_id: str, payment_request: LinkPaymentRequest, db: Session = Depends(get_db)):
@@ -331,15 +477,8 @@ def create_mobile_money_payment(payment_request: MobileMoneyPaymentRequest, db:
     )
 
 @app.get("/mobile-money-payments/{payment_id}", response_model=MobileMoneyPaymentResponse)
-def read_mobile_money_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return MobileMoneyPaymentResponse(
-        mobile_money_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_mobile_money_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "mobile_money_payment_id")
 
 @app.put("/mobile-money-payments/{payment_id}", response_model=MobileMoneyPaymentResponse)
 def update_mobile_money_payment(payment_id: str, payment_request: MobileMoneyPaymentRequest, db: Session = Depends(get_db)):
@@ -374,15 +513,8 @@ def create_mpesa_payment(payment_request: MpesaPaymentRequest, db: Session = Dep
     )
 
 @app.get("/mpesa-payments/{payment_id}", response_model=MpesaPaymentResponse)
-def read_mpesa_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return MpesaPaymentResponse(
-        mpesa_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_mpesa_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "mpesa_payment_id")
 
 @app.put("/mpesa-payments/{payment_id}", response_model=MpesaPaymentResponse)
 def update_mpesa_payment(payment_id: str, payment_request: MpesaPaymentRequest, db: Session = Depends(get_db)):
@@ -417,15 +549,8 @@ def create_airtel_money_payment(payment_request: AirtelMoneyPaymentRequest, db:
    )
 
 @app.get("/airtel-money-payments/{payment_id}", response_model=AirtelMoneyPaymentResponse)
-def read_airtel_money_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return AirtelMoneyPaymentResponse(
-        airtel_money_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_airtel_money_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "airtel_money_payment_id")
 
 @app.put("/airtel-money-payments/{payment_id}", response_model=AirtelMoneyPaymentResponse)
 def update_airtel_money_payment(payment_id: str, payment_request: AirtelMoneyPaymentRequest, db: Session = Depends(get_db)):
@@ -460,15 +585,8 @@ def create_vodafone_cash_payment(payment_request: VodafoneCashPaymentRequest, db
     )
 
 @app.get("/vodafone-cash-payments/{payment_id}", response_model=VodafoneCashPaymentResponse)
-def read_vodafone_cash_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return VodafoneCashPaymentResponse(
-        vodafone_cash_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_vodafone_cash_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "vodafone_cash_payment_id")
 
 @app.put("/vodafone-cash-payments/{payment_id}", response_model=VodafoneCashPaymentResponse)
 def update_vodafone_cash_payment(payment_id: str, payment_request: VodafoneCashPaymentRequest, db: Session = Depends(get_db)):
@@ -503,15 +621,8 @@ def create_tigo_cash_payment(payment_request: TigoCashPaymentRequest, db: Sessio
     )
 
 @app.get("/tigo-cash-payments/{payment_id}", response_model=TigoCashPaymentResponse)
-def read_tigo_cash_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return TigoCashPaymentResponse(
-        tigo_cash_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_tigo_cash_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "tigo_cash_payment_id")
 
 @app.put("/tigo-cash-payments/{payment_id}", response_model=TigoCashPaymentResponse)
 def update_tigo_cash_payment(payment_id: str, payment_request: TigoCashPaymentRequest, db: Session = Depends(get_db)):
@@ -546,15 +657,8 @@ def create_eft_payment(payment_request: EFTPaymentRequest, db: Session = Depends
     )
 
 @app.get("/eft-payments/{payment_id}", response_model=EFTPaymentResponse)
-def read_eft_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return EFTPaymentResponse(
-        eft_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_eft_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "eft_payment_id")
 
 @app.put("/eft-payments/{payment_id}", response_model=EFTPaymentResponse)
 def update_eft_payment(payment_id: str, payment_request: EFTPaymentRequest, db: Session = Depends(get_db)):
@@ -589,15 +693,8 @@ def create_snapscan_payment(payment_request: SnapScanPaymentRequest, db: Session
     )
 
 @app.get("/snapscan-payments/{payment_id}", response_model=SnapScanPaymentResponse)
-def read_snapscan_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return SnapScanPaymentResponse(
-        snapscan_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_snapscan_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "snapscan_payment_id")
 
 @app.put("/snapscan-payments/{payment_id}", response_model=SnapScanPaymentResponse)
 def update_snapscan_payment(payment_id: str, payment_request: SnapScanPaymentRequest, db: Session = Depends(get_db)):
@@ -632,15 +729,8 @@ def create_apple_pay_payment(payment_request: ApplePayPaymentRequest, db: Sessio
     )
 
 @app.get("/apple-pay-payments/{payment_id}", response_model=ApplePayPaymentResponse)
-def read_apple_pay_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return ApplePayPaymentResponse(
-        applepay_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_apple_pay_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "applepay_payment_id")
 
 @app.put("/apple-pay-payments/{payment_id}", response_model=ApplePayPaymentResponse)
 def update_apple_pay_payment(payment_id: str, payment_request: ApplePayPaymentRequest, db: Session = Depends(get_db)):
@@ -675,15 +765,8 @@ def create_google_pay_payment(payment_request: GooglePayPaymentRequest, db: Sess
     )
 
 @app.get("/google-pay-payments/{payment_id}", response_model=GooglePayPaymentResponse)
-def read_google_pay_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return GooglePayPaymentResponse(
-        googlepay_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_google_pay_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "googlepay_payment_id")
 
 @app.put("/google-pay-payments/{payment_id}", response_model=GooglePayPaymentResponse)
 def update_google_pay_payment(payment_id: str, payment_request: GooglePayPaymentRequest, db: Session = Depends(get_db)):
@@ -718,15 +801,8 @@ def create_samsung_pay_payment(payment_request: SamsungPayPaymentRequest, db: Se
     )
 
 @app.get("/samsung-pay-payments/{payment_id}", response_model=SamsungPayPaymentResponse)
-def read_samsung_pay_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return SamsungPayPaymentResponse(
-        samsungpay_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_samsung_pay_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "samsungpay_payment_id")
 
 @app.put("/samsung-pay-payments/{payment_id}", response_model=SamsungPayPaymentResponse)
 def update_samsung_pay_payment(payment_id: str, payment_request: SamsungPayPaymentRequest, db: Session = Depends(get_db)):
@@ -761,15 +837,8 @@ def create_mtn_mobile_money_payment(payment_request: MTNMobileMoneyPaymentReques
     )
 
 @app.get("/mtn-mobile-money-payments/{payment_id}", response_model=MTNMobileMoneyPaymentResponse)
-def read_mtn_mobile_money_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = get_payment(db=db, payment_id=payment_id)
-    if payment is None:
-        raise HTTPException(status_code=404, detail="Payment not found")
-    return MTNMobileMoneyPaymentResponse(
-        mtn_mobile_money_payment_id=payment.payment_id,
-        status=payment.payment_status,
-        timestamp=payment.timestamp
-    )
+def read_mtn_mobile_money_payment(payment_id: str, db: Session = Depends(get_read_db)):
+    return payment_json(db, payment_id, "mtn_mobile_money_payment_id")
 
 @app.put("/mtn-mobile-money-payments/{payment_id}", response_model=MTNMobileMoneyPaymentResponse)
 def update_mtn_mobile_money_payment(payment_id: str, payment_request: MTNMobileMoneyPaymentRequest, db: Session = Depends(get_db)):
@@ -813,7 +882,7 @@ def create_bank_account(bank_account_request: BankAccountRequest, db: Session =
     )
 
 @app.get("/bank-accounts/{bank_account_id}", response_model=BankAccountResponse)
-def read_bank_account(bank_account_id: str, db: Session = Depends(get_db)):
+def read_bank_account(bank_account_id: str, db: Session = Depends(get_read_db)):
     bank_account = db.query(RecurringPayment).filter(RecurringPayment.id == bank_account_id).first()
     if bank_account is None:
         raise HTTPException(status_code=404, detail="Bank account not found")
@@ -849,4 +918,255 @@ def delete_bank_account(bank_account_id: str, db: Session = Depends(get_db)):
         bank_account_id=bank_account.account_id,
         status=bank_account.account_status,
         timestamp=bank_account.timestamp
-    )
\ No newline at end of file
+    )
+
+# Wallet Transfer Endpoints
+@app.post("/wallet-transfers/", response_model=WalletTransferResponse)
+def create_transfer(transfer_request: WalletTransferRequest, db: Session = Depends(get_db)):
+    try:
+        transfer = create_wallet_transfer(
+            db=db,
+            source_wallet_id=str(transfer_request.source_wallet_id),
+            destination_wallet_id=str(transfer_request.destination_wallet_id),
+            amount=transfer_request.amount,
+            currency=transfer_request.currency,
+        )
+    except TransferError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return WalletTransferResponse(
+        transfer_id=transfer.transfer_id,
+        status=transfer.transfer_status,
+        expires_at=transfer.expires_at,
+        timestamp=transfer.transfer_date
+    )
+
+@app.post("/wallet-transfers/{transfer_id}/confirm", response_model=WalletTransferResponse)
+def confirm_transfer(transfer_id: str, db: Session = Depends(get_db)):
+    try:
+        transfer = execute_wallet_transfer(db=db, transfer_id=transfer_id)
+    except TransferError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return WalletTransferResponse(
+        transfer_id=transfer.transfer_id,
+        status=transfer.transfer_status,
+        expires_at=transfer.expires_at,
+        timestamp=transfer.transfer_date
+    )
+
+# FX Endpoints
+@app.post("/fx/rates/", response_model=FxRateResponse)
+def create_fx_rate(rate_request: FxRateRequest, db: Session = Depends(get_db)):
+    fx_rate = record_rate(
+        db=db,
+        base_currency=rate_request.base_currency,
+        quote_currency=rate_request.quote_currency,
+        rate=rate_request.rate,
+        effective_at=rate_request.effective_at,
+        source=rate_request.source,
+    )
+    return FxRateResponse(
+        rate_id=fx_rate.id,
+        base_currency=fx_rate.base_currency,
+        quote_currency=fx_rate.quote_currency,
+        rate=fx_rate.rate,
+        effective_at=fx_rate.effective_at
+    )
+
+@app.post("/fx/convert", response_model=FxConvertResponse)
+def convert_currency(convert_request: FxConvertRequest):
+    as_of = convert_request.as_of or datetime.utcnow()
+    try:
+        amounts = convert_amounts(convert_request.amounts, convert_request.from_currency, convert_request.to_currency, as_of)
+    except UnsupportedCurrency as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RateNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return FxConvertResponse(
+        amounts=amounts,
+        from_currency=convert_request.from_currency,
+        to_currency=convert_request.to_currency,
+        as_of=as_of
+    )
+
+# Split Payment Endpoints
+@app.post("/split-payments/", response_model=SplitPaymentResponse)
+def create_split_payment(split_request: SplitPaymentRequest, db: Session = Depends(get_db)):
+    try:
+        split_id, timestamp, rows = execute_split(
+            db=db,
+            user_id=str(split_request.user_id),
+            amount=split_request.amount,
+            currency=split_request.currency,
+            shares=[(str(share.beneficiary_id), share.percentage, share.amount) for share in split_request.shares],
+            payment_method=split_request.payment_method,
+        )
+    except (SplitError, UnsupportedCurrency) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return SplitPaymentResponse(
+        split_payment_id=split_id,
+        status=PaymentStatus.confirmed,
+        allocations=[
+            SplitAllocationResponse(beneficiary_id=row["beneficiary_id"], amount=Money(row["amount"], row["currency"]))
+            for row in rows
+        ],
+        timestamp=timestamp
+    )
+
+# Payment Plan Endpoints
+def instalment_plan_response(plan):
+    schedule = InstalmentSchedule.for_plan(plan)
+    return InstalmentPlanResponse(
+        paymentplan_id=plan.paymentplan_id,
+        status=plan.status,
+        instalments=[
+            InstalmentResponse(sequence=i.sequence, due_date=i.due_date, amount=Money(i.amount, plan.currency))
+            for i in schedule
+        ],
+        timestamp=plan.date
+    )
+
+@app.post("/payment-plans/", response_model=InstalmentPlanResponse)
+def create_payment_plan(plan_request: InstalmentPlanRequest, db: Session = Depends(get_db)):
+    try:
+        plan = create_instalment_plan(
+            db=db,
+            user_id=str(plan_request.user_id),
+            amount=plan_request.amount,
+            currency=plan_request.currency,
+            instalment_count=plan_request.instalment_count,
+            frequency=plan_request.frequency.value,
+            start_date=plan_request.start_date,
+            payment_method=plan_request.payment_method,
+        )
+    except UnsupportedCurrency as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return instalment_plan_response(plan)
+
+@app.get("/payment-plans/{paymentplan_id}", response_model=InstalmentPlanResponse)
+def read_payment_plan(paymentplan_id: str, db: Session = Depends(get_read_db)):
+    plan = db.query(PaymentPlan).filter(PaymentPlan.paymentplan_id == paymentplan_id).first()
+    if plan is None or plan.instalment_count is None:
+        raise HTTPException(status_code=404, detail="Payment plan not found")
+    return instalment_plan_response(plan)
+
+# USSD Endpoints
+# The menu is compiled once; hops that only navigate never touch the database
+ussd_engine = UssdEngine(UssdMenu(DEFAULT_MENU, DEFAULT_ACTIONS), session_store(), SessionLocal)
+
+# Only the aggregator may take hops: the caller's number is its word
+async def ussd_aggregator(request: Request):
+    try:
+        authorise_aggregator(await request.body(), request.headers.get(SIGNATURE_HEADER), request.client.host if request.client else None)
+    except UssdError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+@app.post("/ussd/", response_class=PlainTextResponse, dependencies=[Depends(ussd_aggregator)])
+def ussd_hop(ussd_request: UssdRequest):
+    return ussd_engine.handle(ussd_request.session_id, ussd_request.phone_number, ussd_request.text)
+
+@app.put("/wallets/{wallet_id}/ussd", response_model=UssdLinkResponse)
+def link_ussd_wallet(wallet_id: str, link_request: UssdLinkRequest, token_data: TokenData = Depends(get_current_user), db: Session = Depends(get_db)):
+    wallet = db.query(models.Wallet).filter(models.Wallet.wallet_id == wallet_id).first()
+    if wallet is None or wallet.user_id != str(token_data.user_id):
+        raise HTTPException(status_code=404, detail="Wallet not found")
+    msisdn = normalise_msisdn(link_request.phone_number)
+    if msisdn is None:
+        raise HTTPException(status_code=400, detail="Invalid phone number")
+    try:
+        wallet = link_wallet(db, wallet, msisdn, link_request.pin)
+    except UssdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return UssdLinkResponse(wallet_id=wallet.wallet_id, wallet_msisdn=wallet.wallet_msisdn)
+
+# 2FA Endpoints
+@app.post("/2fa/send", response_model=TwoFASendResponse)
+def send_2fa_code(send_request: TwoFASendRequest, db: Session = Depends(get_db)):
+    try:
+        code, expires = otp_store.issue(send_request.phone_number, db)
+    except OtpLocked as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    # Committed with the code's hash; the dispatcher redacts the text once sent
+    enqueue_sms(db, f"PlayerOne: your verification code is {code}.", recipient=send_request.phone_number, sensitive=True)
+    db.commit()
+    notify_dispatcher()
+    return TwoFASendResponse(phone_number=send_request.phone_number, expires_at=datetime.utcfromtimestamp(expires))
+
+# Against otp_codes, so a code sent through one worker verifies on any
+# other, once; locked phones are turned away from memory
+@app.post("/2fa/verify", response_model=TwoFAVerifyResponse)
+def verify_2fa_code(verify_request: TwoFAVerifyRequest, db: Session = Depends(get_db)):
+    try:
+        verified = otp_store.verify(verify_request.phone_number, verify_request.code, db)
+    except OtpLocked as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    if not verified:
+        raise HTTPException(status_code=400, detail="Invalid or expired code")
+    return TwoFAVerifyResponse(phone_number=verify_request.phone_number, verified=True)
+
+
+# Change feed for downstream mirrors: pass the last X-Next-Since back as `since`.
+# Caught-up clients are held up to `wait` seconds for the next commit. Only
+# tokens with the changes:read scope may tail it. With sharding on, each
+# shard's payments have their own entry in the cursor.
+@app.get("/changes", dependencies=[Depends(require_scope(CHANGE_FEED_SCOPE))])
+async def tail_changes(since: str = "0", tables: str = "payments,transactions", limit: int = 1000, wait: float = 0.0):
+    try:
+        sources = change_sources(parse_tables(tables), SessionLocal, shard_router.shard_factories if shard_router else None)
+        cursor = parse_cursor(since, list(sources))
+    except ChangeFeedError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not 1 <= limit <= MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_LIMIT}")
+    changes = await wait_for_changes(sources, cursor, limit, max(wait, 0.0))
+    return StreamingResponse(ndjson(changes), media_type="application/x-ndjson",
+                             headers={"X-Next-Since": format_cursor(next_cursor(cursor, changes))})
+
+# Aggregations for reports, answered from the latest columnar snapshot in a
+# worker process rather than from the database
+@app.post("/analytics/query", response_model=AnalyticsQueryResponse)
+async def analytics_query(query: AnalyticsQuery):
+    try:
+        return await run_query(query.model_dump(mode="json"))
+    except SnapshotMissing as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except AnalyticsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Newest payments; without a user_id every shard is queried in parallel and
+# their sorted pages merged
+@app.get("/payments", response_model=List[PaymentSummaryResponse])
+def list_payments(user_id: Optional[str] = None, status: Optional[models.PaymentStatus] = None, limit: int = 50,
+                  db: Session = Depends(get_read_db)):
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    if user_id is not None or shard_router is None:
+        with payments_db(db, user_id=user_id, writing=False) as shard_db:
+            payments = recent_payments(shard_db, user_id, status, limit)
+    else:
+        payments = shard_router.gather(
+            lambda shard_db: recent_payments(shard_db, None, status, limit), key=lambda payment: payment.timestamp, limit=limit, reverse=True
+        )
+    return [
+        PaymentSummaryResponse(
+            id=payment.id, user_id=payment.user_id, amount=payment.amount, currency=payment.currency, status=payment.payment_status,
+            channel=payment.channel, merchant_id=payment.merchant_id, timestamp=payment.timestamp,
+        )
+        for payment in payments
+    ]
+
+# Saved instruments of one user across channels (comma-separated), newest first
+@app.get("/instruments", response_model=List[InstrumentResponse])
+def list_instruments(user_id: str, channels: Optional[str] = None, limit: int = 100, db: Session = Depends(get_read_db)):
+    if not 1 <= limit <= MAX_INSTRUMENTS:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_INSTRUMENTS}")
+    try:
+        requested = parse_channels(channels)
+    except InstrumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return [
+        InstrumentResponse(
+            id=instrument.id, channel=instrument.channel, user_id=instrument.user_id, number=instrument.number, status=instrument.status,
+            date=instrument.date, message=instrument.message, details=instrument.details,
+        )
+        for instrument in user_instruments(db, user_id, requested, limit=limit)
+    ]
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from nuAPI.models import Merchant
+
+ACTIVE_STATUSES = frozenset({"active"})
+REFRESH_INTERVAL = 5.0  # seconds
+# Longest a merchant write can take to commit. A row stamped before a
+# refresh can still commit after it, so each refresh re-reads this much.
+REFRESH_OVERLAP = timedelta(seconds=30)
+
+logger = logging.getLogger(__name__)
+
+
+class MerchantError(Exception):
+    pass
+
+
+class MerchantInfo(NamedTuple):
+    merchant_id: str
+    status: str
+    category: str
+    account: str
+
+
+_COLUMNS = (Merchant.merchant_id, Merchant.merchant_status, Merchant.merchant_category, Merchant.merchant_account)
+
+
+class MerchantCache:
+    # Active merchants keyed by merchant_id. A load or a refresh builds a new
+    # dict and swaps it in with one store, and entries are immutable tuples,
+    # so readers never take the lock and never see a half-applied refresh.
+    def __init__(self):
+        self.merchants: Dict[str, MerchantInfo] = {}
+        # Rows stamped before this have all been applied
+        self.watermark: Optional[datetime] = None
+        self.version = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _apply(merchants: Dict[str, MerchantInfo], rows):
+        for merchant_id, status, category, account in rows:
+            if status in ACTIVE_STATUSES:
+                merchants[merchant_id] = MerchantInfo(merchant_id, status, category, account)
+            else:
+                merchants.pop(merchant_id, None)
+
+    def load(self, db: Session) -> int:
+        merchants: Dict[str, MerchantInfo] = {}
+        with self._lock:
+            started = datetime.utcnow()
+            self._apply(merchants, db.query(*_COLUMNS).filter(Merchant.merchant_status.in_(ACTIVE_STATUSES)))
+            self.merchants = merchants
+            self.watermark = started - REFRESH_OVERLAP
+            self.version += 1
+        return len(merchants)
+
+    # Apply rows changed since the watermark; cost follows the rows changed, not the table
+    def refresh(self, db: Session) -> int:
+        if self.watermark is None:
+            return self.load(db)
+        with self._lock:
+            started = datetime.utcnow()
+            rows = db.query(*_COLUMNS).filter(Merchant.updated_at >= self.watermark).all()
+            if rows:
+                merchants = dict(self.merchants)
+                self._apply(merchants, rows)
+                self.merchants = merchants
+                self.version += 1
+            self.watermark = started - REFRESH_OVERLAP
+        return len(rows)
+
+    def get(self, merchant_id: str) -> Optional[MerchantInfo]:
+        return self.merchants.get(merchant_id)
+
+    # The merchant if it is active, without touching the database
+    def require_active(self, merchant_id: str) -> MerchantInfo:
+        merchant = self.merchants.get(merchant_id)
+        if merchant is None:
+            raise MerchantError(f"Merchant {merchant_id} is unknown or not active")
+        return merchant
+
+    def __len__(self):
+        return len(self.merchants)
+
+
+merchant_cache = MerchantCache()
+
+
+def start_refresh_worker(session_factory, interval: float = REFRESH_INTERVAL) -> threading.Thread:
+    def run():
+        while True:
+            time.sleep(interval)
+            db = session_factory()
+            try:
+                merchant_cache.refresh(db)
+            except Exception:
+                logger.exception("Merchant cache refresh failed")
+            finally:
+                db.close()
+
+    db = session_factory()
+    try:
+        merchant_cache.load(db)
+    finally:
+        db.close()
+    worker = threading.Thread(target=run, name="merchant-refresh", daemon=True)
+    worker.start()
+    return worker
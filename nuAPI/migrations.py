@@ -0,0 +1,180 @@
+# Columns added to tables that already existed. create_all only creates
+# missing tables, so a database from before such a change gets the column
+# here: ALTER TABLE ... ADD COLUMN, then whatever indexes of the table are
+# missing, then any backfill. nuAPI.main runs it at startup; every step
+# checks first, so a re-run does nothing.
+#
+#   python -m nuAPI.migrations
+import argparse
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import inspect, literal, text
+
+# (table, column, value for existing rows). A value is required for a NOT
+# NULL column, and may be a callable evaluated when the migration runs.
+ADDED_COLUMNS: List[Tuple[str, str, Optional[object]]] = [
+    ("wallets", "wallet_balance", 0),  # debited and credited by wallet transfers
+    ("wallets", "wallet_currency", None),  # transfers must be in it; unset takes any
+    ("paymentplan", "instalment_count", None),  # unset on plans that are not instalment plans
+    ("paymentplan", "instalment_frequency", None),
+    ("paymentplan", "instalment_start_date", None),
+    ("paymentplan", "instalments_materialised", 0),  # instalment rows written so far
+    ("paymentplan", "next_instalment_date", None),  # due date the scheduler looks for
+    ("sms_outbox", "claimed_by", None),  # dispatcher sending the message
+    ("sms_outbox", "claimed_until", None),  # when another dispatcher may take it over
+    ("kyc", "document_hash", None),  # for duplicate document checks; filled by kyc.backfill_document_hashes
+    ("kyc", "rejection_reason", None),
+    ("kyc", "claimed_by", None),  # screening worker holding the record
+    ("kyc", "claimed_at", None),
+    ("kyc", "checked_at", None),  # when screening finished
+    ("payments", "channel", None),  # part of the duplicate payment fingerprint
+    ("merchants", "updated_at", datetime.utcnow),  # watermark the merchant cache refreshes from
+    ("payments", "merchant_id", None),
+    ("payments", "card_token", None),  # vault token of the card paid with
+    # Existing keys are plain legacy keys: version 0, which the unique
+    # (user_id, key_version) index leaves out, and no master key
+    ("encryption", "key_version", 0),
+    ("encryption", "master_key_id", None),
+    ("payments", "change_seq", None),  # position in the change feed
+    ("transactions", "change_seq", None),  # position in the change feed
+    ("payments", "shard_slot", None),  # slot the shard router places the payment by
+    ("sms_outbox", "sensitive", False),  # holds a code; redacted once sent
+    ("wallets", "wallet_msisdn", None),  # number USSD sessions are matched on
+    ("wallets", "wallet_pin_hash", None),  # USSD PIN
+    ("wallets", "wallet_pin_failures", 0),  # wrong USSD PINs since the last right one
+]
+# Rows a backfill reads and writes at a time
+BACKFILL_BATCH_SIZE = 10_000
+# Run once, on the connection that added the column, keyed "table.column"
+BACKFILLS: Dict[str, Callable] = {}
+# Run before a missing index is created, keyed by index name
+BEFORE_INDEXES: Dict[str, Callable] = {}
+
+
+class MigrationError(Exception):
+    pass
+
+
+# Duplicate schedules written by concurrent materialise runs, before the
+# unique (paymentplan_id, sequence) index existed; one row of each is kept
+def _drop_duplicate_instalments(connection):
+    duplicates = connection.execute(text(
+        "SELECT paymentplan_id, sequence FROM paymentplaninstalment GROUP BY paymentplan_id, sequence HAVING count(*) > 1"
+    )).all()
+    for paymentplan_id, sequence in duplicates:
+        ids = connection.execute(text(
+            "SELECT instalment_id FROM paymentplaninstalment WHERE paymentplan_id = :plan AND sequence = :sequence"
+        ), {"plan": paymentplan_id, "sequence": sequence}).scalars().all()
+        connection.execute(text("DELETE FROM paymentplaninstalment WHERE instalment_id = :id"), [{"id": id_} for id_ in ids[1:]])
+
+
+BEFORE_INDEXES["ix_paymentplaninstalment_plan_sequence"] = _drop_duplicate_instalments
+
+
+# Routing and move_slots read the slot from the row, so existing payments
+# get theirs before any shard is added
+def _fill_shard_slots(connection, batch_size: int = BACKFILL_BATCH_SIZE):
+    from nuAPI.sharding import user_slot
+
+    while True:
+        rows = connection.execute(text("SELECT id, user_id FROM payments WHERE shard_slot IS NULL LIMIT :n"), {"n": batch_size}).all()
+        if not rows:
+            return
+        connection.execute(text("UPDATE payments SET shard_slot = :slot WHERE id = :id"),
+                           [{"slot": user_slot(user_id), "id": id_} for id_, user_id in rows])
+
+
+BACKFILLS["payments.shard_slot"] = _fill_shard_slots
+
+
+# Verification codes queued before messages could be flagged: flagged now,
+# and redacted unless still waiting to be sent
+def _redact_sent_codes(connection):
+    from nuAPI.notifications import REDACTED_MESSAGE
+
+    connection.execute(text("UPDATE sms_outbox SET sensitive = :true WHERE message LIKE 'PlayerOne: your verification code is%'"), {"true": True})
+    connection.execute(text("UPDATE sms_outbox SET message = :redacted WHERE sensitive = :true AND status != 'pending'"),
+                       {"redacted": REDACTED_MESSAGE, "true": True})
+
+
+BACKFILLS["sms_outbox.sensitive"] = _redact_sent_codes
+
+
+# USSD used to match the caller's last ten digits against wallet_number, so
+# wallets get that number in full; one shared by several wallets is left
+# unset on all of them, to be linked again by its owner
+def _fill_wallet_msisdns(connection):
+    from nuAPI.ussd import normalise_msisdn
+
+    numbers = {}
+    for wallet_id, wallet_number in connection.execute(text("SELECT wallet_id, wallet_number FROM wallets")):
+        msisdn = normalise_msisdn(wallet_number)
+        if msisdn is not None:
+            numbers.setdefault(msisdn, []).append(wallet_id)
+    rows = [{"msisdn": msisdn, "id": ids[0]} for msisdn, ids in numbers.items() if len(ids) == 1]
+    if rows:
+        connection.execute(text("UPDATE wallets SET wallet_msisdn = :msisdn WHERE wallet_id = :id"), rows)
+
+
+BACKFILLS["wallets.wallet_msisdn"] = _fill_wallet_msisdns
+
+
+def _add_column_ddl(connection, table, name: str, fill) -> str:
+    column = table.c[name]
+    ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{name}" {column.type.compile(dialect=connection.dialect)}'
+    if not column.nullable:
+        if fill is None:
+            raise MigrationError(f"{table.name}.{name} is NOT NULL and has no value for existing rows")
+        value = fill() if callable(fill) else fill
+        ddl += " NOT NULL DEFAULT " + str(literal(value, column.type).compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    return ddl
+
+
+def upgrade(engine, metadata=None, log=print) -> List[str]:
+    if metadata is None:
+        from nuAPI.models import Base
+        metadata = Base.metadata
+    added = []
+    with engine.begin() as connection:
+        tables = set(inspect(connection).get_table_names())
+        for table_name, name, fill in ADDED_COLUMNS:
+            if table_name not in tables:
+                continue
+            if name in {column["name"] for column in inspect(connection).get_columns(table_name)}:
+                continue
+            connection.execute(text(_add_column_ddl(connection, metadata.tables[table_name], name, fill)))
+            backfill = BACKFILLS.get(f"{table_name}.{name}")
+            if backfill is not None:
+                backfill(connection)
+            added.append(f"{table_name}.{name}")
+        for table in metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+            indexes = {index["name"] for index in inspect(connection).get_indexes(table.name)}
+            for index in table.indexes:
+                # Indexes on columns no entry above adds yet are left for later
+                if index.name in indexes or not all(column.name in columns for column in index.columns):
+                    continue
+                before = BEFORE_INDEXES.get(index.name)
+                if before is not None:
+                    before(connection)
+                index.create(connection)
+    if added:
+        log("added columns: " + ", ".join(added))
+    return added
+
+
+def main():
+    from nuAPI.database import engine
+
+    argparse.ArgumentParser().parse_args()
+    t = time.perf_counter()
+    added = upgrade(engine)
+    print(f"{len(added)} columns added in {time.perf_counter() - t:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,12 @@ from typing import List, Optional
 from enum import Enum
 from uuid import UUID, uuid4
 from datetime import date, datetime, timedelta
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Enum as SQLAlchemyEnum, DateTime, Numeric, Boolean, JSON
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, Enum as SQLAlchemyEnum, DateTime, Numeric, Boolean, JSON, Index, LargeBinary, Float, text
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import composite, relationship, synonym
 from sqlalchemy.ext.declarative import declarative_base
+from nuAPI.ids import UUIDKey, new_id
+from nuAPI.money import MinorUnits, Money
 
 Base = declarative_base()
 
@@ -26,7 +29,7 @@ class User(BaseModel):
 class Customer(Base):
     __tablename__ = 'customers'
 
-    customer_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    customer_id = Column(UUIDKey, primary_key=True, default=new_id)
     customer_name = Column(String, nullable=False)
     email = Column(String, nullable=False)
     password = Column(String, nullable=False)
@@ -37,16 +40,17 @@ class Customer(Base):
 class Transaction(Base):
     __tablename__ = 'transactions'
 
-    transaction_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    transaction_id = Column(UUIDKey, primary_key=True, default=new_id)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
-    date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, default=lambda: str(uuid4()), nullable=False)
-    payment_reference = Column(String, default=lambda: str(uuid4()), nullable=False)
+    date = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    account_reference = Column(String, default=new_id, nullable=False)
+    payment_reference = Column(String, default=new_id, nullable=False)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
     message = Column(String, nullable=True)
+    change_seq = Column(Integer, nullable=True, index=True)  # Assigned on every write, see nuAPI.changes
 
 class Currency(str, Enum):
     USD = "USD"
@@ -57,6 +61,19 @@ class Currency(str, Enum):
     GHS = "GHS"
     ZAR = "ZAR"
 
+class FxRate(Base):
+    __tablename__ = 'fx_rates'
+    __table_args__ = (
+        Index('ix_fx_rates_pair_effective_at', 'base_currency', 'quote_currency', 'effective_at'),
+    )
+
+    id = Column(UUIDKey, primary_key=True, default=new_id)
+    base_currency = Column(String, nullable=False)
+    quote_currency = Column(String, nullable=False)
+    rate = Column(Numeric, nullable=False)  # Units of quote_currency per one unit of base_currency
+    effective_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    source = Column(String, nullable=True)
+
 class Authorization(BaseModel):
     access_token: str
     token_type: str
@@ -71,7 +88,7 @@ class TwoFA(BaseModel):
 class FraudDetection(Base):
     __tablename__ = 'fraud_detection'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     transaction_id = Column(String, nullable=False)
     transaction_date = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -98,7 +115,7 @@ class KYCStatus(str, Enum):
 class KYCModel(Base):
     __tablename__ = 'kyc'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
     date_of_birth = Column(Date, nullable=False)
@@ -109,18 +126,23 @@ class KYCModel(Base):
     document_expiry = Column(Date, nullable=False)  # Document expiry date
     phone_number = Column(String, nullable=False)
     email = Column(String, nullable=False)
-    status = Column(SQLAlchemyEnum(KYCStatus), default=KYCStatus.pending, nullable=False)  # Can be Pending, Approved, Rejected
+    status = Column(SQLAlchemyEnum(KYCStatus), default=KYCStatus.pending, nullable=False, index=True)  # Can be Pending, Approved, Rejected
+    document_hash = Column(String, nullable=True, index=True)  # SHA-256 of the normalised type/issuer/number, for duplicate checks
+    rejection_reason = Column(String, nullable=True)
+    claimed_by = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    checked_at = Column(DateTime, nullable=True)
 
 class Refund(Base):
     __tablename__ = 'refunds'
 
-    refund_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    refund_id = Column(UUIDKey, primary_key=True, default=new_id)
     transaction_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
-    date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    date = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     refund_method = Column(String, nullable=False)
     refund_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -142,7 +164,7 @@ class Dispute(BaseModel):
 class AuditTrail(Base):
     __tablename__ = 'audit_trail'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     action = Column(String, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -159,7 +181,7 @@ class PaymentChannel(str, Enum):
 class CustomerSupport(Base):
     __tablename__ = 'customer_support'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     interaction = Column(JSON, nullable=False)
     interaction_date = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -170,7 +192,7 @@ class CustomerSupport(Base):
 class Merchant(Base):
     __tablename__ = 'merchants'
 
-    merchant_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    merchant_id = Column(UUIDKey, primary_key=True, default=new_id)
     merchant_name = Column(String, nullable=False)
     merchant_email = Column(String, nullable=False)
     merchant_phone = Column(String, nullable=False)
@@ -181,21 +203,38 @@ class Merchant(Base):
     merchant_category = Column(String, nullable=False)
     merchant_status = Column(String, nullable=False)
     merchant_account = Column(String, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False, index=True)
 
 class Encryption(Base):
     __tablename__ = 'encryption'
-
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    encryption_key = Column(String, nullable=False)
+    __table_args__ = (
+        # One data key per tenant and version; legacy keys all sit at version 0
+        Index('ix_encryption_user_id_key_version', 'user_id', 'key_version', unique=True,
+              sqlite_where=text('key_version > 0'), postgresql_where=text('key_version > 0')),
+    )
+
+    id = Column(UUIDKey, primary_key=True, default=new_id)
+    user_id = Column(String, nullable=False)  # The tenant the data key belongs to
+    encryption_key = Column(String, nullable=False)  # Data key wrapped by the master key (nuAPI.envelope)
+    key_version = Column(Integer, nullable=False, default=1)
+    master_key_id = Column(String, nullable=True)  # None for legacy rows still holding a plain key
     encryption_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    encryption_status = Column(String, nullable=False)
+    encryption_status = Column(String, nullable=False)  # active or retired
     encryption_message = Column(String, nullable=True)
 
+class KeyRotationJob(Base):
+    __tablename__ = 'key_rotation_jobs'
+
+    id = Column(String, primary_key=True)  # table.column
+    last_id = Column(String, nullable=True)  # Primary key of the last row re-encrypted
+    rows_done = Column(Integer, nullable=False, default=0)
+    status = Column(String, nullable=False)  # running or done
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
 class Subscription(Base):
     __tablename__ = 'subscriptions'
 
-    subscription_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    subscription_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     subscription_date = Column(DateTime, default=datetime.utcnow, nullable=False)
     subscription_status = Column(String, nullable=False)
@@ -204,7 +243,7 @@ class Subscription(Base):
 class PaymentMethod(Base):
     __tablename__ = 'payment_methods'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     method_type = Column(String, nullable=False)
     details = Column(String, nullable=False)
@@ -214,13 +253,13 @@ class PaymentMethod(Base):
 class Charge(Base):
     __tablename__ = 'charges'
 
-    charge_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    charge_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
-    date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    date = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -229,13 +268,13 @@ class Charge(Base):
 class RecurringCharges(Base):
     __tablename__ = 'recurringcharges'
 
-    recurringcharge_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    recurringcharge_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -250,72 +289,171 @@ class RecurringCharges(Base):
     last_payment_date = Column(DateTime, default=datetime.utcnow, nullable=False)
     payment_history = Column(JSON, nullable=False)
 
-class Card(Base):
-    __tablename__ = 'cards'
-
-    card_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+class PaymentInstrument(Base):
+    # Saved cards, bank accounts, QR codes, POS terminals and the like in one
+    # table: `channel` says which, and fields only one channel has go in
+    # `details`. The per-channel classes below map onto it under their old
+    # names, and nuAPI.instruments keeps views under the old table names.
+    __tablename__ = 'payment_instruments'
+    __table_args__ = (
+        Index('ix_payment_instruments_channel_user_date', 'channel', 'user_id', 'date'),
+        # Covers counts by channel and status over a date range
+        Index('ix_payment_instruments_date_channel_status', 'date', 'channel', 'status'),
+    )
+
+    id = Column(UUIDKey, primary_key=True, default=new_id)
+    channel = Column(String, nullable=False)
     user_id = Column(String, nullable=False)
-    card_number = Column(String, nullable=False)
-    card_name = Column(String, nullable=False)
-    card_expiry = Column(String, nullable=False)
-    card_cvv = Column(String, nullable=False)
-    card_type = Column(String, nullable=False)
-    card_status = Column(String, nullable=False)
-    card_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    card_message = Column(String, nullable=True)
-
-class Bank(Base):
-    __tablename__ = 'banks'
-
-    bank_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    bank_name = Column(String, nullable=False)
-    bank_branch = Column(String, nullable=False)
-    bank_account = Column(String, nullable=False)
-    bank_status = Column(String, nullable=False)
-    bank_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    bank_message = Column(String, nullable=True)
+    number = Column(String, nullable=False)  # Card token, account number, QR code, terminal id, ...
+    status = Column(String, nullable=False)
+    date = Column(DateTime, default=datetime.utcnow, nullable=False)
+    message = Column(String, nullable=True)
+    details = Column(JSON, nullable=True)
+
+    __mapper_args__ = {'polymorphic_on': channel, 'polymorphic_identity': 'instrument'}
+
+# A channel-specific field kept in PaymentInstrument.details, readable,
+# writable and filterable like a column
+def _detail(key):
+    @hybrid_property
+    def value(self):
+        return (self.details or {}).get(key)
+
+    @value.setter
+    def value(self, new_value):
+        self.details = {**(self.details or {}), key: new_value}
+
+    @value.expression
+    def value(cls):
+        return cls.details[key].as_string()
+
+    return value
+
+class Card(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'card'}
+
+    card_id = synonym('id')
+    card_number = synonym('number')  # Vault token (nuAPI.vault), never the PAN
+    card_name = _detail('card_name')
+    card_expiry = _detail('card_expiry')
+    card_cvv = None  # Not stored; CVVs must not be kept after authorisation
+    card_type = _detail('card_type')
+    card_status = synonym('status')
+    card_date = synonym('date')
+    card_message = synonym('message')
+
+class Bank(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'bank'}
+
+    bank_id = synonym('id')
+    bank_name = _detail('bank_name')
+    bank_branch = _detail('bank_branch')
+    bank_account = synonym('number')
+    bank_status = synonym('status')
+    bank_date = synonym('date')
+    bank_message = synonym('message')
 
 class Wallet(Base):
     __tablename__ = 'wallets'
 
-    wallet_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    wallet_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     wallet_name = Column(String, nullable=False)
     wallet_number = Column(String, nullable=False)
     wallet_status = Column(String, nullable=False)
     wallet_date = Column(DateTime, default=datetime.utcnow, nullable=False)
     wallet_message = Column(String, nullable=True)
-
-class Ussd(Base):
-    __tablename__ = 'ussd'
-
-    ussd_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    ussd_number = Column(String, nullable=False)
-    ussd_status = Column(String, nullable=False)
-    ussd_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    ussd_message = Column(String, nullable=True)
-
-class Qr(Base):
-    __tablename__ = 'qr'
-
-    qr_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    qr_code = Column(String, nullable=False)
-    qr_status = Column(String, nullable=False)
-    qr_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    qr_message = Column(String, nullable=True)
-
-class Pos(Base):
-    __tablename__ = 'pos'
-
-    pos_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    pos_number = Column(String, nullable=False)
-    pos_status = Column(String, nullable=False)
-    pos_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    pos_message = Column(String, nullable=True)
+    wallet_balance = Column(Numeric, default=0, nullable=False)
+    wallet_currency = Column(String, nullable=True)
+    # Full international number, digits only, that USSD sessions sign in with
+    wallet_msisdn = Column(String, nullable=True, unique=True, index=True)
+    wallet_pin_hash = Column(String, nullable=True)
+    wallet_pin_failures = Column(Integer, default=0, nullable=False)
+
+class WalletTransfer(Base):
+    __tablename__ = 'wallet_transfers'
+
+    transfer_id = Column(UUIDKey, primary_key=True, default=new_id)
+    source_wallet_id = Column(UUIDKey, nullable=False)
+    destination_wallet_id = Column(UUIDKey, nullable=False)
+    amount = Column(Numeric, nullable=False)
+    currency = Column(String, nullable=False)
+    transfer_status = Column(String, nullable=False)
+    transfer_date = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    transfer_message = Column(String, nullable=True)
+
+class Ussd(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'ussd'}
+
+    ussd_id = synonym('id')
+    ussd_number = synonym('number')
+    ussd_status = synonym('status')
+    ussd_date = synonym('date')
+    ussd_message = synonym('message')
+
+class Qr(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'qr'}
+
+    qr_id = synonym('id')
+    qr_code = synonym('number')
+    qr_status = synonym('status')
+    qr_date = synonym('date')
+    qr_message = synonym('message')
+
+class Pos(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'pos'}
+
+    pos_id = synonym('id')
+    pos_number = synonym('number')
+    pos_status = synonym('status')
+    pos_date = synonym('date')
+    pos_message = synonym('message')
+
+class CashPayments(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'cash'}
+
+    cashpayment_id = synonym('id')
+    cashpayment_number = synonym('number')
+    cashpayment_status = synonym('status')
+    cashpayment_date = synonym('date')
+    cashpayment_message = synonym('message')
+
+class SnapScan(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'snapscan'}
+
+    snapscan_id = synonym('id')
+    snapscan_number = synonym('number')
+    snapscan_status = synonym('status')
+    snapscan_date = synonym('date')
+    snapscan_message = synonym('message')
+
+class ApplePay(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'applepay'}
+
+    applepay_id = synonym('id')
+    applepay_number = synonym('number')
+    applepay_status = synonym('status')
+    applepay_date = synonym('date')
+    applepay_message = synonym('message')
+
+class GooglePay(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'googlepay'}
+
+    googlepay_id = synonym('id')
+    googlepay_number = synonym('number')
+    googlepay_status = synonym('status')
+    googlepay_date = synonym('date')
+    googlepay_message = synonym('message')
+
+class SamsungPay(PaymentInstrument):
+    __mapper_args__ = {'polymorphic_identity': 'samsungpay'}
+
+    samsungpay_id = synonym('id')
+    samsungpay_number = synonym('number')
+    samsungpay_status = synonym('status')
+    samsungpay_date = synonym('date')
+    samsungpay_message = synonym('message')
 
 class PaymentStatus(str, Enum):
     confirmed = "confirmed"
@@ -328,74 +466,24 @@ class PaymentStatus(str, Enum):
 class MobileMoney(Base):
     __tablename__ = 'mobilemoney'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     payment_status = Column(SQLAlchemyEnum(PaymentStatus), nullable=False)
-    transaction_reference = Column(String, default=lambda: str(uuid4()), nullable=False)
+    transaction_reference = Column(String, default=new_id, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
 
-class CashPayments(Base):
-    __tablename__ = 'cashpayment'
-
-    cashpayment_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    cashpayment_number = Column(String, nullable=False)
-    cashpayment_status = Column(String, nullable=False)
-    cashpayment_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    cashpayment_message = Column(String, nullable=True)
-
-class SnapScan(Base):
-    __tablename__ = 'snapscan'
-
-    snapscan_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    snapscan_number = Column(String, nullable=False)
-    snapscan_status = Column(String, nullable=False)
-    snapscan_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    snapscan_message = Column(String, nullable=True)
-
-class ApplePay(Base):
-    __tablename__ = 'applepay'
-
-    applepay_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    applepay_number = Column(String, nullable=False)
-    applepay_status = Column(String, nullable=False)
-    applepay_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    applepay_message = Column(String, nullable=True)
-
-class GooglePay(Base):
-    __tablename__ = 'googlepay'
-
-    googlepay_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    googlepay_number = Column(String, nullable=False)
-    googlepay_status = Column(String, nullable=False)
-    googlepay_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    googlepay_message = Column(String, nullable=True)
-
-class SamsungPay(Base):
-    __tablename__ = 'samsungpay'
-
-    samsungpay_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    user_id = Column(String, nullable=False)
-    samsungpay_number = Column(String, nullable=False)
-    samsungpay_status = Column(String, nullable=False)
-    samsungpay_date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    samsungpay_message = Column(String, nullable=True)
-
 class BulkCharge(Base):
     __tablename__ = 'bulkcharge'
 
-    bulkcharge_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    bulkcharge_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -406,13 +494,13 @@ class BulkCharge(Base):
 class BulkRefund(Base):
     __tablename__ = 'bulkrefund'
 
-    bulkrefund_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    bulkrefund_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     refund_method = Column(String, nullable=False)
     refund_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -423,13 +511,13 @@ class BulkRefund(Base):
 class BulkDispute(Base):
     __tablename__ = 'bulkdispute'
 
-    bulkdispute_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    bulkdispute_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     dispute_method = Column(String, nullable=False)
     dispute_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -440,13 +528,13 @@ class BulkDispute(Base):
 class SplitPayment(Base):
     __tablename__ = 'splitpayment'
 
-    splitpayment_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    splitpayment_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -457,13 +545,13 @@ class SplitPayment(Base):
 class MultiSplitPayment(Base):
     __tablename__ = 'multisplitpayment'
 
-    multisplitpayment_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    multisplitpayment_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -471,33 +559,73 @@ class MultiSplitPayment(Base):
     multisplitpayment_date = Column(DateTime, default=datetime.utcnow, nullable=False)
     multisplitpayment_message = Column(String, nullable=True)
 
+class SplitAllocation(Base):
+    __tablename__ = 'splitallocation'
+
+    allocation_id = Column(UUIDKey, primary_key=True, default=new_id)
+    split_id = Column(String, nullable=False, index=True)  # splitpayment_id or multisplitpayment_id
+    split_type = Column(String, nullable=False)
+    beneficiary_id = Column(String, nullable=False)
+    amount = Column(MinorUnits, nullable=False)
+    currency = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    date = Column(DateTime, default=datetime.utcnow, nullable=False)
+    money = composite(Money, amount, currency)
+
 class PaymentPlan(Base):
     __tablename__ = 'paymentplan'
 
-    paymentplan_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    paymentplan_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
     message = Column(String, nullable=True)
     paymentplan_date = Column(DateTime, default=datetime.utcnow, nullable=False)
     paymentplan_message = Column(String, nullable=True)
+    # Instalment schedule parameters; the schedule itself is computed, not stored
+    instalment_count = Column(Integer, nullable=True)
+    instalment_frequency = Column(String, nullable=True)
+    instalment_start_date = Column(Date, nullable=True)
+    instalments_materialised = Column(Integer, default=0, nullable=False)
+    next_instalment_date = Column(Date, nullable=True, index=True)  # First instalment not yet materialised
+
+class InstalmentFrequency(str, Enum):
+    daily = "daily"
+    weekly = "weekly"
+    monthly = "monthly"
+
+class PaymentPlanInstalment(Base):
+    __tablename__ = 'paymentplaninstalment'
+    __table_args__ = (
+        Index('ix_paymentplaninstalment_status_due_date', 'status', 'due_date'),
+        Index('ix_paymentplaninstalment_plan_sequence', 'paymentplan_id', 'sequence', unique=True),
+    )
+
+    instalment_id = Column(UUIDKey, primary_key=True, default=new_id)
+    paymentplan_id = Column(String, nullable=False)
+    sequence = Column(Integer, nullable=False)
+    due_date = Column(Date, nullable=False)
+    amount = Column(MinorUnits, nullable=False)
+    currency = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    money = composite(Money, amount, currency)
 
 class DedicatedVirtualAccount(Base):
     __tablename__ = 'dedicatedvirtualaccount'
 
-    dedicatedvirtualaccount_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    dedicatedvirtualaccount_id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -509,14 +637,14 @@ class DedicatedVirtualAccount(Base):
 class PaymentLink(Base):
     __tablename__ = 'paymentlink'
 
-    paymentlink_id= Column(String, primary_key=True, default=lambda: str(uuid4()))
+    paymentlink_id= Column(UUIDKey, primary_key=True, default=new_id)
     paymentlink_url = Column(String, nullable=False)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -527,14 +655,14 @@ class PaymentLink(Base):
 class PaymentRequest(Base):
     __tablename__ = 'paymentrequest'
 
-    paymentrequest_id= Column(String, primary_key=True, default=lambda: str(uuid4()))
+    paymentrequest_id= Column(UUIDKey, primary_key=True, default=new_id)
     paymentrequest_url = Column(String, nullable=False)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
-    account_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
-    payment_reference = Column(String, nullable=False, default=lambda: str(uuid4()))
+    account_reference = Column(String, nullable=False, default=new_id)
+    payment_reference = Column(String, nullable=False, default=new_id)
     payment_method = Column(String, nullable=False)
     payment_gateway_response = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -552,23 +680,185 @@ class PaymentStatus(str, Enum):
 
 class Payments(Base):
     __tablename__ = 'payments'
+    __table_args__ = (
+        Index('ix_payments_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     amount = Column(Numeric, nullable=False)
     currency = Column(String, nullable=False)
-    payment_id = Column(String, default=lambda: str(uuid4()), nullable=False)
-    payment_reference = Column(String, default=lambda: str(uuid4()), nullable=False)
+    payment_id = Column(String, default=new_id, nullable=False, index=True)  # The id clients are given; see nuAPI.sharding.new_payment_id
+    payment_reference = Column(String, default=new_id, nullable=False)
     payment_status = Column(SQLAlchemyEnum(PaymentStatus), nullable=False)
-    transaction_reference = Column(String, default=lambda: str(uuid4()), nullable=False)
+    transaction_reference = Column(String, default=new_id, nullable=False)
     description = Column(String, nullable=True)
-    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    channel = Column(String, nullable=True)  # card, bank_transfer, mpesa, ...
+    merchant_id = Column(String, nullable=True, index=True)
+    card_token = Column(String, nullable=True)
+    change_seq = Column(Integer, nullable=True, index=True)  # Assigned on every write, see nuAPI.changes
+    shard_slot = Column(Integer, nullable=True, index=True)  # Hash slot of user_id, also the last 3 hex digits of id and payment_id, see nuAPI.sharding
+    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
 
 class RecurringPayment(Base):
     __tablename__ = 'recurring_payments'
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=new_id)
     user_id = Column(String, nullable=False)
     recurring_status = Column(String, nullable=False)
     recurring_date = Column(DateTime, nullable=False)
-    recurring_message = Column(String, nullable=True)
\ No newline at end of file
+    recurring_message = Column(String, nullable=True)
+
+class ReconciliationStatus(str, Enum):
+    matched = "matched"
+    amount_mismatch = "amount_mismatch"
+    missing_ours = "missing_ours"
+    missing_theirs = "missing_theirs"
+    duplicate = "duplicate"
+
+class ReconciliationRun(Base):
+    __tablename__ = 'reconciliation_runs'
+
+    run_id = Column(UUIDKey, primary_key=True, default=new_id)
+    provider = Column(String, nullable=False)
+    settlement_date = Column(Date, nullable=False)
+    settlement_file = Column(String, nullable=False)
+    strategy = Column(String, nullable=False)  # hash or sort_merge
+    started_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+    counts = Column(JSON, nullable=True)
+
+class ReconciliationResult(Base):
+    __tablename__ = 'reconciliation_results'
+
+    id = Column(UUIDKey, primary_key=True, default=new_id)
+    run_id = Column(String, nullable=False, index=True)
+    reference = Column(String, nullable=False, index=True)
+    status = Column(SQLAlchemyEnum(ReconciliationStatus), nullable=False)
+    our_amount = Column(MinorUnits, nullable=True)
+    their_amount = Column(MinorUnits, nullable=True)
+    currency = Column(String, nullable=True)
+
+class SmsStatus(str, Enum):
+    pending = "pending"
+    sent = "sent"
+    failed = "failed"
+
+class SmsOutbox(Base):
+    __tablename__ = 'sms_outbox'
+    __table_args__ = (
+        Index('ix_sms_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    id = Column(UUIDKey, primary_key=True, default=new_id)
+    user_id = Column(String, nullable=True)
+    recipient = Column(String, nullable=True)  # Resolved from user_id by the dispatcher when not given
+    message = Column(String, nullable=False)
+    status = Column(String, default=SmsStatus.pending.value, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    provider_message_id = Column(String, nullable=True)
+    last_error = Column(String, nullable=True)
+    claimed_by = Column(String, nullable=True)  # Dispatcher sending it, until claimed_until; see nuAPI.notifications
+    claimed_until = Column(DateTime, nullable=True)
+    sensitive = Column(Boolean, default=False, nullable=False)  # The message is redacted once sent or given up on
+
+class OtpCode(Base):
+    __tablename__ = 'otp_codes'
+
+    phone_number = Column(String, primary_key=True)
+    code_hash = Column(String, nullable=True)  # HMAC-SHA256 of the code, never the code itself; cleared once used
+    expires_at = Column(DateTime, nullable=True)
+    failures = Column(JSON, nullable=False, default=list)  # No longer written; attempts are counted in otp_attempts
+
+class OtpAttempt(Base):
+    __tablename__ = 'otp_attempts'
+    __table_args__ = (
+        Index('ix_otp_attempts_phone_kind_at', 'phone_number', 'kind', 'at'),
+    )
+
+    # Insert-only, so concurrent workers never lose each other's counts
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    phone_number = Column(String, nullable=False)
+    kind = Column(String, nullable=False)  # send or failure
+    at = Column(DateTime, nullable=False, index=True)
+
+class ScreeningHit(Base):
+    __tablename__ = 'screening_hits'
+
+    id = Column(UUIDKey, primary_key=True, default=new_id)
+    subject_type = Column(String, nullable=False)  # kyc or customer
+    subject_id = Column(String, nullable=False, index=True)
+    watchlist_id = Column(String, nullable=False)
+    watchlist_name = Column(String, nullable=False)
+    score = Column(Numeric, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class CardVault(Base):
+    __tablename__ = 'card_vault'
+
+    token = Column(String, primary_key=True)
+    pan_digest = Column(String, nullable=False, unique=True)  # Keyed HMAC of the PAN, for dedup without decrypting
+    pan_ciphertext = Column(LargeBinary, nullable=False)  # AES-GCM nonce + ciphertext
+    bin = Column(String(6), nullable=False, index=True)
+    last4 = Column(String(4), nullable=False)
+    scheme = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class PaymentEvent(Base):
+    __tablename__ = 'payment_events'
+    # Pruning can empty the table; without AUTOINCREMENT SQLite would then
+    # hand out seqs consumers have already passed
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)  # Delivery order
+    event_type = Column(String, nullable=False)  # payment.created, payment.updated, payment.deleted
+    payment_id = Column(String, nullable=False, index=True)
+    user_id = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class ConsumerOffset(Base):
+    __tablename__ = 'consumer_offsets'
+
+    consumer = Column(String, primary_key=True)
+    last_seq = Column(Integer, nullable=False, default=0)  # Highest payment_events.seq delivered
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+class ChangeCounter(Base):
+    __tablename__ = 'change_counters'
+
+    name = Column(String, primary_key=True)  # The table whose change_seq it hands out
+    value = Column(Integer, nullable=False)
+
+class ChangeTombstone(Base):
+    __tablename__ = 'change_tombstones'
+
+    table_name = Column(String, primary_key=True)  # Each table has its own sequence
+    change_seq = Column(Integer, primary_key=True)
+    row_id = Column(String, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class ExportWatermark(Base):
+    __tablename__ = 'export_watermarks'
+
+    source = Column(String, primary_key=True)
+    position = Column(String, nullable=False)  # Last exported change_seq or date, see nuAPI.export
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+class ReplicationHeartbeat(Base):
+    __tablename__ = 'replication_heartbeat'
+
+    id = Column(Integer, primary_key=True)
+    beat_at = Column(Float, nullable=False)  # Unix time written on the primary, see nuAPI.replicas
+
+class ShardSlotRange(Base):
+    __tablename__ = 'shard_slots'
+
+    first_slot = Column(Integer, primary_key=True)
+    last_slot = Column(Integer, nullable=False)
+    shard = Column(Integer, nullable=False)
+    state = Column(String, nullable=False, default="active")  # active, or frozen during the last step of a move
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
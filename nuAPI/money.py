@@ -0,0 +1,230 @@
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from typing import Annotated, Any, Iterable, Optional
+
+from pydantic import BeforeValidator
+from pydantic_core import core_schema
+from sqlalchemy import BigInteger
+from sqlalchemy.types import TypeDecorator
+
+# Minor-unit exponents for models.Currency (cents, kobo, cents, pesewas, ...)
+CURRENCY_EXPONENTS = {
+    "USD": 2,
+    "EUR": 2,
+    "GBP": 2,
+    "NGN": 2,
+    "KES": 2,
+    "GHS": 2,
+    "ZAR": 2,
+}
+
+
+class UnsupportedCurrency(ValueError):
+    pass
+
+
+class CurrencyMismatch(ValueError):
+    pass
+
+
+def currency_exponent(currency: str) -> int:
+    try:
+        return CURRENCY_EXPONENTS[currency]
+    except KeyError:
+        raise UnsupportedCurrency(f"Unsupported currency {currency}")
+
+
+def to_minor(amount: Decimal, currency: str) -> int:
+    return int(amount.scaleb(currency_exponent(currency)).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def from_minor(minor: int, currency: str) -> Decimal:
+    return Decimal(minor).scaleb(-currency_exponent(currency))
+
+
+def parse_minor(text: str, exponent: int) -> int:
+    # "1500.5" -> 150050 without going through Decimal; extra fraction
+    # digits are rounded half up like to_minor
+    whole, _, fraction = text.partition(".")
+    if len(fraction) == exponent and fraction.isdigit():
+        return int(whole + fraction)
+    text = text.strip()
+    negative = text.startswith("-")
+    if negative or text.startswith("+"):
+        text = text[1:]
+    whole, _, fraction = text.partition(".")
+    minor = int(whole or "0") * 10 ** exponent
+    if fraction:
+        if len(fraction) > exponent:
+            minor += int(fraction[:exponent] or "0") + (fraction[exponent] >= "5")
+        else:
+            minor += int(fraction.ljust(exponent, "0"))
+    return -minor if negative else minor
+
+
+def format_minor(minor: int, exponent: int) -> str:
+    # Same text as str() of the quantized Decimal, built with int ops only
+    if not exponent:
+        return str(minor)
+    if minor < 0:
+        return "-" + format_minor(-minor, exponent)
+    whole, fraction = divmod(minor, 10 ** exponent)
+    return "%d.%0*d" % (whole, exponent, fraction)
+
+
+class Money:
+    # Amount as an int in minor units plus its currency; arithmetic and
+    # comparisons are int ops, Decimal only appears at the API/DB boundary.
+    # Models map it onto a MinorUnits column and its currency column with
+    # composite(Money, amount, currency).
+    __slots__ = ("minor", "currency")
+
+    def __init__(self, minor: int, currency: str):
+        self.minor = minor
+        self.currency = currency
+
+    @classmethod
+    def from_decimal(cls, amount: Decimal, currency: str) -> "Money":
+        return cls(to_minor(Decimal(amount), currency), currency)
+
+    def to_decimal(self) -> Decimal:
+        return from_minor(self.minor, self.currency)
+
+    def __composite_values__(self):
+        return self.minor, self.currency
+
+    def __str__(self):
+        return format_minor(self.minor, currency_exponent(self.currency))
+
+    def __repr__(self):
+        return f"Money('{self}', '{self.currency}')"
+
+    def _other_minor(self, other: "Money") -> int:
+        if not isinstance(other, Money):
+            raise TypeError(f"Cannot combine Money and {type(other).__name__}")
+        if other.currency != self.currency:
+            raise CurrencyMismatch(f"Cannot combine {self.currency} and {other.currency}")
+        return other.minor
+
+    def __add__(self, other: "Money") -> "Money":
+        return Money(self.minor + self._other_minor(other), self.currency)
+
+    def __sub__(self, other: "Money") -> "Money":
+        return Money(self.minor - self._other_minor(other), self.currency)
+
+    def __neg__(self) -> "Money":
+        return Money(-self.minor, self.currency)
+
+    def __mul__(self, factor: int) -> "Money":
+        if not isinstance(factor, int):
+            return NotImplemented
+        return Money(self.minor * factor, self.currency)
+
+    __rmul__ = __mul__
+
+    def __bool__(self):
+        return self.minor != 0
+
+    def __eq__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.minor == other.minor and self.currency == other.currency
+
+    def __hash__(self):
+        return hash((self.minor, self.currency))
+
+    # None when other is not Money, so Python falls back and raises TypeError
+    def _compared_minor(self, other) -> Optional[int]:
+        if not isinstance(other, Money):
+            return None
+        if other.currency != self.currency:
+            raise CurrencyMismatch(f"Cannot compare {self.currency} and {other.currency}")
+        return other.minor
+
+    def __lt__(self, other):
+        minor = self._compared_minor(other)
+        return NotImplemented if minor is None else self.minor < minor
+
+    def __le__(self, other):
+        minor = self._compared_minor(other)
+        return NotImplemented if minor is None else self.minor <= minor
+
+    def __gt__(self, other):
+        minor = self._compared_minor(other)
+        return NotImplemented if minor is None else self.minor > minor
+
+    def __ge__(self, other):
+        minor = self._compared_minor(other)
+        return NotImplemented if minor is None else self.minor >= minor
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: Any, handler: Any):
+        # Round-trips as {"amount": ..., "currency": ...}: the amount is a
+        # string in JSON (a Decimal in Python mode), as the Decimal fields are
+        return core_schema.no_info_plain_validator_function(
+            _validate_money,
+            serialization=core_schema.plain_serializer_function_ser_schema(_serialize_money, info_arg=True),
+        )
+
+
+def _validate_money(value: Any) -> Money:
+    if isinstance(value, Money):
+        return value
+    if not (isinstance(value, dict) and "amount" in value and "currency" in value):
+        raise ValueError("Expected Money or an object with amount and currency")
+    if isinstance(value["amount"], bool):
+        raise ValueError("Money amounts must be numbers or numeric strings")
+    try:
+        amount = Decimal(str(value["amount"]))
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount {value['amount']!r}")
+    if not amount.is_finite():
+        raise ValueError(f"Invalid amount {value['amount']!r}")
+    currency = value["currency"]
+    minor = amount.scaleb(currency_exponent(currency))
+    if minor != minor.to_integral_value():
+        raise ValueError(f"{amount} has more decimal places than {currency} allows")
+    return Money(int(minor), currency)
+
+
+def _serialize_money(value: Money, info) -> Any:
+    if info.mode_is_json():
+        return {"amount": str(value), "currency": value.currency}
+    return {"amount": value.to_decimal(), "currency": value.currency}
+
+
+def _money_to_decimal(value: Any) -> Any:
+    return value.to_decimal() if isinstance(value, Money) else value
+
+
+# A Decimal amount field that also takes Money, so responses built from
+# minor units keep the Decimal wire format
+MoneyAmount = Annotated[Decimal, BeforeValidator(_money_to_decimal)]
+
+
+def sum_money(amounts: Iterable[Money], currency: str) -> Money:
+    total = 0
+    for amount in amounts:
+        if amount.currency != currency:
+            raise CurrencyMismatch(f"Cannot combine {currency} and {amount.currency}")
+        total += amount.minor
+    return Money(total, currency)
+
+
+class MinorUnits(TypeDecorator):
+    # BIGINT column holding an amount in minor units; accepts Money or int
+    # and reads back as int, since the currency is another column. Read
+    # Money through the model's composite.
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[Any], dialect) -> Optional[int]:
+        if isinstance(value, bool):
+            raise TypeError("MinorUnits columns take Money or int minor units, not bool")
+        if value is None or isinstance(value, int):
+            return value
+        if isinstance(value, Money):
+            return value.minor
+        raise TypeError(f"MinorUnits columns take Money or int minor units, not {type(value).__name__}")
+
+    def process_result_value(self, value: Optional[int], dialect) -> Optional[int]:
+        return value
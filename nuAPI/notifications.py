@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+from uuid import uuid4
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from nuAPI.models import Customer, SmsOutbox, SmsStatus
+
+# Set to the provider endpoint (or nuAPI.sms_stub's, e.g. http://127.0.0.1:8025/messages) to start sending
+SMS_PROVIDER_URL = None
+SMS_BATCH_SIZE = 100  # messages per provider request
+SMS_RATE_PER_SECOND = 50.0
+MAX_SMS_LENGTH = 459  # three concatenated segments
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = timedelta(seconds=30)
+# A claim is released when its results are saved; one older than this is
+# assumed abandoned (its dispatcher died) and the rows can be taken again
+CLAIM_LEASE = timedelta(minutes=5)
+# What a sensitive message (a one-time code) is replaced with once it has
+# been sent or given up on, so the outbox never keeps it
+REDACTED_MESSAGE = "[redacted]"
+
+# (recipient, text, outbox ids folded into it)
+Message = Tuple[str, str, List[str]]
+# (provider message id, error) per message
+SendResult = Tuple[Optional[str], Optional[str]]
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationError(Exception):
+    pass
+
+
+# Add an SMS to the outbox inside the caller's transaction; nothing is sent inline
+def enqueue_sms(db: Session, message: str, user_id: Optional[str] = None, recipient: Optional[str] = None,
+                sensitive: bool = False) -> SmsOutbox:
+    if user_id is None and recipient is None:
+        raise NotificationError("An SMS needs a user_id or a recipient")
+    sms = SmsOutbox(user_id=user_id, recipient=recipient, message=message, status=SmsStatus.pending.value, attempts=0,
+                    next_attempt_at=datetime.utcnow(), sensitive=sensitive)
+    db.add(sms)
+    return sms
+
+
+def coalesce(rows: Sequence[Tuple[str, str, str]], max_length: int = MAX_SMS_LENGTH) -> List[Message]:
+    # Messages for the same recipient are joined into as few SMS as fit,
+    # keeping each recipient's messages in outbox order
+    by_recipient: "OrderedDict[str, List[Message]]" = OrderedDict()
+    for outbox_id, recipient, text in rows:
+        messages = by_recipient.setdefault(recipient, [])
+        if messages and len(messages[-1][1]) + 1 + len(text) <= max_length:
+            _, joined, ids = messages[-1]
+            ids.append(outbox_id)
+            messages[-1] = (recipient, joined + "\n" + text, ids)
+        else:
+            messages.append((recipient, text, [outbox_id]))
+    return [message for messages in by_recipient.values() for message in messages]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self, count: int = 1):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # A batch larger than the bucket waits for a full bucket and then overdraws it
+            if self.tokens >= min(count, self.capacity):
+                self.tokens -= count
+                return
+            await asyncio.sleep((min(count, self.capacity) - self.tokens) / self.rate)
+
+
+class HttpSmsProvider:
+    # JSON over HTTP: {"messages": [{"to", "text"}]} -> {"results": [{"id"} or {"error"}]}
+    def __init__(self, url: str, batch_size: int = SMS_BATCH_SIZE, timeout: float = 10.0):
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+    def _post(self, messages: Sequence[Tuple[str, str]]) -> List[SendResult]:
+        body = json.dumps({"messages": [{"to": to, "text": text} for to, text in messages]}).encode()
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                results = json.loads(response.read())["results"]
+        except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+            raise NotificationError(f"SMS provider request failed: {e}")
+        if len(results) != len(messages):
+            raise NotificationError("SMS provider returned the wrong number of results")
+        return [(result.get("id"), result.get("error")) for result in results]
+
+    async def send_batch(self, messages: Sequence[Tuple[str, str]]) -> List[SendResult]:
+        return await asyncio.to_thread(self._post, messages)
+
+
+class NotificationDispatcher:
+    def __init__(self, session_factory, provider, rate: float = SMS_RATE_PER_SECOND, claim_size: int = 1000, interval: float = 1.0, retry_backoff: timedelta = RETRY_BACKOFF):
+        self.session_factory = session_factory
+        self.provider = provider
+        self.bucket = TokenBucket(rate)
+        self.claim_size = claim_size
+        self.interval = interval
+        self.retry_backoff = retry_backoff
+        self.worker_id = uuid4().hex
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    # (sendable rows, updates for rows that cannot be sent, attempts so far
+    # and sensitive flag per row)
+    def _load_due(self, now: datetime) -> Tuple[List[Tuple[str, str, str]], List[dict], Dict[str, Tuple[int, bool]]]:
+        db = self.session_factory()
+        try:
+            # Every API worker (and shard) runs a dispatcher: rows are claimed
+            # with a conditional update first, so each is sent by one of them
+            due = (SmsOutbox.status == SmsStatus.pending.value, SmsOutbox.next_attempt_at <= now,
+                   or_(SmsOutbox.claimed_until.is_(None), SmsOutbox.claimed_until < now))
+            ids = [outbox_id for (outbox_id,) in db.query(SmsOutbox.id).filter(*due).order_by(SmsOutbox.next_attempt_at).limit(self.claim_size)]
+            if not ids:
+                return [], [], {}
+            db.query(SmsOutbox).filter(SmsOutbox.id.in_(ids), *due).update(
+                {SmsOutbox.claimed_by: self.worker_id, SmsOutbox.claimed_until: now + CLAIM_LEASE}, synchronize_session=False
+            )
+            db.commit()
+            rows = db.query(SmsOutbox.id, SmsOutbox.user_id, SmsOutbox.recipient, SmsOutbox.message, SmsOutbox.attempts, SmsOutbox.sensitive).filter(
+                SmsOutbox.id.in_(ids), SmsOutbox.claimed_by == self.worker_id, SmsOutbox.status == SmsStatus.pending.value,
+            ).order_by(SmsOutbox.next_attempt_at).all()
+            # Phone numbers for the whole claim in one query
+            user_ids = {row.user_id for row in rows if row.recipient is None}
+            phones: Dict[str, str] = {}
+            if user_ids:
+                phones = dict(db.query(Customer.customer_id, Customer.phone_number).filter(Customer.customer_id.in_(user_ids)).all())
+        finally:
+            db.close()
+        sendable = []
+        unresolved = []
+        for row in rows:
+            recipient = row.recipient or phones.get(row.user_id)
+            if recipient is None:
+                update = {"id": row.id, "status": SmsStatus.failed.value, "attempts": row.attempts + 1, "last_error": "No phone number for user",
+                          "claimed_by": None, "claimed_until": None}
+                if row.sensitive:
+                    update["message"] = REDACTED_MESSAGE
+                unresolved.append(update)
+            else:
+                sendable.append((row.id, recipient, row.message))
+        return sendable, unresolved, {row.id: (row.attempts, row.sensitive) for row in rows}
+
+    def _save(self, updates: List[dict]):
+        db = self.session_factory()
+        try:
+            db.bulk_update_mappings(SmsOutbox, updates)
+            db.commit()
+        finally:
+            db.close()
+
+    def _result_updates(self, message: Message, result: SendResult, attempts: Dict[str, Tuple[int, bool]], now: datetime) -> List[dict]:
+        recipient, _, ids = message
+        provider_id, error = result
+        updates = []
+        for outbox_id in ids:
+            previous, sensitive = attempts[outbox_id]
+            attempt = previous + 1
+            update = {"id": outbox_id, "recipient": recipient, "attempts": attempt, "claimed_by": None, "claimed_until": None}
+            if error is None:
+                update.update(status=SmsStatus.sent.value, sent_at=now, provider_message_id=provider_id, last_error=None)
+            elif attempt >= MAX_ATTEMPTS:
+                update.update(status=SmsStatus.failed.value, last_error=error)
+            else:
+                update.update(next_attempt_at=now + self.retry_backoff * 2 ** (attempt - 1), last_error=error)
+            if sensitive and "status" in update:
+                update["message"] = REDACTED_MESSAGE
+            updates.append(update)
+        return updates
+
+    # Send everything due now; returns the number of outbox rows handled
+    async def dispatch_once(self) -> int:
+        now = datetime.utcnow()
+        rows, updates, attempts = await asyncio.to_thread(self._load_due, now)
+        messages = coalesce(rows)
+        batch_size = self.provider.batch_size
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start:start + batch_size]
+            await self.bucket.acquire(len(batch))
+            try:
+                results = await self.provider.send_batch([(recipient, text) for recipient, text, _ in batch])
+            except NotificationError as e:
+                results = [(None, str(e))] * len(batch)
+            sent_at = datetime.utcnow()
+            for message, result in zip(batch, results):
+                updates.extend(self._result_updates(message, result, attempts, sent_at))
+        if updates:
+            await asyncio.to_thread(self._save, updates)
+        return len(updates)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                handled = await self.dispatch_once()
+            except Exception:
+                logger.exception("Notification dispatch failed")
+                handled = 0
+            if handled < self.claim_size:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    # Safe to call from request threads once enqueued rows are committed
+    def notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+
+# One dispatcher per database holding an SMS outbox: the primary, or each shard
+notification_dispatchers: List[NotificationDispatcher] = []
+
+
+def start_notification_dispatcher(session_factory, url: Optional[str] = None) -> Optional[asyncio.Task]:
+    url = url or SMS_PROVIDER_URL
+    if not url:
+        return None
+    dispatcher = NotificationDispatcher(session_factory, HttpSmsProvider(url))
+    notification_dispatchers.append(dispatcher)
+    return asyncio.get_running_loop().create_task(dispatcher.run())
+
+
+def notify_dispatcher():
+    for dispatcher in notification_dispatchers:
+        dispatcher.notify()
@@ -0,0 +1,234 @@
+# One-time passcodes for 2FA; only HMACs of codes are kept. Without a
+# session the store works from memory alone (one process, benchmarks). With
+# one, as the API calls it, the database is the shared store, so every
+# worker sees the same codes and limits: codes are written to otp_codes when
+# issued and used up there with a conditional update, and sends and failed
+# attempts are counted in otp_attempts. Lockouts a process has seen are
+# kept in memory, so a locked phone is turned away without a query.
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, Optional, Tuple
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from nuAPI.models import OtpAttempt, OtpCode
+
+OTP_LENGTH = 6
+OTP_TTL = 300.0  # seconds
+MAX_VERIFY_ATTEMPTS = 5  # failed verifications per phone per window
+MAX_SENDS = 5  # codes issued per phone per window
+ATTEMPT_WINDOW = 900.0  # seconds
+# The same in every process, so any worker verifies any worker's codes.
+# Unless set here it is read on first use from the NUAPI_OTP_SECRET
+# environment variable or else from the file OTP_SECRET_FILE (or
+# NUAPI_OTP_SECRET_FILE) names; required
+OTP_SECRET: Optional[bytes] = None
+OTP_SECRET_FILE: Optional[str] = None
+MIN_SECRET_LENGTH = 32
+
+logger = logging.getLogger(__name__)
+
+
+class OtpError(Exception):
+    pass
+
+
+class OtpLocked(OtpError):
+    pass
+
+
+def load_otp_secret() -> Optional[bytes]:
+    global OTP_SECRET
+    if OTP_SECRET is None:
+        secret = os.environ.get("NUAPI_OTP_SECRET")
+        path = OTP_SECRET_FILE or os.environ.get("NUAPI_OTP_SECRET_FILE")
+        if not secret and path:
+            with open(path) as f:
+                secret = f.read().strip()
+        if secret:
+            if len(secret) < MIN_SECRET_LENGTH:
+                raise OtpError(f"OTP_SECRET must be at least {MIN_SECRET_LENGTH} characters")
+            OTP_SECRET = secret.encode()
+    return OTP_SECRET
+
+
+class SlidingWindowCounter:
+    # Exact sliding window: the last `limit` event times per key, so a check
+    # is a deque append/popleft whatever the traffic.
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self.events: Dict[str, Deque[float]] = {}
+
+    def _live(self, key: str, now: float) -> Optional[Deque[float]]:
+        events = self.events.get(key)
+        if events is not None:
+            while events and events[0] <= now - self.window:
+                events.popleft()
+            if not events:
+                del self.events[key]
+                return None
+        return events
+
+    def exceeded(self, key: str, now: float) -> bool:
+        events = self._live(key, now)
+        return events is not None and len(events) >= self.limit
+
+    def hit(self, key: str, now: float):
+        events = self._live(key, now)
+        if events is None:
+            events = self.events[key] = deque(maxlen=self.limit)
+        events.append(now)
+
+    def reset(self, key: str):
+        self.events.pop(key, None)
+
+
+def _utc(timestamp: float) -> datetime:
+    return datetime.utcfromtimestamp(timestamp)
+
+
+def _epoch(moment: datetime) -> float:
+    return (moment - datetime(1970, 1, 1)).total_seconds()
+
+
+class OtpStore:
+    # Hashes of live codes keyed by phone number; only the hash is kept, so
+    # a dump of memory or of otp_codes does not reveal codes.
+    def __init__(self, secret: Optional[bytes] = None, ttl: float = OTP_TTL):
+        self._secret = secret
+        self.ttl = ttl
+        self.codes: Dict[str, Tuple[bytes, float]] = {}
+        self.failures = SlidingWindowCounter(MAX_VERIFY_ATTEMPTS, ATTEMPT_WINDOW)
+        self.sends = SlidingWindowCounter(MAX_SENDS, ATTEMPT_WINDOW)
+        self._lock = threading.Lock()
+
+    def require_secret(self) -> bytes:
+        secret = self._secret or load_otp_secret()
+        if not secret:
+            raise OtpError("OTP_SECRET is not configured: set NUAPI_OTP_SECRET or NUAPI_OTP_SECRET_FILE")
+        return secret
+
+    def _digest(self, phone_number: str, code: str) -> bytes:
+        return hmac.new(self.require_secret(), f"{phone_number}:{code}".encode(), hashlib.sha256).digest()
+
+    # The phone's attempts of `kind` inside the window, from otp_attempts into
+    # `counter`; once a phone is locked here, later tries skip the query
+    def _load_attempts(self, db: Session, phone_number: str, kind: str, counter: SlidingWindowCounter, now: float) -> bool:
+        times = [_epoch(at) for (at,) in db.query(OtpAttempt.at).filter(
+            OtpAttempt.phone_number == phone_number, OtpAttempt.kind == kind, OtpAttempt.at > _utc(now - ATTEMPT_WINDOW),
+        ).order_by(OtpAttempt.at.desc()).limit(counter.limit)]
+        with self._lock:
+            counter.reset(phone_number)
+            for at in reversed(times):
+                counter.hit(phone_number, at)
+            return counter.exceeded(phone_number, now)
+
+    # With a session the code and the send are added to it, for the caller
+    # to commit with the SMS that carries the code
+    def issue(self, phone_number: str, db: Optional[Session] = None, now: Optional[float] = None) -> Tuple[str, float]:
+        now = now or time.time()
+        code = str(secrets.randbelow(10 ** OTP_LENGTH)).zfill(OTP_LENGTH)
+        expires = now + self.ttl
+        digest = self._digest(phone_number, code)
+        with self._lock:
+            locked = self.sends.exceeded(phone_number, now)
+        if not locked and db is not None:
+            locked = self._load_attempts(db, phone_number, "send", self.sends, now)
+        if locked:
+            raise OtpLocked("Too many codes requested, try again later")
+        if db is not None:
+            db.add(OtpAttempt(phone_number=phone_number, kind="send", at=_utc(now)))
+            db.merge(OtpCode(phone_number=phone_number, code_hash=digest.hex(), expires_at=_utc(expires), failures=[]))
+        with self._lock:
+            self.sends.hit(phone_number, now)
+            self.codes[phone_number] = (digest, expires)
+        return code, expires
+
+    # Without a session only this process's codes and counts are consulted
+    def verify(self, phone_number: str, code: str, db: Optional[Session] = None, now: Optional[float] = None) -> bool:
+        now = now or time.time()
+        digest = self._digest(phone_number, code)
+        with self._lock:
+            locked = self.failures.exceeded(phone_number, now)
+        if not locked and db is not None:
+            locked = self._load_attempts(db, phone_number, "failure", self.failures, now)
+        if locked:
+            raise OtpLocked("Too many attempts, try again later")
+        if db is not None:
+            return self._verify_shared(db, phone_number, digest, now)
+        with self._lock:
+            entry = self.codes.get(phone_number)
+            if entry is not None and entry[1] > now and hmac.compare_digest(entry[0], digest):
+                # Codes are single use
+                del self.codes[phone_number]
+                self.failures.reset(phone_number)
+                return True
+            self.failures.hit(phone_number, now)
+            return False
+
+    # The code is used up by clearing its hash only if it is still there, so
+    # of two workers verifying it at once exactly one succeeds
+    def _verify_shared(self, db: Session, phone_number: str, digest: bytes, now: float) -> bool:
+        used = db.execute(update(OtpCode).where(
+            OtpCode.phone_number == phone_number, OtpCode.code_hash == digest.hex(), OtpCode.expires_at > _utc(now),
+        ).values(code_hash=None, expires_at=None)).rowcount == 1
+        if used:
+            db.query(OtpAttempt).filter(OtpAttempt.phone_number == phone_number, OtpAttempt.kind == "failure").delete(synchronize_session=False)
+        else:
+            db.add(OtpAttempt(phone_number=phone_number, kind="failure", at=_utc(now)))
+        db.commit()
+        with self._lock:
+            if used:
+                self.codes.pop(phone_number, None)
+                self.failures.reset(phone_number)
+            else:
+                self.failures.hit(phone_number, now)
+        return used
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = now or time.time()
+        with self._lock:
+            expired = [phone for phone, (_, expires) in self.codes.items() if expires <= now]
+            for phone in expired:
+                del self.codes[phone]
+        return len(expired)
+
+    # Used and expired codes, and attempts older than the window
+    def purge(self, db: Session, now: Optional[float] = None) -> int:
+        now = now or time.time()
+        deleted = db.query(OtpCode).filter((OtpCode.expires_at <= _utc(now)) | OtpCode.code_hash.is_(None)).delete(synchronize_session=False)
+        deleted += db.query(OtpAttempt).filter(OtpAttempt.at <= _utc(now - ATTEMPT_WINDOW)).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+
+otp_store = OtpStore()
+
+
+def start_sweep_worker(session_factory, interval: float = 60.0) -> threading.Thread:
+    def run():
+        while True:
+            time.sleep(interval)
+            otp_store.sweep()
+            db = session_factory()
+            try:
+                otp_store.purge(db)
+            except Exception:
+                logger.exception("OTP purge failed")
+            finally:
+                db.close()
+
+    # Refuse to start rather than hash codes under a key no other process has
+    otp_store.require_secret()
+    worker = threading.Thread(target=run, name="otp-sweep", daemon=True)
+    worker.start()
+    return worker
@@ -1,6 +1,6 @@
 from fastapi import FastAPI
-from typing import List
-from pydantic import BaseModel, Field, Optional, constr, condecimal
+from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field, constr, condecimal
 import uuid
 from uuid import UUID, uuid4 
 import random
@@ -38,6 +38,8 @@ class Payments(Base):
 
 
 class PaymentResponse(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     payment: Payments
     status: PaymentStatus
     message: Optional[str]= None
@@ -55,9 +57,9 @@ class CardPaymentRequest(BaseModel):
     amount: Decimal
     currency: str
     customer_name: str
-    card_number: str = Field(..., min_length=16, max_length=19, regex=r'^\d{16,19}$')
-    card_expiry: str = Field(..., min_length= 3, max_length=5, regex=r'^\/d{0[1-9]2[2-6]}$')
-    cvv: str = Field(..., min_length=3, max_length=4, regex=r'^\d{3,4}$')
+    card_number: str = Field(..., min_length=16, max_length=19, pattern=r'^\d{16,19}$')
+    card_expiry: str = Field(..., min_length= 3, max_length=5, pattern=r'^(0[1-9]|1[0-2])/\d{2}$')
+    cvv: str = Field(..., min_length=3, max_length=4, pattern=r'^\d{3,4}$')
     status: PaymentStatus
     transaction_reference: uuid.UUID
 
@@ -65,7 +67,7 @@ class CardPaymentRequest(BaseModel):
 class CardPaymentResponse(BaseModel):
     card_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_payment(payment_request: CardPaymentRequest) -> CardPaymentResponse:
     card_payment_id : UUID = uuid4()
@@ -121,7 +123,7 @@ class BankTransferRequest(BaseModel):
 class BankTransferResponse(BaseModel):
     transfer_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_transfer(transfer_request: BankTransferRequest) -> BankTransferResponse:
     transfer_id: UUID = uuid4()
@@ -148,7 +150,7 @@ class WalletPaymentRequest(BaseModel):
 class WalletPaymentResponse(BaseModel):
     wallet_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_wallet_payment(wallet_request: WalletPaymentRequest) -> WalletPaymentResponse:
     wallet_payment_id: UUID = uuid4()
@@ -175,7 +177,7 @@ class WalletTransferRequest(BaseModel):
 class WalletTransferResponse(BaseModel):
     transfer_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_wallet_transfer(transfer_request: WalletTransferRequest) -> WalletTransferResponse:
     transfer_id: UUID = uuid4()
@@ -200,7 +202,7 @@ class QrPaymentRequest(BaseModel):
 class QrPaymentResponse(BaseModel):
     qr_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 
 def process_qr_payment(qr_request: QrPaymentRequest) -> QrPaymentResponse:
@@ -226,7 +228,7 @@ class PosPaymentRequest(BaseModel):
 class PosPaymentResponse(BaseModel):
     pos_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_pos_payment(pos_request: PosPaymentRequest) -> PosPaymentResponse:
     pos_payment_id: UUID = uuid4()
@@ -251,7 +253,7 @@ class BankPaymentRequest(BaseModel):
 class BankPaymentResponse(BaseModel):
     bank_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow  
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_bank_payment(bank_request: BankPaymentRequest) -> BankPaymentResponse:
     bank_payment_id: UUID = uuid4()
@@ -277,7 +279,7 @@ class LinkPaymentRequest(BaseModel):
 class LinkPaymentResponse(BaseModel):
     link_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_link_payment(link_request: LinkPaymentRequest) -> LinkPaymentResponse:
     link_payment_id: UUID = uuid4()
@@ -303,7 +305,7 @@ class MobileMoneyPaymentRequest(BaseModel):
 class MobileMoneyPaymentResponse(BaseModel):
     mobile_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_mobile_money_payment(mobile_request: MobileMoneyPaymentRequest) -> MobileMoneyPaymentResponse:
     mobile_payment_id: UUID = uuid4()
@@ -329,7 +331,7 @@ class MpesaPaymentRequest(BaseModel):
 class MpesaPaymentResponse(BaseModel):
     mpesa_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_mpesa_payment(mpesa_request: MpesaPaymentRequest) -> MpesaPaymentResponse:
     mpesa_payment_id: UUID = uuid4()
@@ -354,7 +356,7 @@ class AirtelMoneyPaymentRequest(BaseModel):
 class AirtelMoneyPaymentResponse(BaseModel):
     airtel_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_airtel_money_payment(airtel_request: AirtelMoneyPaymentRequest) -> AirtelMoneyPaymentResponse:
     airtel_payment_id: UUID = uuid4()
@@ -379,7 +381,7 @@ class VodafoneCashPaymentRequest(BaseModel):
 class VodafoneCashPaymentResponse(BaseModel):
     vodafone_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_vodafone_cash_payment(vodafone_request: VodafoneCashPaymentRequest) -> VodafoneCashPaymentResponse:
     vodafone_payment_id: UUID = uuid4()
@@ -404,7 +406,7 @@ class TigoCashPaymentRequest(BaseModel):
 class TigoCashPaymentResponse(BaseModel):
     tigo_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_tigo_cash_payment(tigo_request: TigoCashPaymentRequest) -> TigoCashPaymentResponse:
     tigo_payment_id: UUID = uuid4()
@@ -431,7 +433,7 @@ class EFTPaymentRequest(BaseModel):
 class EFTPaymentResponse(BaseModel):
     eft_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_eft_payment(eft_request: EFTPaymentRequest) -> EFTPaymentResponse:
     eft_payment_id: UUID = uuid4()
@@ -456,7 +458,7 @@ class SnapScanPaymentRequest(BaseModel):
 class SnapScanPaymentResponse(BaseModel):
     snapscan_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_snapscan_payment(snapscan_request: SnapScanPaymentRequest) -> SnapScanPaymentResponse:
     snapscan_payment_id: UUID = uuid4()
@@ -573,7 +575,7 @@ class SamsungPayPaymentRequest(BaseModel):
 class SamsungPayPaymentResponse(BaseModel):
     samsungpay_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_samsungpay_payment(samsungpay_request: SamsungPayPaymentRequest) -> SamsungPayPaymentResponse:
     samsungpay_payment_id: UUID = uuid4()
@@ -598,7 +600,7 @@ class AirtelTigoMoneyPaymentRequest(BaseModel):
 class AirtelTigoMoneyPaymentResponse(BaseModel):
     airteltigo_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_airteltigo_money_payment(airteltigo_request: AirtelTigoMoneyPaymentRequest) -> AirtelTigoMoneyPaymentResponse:
     airteltigo_payment_id: UUID = uuid4()
@@ -623,7 +625,7 @@ class MTNMobileMoneyPaymentRequest(BaseModel):
 class MTNMobileMoneyPaymentResponse(BaseModel):
     mtn_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_mtn_mobile_money_payment(mtn_request: MTNMobileMoneyPaymentRequest) -> MTNMobileMoneyPaymentResponse:
     mtn_payment_id: UUID = uuid4()
@@ -648,7 +650,7 @@ class VodafoneMobileMoneyPaymentRequest(BaseModel):
 class VodafoneMobileMoneyPaymentResponse(BaseModel):
     vodafone_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 def process_vodafone_mobile_money_payment(vodafone_request: VodafoneMobileMoneyPaymentRequest) -> VodafoneMobileMoneyPaymentResponse:
     vodafone_payment_id: UUID = uuid4()
@@ -674,6 +676,6 @@ class DedicatedVirtualAccountRequest(BaseModel):
 class DedicatedVirtualAccountResponse(BaseModel):
     virtual_payment_id: UUID = uuid4()
     status: PaymentStatus
-    timestamp: datetime.utcnow
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 
@@ -0,0 +1,265 @@
+import abc
+import math
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import jwt
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+from nuAPI.auth import ALGORITHM, SECRET_KEY
+
+# (tokens per second, burst) for each kind of caller
+RATE_LIMITS = {
+    "user": (10.0, 20),
+    "merchant": (100.0, 200),
+    "ip": (30.0, 60),
+}
+# Routes with their own budgets, keyed by the first path segment; kinds not
+# listed fall back to RATE_LIMITS
+ROUTE_LIMITS = {
+    "/card-payments": {"user": (5.0, 10)},
+    "/2fa": {"ip": (1.0, 5), "user": (1.0, 5)},
+    "/ussd": {"ip": (500.0, 1000)},  # every hop arrives from the aggregator's gateway
+}
+MAX_BUCKETS = 200_000
+# Path to a sqlite file shared by the workers on one host; None keeps buckets in process
+RATE_LIMIT_DB = None
+# Claim of a verified bearer token naming the merchant the caller acts for.
+# Headers are the client's say-so, so a merchant bucket is never keyed on one.
+MERCHANT_CLAIM = "merchant_id"
+
+# (key, seconds per token, seconds of burst), i.e. (key, 1 / rate, burst / rate)
+Bucket = Tuple[str, float, float]
+
+
+class RateLimitBackend(abc.ABC):
+    # Backends that wait on I/O are called from a worker thread, not the event loop
+    blocking = False
+
+    # Charge one token to every bucket, or to none of them. Returns 0.0 when
+    # allowed, otherwise the seconds until all of them would allow it.
+    @abc.abstractmethod
+    def take(self, buckets: Sequence[Bucket], now: float) -> float:
+        raise NotImplementedError
+
+
+# A bucket is stored as the time it will be full again: its level is
+# burst - (full_at - now) * rate, so refill needs no timer or writes.
+# Returns the new full_at and how far over the burst taking a token goes.
+def _charge(full_at: float, now: float, interval: float, tolerance: float) -> Tuple[float, float]:
+    if full_at < now:
+        full_at = now
+    full_at += interval
+    return full_at, full_at - now - tolerance
+
+
+class LocalBackend(RateLimitBackend):
+    # One double per key in a flat array; slots of buckets that have refilled
+    # completely are recycled, since a full bucket is the same as no bucket.
+    # The table never holds more than max_buckets: past that the least
+    # recently used buckets go, and their callers start again from full.
+    def __init__(self, max_buckets: int = MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.slots: "OrderedDict[str, int]" = OrderedDict()
+        self.full_at = array("d")
+        self._free: List[int] = []
+        self._lock = threading.Lock()
+
+    def _slot(self, key: str) -> int:
+        slot = self.slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self.full_at[slot] = 0.0
+            else:
+                slot = len(self.full_at)
+                self.full_at.append(0.0)
+            self.slots[key] = slot
+        return slot
+
+    def _evict(self, now: float):
+        full = [key for key, slot in self.slots.items() if self.full_at[slot] <= now]
+        for key in full:
+            self._free.append(self.slots.pop(key))
+        # Mostly live buckets: drop the least recently used too, freeing a
+        # quarter of the table so it is not rescanned on every new key
+        for _ in range(min(len(self.slots), max(1, self.max_buckets // 4) - len(full))):
+            self._free.append(self.slots.popitem(last=False)[1])
+
+    def take(self, buckets: Sequence[Bucket], now: float) -> float:
+        with self._lock:
+            slots = self.slots
+            # Room made before charging, so no bucket of this call is evicted mid-way
+            if len(slots) + len(buckets) > self.max_buckets and len(self._free) < len(buckets):
+                self._evict(now)
+            table = self.full_at
+            charged = []
+            wait = 0.0
+            for key, interval, tolerance in buckets:
+                slot = slots.get(key)
+                if slot is None:
+                    slot = self._slot(key)
+                else:
+                    slots.move_to_end(key)
+                full_at, over = _charge(table[slot], now, interval, tolerance)
+                if over > wait:
+                    wait = over
+                charged.append((slot, full_at))
+            if wait:
+                return wait
+            for slot, full_at in charged:
+                table[slot] = full_at
+        return 0.0
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class SqliteBackend(RateLimitBackend):
+    # Local stand-in for a shared store (Redis and the like) so several
+    # workers on one host draw from the same buckets
+    blocking = True
+
+    def __init__(self, path: str, purge_interval: float = 5.0):
+        self.path = path
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._local = threading.local()
+        self._connection().execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, full_at REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            # Buckets are disposable, so skip the fsync on every decision
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+        return connection
+
+    def take(self, buckets: Sequence[Bucket], now: float) -> float:
+        connection = self._connection()
+        keys = [key for key, _, _ in buckets]
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            stored = dict(connection.execute(
+                f"SELECT key, full_at FROM rate_buckets WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchall())
+            charged = []
+            wait = 0.0
+            for key, interval, tolerance in buckets:
+                full_at, over = _charge(stored.get(key, 0.0), now, interval, tolerance)
+                if over > wait:
+                    wait = over
+                charged.append((key, full_at))
+            if not wait:
+                connection.executemany("INSERT OR REPLACE INTO rate_buckets VALUES (?, ?)", charged)
+            if now >= self._next_purge:
+                self._next_purge = now + self.purge_interval
+                connection.execute("DELETE FROM rate_buckets WHERE full_at <= ?", (now,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+
+def rate_limit_backend(path: Optional[str] = None) -> RateLimitBackend:
+    path = path or RATE_LIMIT_DB
+    return SqliteBackend(path) if path else LocalBackend()
+
+
+# The user and merchant an Authorization header's bearer token belongs to,
+# or Nones if it does not verify. Cached on the raw header so a client's
+# repeated calls cost a dict lookup rather than an HMAC.
+@lru_cache(maxsize=65536)
+def _bearer_subject(authorization: bytes) -> Tuple[Optional[str], Optional[str], float]:
+    scheme, _, token = authorization.decode("latin-1").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None, None, 0.0
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        return None, None, 0.0
+    merchant_id = payload.get(MERCHANT_CLAIM)
+    return payload.get("sub"), str(merchant_id) if merchant_id else None, float(payload.get("exp", math.inf))
+
+
+def token_user(authorization: bytes, now: float) -> Optional[str]:
+    user_id, _, expires = _bearer_subject(authorization)
+    return user_id if expires > now else None
+
+
+def token_callers(authorization: bytes, now: float) -> Tuple[Optional[str], Optional[str]]:
+    user_id, merchant_id, expires = _bearer_subject(authorization)
+    return (user_id, merchant_id) if expires > now else (None, None)
+
+
+class RateLimiter:
+    def __init__(self, backend: Optional[RateLimitBackend] = None, limits=None, route_limits=None):
+        self.backend = backend or rate_limit_backend()
+        self.limits = limits or RATE_LIMITS
+        self.route_limits = route_limits or ROUTE_LIMITS
+        self._plans: Dict[str, Tuple[str, Dict[str, Tuple[float, float]]]] = {}
+
+    # Bucket namespace and (interval, tolerance) per kind for a route, worked
+    # out once per path segment
+    def _plan(self, path: str) -> Tuple[str, Dict[str, Tuple[float, float]]]:
+        segment = "/" + path.split("/", 2)[1]
+        plan = self._plans.get(segment)
+        if plan is None:
+            overrides = self.route_limits.get(segment)
+            limits = {**self.limits, **(overrides or {})}
+            plan = (segment if overrides else "*", {kind: (1.0 / rate, burst / rate) for kind, (rate, burst) in limits.items()})
+            if len(self._plans) < 1024:
+                self._plans[segment] = plan
+        return plan
+
+    def callers(self, scope, now: float) -> Dict[str, str]:
+        callers = {}
+        client = scope.get("client")
+        if client:
+            callers["ip"] = client[0]
+        for name, value in scope.get("headers", ()):
+            if name == b"authorization":
+                user_id, merchant_id = token_callers(value, now)
+                if user_id:
+                    callers["user"] = user_id
+                if merchant_id:
+                    callers["merchant"] = merchant_id
+        return callers
+
+    def check(self, scope, now: Optional[float] = None) -> float:
+        now = now or time.time()
+        namespace, limits = self._plan(scope["path"])
+        buckets = [
+            (f"{kind}:{namespace}:{caller}", *limits[kind])
+            for kind, caller in self.callers(scope, now).items() if kind in limits
+        ]
+        return self.backend.take(buckets, now) if buckets else 0.0
+
+
+class RateLimitMiddleware:
+    # Plain ASGI so an allowed request costs one backend call and nothing else
+    def __init__(self, app, limiter: Optional[RateLimiter] = None):
+        self.app = app
+        self.limiter = limiter or RateLimiter()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            if self.limiter.backend.blocking:
+                wait = await run_in_threadpool(self.limiter.check, scope)
+            else:
+                wait = self.limiter.check(scope)
+            if wait:
+                response = JSONResponse(
+                    {"detail": "Too many requests"}, status_code=429, headers={"Retry-After": str(math.ceil(wait))}
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
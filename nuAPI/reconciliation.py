@@ -0,0 +1,366 @@
+import csv
+import heapq
+import os
+import pickle
+import tempfile
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import String, cast, func, or_, select
+from sqlalchemy.orm import Session
+
+from nuAPI import sharding
+from nuAPI.models import Payments, ReconciliationResult, ReconciliationRun, ReconciliationStatus, Transaction
+from nuAPI.money import currency_exponent, parse_minor
+
+# (reference, amount in minor units, currency)
+SettlementRow = Tuple[str, int, str]
+
+DEFAULT_CHUNK_SIZE = 100_000
+# Above this many of our references for the day, fall back to sort-merge
+MAX_INDEX_ENTRIES = 10_000_000
+
+
+class ReconciliationError(Exception):
+    pass
+
+
+# Parse a settlement CSV in fixed-size chunks so memory stays flat for large files
+def read_settlement_chunks(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, reference_column: str = "reference", amount_column: str = "amount", currency_column: str = "currency") -> Iterator[List[SettlementRow]]:
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        reference_index = header.index(reference_column)
+        amount_index = header.index(amount_column)
+        currency_index = header.index(currency_column)
+        exponents: Dict[str, int] = {}
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                return
+            chunk = []
+            for row in rows:
+                currency = row[currency_index]
+                exponent = exponents.get(currency)
+                if exponent is None:
+                    exponent = exponents[currency] = currency_exponent(currency)
+                chunk.append((row[reference_index], parse_minor(row[amount_index], exponent), currency))
+            yield chunk
+
+
+def _day_bounds(settlement_date: date) -> Tuple[datetime, datetime]:
+    start = datetime.combine(settlement_date, time.min)
+    return start, start + timedelta(days=1)
+
+
+# Where payments are kept, as (session, filter): the primary, or with
+# sharding on every shard, each counting only the slots the map gives it so
+# rows caught mid-move on two shards are counted once
+def payment_sources(db: Session) -> List[Tuple[Session, list]]:
+    router = sharding.shard_router
+    if router is None:
+        return [(db, [])]
+    sources = []
+    for shard in range(len(router.shard_factories)):
+        owned = [Payments.shard_slot.between(first, last) for first, last, owner, _ in router.map.ranges if owner == shard]
+        sources.append((router.session(shard), [or_(Payments.shard_slot.is_(None), *owned)]))
+    return sources
+
+
+# The database sorts references as Python compares them, by code point
+# (UTF-8 byte order), or the merge joins below would pass over matches
+def _by_code_point(db: Session, column):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return column.collate("C")
+    if dialect == "mysql":
+        return column.collate("utf8mb4_bin")
+    return column  # SQLite's default BINARY collation already does
+
+
+def _ascending(rows: Iterator[tuple]) -> Iterator[tuple]:
+    previous = None
+    for row in rows:
+        if previous is not None and row[0] < previous:
+            raise ReconciliationError(f"References came back out of order: {row[0]!r} after {previous!r}")
+        previous = row[0]
+        yield row
+
+
+def _count_our_entries(db: Session, payments: List[Tuple[Session, list]], start: datetime, end: datetime) -> int:
+    payment_count = sum(
+        payment_db.query(func.count(Payments.id)).filter(Payments.timestamp >= start, Payments.timestamp < end, *where).scalar()
+        for payment_db, where in payments
+    )
+    transactions = db.query(func.count(Transaction.transaction_id)).filter(Transaction.date >= start, Transaction.date < end).scalar()
+    return payment_count + transactions
+
+
+def _stream(db: Session, statement) -> Iterator[tuple]:
+    # Core rows, not ORM entities; amounts come back as text so they reach
+    # minor units without a float or Decimal round trip
+    exponents: Dict[str, int] = {}
+    for row in db.execute(statement.execution_options(yield_per=DEFAULT_CHUNK_SIZE)):
+        currency = row[-1]
+        exponent = exponents.get(currency)
+        if exponent is None:
+            exponent = exponents[currency] = currency_exponent(currency)
+        yield row[:-2], parse_minor(row[-2], exponent), currency
+
+
+def _our_entries(db: Session, payments: List[Tuple[Session, list]], start: datetime, end: datetime) -> Iterator[Tuple[Tuple[str, ...], int, str]]:
+    # A payment can be quoted by either of its references
+    for payment_db, where in payments:
+        yield from _stream(payment_db, select(
+            Payments.transaction_reference, Payments.payment_reference, cast(Payments.amount, String), Payments.currency
+        ).where(Payments.timestamp >= start, Payments.timestamp < end, *where))
+    yield from _stream(db, select(
+        Transaction.payment_reference, cast(Transaction.amount, String), Transaction.currency
+    ).where(Transaction.date >= start, Transaction.date < end))
+
+
+def _our_keys_sorted(db: Session, payments: List[Tuple[Session, list]], start: datetime, end: datetime) -> Iterator[Tuple[str, int, str, int, str]]:
+    # (reference, kind, primary reference, amount, currency) for every
+    # reference our entries can be quoted by, in reference order. kind is 0
+    # for payments (quoted by either reference) and 1 for transactions. Equal
+    # references come out payments first, so the last one owns the
+    # reference, as the last write does in the hash index.
+    streams = [
+        (payment_db, 0, select(column, Payments.transaction_reference.label("primary"), cast(Payments.amount, String), Payments.currency)
+         .where(Payments.timestamp >= start, Payments.timestamp < end, *where).order_by(_by_code_point(payment_db, column)))
+        for column in (Payments.transaction_reference, Payments.payment_reference)
+        for payment_db, where in payments
+    ]
+    streams.append(
+        (db, 1, select(Transaction.payment_reference, Transaction.payment_reference.label("primary"), cast(Transaction.amount, String), Transaction.currency)
+         .where(Transaction.date >= start, Transaction.date < end).order_by(_by_code_point(db, Transaction.payment_reference)))
+    )
+    return heapq.merge(*(_ascending(_keyed(session, kind, statement)) for session, kind, statement in streams), key=itemgetter(0))
+
+
+def _keyed(db: Session, kind: int, statement) -> Iterator[Tuple[str, int, str, int, str]]:
+    for (reference, primary), amount, currency in _stream(db, statement):
+        yield reference, kind, primary, amount, currency
+
+
+def _our_entries_sorted(db: Session, payments: List[Tuple[Session, list]], start: datetime, end: datetime) -> Iterator[Tuple[str, int, int, str]]:
+    # (primary reference, kind, amount, currency), one per entry
+    streams = [
+        _stream(payment_db, select(Payments.transaction_reference, cast(Payments.amount, String), Payments.currency)
+                .where(Payments.timestamp >= start, Payments.timestamp < end, *where)
+                .order_by(_by_code_point(payment_db, Payments.transaction_reference)))
+        for payment_db, where in payments
+    ]
+    transactions = _stream(db, select(
+        Transaction.payment_reference, cast(Transaction.amount, String), Transaction.currency
+    ).where(Transaction.date >= start, Transaction.date < end).order_by(_by_code_point(db, Transaction.payment_reference)))
+    return heapq.merge(
+        *(_ascending((refs[0], 0, amount, currency) for refs, amount, currency in stream) for stream in streams),
+        _ascending((refs[0], 1, amount, currency) for refs, amount, currency in transactions),
+        key=itemgetter(0, 1),
+    )
+
+
+class _ResultWriter:
+    def __init__(self, db: Session, run_id: str, store_matched: bool, batch_size: int):
+        self.db = db
+        self.run_id = run_id
+        self.store_matched = store_matched
+        self.batch_size = batch_size
+        self.rows: List[dict] = []
+        self.counts = {status.value: 0 for status in ReconciliationStatus}
+
+    def add(self, status: ReconciliationStatus, reference: str, our_amount: Optional[int], their_amount: Optional[int], currency: Optional[str]):
+        self.counts[status.value] += 1
+        if status is ReconciliationStatus.matched and not self.store_matched:
+            return
+        self.rows.append({
+            "run_id": self.run_id,
+            "reference": reference,
+            "status": status,
+            "our_amount": our_amount,
+            "their_amount": their_amount,
+            "currency": currency,
+        })
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.db.execute(ReconciliationResult.__table__.insert(), self.rows)
+            self.rows = []
+
+
+def _reconcile_hash(db: Session, payments: List[Tuple[Session, list]], start: datetime, end: datetime, chunks: Iterator[List[SettlementRow]],
+                    writer: _ResultWriter):
+    references: List[str] = []
+    amounts: List[int] = []
+    currencies: List[str] = []
+    index: Dict[str, int] = {}
+    for refs, amount, currency in _our_entries(db, payments, start, end):
+        position = len(amounts)
+        references.append(refs[0])
+        amounts.append(amount)
+        currencies.append(currency)
+        for reference in refs:
+            index[reference] = position
+    matched = bytearray(len(amounts))
+    store_matched = writer.store_matched
+    matched_count = 0
+
+    for chunk in chunks:
+        for reference, their_amount, currency in chunk:
+            position = index.get(reference)
+            if position is None:
+                writer.add(ReconciliationStatus.missing_ours, reference, None, their_amount, currency)
+            elif matched[position]:
+                writer.add(ReconciliationStatus.duplicate, reference, amounts[position], their_amount, currency)
+            else:
+                matched[position] = 1
+                our_amount = amounts[position]
+                if our_amount == their_amount and currencies[position] == currency:
+                    if store_matched:
+                        writer.add(ReconciliationStatus.matched, reference, our_amount, their_amount, currency)
+                    else:
+                        matched_count += 1
+                else:
+                    writer.add(ReconciliationStatus.amount_mismatch, reference, our_amount, their_amount, currency)
+
+    writer.counts[ReconciliationStatus.matched.value] += matched_count
+
+    position = matched.find(0)
+    while position != -1:
+        writer.add(ReconciliationStatus.missing_theirs, references[position], amounts[position], None, currencies[position])
+        position = matched.find(0, position + 1)
+
+
+def _write_run(rows: list, path: str):
+    with open(path, "wb") as f:
+        for start in range(0, len(rows), 10_000):
+            pickle.dump(rows[start:start + 10_000], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _sorted_runs(chunks: Iterator[List[SettlementRow]], directory: str) -> List[str]:
+    # Each file row becomes (reference, amount, currency, line number)
+    paths = []
+    line = 0
+    for number, chunk in enumerate(chunks):
+        rows = [(reference, amount, currency, line + offset) for offset, (reference, amount, currency) in enumerate(chunk)]
+        line += len(chunk)
+        rows.sort(key=itemgetter(0))
+        path = os.path.join(directory, f"run-{number}.pickle")
+        _write_run(rows, path)
+        paths.append(path)
+    return paths
+
+
+def _read_run(path: str) -> Iterator[tuple]:
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+
+def _reconcile_sort_merge(db: Session, payments: List[Tuple[Session, list]], start: datetime, end: datetime, chunks: Iterator[List[SettlementRow]],
+                          writer: _ResultWriter):
+    # External sort of the file into sorted runs, then two merge joins with
+    # memory bounded by one chunk. The first joins the file against every
+    # reference of ours and turns each hit into a claim on the entry that
+    # reference belongs to; the claims are spilled in runs sorted by entry.
+    # The second walks our entries against their claims: the claim earliest
+    # in the file matches (or mismatches), later ones are duplicates, and an
+    # entry with no claim is missing theirs. Same outcome as the hash join.
+    with tempfile.TemporaryDirectory(prefix="reconciliation-") as directory:
+        theirs = heapq.merge(*(_read_run(path) for path in _sorted_runs(chunks, directory)), key=itemgetter(0))
+        ours = _our_keys_sorted(db, payments, start, end)
+        our_row = next(ours, None)
+        owner_reference = owner = None
+        claims: List[tuple] = []
+        claim_runs: List[str] = []
+
+        def spill():
+            claims.sort()
+            path = os.path.join(directory, f"claims-{len(claim_runs)}.pickle")
+            _write_run(claims, path)
+            claim_runs.append(path)
+            claims.clear()
+
+        for reference, their_amount, currency, line in theirs:
+            if reference != owner_reference:
+                while our_row is not None and our_row[0] < reference:
+                    our_row = next(ours, None)
+                owner = None
+                while our_row is not None and our_row[0] == reference:
+                    owner = our_row
+                    our_row = next(ours, None)
+                owner_reference = reference
+            if owner is None:
+                writer.add(ReconciliationStatus.missing_ours, reference, None, their_amount, currency)
+                continue
+            claims.append((owner[2], owner[1], line, reference, their_amount, currency))
+            if len(claims) >= writer.batch_size:
+                spill()
+        if claims:
+            spill()
+
+        claimed = heapq.merge(*(_read_run(path) for path in claim_runs))
+        claim = next(claimed, None)
+        for primary, kind, our_amount, our_currency in _our_entries_sorted(db, payments, start, end):
+            while claim is not None and claim[:2] < (primary, kind):
+                claim = next(claimed, None)
+            if claim is None or claim[:2] != (primary, kind):
+                writer.add(ReconciliationStatus.missing_theirs, primary, our_amount, None, our_currency)
+                continue
+            _, _, _, reference, their_amount, currency = claim
+            if our_amount == their_amount and our_currency == currency:
+                writer.add(ReconciliationStatus.matched, reference, our_amount, their_amount, currency)
+            else:
+                writer.add(ReconciliationStatus.amount_mismatch, reference, our_amount, their_amount, currency)
+            claim = next(claimed, None)
+            while claim is not None and claim[:2] == (primary, kind):
+                writer.add(ReconciliationStatus.duplicate, claim[3], our_amount, claim[4], claim[5])
+                claim = next(claimed, None)
+
+
+# Reconcile one provider settlement file against the day's payments, on
+# every shard if sharded, and transactions
+def reconcile_settlement_file(db: Session, path: str, settlement_date: date, provider: str, chunk_size: int = DEFAULT_CHUNK_SIZE, max_index_entries: int = MAX_INDEX_ENTRIES, store_matched: bool = False, **columns) -> ReconciliationRun:
+    start, end = _day_bounds(settlement_date)
+    payments = payment_sources(db)
+    try:
+        return _reconcile(db, payments, path, settlement_date, provider, start, end, chunk_size, max_index_entries, store_matched, columns)
+    finally:
+        for payment_db, _ in payments:
+            if payment_db is not db:
+                payment_db.close()
+
+
+def _reconcile(db: Session, payments: List[Tuple[Session, list]], path: str, settlement_date: date, provider: str, start: datetime, end: datetime,
+               chunk_size: int, max_index_entries: int, store_matched: bool, columns: Dict[str, str]) -> ReconciliationRun:
+    strategy = "hash" if _count_our_entries(db, payments, start, end) <= max_index_entries else "sort_merge"
+    run = ReconciliationRun(provider=provider, settlement_date=settlement_date, settlement_file=os.path.basename(path), strategy=strategy)
+    try:
+        db.add(run)
+        db.flush()
+
+        writer = _ResultWriter(db, run.run_id, store_matched, chunk_size)
+        chunks = read_settlement_chunks(path, chunk_size, **columns)
+        if strategy == "hash":
+            _reconcile_hash(db, payments, start, end, chunks, writer)
+        else:
+            _reconcile_sort_merge(db, payments, start, end, chunks, writer)
+        writer.flush()
+
+        run.counts = writer.counts
+        run.finished_at = datetime.utcnow()
+        db.commit()
+    except Exception:
+        # Results already flushed for a failed run are not kept
+        db.rollback()
+        raise
+    db.refresh(run)
+    return run
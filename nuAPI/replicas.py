@@ -0,0 +1,246 @@
+# Read/write session routing: GETs read from a replica that is healthy, not
+# too far behind and has caught up with the caller's own last write; all
+# writes stay on the primary. Replica freshness comes from a heartbeat row
+# the primary rewrites every probe interval.
+#
+#   python -m nuAPI.replicas sqlite-follow test.db replica1.db replica2.db
+import argparse
+import itertools
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from http.cookies import CookieError, SimpleCookie
+from typing import List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from nuAPI.database import SessionLocal
+from nuAPI.models import ReplicationHeartbeat
+from nuAPI.ratelimit import token_user
+
+# e.g. ["sqlite:///./replica1.db", "postgresql://reader@replica-2/nuapi"]
+REPLICA_URLS: List[str] = []
+REPLICA_POLICY = "least_latency"  # or "round_robin"
+MAX_REPLICA_LAG = 5.0  # seconds; replicas further behind get no reads
+PROBE_INTERVAL = 1.0  # seconds between heartbeats and replica probes
+LATENCY_SMOOTHING = 0.2  # weight of the newest probe in a replica's latency average
+STICKY_COOKIE = "nu_written_at"
+MAX_STICKY_CLIENTS = 100_000
+
+_HEARTBEAT_ID = 1
+
+logger = logging.getLogger(__name__)
+
+
+class Replica:
+    def __init__(self, name: str, session_factory):
+        self.name = name
+        self.session_factory = session_factory
+        self.latency: Optional[float] = None  # smoothed probe time, seconds
+        self.applied_at: Optional[float] = None  # newest primary heartbeat the replica has
+        self.healthy = False
+
+    @classmethod
+    def from_url(cls, url: str) -> "Replica":
+        connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+        engine = create_engine(url, connect_args=connect_args)
+        return cls(engine.url.render_as_string(hide_password=True), sessionmaker(autocommit=False, autoflush=False, bind=engine))
+
+    def probe(self):
+        db = self.session_factory()
+        try:
+            started = time.perf_counter()
+            beat_at = db.query(ReplicationHeartbeat.beat_at).filter(ReplicationHeartbeat.id == _HEARTBEAT_ID).scalar()
+            elapsed = time.perf_counter() - started
+        except Exception:
+            self.healthy = False
+            raise
+        finally:
+            db.close()
+        self.latency = elapsed if self.latency is None else self.latency + LATENCY_SMOOTHING * (elapsed - self.latency)
+        self.applied_at = beat_at
+        self.healthy = beat_at is not None
+
+
+class ReplicaRouter:
+    def __init__(self, primary_factory, replicas: Optional[List[Replica]] = None, policy: str = REPLICA_POLICY,
+                 max_lag: float = MAX_REPLICA_LAG):
+        self.primary_factory = primary_factory
+        self.replicas = list(replicas or [])
+        self.policy = policy
+        self.max_lag = max_lag
+        self._turn = itertools.count()
+        # Last write time per client, for callers that do not send the cookie back
+        self._written: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def heartbeat(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        db = self.primary_factory()
+        try:
+            updated = db.query(ReplicationHeartbeat).filter(ReplicationHeartbeat.id == _HEARTBEAT_ID).update(
+                {ReplicationHeartbeat.beat_at: now}, synchronize_session=False
+            )
+            if not updated:
+                db.add(ReplicationHeartbeat(id=_HEARTBEAT_ID, beat_at=now))
+            db.commit()
+        finally:
+            db.close()
+        return now
+
+    def probe(self):
+        for replica in self.replicas:
+            try:
+                replica.probe()
+            except Exception:
+                logger.exception("Replica %s probe failed", replica.name)
+
+    def record_write(self, client: str, written_at: float):
+        with self._lock:
+            self._written[client] = written_at
+            self._written.move_to_end(client)
+            while len(self._written) > MAX_STICKY_CLIENTS:
+                self._written.popitem(last=False)
+
+    def written_at(self, client: str) -> Optional[float]:
+        with self._lock:
+            return self._written.get(client)
+
+    # A replica has applied everything committed before the heartbeat it
+    # shows, so one whose heartbeat is newer than the caller's last write
+    # can serve that caller's reads
+    def choose(self, fresh_after: Optional[float] = None, now: Optional[float] = None) -> Optional[Replica]:
+        now = time.time() if now is None else now
+        oldest = now - self.max_lag
+        if fresh_after is not None:
+            oldest = max(oldest, fresh_after)
+        candidates = [replica for replica in self.replicas if replica.healthy and replica.applied_at >= oldest]
+        if not candidates:
+            return None
+        if self.policy == "round_robin":
+            return candidates[next(self._turn) % len(candidates)]
+        return min(candidates, key=lambda replica: replica.latency)
+
+    def read_session(self, fresh_after: Optional[float] = None) -> Session:
+        replica = self.choose(fresh_after)
+        return replica.session_factory() if replica else self.primary_factory()
+
+    def run(self, interval: float = PROBE_INTERVAL):
+        while True:
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception("Replication heartbeat failed")
+            self.probe()
+            time.sleep(interval)
+
+
+read_router = ReplicaRouter(SessionLocal, [Replica.from_url(url) for url in REPLICA_URLS])
+
+
+def start_replica_monitor(router: ReplicaRouter = read_router) -> Optional[threading.Thread]:
+    if not router.replicas:
+        return None
+    worker = threading.Thread(target=router.run, name="replica-monitor", daemon=True)
+    worker.start()
+    return worker
+
+
+def _client_key(scope) -> Optional[str]:
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            user_id = token_user(value, time.time())
+            if user_id:
+                return "user:" + user_id
+    client = scope.get("client")
+    return "ip:" + client[0] if client else None
+
+
+def _cookie_written_at(scope) -> Optional[float]:
+    for name, value in scope.get("headers", ()):
+        if name == b"cookie":
+            try:
+                morsel = SimpleCookie(value.decode("latin-1")).get(STICKY_COOKIE)
+                return float(morsel.value) if morsel else None
+            except (CookieError, ValueError):
+                return None
+    return None
+
+
+class ReadYourWritesMiddleware:
+    # Successful writes stamp the caller (server-side and in a cookie) with
+    # their time; GETs carry the newest stamp in request.state.fresh_after
+    # for get_read_db. Stamps only matter for MAX_REPLICA_LAG seconds, since
+    # any replica fresher than that has the write anyway.
+    def __init__(self, app, router: ReplicaRouter = read_router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.router.replicas:
+            await self.app(scope, receive, send)
+            return
+        client = _client_key(scope)
+        if scope["method"] in ("GET", "HEAD"):
+            stamps = [stamp for stamp in (_cookie_written_at(scope), client and self.router.written_at(client)) if stamp]
+            scope.setdefault("state", {})["fresh_after"] = max(stamps) if stamps else None
+            await self.app(scope, receive, send)
+            return
+
+        async def stamp_write(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                written_at = time.time()
+                if client:
+                    self.router.record_write(client, written_at)
+                cookie = f"{STICKY_COOKIE}={written_at:.6f}; Max-Age={math.ceil(self.router.max_lag)}; Path=/; HttpOnly"
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode("latin-1"))]}
+            await send(message)
+
+        await self.app(scope, receive, stamp_write)
+
+
+# Local stand-in for streaming replication: copies a SQLite primary into
+# each replica file with the online backup API every `interval` seconds
+def follow_sqlite(primary: str, replicas: List[str], interval: float = 1.0):
+    while True:
+        source = sqlite3.connect(primary)
+        try:
+            for path in replicas:
+                target = sqlite3.connect(path)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+        finally:
+            source.close()
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    follow = commands.add_parser("sqlite-follow")
+    follow.add_argument("primary")
+    follow.add_argument("replicas", nargs="+")
+    follow.add_argument("--interval", type=float, default=1.0)
+    commands.add_parser("status")
+    args = parser.parse_args()
+
+    if args.command == "sqlite-follow":
+        follow_sqlite(args.primary, args.replicas, args.interval)
+    else:
+        now = read_router.heartbeat()
+        time.sleep(PROBE_INTERVAL)
+        read_router.probe()
+        for replica in read_router.replicas:
+            lag = "-" if replica.applied_at is None else f"{now - replica.applied_at:+.2f}s"
+            latency = "-" if replica.latency is None else f"{replica.latency * 1e3:.2f}ms"
+            print(f"{replica.name}: healthy={replica.healthy} behind={lag} latency={latency}")
+
+
+if __name__ == "__main__":
+    main()
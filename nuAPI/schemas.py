@@ -1,9 +1,10 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from uuid import UUID, uuid4
 from decimal import Decimal
-from datetime import datetime
+from datetime import date, datetime
 from enum import Enum
-from typing import Optional
+from typing import Any, Dict, List, Optional, Union
+from nuAPI.money import MoneyAmount
 
 class PaymentStatus(str, Enum):
     confirmed = "confirmed"
@@ -18,16 +19,26 @@ class CardPaymentRequest(BaseModel):
     amount: Decimal
     currency: str
     customer_name: str
-    card_number: str = Field(..., min_length=16, max_length=19, pattern=r'^\d{16,19}$')
+    # Either the raw card number, which is vaulted on arrival, or a token from an earlier payment
+    card_number: Optional[str] = Field(None, min_length=16, max_length=19, pattern=r'^\d{16,19}$')
+    card_token: Optional[str] = Field(None, min_length=16, max_length=19, pattern=r'^9\d{15,18}$')
     card_expiry: str = Field(..., min_length=3, max_length=5, pattern=r'^\d{2}/\d{2}$')
     cvv: str = Field(..., min_length=3, max_length=4, pattern=r'^\d{3,4}$')
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_card(self):
+        if (self.card_number is None) == (self.card_token is None):
+            raise ValueError("Give either a card_number or a card_token")
+        return self
 
 class CardPaymentResponse(BaseModel):
     card_payment_id: UUID = Field(default_factory=uuid4)
     status: PaymentStatus
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    card_token: Optional[str] = None
 
 class BankTransferRequest(BaseModel):
     transfer_id: UUID = Field(default_factory=uuid4)
@@ -53,6 +64,7 @@ class BankPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    merchant_id: Optional[str] = None
 
 class BankPaymentResponse(BaseModel):
     bank_payment_id: UUID = Field(default_factory=uuid4)
@@ -65,6 +77,7 @@ class CashPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class CashPaymentResponse(BaseModel):
     cash_payment_id: UUID = Field(default_factory=uuid4)
@@ -77,6 +90,7 @@ class LinkPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class LinkPaymentResponse(BaseModel):
     link_payment_id: UUID = Field(default_factory=uuid4)
@@ -89,6 +103,7 @@ class MobileMoneyPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class MobileMoneyPaymentResponse(BaseModel):
     mobile_money_payment_id: UUID = Field(default_factory=uuid4)
@@ -101,6 +116,7 @@ class MpesaPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class MpesaPaymentResponse(BaseModel):
     mpesa_payment_id: UUID = Field(default_factory=uuid4)
@@ -113,6 +129,7 @@ class AirtelMoneyPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class AirtelMoneyPaymentResponse(BaseModel):
     airtel_money_payment_id: UUID = Field(default_factory=uuid4)
@@ -125,6 +142,7 @@ class VodafoneCashPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class VodafoneCashPaymentResponse(BaseModel):
     vodafone_cash_payment_id: UUID = Field(default_factory=uuid4)
@@ -137,6 +155,7 @@ class TigoCashPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class TigoCashPaymentResponse(BaseModel):
     tigo_cash_payment_id: UUID = Field(default_factory=uuid4)
@@ -149,6 +168,7 @@ class EFTPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class EFTPaymentResponse(BaseModel):
     eft_payment_id: UUID = Field(default_factory=uuid4)
@@ -161,6 +181,7 @@ class SnapScanPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class SnapScanPaymentResponse(BaseModel):
     snapscan_payment_id: UUID = Field(default_factory=uuid4)
@@ -173,6 +194,7 @@ class ApplePayPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class ApplePayPaymentResponse(BaseModel):
     applepay_payment_id: UUID = Field(default_factory=uuid4)
@@ -185,6 +207,7 @@ class GooglePayPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class GooglePayPaymentResponse(BaseModel):
     googlepay_payment_id: UUID = Field(default_factory=uuid4)
@@ -197,6 +220,7 @@ class SamsungPayPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class SamsungPayPaymentResponse(BaseModel):
     samsungpay_payment_id: UUID = Field(default_factory=uuid4)
@@ -209,6 +233,7 @@ class MTNMobileMoneyPaymentRequest(BaseModel):
     currency: str
     status: PaymentStatus
     transaction_reference: UUID = Field(default_factory=uuid4)
+    merchant_id: Optional[str] = None
 
 class MTNMobileMoneyPaymentResponse(BaseModel):
     mtn_mobile_money_payment_id: UUID = Field(default_factory=uuid4)
@@ -228,4 +253,201 @@ class BankAccountRequest(BaseModel):
 class BankAccountResponse(BaseModel):
     account_id: UUID = Field(default_factory=uuid4)
     status: PaymentStatus
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class WalletTransferRequest(BaseModel):
+    source_wallet_id: UUID
+    destination_wallet_id: UUID
+    amount: Decimal = Field(..., gt=0)
+    currency: str
+
+class WalletTransferResponse(BaseModel):
+    transfer_id: UUID
+    status: PaymentStatus
+    expires_at: datetime
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class FxRateRequest(BaseModel):
+    base_currency: str
+    quote_currency: str
+    rate: Decimal = Field(..., gt=0)
+    effective_at: Optional[datetime] = None
+    source: Optional[str] = None
+
+class FxRateResponse(BaseModel):
+    rate_id: UUID
+    base_currency: str
+    quote_currency: str
+    rate: Decimal
+    effective_at: datetime
+
+class FxConvertRequest(BaseModel):
+    amounts: List[Decimal]
+    from_currency: str
+    to_currency: str
+    as_of: Optional[datetime] = None
+
+class FxConvertResponse(BaseModel):
+    amounts: List[Decimal]
+    from_currency: str
+    to_currency: str
+    as_of: datetime
+
+class SplitShare(BaseModel):
+    beneficiary_id: UUID
+    percentage: Optional[Decimal] = Field(None, gt=0, le=100)
+    amount: Optional[Decimal] = Field(None, gt=0)
+
+    @model_validator(mode="after")
+    def check_one_of(self):
+        if (self.percentage is None) == (self.amount is None):
+            raise ValueError("Give either a percentage or an amount for each share")
+        return self
+
+class SplitPaymentRequest(BaseModel):
+    user_id: UUID = Field(default_factory=uuid4)
+    amount: Decimal = Field(..., gt=0)
+    currency: str
+    payment_method: str
+    shares: List[SplitShare] = Field(..., min_length=1)
+
+class SplitAllocationResponse(BaseModel):
+    beneficiary_id: UUID
+    amount: MoneyAmount
+
+class SplitPaymentResponse(BaseModel):
+    split_payment_id: UUID
+    status: PaymentStatus
+    allocations: List[SplitAllocationResponse]
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class InstalmentFrequency(str, Enum):
+    daily = "daily"
+    weekly = "weekly"
+    monthly = "monthly"
+
+class InstalmentPlanRequest(BaseModel):
+    user_id: UUID = Field(default_factory=uuid4)
+    amount: Decimal = Field(..., gt=0)
+    currency: str
+    instalment_count: int = Field(..., ge=1, le=1000)
+    frequency: InstalmentFrequency
+    start_date: date
+    payment_method: str
+
+class InstalmentResponse(BaseModel):
+    sequence: int
+    due_date: date
+    amount: MoneyAmount
+
+class InstalmentPlanResponse(BaseModel):
+    paymentplan_id: UUID
+    status: PaymentStatus
+    instalments: List[InstalmentResponse]
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class UssdRequest(BaseModel):
+    session_id: str
+    service_code: Optional[str] = None
+    phone_number: str
+    text: str = ""
+
+class UssdLinkRequest(BaseModel):
+    phone_number: str = Field(..., pattern=r'^\+?\d{7,15}$')
+    pin: str = Field(..., pattern=r'^\d{4,6}$')
+
+class UssdLinkResponse(BaseModel):
+    wallet_id: str
+    wallet_msisdn: str
+
+class TwoFASendRequest(BaseModel):
+    phone_number: str = Field(..., pattern=r'^\+?\d{7,15}$')
+
+class TwoFASendResponse(BaseModel):
+    phone_number: str
+    expires_at: datetime
+
+class TwoFAVerifyRequest(BaseModel):
+    phone_number: str = Field(..., pattern=r'^\+?\d{7,15}$')
+    code: str = Field(..., pattern=r'^\d{4,8}$')
+
+class TwoFAVerifyResponse(BaseModel):
+    phone_number: str
+    verified: bool
+
+class AnalyticsTable(str, Enum):
+    payments = "payments"
+    transactions = "transactions"
+
+class AnalyticsOp(str, Enum):
+    eq = "eq"
+    ne = "ne"
+    lt = "lt"
+    lte = "lte"
+    gt = "gt"
+    gte = "gte"
+    between = "between"
+    in_ = "in"
+    not_in = "not_in"
+
+class AnalyticsFunction(str, Enum):
+    count = "count"
+    sum = "sum"
+    avg = "avg"
+    min = "min"
+    max = "max"
+    percentile = "percentile"
+
+class AnalyticsBucket(str, Enum):
+    minute = "minute"
+    hour = "hour"
+    day = "day"
+    week = "week"
+
+class AnalyticsFilter(BaseModel):
+    column: str
+    op: AnalyticsOp = AnalyticsOp.eq
+    # Timestamps are ISO 8601 strings (UTC); between is [start, end)
+    value: Union[float, str, None, List[Union[float, str, None]]]
+
+class AnalyticsAggregate(BaseModel):
+    fn: AnalyticsFunction
+    column: Optional[str] = None
+    q: Optional[float] = Field(None, ge=0, le=1)
+
+class AnalyticsQuery(BaseModel):
+    table: AnalyticsTable = AnalyticsTable.payments
+    filters: List[AnalyticsFilter] = []
+    group_by: List[str] = []
+    bucket: Optional[AnalyticsBucket] = None
+    aggregates: List[AnalyticsAggregate] = Field(..., min_length=1)
+    order_by: Optional[str] = None
+    descending: bool = True
+    limit: int = Field(1000, ge=1, le=100_000)
+
+class AnalyticsQueryResponse(BaseModel):
+    columns: List[str]
+    rows: List[list]
+    matched_rows: int
+    snapshot_at: datetime
+    elapsed_ms: float
+
+class PaymentSummaryResponse(BaseModel):
+    id: str
+    user_id: str
+    amount: Decimal
+    currency: str
+    status: PaymentStatus
+    channel: Optional[str] = None
+    merchant_id: Optional[str] = None
+    timestamp: datetime
+
+class InstrumentResponse(BaseModel):
+    id: str
+    channel: str
+    user_id: str
+    number: str
+    status: str
+    date: datetime
+    message: Optional[str] = None
+    details: Optional[Dict[str, Any]] = None
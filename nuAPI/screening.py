@@ -0,0 +1,383 @@
+# Watchlist (sanctions/PEP) name screening with blocking, so each name is only
+# scored against watchlist entries that share phonetic or n-gram keys with it.
+#
+#   python -m nuAPI.screening watchlist.csv --kyc --customers
+import argparse
+import csv
+import os
+import re
+import time
+import unicodedata
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice, repeat
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from nuAPI.models import Customer, KYCModel, ScreeningHit
+
+try:
+    from rapidfuzz.distance import JaroWinkler as _rapidfuzz_jaro_winkler
+except ImportError:  # optional: pip install nuAPI[screening]
+    _rapidfuzz_jaro_winkler = None
+
+DEFAULT_THRESHOLD = 0.88
+# Keys shared by more entries than this (e.g. the soundex of a very common
+# surname) are wide blocks: still scored in full, never skipped, since a
+# skipped block is a missed sanctions match. Counted in wide_blocks.
+MAX_BLOCK_SIZE = 5000
+
+# (watchlist id, watchlist name, score)
+Match = Tuple[str, str, float]
+
+_SOUNDEX_CODES = {}
+for _letters, _code in (("BFPV", "1"), ("CGJKQSXZ", "2"), ("DT", "3"), ("L", "4"), ("MN", "5"), ("R", "6")):
+    for _letter in _letters:
+        _SOUNDEX_CODES[_letter] = _code
+_NON_LETTERS = re.compile(r"[^A-Z ]+")
+
+
+def normalise_name(name: str) -> List[str]:
+    # Accents folded, punctuation dropped, tokens sorted so word order does not matter
+    folded = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().upper()
+    return sorted(_NON_LETTERS.sub(" ", folded).split())
+
+
+@lru_cache(maxsize=1 << 16)
+def soundex(token: str) -> str:
+    code = token[0]
+    previous = _SOUNDEX_CODES.get(code, "")
+    for letter in token[1:]:
+        digit = _SOUNDEX_CODES.get(letter, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                return code
+        if letter not in "HW":
+            previous = digit
+    return code.ljust(4, "0")
+
+
+@lru_cache(maxsize=1 << 16)
+def token_keys(token: str) -> Tuple[str, ...]:
+    # Soundex tolerates vowel and similar-consonant spelling changes; the
+    # trigram after the first letter catches a typo in the first letter,
+    # which soundex keeps verbatim.
+    if len(token) < 2:
+        return ()
+    if len(token) < 4:
+        return ("S" + soundex(token),)
+    return ("S" + soundex(token), "Q" + token[1:4])
+
+
+def pair_keys(tokens: Sequence[str]) -> Set[str]:
+    # A key per pair of words (order-free), so a multi-word name only meets
+    # entries that agree on two of its words; a block then holds the few
+    # people sharing a first name and surname, not everyone sharing either.
+    per_token = [token_keys(token) for token in tokens]
+    keys = set()
+    for i, first in enumerate(per_token):
+        for second in per_token[i + 1:]:
+            for a in first:
+                for b in second:
+                    keys.add(f"{a}|{b}" if a <= b else f"{b}|{a}")
+    return keys
+
+
+def _jaro_winkler(a: str, b: str) -> float:
+    if a == b:
+        return 1.0
+    len_a, len_b = len(a), len(b)
+    if not len_a or not len_b:
+        return 0.0
+    window = max(max(len_a, len_b) // 2 - 1, 0)
+    matched_b = [False] * len_b
+    matches_a = []
+    find = b.find
+    for i, char in enumerate(a):
+        end = i + window + 1
+        j = find(char, i - window if i > window else 0, end)
+        while j != -1 and matched_b[j]:
+            j = find(char, j + 1, end)
+        if j != -1:
+            matched_b[j] = True
+            matches_a.append(char)
+    matches = len(matches_a)
+    if not matches:
+        return 0.0
+    matches_b = [b[j] for j in range(len_b) if matched_b[j]]
+    transpositions = sum(x != y for x, y in zip(matches_a, matches_b)) // 2
+    jaro = (matches / len_a + matches / len_b + (matches - transpositions) / matches) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+if _rapidfuzz_jaro_winkler is not None:
+    jaro_winkler = _rapidfuzz_jaro_winkler.similarity
+else:
+    jaro_winkler = _jaro_winkler
+
+# Names repeat a small vocabulary of words, so word pairs are scored once
+_word_similarity = lru_cache(maxsize=1 << 18)(jaro_winkler)
+
+
+def name_similarity(tokens: Tuple[str, ...], other: Tuple[str, ...], threshold: float = 0.0) -> float:
+    # Each word of the shorter name against its best match in the longer
+    # one, weighted by length, so word order and extra middle names do not
+    # count against a match. A lone word against a multi-word name falls
+    # back to comparing the whole names. Returns 0 as soon as the threshold
+    # is out of reach.
+    shorter, longer = (tokens, other) if len(tokens) <= len(other) else (other, tokens)
+    if len(shorter) < min(2, len(longer)):
+        return jaro_winkler(" ".join(tokens), " ".join(other))
+    weight = sum(len(token) for token in shorter)
+    allowed_loss = (1 - threshold) * weight
+    loss = 0.0
+    for token in shorter:
+        if token in longer:
+            continue
+        best = 0.0
+        length = len(token)
+        for candidate in longer:
+            # The best Jaro-Winkler two lengths allow is 0.8 + 0.2 * ratio,
+            # so skip words whose length alone rules out beating best
+            other_length = len(candidate)
+            if best > 0.8 and (length if length < other_length else other_length) < (best - 0.8) * 5 * (other_length if length < other_length else length):
+                continue
+            score = _word_similarity(token, candidate)
+            if score > best:
+                best = score
+        loss += (1 - best) * length
+        if loss > allowed_loss + 1e-9:
+            return 0.0
+    return 1 - loss / weight
+
+
+def read_watchlist(path: str, id_column: str = "id", name_column: str = "name") -> Dict[str, str]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return {row[id_column]: row[name_column] for row in csv.DictReader(f)}
+
+
+def _post(postings: Dict[str, Set[int]], keys: Iterable[str], slot: int):
+    for key in keys:
+        posting = postings.get(key)
+        if posting is None:
+            posting = postings[key] = set()
+        posting.add(slot)
+
+
+def _unpost(postings: Dict[str, Set[int]], keys: Iterable[str], slot: int):
+    for key in keys:
+        posting = postings[key]
+        posting.discard(slot)
+        if not posting:
+            del postings[key]
+
+
+class ScreeningIndex:
+    def __init__(self, max_block_size: int = MAX_BLOCK_SIZE):
+        self.max_block_size = max_block_size
+        self.wide_blocks = 0
+        # Pair keys for multi-word entries, word keys for one-word entries
+        self.postings: Dict[str, Set[int]] = {}
+        # Word keys of every entry, only used to screen one-word names
+        self.word_postings: Dict[str, Set[int]] = {}
+        # Entries live in parallel lists addressed by a slot number; removed
+        # slots are recycled so incremental reloads never rebuild.
+        self.watchlist_ids: List[Optional[str]] = []
+        self.names: List[Optional[str]] = []
+        self.tokens: List[Tuple[str, ...]] = []
+        self.keys: List[Tuple[str, ...]] = []
+        self.slots: Dict[str, int] = {}
+        self._free: List[int] = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, watchlist_id: str, name: str):
+        if watchlist_id in self.slots:
+            self.remove(watchlist_id)
+        tokens = tuple(normalise_name(name))
+        words = tuple({key for token in tokens for key in token_keys(token)})
+        keys = tuple(pair_keys(tokens)) if len(tokens) > 1 else words
+        slot = self._free.pop() if self._free else len(self.names)
+        if slot == len(self.names):
+            self.watchlist_ids.append(None)
+            self.names.append(None)
+            self.tokens.append(())
+            self.keys.append(())
+        self.watchlist_ids[slot] = watchlist_id
+        self.names[slot] = name
+        self.tokens[slot] = tokens
+        self.keys[slot] = keys
+        self.slots[watchlist_id] = slot
+        _post(self.postings, keys, slot)
+        _post(self.word_postings, words, slot)
+
+    def remove(self, watchlist_id: str):
+        slot = self.slots.pop(watchlist_id)
+        _unpost(self.postings, self.keys[slot], slot)
+        _unpost(self.word_postings, {key for token in self.tokens[slot] for key in token_keys(token)}, slot)
+        self.watchlist_ids[slot] = self.names[slot] = None
+        self.tokens[slot] = self.keys[slot] = ()
+        self._free.append(slot)
+
+    # Apply a new version of the watchlist as a diff: only added, changed and
+    # removed entries touch the index. Returns (added, changed, removed).
+    def reload(self, entries: Dict[str, str]) -> Tuple[int, int, int]:
+        removed = [watchlist_id for watchlist_id in self.slots if watchlist_id not in entries]
+        for watchlist_id in removed:
+            self.remove(watchlist_id)
+        added = changed = 0
+        for watchlist_id, name in entries.items():
+            slot = self.slots.get(watchlist_id)
+            if slot is None:
+                added += 1
+            elif self.names[slot] == name:
+                continue
+            else:
+                changed += 1
+            self.add(watchlist_id, name)
+        return added, changed, len(removed)
+
+    @classmethod
+    def from_file(cls, path: str, **columns) -> "ScreeningIndex":
+        index = cls()
+        index.reload(read_watchlist(path, **columns))
+        return index
+
+    def _candidates(self, tokens: Tuple[str, ...]) -> Set[int]:
+        words = {key for token in tokens for key in token_keys(token)}
+        if len(tokens) > 1:
+            # Multi-word entries agreeing on two words, plus one-word entries matching any word
+            keys = pair_keys(tokens) | words
+            postings = self.postings
+        else:
+            keys = words
+            postings = self.word_postings
+        candidates: Set[int] = set()
+        for key in keys:
+            posting = postings.get(key)
+            if posting is not None:
+                if len(posting) > self.max_block_size:
+                    self.wide_blocks += 1
+                candidates.update(posting)
+        return candidates
+
+    def screen(self, name: str, threshold: float = DEFAULT_THRESHOLD, limit: int = 5) -> List[Match]:
+        tokens = tuple(normalise_name(name))
+        if not tokens:
+            return []
+        entry_tokens = self.tokens
+        matches = []
+        for slot in self._candidates(tokens):
+            score = name_similarity(tokens, entry_tokens[slot], threshold)
+            if score >= threshold:
+                matches.append((self.watchlist_ids[slot], self.names[slot], score))
+        matches.sort(key=lambda match: -match[2])
+        return matches[:limit]
+
+    def screen_many(self, subjects: Iterable[Tuple[str, str]], threshold: float = DEFAULT_THRESHOLD) -> Iterator[Tuple[str, Match]]:
+        for subject_id, name in subjects:
+            for match in self.screen(name, threshold):
+                yield subject_id, match
+
+
+_worker_index: Optional[ScreeningIndex] = None
+
+
+def _init_worker(index: ScreeningIndex):
+    global _worker_index
+    _worker_index = index
+
+
+def _screen_batch(subjects: List[Tuple[str, str]], threshold: float) -> List[Tuple[str, Match]]:
+    return list(_worker_index.screen_many(subjects, threshold))
+
+
+# Screen on a process pool; each worker gets its own copy of the index once
+def screen_parallel(index: ScreeningIndex, subjects: Iterable[Tuple[str, str]], threshold: float = DEFAULT_THRESHOLD, workers: Optional[int] = None, batch_size: int = 10_000) -> Iterator[Tuple[str, Match]]:
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from index.screen_many(subjects, threshold)
+        return
+    subjects = iter(subjects)
+    batches = iter(lambda: list(islice(subjects, batch_size)), [])
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(index,)) as executor:
+        for hits in executor.map(_screen_batch, batches, repeat(threshold)):
+            yield from hits
+
+
+def _save_hits(db: Session, subject_type: str, hits: Iterator[Tuple[str, Match]], batch_size: int = 10_000) -> int:
+    now = datetime.utcnow()
+    rows = []
+    saved = 0
+    for subject_id, (watchlist_id, watchlist_name, score) in hits:
+        rows.append({
+            "subject_type": subject_type,
+            "subject_id": subject_id,
+            "watchlist_id": watchlist_id,
+            "watchlist_name": watchlist_name,
+            "score": score,
+            "created_at": now,
+        })
+        if len(rows) >= batch_size:
+            db.execute(ScreeningHit.__table__.insert(), rows)
+            saved += len(rows)
+            rows = []
+    if rows:
+        db.execute(ScreeningHit.__table__.insert(), rows)
+        saved += len(rows)
+    db.commit()
+    return saved
+
+
+def screen_kyc(db: Session, index: ScreeningIndex, threshold: float = DEFAULT_THRESHOLD, workers: Optional[int] = None) -> int:
+    subjects = (
+        (row.id, f"{row.first_name} {row.last_name}")
+        for row in db.execute(select(KYCModel.id, KYCModel.first_name, KYCModel.last_name).execution_options(yield_per=50_000))
+    )
+    return _save_hits(db, "kyc", screen_parallel(index, subjects, threshold, workers))
+
+
+def screen_customers(db: Session, index: ScreeningIndex, threshold: float = DEFAULT_THRESHOLD, workers: Optional[int] = None) -> int:
+    subjects = (
+        (row.customer_id, row.customer_name)
+        for row in db.execute(select(Customer.customer_id, Customer.customer_name).execution_options(yield_per=50_000))
+    )
+    return _save_hits(db, "customer", screen_parallel(index, subjects, threshold, workers))
+
+
+def main():
+    from nuAPI.database import SessionLocal
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("watchlist")
+    parser.add_argument("--kyc", action="store_true")
+    parser.add_argument("--customers", action="store_true")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    index = ScreeningIndex.from_file(args.watchlist)
+    print(f"Indexed {len(index):,} watchlist entries in {time.perf_counter() - t:.2f}s")
+    db = SessionLocal()
+    try:
+        if args.kyc:
+            print("KYC hits:", screen_kyc(db, index, args.threshold, args.workers))
+        if args.customers:
+            print("Customer hits:", screen_customers(db, index, args.threshold, args.workers))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,9 @@ setup(
         "fastapi",
         "sqlalchemy",
         "uvicorn",
+        "pyjwt",
+        "cryptography",
+        "numpy",
         # other dependencies
     ],
     extras_require={
@@ -15,6 +18,15 @@ setup(
             'pytest',
             # other development dependencies
         ],
+        'screening': [
+            'rapidfuzz',
+        ],
+        'analytics': [
+            'pyarrow',
+        ],
+        'fast': [
+            'orjson',
+        ],
     },
 )
 
@@ -0,0 +1,389 @@
+# Horizontal sharding of payments by user_id. Every user hashes to one of
+# SLOTS fixed slots and contiguous slot ranges are assigned to shards in the
+# shard_slots table on the primary, so adding a shard moves whole ranges and
+# nothing is ever rehashed. A payment id ends in its slot, so a lookup by id
+# routes without reading any directory; only ids minted before that, and
+# lookups in a range that is being moved, are looked for on every shard.
+#
+#   python -m nuAPI.sharding status
+#   python -m nuAPI.sharding backfill
+#   python -m nuAPI.sharding move 0 511 2
+import argparse
+import hashlib
+import heapq
+import logging
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+from uuid import UUID
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+
+from nuAPI.changes import last_seq, next_seqs
+from nuAPI.database import SessionLocal
+from nuAPI.ids import uuid7
+from nuAPI.models import Base, ChangeTombstone, Payments, ShardSlotRange
+
+# e.g. ["sqlite:///./shard0.db", "sqlite:///./shard1.db"]; empty keeps payments on the primary
+SHARD_URLS: List[str] = []
+SLOTS = 4096  # fixed for good: payment ids carry the slot as their last three hex digits
+MAP_REFRESH_INTERVAL = 1.0  # seconds
+SCATTER_WORKERS = 8
+MOVE_BATCH_SIZE = 1000
+# A range is frozen for this long before the last copy of a move, so every
+# process has reloaded the map and stopped writing to the old shard
+FREEZE_GRACE = 3 * MAP_REFRESH_INTERVAL
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+class ShardingError(Exception):
+    pass
+
+
+class ShardMoving(ShardingError):
+    pass
+
+
+def user_slot(user_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(user_id.encode(), digest_size=8).digest(), "big") % SLOTS
+
+
+# A UUIDv7 whose last 12 random bits are the slot, marked version 8 (custom)
+# so it cannot be mistaken for an id from before, whose last digits are
+# random; still time-ordered. Used as both id and payment_id.
+def new_payment_id(slot: int) -> str:
+    return str(UUID(int=uuid7().int & ~(0xF << 76) & ~0xFFF | (0x8 << 76) | slot))
+
+
+def payment_slot(payment_id: str) -> Optional[int]:
+    if not isinstance(payment_id, str) or len(payment_id) != 36 or payment_id[14] != "8":
+        return None
+    try:
+        return int(payment_id[-3:], 16)
+    except ValueError:
+        return None
+
+
+class ShardMap:
+    def __init__(self, ranges: Sequence[Tuple[int, int, int, str]]):
+        self.ranges = sorted(tuple(r) for r in ranges)
+        self.shards = array("h", [-1]) * SLOTS
+        self.frozen = bytearray(SLOTS)
+        for first, last, shard, state in self.ranges:
+            for slot in range(first, last + 1):
+                self.shards[slot] = shard
+                self.frozen[slot] = state == "frozen"
+        if -1 in self.shards:
+            raise ShardingError(f"Slot {self.shards.index(-1)} is not assigned to a shard")
+
+    @classmethod
+    def even(cls, shards: int) -> "ShardMap":
+        bounds = [SLOTS * n // shards for n in range(shards + 1)]
+        return cls([(bounds[n], bounds[n + 1] - 1, n, "active") for n in range(shards)])
+
+
+def shard_engine(url: str):
+    engine = create_engine(url, connect_args={"check_same_thread": False} if url.startswith("sqlite") else {})
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+class ShardRouter:
+    def __init__(self, directory_factory, shard_factories: Sequence):
+        self.directory_factory = directory_factory
+        self.shard_factories = list(shard_factories)
+        self.map = ShardMap.even(len(self.shard_factories))
+        self._pool = ThreadPoolExecutor(max_workers=SCATTER_WORKERS, thread_name_prefix="shard-scatter")
+
+    def load_map(self) -> ShardMap:
+        db = self.directory_factory()
+        try:
+            rows = db.query(ShardSlotRange.first_slot, ShardSlotRange.last_slot, ShardSlotRange.shard, ShardSlotRange.state).all()
+            if not rows:
+                # First start: spread the slots evenly and record that
+                shard_map = ShardMap.even(len(self.shard_factories))
+                try:
+                    db.execute(ShardSlotRange.__table__.insert(), [
+                        {"first_slot": first, "last_slot": last, "shard": shard, "state": state} for first, last, shard, state in shard_map.ranges
+                    ])
+                    db.commit()
+                except IntegrityError:
+                    db.rollback()  # another process wrote it first
+                    return self.load_map()
+            else:
+                shard_map = ShardMap(rows)
+        finally:
+            db.close()
+        if max(shard for _, _, shard, _ in shard_map.ranges) >= len(self.shard_factories):
+            raise ShardingError("The slot map names a shard missing from SHARD_URLS")
+        self.map = shard_map
+        return shard_map
+
+    def shard_for_slot(self, slot: int, writing: bool = False) -> int:
+        if writing and self.map.frozen[slot]:
+            raise ShardMoving("Payments for this user are being moved between shards; retry shortly")
+        return self.map.shards[slot]
+
+    def session(self, shard: int) -> Session:
+        return self.shard_factories[shard]()
+
+    def scatter(self, fn: Callable[[Session], T]) -> List[T]:
+        def run(factory):
+            db = factory()
+            try:
+                return fn(db)
+            finally:
+                db.close()
+
+        return list(self._pool.map(run, self.shard_factories))
+
+    # Runs `fn` on every shard at once and merges the already sorted results
+    def gather(self, fn: Callable[[Session], List[T]], key: Callable[[T], object], limit: int, reverse: bool = False) -> List[T]:
+        return list(islice(heapq.merge(*self.scatter(fn), key=key, reverse=reverse), limit))
+
+    # The shard a payment is on, by payment_id: the one its slot maps to,
+    # without a query. Every process sees a range frozen before its rows
+    # leave the old shard, so only a frozen slot is looked for everywhere,
+    # as is an id minted before ids carried their slot.
+    def locate_payment(self, payment_id: str) -> Tuple[Optional[int], Optional[int]]:
+        slot = payment_slot(payment_id)
+        if slot is not None and not self.map.frozen[slot]:
+            return self.map.shards[slot], slot
+        if slot is None:
+            try:
+                UUID(payment_id)
+            except (TypeError, ValueError, AttributeError):
+                return None, None
+        found = self.scatter(lambda db: db.query(Payments.shard_slot, Payments.user_id).filter(Payments.payment_id == payment_id).first())
+        for shard, row in enumerate(found):
+            if row is not None:
+                return shard, row.shard_slot if row.shard_slot is not None else user_slot(row.user_id)
+        return None, None
+
+    def run(self, interval: float = MAP_REFRESH_INTERVAL):
+        while True:
+            time.sleep(interval)
+            try:
+                self.load_map()
+            except Exception:
+                logger.exception("Shard map refresh failed")
+
+
+shard_router: Optional[ShardRouter] = None
+if SHARD_URLS:
+    shard_router = ShardRouter(SessionLocal, [sessionmaker(autocommit=False, autoflush=False, bind=shard_engine(url)) for url in SHARD_URLS])
+
+
+def start_shard_router(router: Optional[ShardRouter] = None) -> Optional[threading.Thread]:
+    router = router or shard_router
+    if router is None:
+        return None
+    router.load_map()
+    worker = threading.Thread(target=router.run, name="shard-map", daemon=True)
+    worker.start()
+    return worker
+
+
+# The session one user's (or one payment's) rows live in: `db` itself when
+# sharding is off, else a session on that shard, closed on exit. Writes to a
+# range that is mid-move raise ShardMoving.
+@contextmanager
+def payment_session(db: Session, user_id: Optional[str] = None, payment_id: Optional[str] = None,
+                    writing: bool = True) -> Iterator[Optional[Session]]:
+    if shard_router is None:
+        yield db
+        return
+    if user_id is not None:
+        shard = shard_router.shard_for_slot(user_slot(user_id), writing)
+    else:
+        shard, slot = shard_router.locate_payment(payment_id)
+        if shard is None:
+            yield None
+            return
+        shard_router.shard_for_slot(slot, writing)
+    session = shard_router.session(shard)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+# Resharding
+
+def backfill_slots(db: Session, batch_size: int = MOVE_BATCH_SIZE) -> int:
+    # Rows written before the shard_slot column existed
+    filled = 0
+    while True:
+        rows = db.query(Payments.id, Payments.user_id).filter(Payments.shard_slot.is_(None)).limit(batch_size).all()
+        if not rows:
+            return filled
+        db.bulk_update_mappings(Payments, [{"id": row.id, "shard_slot": user_slot(row.user_id)} for row in rows])
+        db.commit()
+        filled += len(rows)
+
+
+def _set_range(directory_factory, first: int, last: int, shard: int, state: str):
+    db = directory_factory()
+    try:
+        ranges = []
+        for row in db.query(ShardSlotRange).all():
+            if row.last_slot < first or row.first_slot > last:
+                ranges.append((row.first_slot, row.last_slot, row.shard, row.state))
+                continue
+            if row.first_slot < first:
+                ranges.append((row.first_slot, first - 1, row.shard, row.state))
+            if row.last_slot > last:
+                ranges.append((last + 1, row.last_slot, row.shard, row.state))
+        ranges.append((first, last, shard, state))
+        ShardMap(ranges)  # raises if the result leaves a gap
+        db.query(ShardSlotRange).delete(synchronize_session=False)
+        db.execute(ShardSlotRange.__table__.insert(), [
+            {"first_slot": f, "last_slot": l, "shard": s, "state": st} for f, l, s, st in sorted(ranges)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def _copy(source: Session, target: Session, first: int, last: int, after_seq: Optional[int], upto_seq: int, batch_size: int) -> int:
+    # Upserts the range's rows (only those changed after `after_seq`, if
+    # given) into the target, restamped from the target's own change
+    # sequence so they show up on its /changes feed. Rows changed after
+    # `upto_seq` are left to the next pass: ids are time-ordered, so without
+    # the bound the keyset cursor would chase new writes forever.
+    table = Payments.__table__
+    in_range = (table.c.shard_slot >= first) & (table.c.shard_slot <= last) & ((table.c.change_seq <= upto_seq) | table.c.change_seq.is_(None))
+    copied = 0
+    last_id = None
+    while True:
+        statement = table.select().where(in_range).order_by(table.c.id).limit(batch_size)
+        if last_id is not None:
+            statement = statement.where(table.c.id > last_id)
+        if after_seq is not None:
+            statement = statement.where(table.c.change_seq > after_seq)
+        rows = [dict(row._mapping) for row in source.execute(statement)]
+        if not rows:
+            return copied
+        ids = [row["id"] for row in rows]
+        seq = next_seqs(target, "payments", len(rows))
+        for offset, row in enumerate(rows):
+            row["change_seq"] = seq + offset
+        target.execute(table.delete().where(table.c.id.in_(ids)))
+        target.execute(table.insert(), rows)
+        target.commit()
+        copied += len(rows)
+        last_id = ids[-1]
+
+
+def _apply_deletes(source: Session, target: Session, first: int, last: int, after_seq: int, upto_seq: int) -> int:
+    tombstones = source.query(ChangeTombstone.row_id).filter(
+        ChangeTombstone.table_name == "payments", ChangeTombstone.change_seq > after_seq, ChangeTombstone.change_seq <= upto_seq,
+    )
+    ids = [row.row_id for row in tombstones]
+    if not ids:
+        return 0
+    ids = [row.id for row in target.query(Payments.id).filter(Payments.id.in_(ids), Payments.shard_slot.between(first, last))]
+    if not ids:
+        return 0
+    target.query(Payments).filter(Payments.id.in_(ids)).delete(synchronize_session=False)
+    seq = next_seqs(target, "payments", len(ids))
+    target.execute(ChangeTombstone.__table__.insert(), [
+        {"change_seq": seq + offset, "table_name": "payments", "row_id": row_id} for offset, row_id in enumerate(ids)
+    ])
+    target.commit()
+    return len(ids)
+
+
+# Copies everything changed after `after_seq` (all of the range if None) up
+# to the sequence read at the start, and returns that mark, where the next
+# pass starts from
+def _pass(source: Session, target: Session, first: int, last: int, after_seq: Optional[int], batch_size: int) -> Tuple[int, int]:
+    source.rollback()  # end any read transaction so the pass sees new commits
+    high = last_seq(source, "payments")
+    copied = _copy(source, target, first, last, after_seq, high, batch_size)
+    if after_seq is not None:
+        _apply_deletes(source, target, first, last, after_seq, high)
+    return copied, high
+
+
+# Online move of slots first..last to another shard. Rows are copied while
+# writes continue, then catch-up passes copy what changed meanwhile (by
+# change_seq, deletes from tombstones). Only the last pass runs with the
+# range frozen, after which the map is flipped and the old copies dropped.
+def move_slots(router: ShardRouter, first: int, last: int, target: int, batch_size: int = MOVE_BATCH_SIZE,
+               grace: float = FREEZE_GRACE, log: Callable[[str], None] = print) -> int:
+    if not 0 <= first <= last < SLOTS:
+        raise ShardingError(f"Slots run from 0 to {SLOTS - 1}")
+    shard_map = router.load_map()
+    sources = {shard_map.shards[slot] for slot in range(first, last + 1)}
+    if len(sources) != 1:
+        raise ShardingError("The range spans several shards; move one source range at a time")
+    source_shard = sources.pop()
+    if source_shard == target:
+        return 0
+    source, destination = router.session(source_shard), router.session(target)
+    try:
+        backfill_slots(source, batch_size)
+        copied, watermark = _pass(source, destination, first, last, None, batch_size)
+        log(f"copied {copied:,} rows from shard {source_shard} to {target}")
+        while True:
+            changed, watermark = _pass(source, destination, first, last, watermark, batch_size)
+            log(f"caught up {changed:,} changed rows")
+            if changed < batch_size:
+                break
+        _set_range(router.directory_factory, first, last, source_shard, "frozen")
+        router.load_map()
+        time.sleep(grace)
+        changed, _ = _pass(source, destination, first, last, watermark, batch_size)
+        _set_range(router.directory_factory, first, last, target, "active")
+        router.load_map()
+        log(f"final pass copied {changed:,} rows; slots {first}-{last} now on shard {target}")
+        # Dropped without tombstones: the rows moved, they were not deleted
+        removed = source.query(Payments).filter(Payments.shard_slot.between(first, last)).delete(synchronize_session=False)
+        source.commit()
+        log(f"removed {removed:,} rows from shard {source_shard}")
+        return copied
+    finally:
+        source.close()
+        destination.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status")
+    commands.add_parser("backfill")
+    move = commands.add_parser("move")
+    move.add_argument("first", type=int)
+    move.add_argument("last", type=int)
+    move.add_argument("target", type=int)
+    move.add_argument("--batch-size", type=int, default=MOVE_BATCH_SIZE)
+    args = parser.parse_args()
+    if shard_router is None:
+        raise SystemExit("SHARD_URLS is empty; sharding is off")
+
+    t = time.perf_counter()
+    if args.command == "status":
+        shard_map = shard_router.load_map()
+        for first, last, shard, state in shard_map.ranges:
+            print(f"slots {first:>4}-{last:<4} shard {shard} {state}")
+        for shard, count in enumerate(shard_router.scatter(lambda db: db.query(func.count(Payments.id)).scalar())):
+            print(f"shard {shard}: {count:,} payments")
+    elif args.command == "backfill":
+        print(sum(shard_router.scatter(backfill_slots)), "slots filled in")
+    else:
+        move_slots(shard_router, args.first, args.last, args.target, args.batch_size)
+    print(f"in {time.perf_counter() - t:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Local stand-in for the SMS provider, speaking the same JSON as HttpSmsProvider.
+#
+#   python -m nuAPI.sms_stub --port 8025 --failure-rate 0.05
+import argparse
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+
+class StubSmsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, failure_rate: float = 0.0, max_batch: int = 1000):
+        super().__init__(address, StubSmsHandler)
+        self.failure_rate = failure_rate
+        self.max_batch = max_batch
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.received = []  # (to, text) of every message accepted
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/messages"
+
+
+class StubSmsHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        try:
+            messages = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["messages"]
+        except (TypeError, ValueError, KeyError):
+            return self._reply(400, {"error": "Malformed request"})
+        if len(messages) > server.max_batch:
+            return self._reply(413, {"error": f"At most {server.max_batch} messages per request"})
+        results = []
+        with server.lock:
+            server.requests += 1
+            for message in messages:
+                if server.random.random() < server.failure_rate:
+                    results.append({"error": "Stub delivery failure"})
+                else:
+                    server.received.append((message["to"], message["text"]))
+                    results.append({"id": str(uuid4())})
+        self._reply(200, {"results": results})
+
+    def _reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Run a stub on a background thread; port 0 picks a free port
+def start_stub_server(port: int = 0, failure_rate: float = 0.0, max_batch: int = 1000) -> StubSmsServer:
+    server = StubSmsServer(("127.0.0.1", port), failure_rate, max_batch)
+    threading.Thread(target=server.serve_forever, name="sms-stub", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = StubSmsServer(("127.0.0.1", args.port), args.failure_rate)
+    print("Stub SMS provider listening on", server.url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy.orm import Session
+
+from nuAPI.ids import new_id
+from nuAPI.models import MultiSplitPayment, PaymentStatus, SplitAllocation, SplitPayment
+from nuAPI.money import to_minor
+
+# Up to this many beneficiaries the parent row is a SplitPayment, above it a MultiSplitPayment
+SPLIT_PAYMENT_MAX_BENEFICIARIES = 2
+
+
+class SplitError(ValueError):
+    pass
+
+
+def largest_remainder(total: int, weights: Sequence[int]) -> List[int]:
+    # Floor every exact quota, then hand the leftover minor units to the
+    # largest fractional remainders (earlier shares win ties), so the parts
+    # always add back up to total.
+    weight_total = sum(weights)
+    if weight_total <= 0:
+        raise SplitError("Share weights must be positive")
+    parts = []
+    remainders = []
+    for index, weight in enumerate(weights):
+        part, remainder = divmod(total * weight, weight_total)
+        parts.append(part)
+        remainders.append((-remainder, index))
+    leftover = total - sum(parts)
+    if leftover:
+        remainders.sort()
+        for _, index in remainders[:leftover]:
+            parts[index] += 1
+    return parts
+
+
+def _percentage_weights(percentages: Sequence[Decimal]) -> List[int]:
+    places = max(-min(p.as_tuple().exponent for p in percentages), 0)
+    weights = [int(p.scaleb(places)) for p in percentages]
+    if any(weight <= 0 for weight in weights):
+        raise SplitError("Percentages must be positive")
+    if sum(weights) != 100 * 10 ** places:
+        raise SplitError("Percentages must add up to 100")
+    return weights
+
+
+# Fixed shares come off the top, percentage shares divide what is left
+def allocate_shares(total: int, shares: Sequence[Tuple[Optional[int], Optional[Decimal]]]) -> List[int]:
+    fixed = [amount for amount, _ in shares if amount is not None]
+    if any(amount <= 0 for amount in fixed):
+        raise SplitError("Fixed share amounts must be positive")
+    remaining = total - sum(fixed)
+    percentages = [percentage for amount, percentage in shares if amount is None]
+    if not percentages:
+        if remaining:
+            raise SplitError("Fixed shares must add up to the payment amount")
+        return list(fixed)
+    if remaining < 0:
+        raise SplitError("Fixed shares exceed the payment amount")
+    allocated = iter(largest_remainder(remaining, _percentage_weights(percentages)))
+    fixed_amounts = iter(fixed)
+    return [next(fixed_amounts) if amount is not None else next(allocated) for amount, _ in shares]
+
+
+# Split one payment between beneficiaries and write all ledger rows in one transaction
+def execute_split(db: Session, user_id: str, amount: Decimal, currency: str, shares: Sequence[Tuple[str, Optional[Decimal], Optional[Decimal]]], payment_method: str):
+    if not shares:
+        raise SplitError("At least one beneficiary is required")
+    total = to_minor(amount, currency)
+    allocations = allocate_shares(total, [
+        (to_minor(share_amount, currency) if share_amount is not None else None, percentage)
+        for _, percentage, share_amount in shares
+    ])
+
+    now = datetime.utcnow()
+    common = dict(
+        user_id=user_id,
+        amount=amount,
+        currency=currency,
+        date=now,
+        payment_method=payment_method,
+        payment_gateway_response="internal",
+        status=PaymentStatus.confirmed.value,
+    )
+    split_id = new_id()
+    if len(shares) <= SPLIT_PAYMENT_MAX_BENEFICIARIES:
+        split_type = "split"
+        db.add(SplitPayment(splitpayment_id=split_id, splitpayment_date=now, **common))
+    else:
+        split_type = "multisplit"
+        db.add(MultiSplitPayment(multisplitpayment_id=split_id, multisplitpayment_date=now, **common))
+
+    rows = [
+        {
+            "allocation_id": new_id(),
+            "split_id": split_id,
+            "split_type": split_type,
+            "beneficiary_id": beneficiary_id,
+            "amount": allocated,
+            "currency": currency,
+            "status": PaymentStatus.confirmed.value,
+            "date": now,
+        }
+        for (beneficiary_id, _, _), allocated in zip(shares, allocations)
+    ]
+    # One executemany for every child row (batched into multi-row VALUES on
+    # drivers that support it) instead of an ORM flush per beneficiary
+    db.execute(SplitAllocation.__table__.insert(), rows)
+    db.commit()
+    return split_id, now, rows
@@ -0,0 +1,241 @@
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Hashable, List, Optional
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from nuAPI.models import PaymentStatus, Wallet, WalletTransfer
+from nuAPI.paymentmodels import TRANSFER_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class TransferError(Exception):
+    pass
+
+
+class TimerWheel:
+    # Hashed timer wheel: a deadline lands in slot (now + ticks) % slots and
+    # carries how many full revolutions it still has to wait, so scheduling,
+    # cancelling and each tick are O(1) per timer instead of a table scan.
+    def __init__(self, tick: timedelta = timedelta(seconds=1), slots: int = 512, start: Optional[datetime] = None):
+        self.tick = tick
+        self.slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        self.current = 0
+        self.now = start or datetime.utcnow()
+        self._slot_of: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def schedule(self, key: Hashable, deadline: datetime):
+        with self._lock:
+            self._cancel(key)
+            ticks = max(1, math.ceil((deadline - self.now) / self.tick))
+            slot = (self.current + ticks) % len(self.slots)
+            self.slots[slot][key] = (ticks - 1) // len(self.slots)
+            self._slot_of[key] = slot
+
+    def cancel(self, key: Hashable):
+        with self._lock:
+            self._cancel(key)
+
+    def _cancel(self, key: Hashable):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self, now: Optional[datetime] = None) -> List[Hashable]:
+        now = now or datetime.utcnow()
+        expired = []
+        with self._lock:
+            while self.now + self.tick <= now:
+                self.now += self.tick
+                self.current = (self.current + 1) % len(self.slots)
+                bucket = self.slots[self.current]
+                for key, rounds in list(bucket.items()):
+                    if rounds:
+                        bucket[key] = rounds - 1
+                    else:
+                        del bucket[key]
+                        del self._slot_of[key]
+                        expired.append(key)
+        return expired
+
+
+transfer_wheel = TimerWheel()
+
+
+def _wallet_statements(source_wallet_id: str, destination_wallet_id: str, amount: Decimal):
+    debit = (
+        update(Wallet)
+        .where(Wallet.wallet_id == source_wallet_id, Wallet.wallet_balance >= amount)
+        .values(wallet_balance=Wallet.wallet_balance - amount)
+    )
+    credit = (
+        update(Wallet)
+        .where(Wallet.wallet_id == destination_wallet_id)
+        .values(wallet_balance=Wallet.wallet_balance + amount)
+    )
+    # Rows are always touched in wallet_id order so two opposing transfers
+    # queue on the same first row instead of deadlocking.
+    if source_wallet_id <= destination_wallet_id:
+        return [(debit, "Insufficient funds"), (credit, "Destination wallet not found")]
+    return [(credit, "Destination wallet not found"), (debit, "Insufficient funds")]
+
+
+def _move_funds(db: Session, source_wallet_id: str, destination_wallet_id: str, amount: Decimal):
+    # Each UPDATE is a single-row atomic read-modify-write, so the row lock is
+    # held only for the rest of this short transaction and hot wallets never
+    # pay for a separate SELECT ... FOR UPDATE round trip.
+    for statement, error in _wallet_statements(source_wallet_id, destination_wallet_id, amount):
+        if db.execute(statement).rowcount != 1:
+            raise TransferError(error)
+
+
+def _check_transfer(db: Session, source_wallet_id: str, destination_wallet_id: str, amount: Decimal, currency: str):
+    if source_wallet_id == destination_wallet_id:
+        raise TransferError("Source and destination wallets must differ")
+    if amount <= 0:
+        raise TransferError("Transfer amount must be positive")
+    wallets = db.query(Wallet.wallet_id, Wallet.wallet_currency).filter(
+        Wallet.wallet_id.in_([source_wallet_id, destination_wallet_id])
+    ).all()
+    if len(wallets) != 2:
+        raise TransferError("Wallet not found")
+    if any(wallet_currency not in (None, currency) for _, wallet_currency in wallets):
+        raise TransferError("Currency does not match wallet currency")
+
+
+# Create a pending wallet transfer
+def create_wallet_transfer(db: Session, source_wallet_id: str, destination_wallet_id: str, amount: Decimal, currency: str, timeout: timedelta = TRANSFER_TIMEOUT):
+    _check_transfer(db, source_wallet_id, destination_wallet_id, amount, currency)
+    now = datetime.utcnow()
+    transfer = WalletTransfer(
+        source_wallet_id=source_wallet_id,
+        destination_wallet_id=destination_wallet_id,
+        amount=amount,
+        currency=currency,
+        transfer_status=PaymentStatus.pending.value,
+        transfer_date=now,
+        expires_at=now + timeout,
+    )
+    db.add(transfer)
+    db.commit()
+    db.refresh(transfer)
+    transfer_wheel.schedule(transfer.transfer_id, transfer.expires_at)
+    return transfer
+
+
+# Debit and credit a pending transfer atomically
+def execute_wallet_transfer(db: Session, transfer_id: str):
+    now = datetime.utcnow()
+    claimed = db.execute(
+        update(WalletTransfer)
+        .where(
+            WalletTransfer.transfer_id == transfer_id,
+            WalletTransfer.transfer_status == PaymentStatus.pending.value,
+            WalletTransfer.expires_at > now,
+        )
+        .values(transfer_status=PaymentStatus.confirmed.value)
+    )
+    if claimed.rowcount != 1:
+        db.rollback()
+        raise TransferError("Transfer is not pending or has expired")
+    transfer = db.query(WalletTransfer).filter(WalletTransfer.transfer_id == transfer_id).one()
+    try:
+        _move_funds(db, transfer.source_wallet_id, transfer.destination_wallet_id, transfer.amount)
+    except TransferError:
+        db.rollback()
+        raise
+    db.commit()
+    transfer_wheel.cancel(transfer_id)
+    db.refresh(transfer)
+    return transfer
+
+
+# Immediate transfer: create and execute in a single transaction
+def transfer_funds(db: Session, source_wallet_id: str, destination_wallet_id: str, amount: Decimal, currency: str):
+    _check_transfer(db, source_wallet_id, destination_wallet_id, amount, currency)
+    now = datetime.utcnow()
+    transfer = WalletTransfer(
+        source_wallet_id=source_wallet_id,
+        destination_wallet_id=destination_wallet_id,
+        amount=amount,
+        currency=currency,
+        transfer_status=PaymentStatus.confirmed.value,
+        transfer_date=now,
+        expires_at=now,
+    )
+    try:
+        _move_funds(db, source_wallet_id, destination_wallet_id, amount)
+        db.add(transfer)
+        db.commit()
+    except TransferError:
+        db.rollback()
+        raise
+    return transfer
+
+
+# Cancel pending transfers whose TRANSFER_TIMEOUT has elapsed
+def expire_wallet_transfers(db: Session, now: Optional[datetime] = None) -> int:
+    expired = transfer_wheel.advance(now)
+    if not expired:
+        return 0
+    try:
+        result = db.execute(
+            update(WalletTransfer)
+            .where(
+                WalletTransfer.transfer_id.in_(expired),
+                WalletTransfer.transfer_status == PaymentStatus.pending.value,
+            )
+            .values(transfer_status=PaymentStatus.cancelled.value, transfer_message="Transfer timed out")
+        )
+        db.commit()
+    except Exception:
+        # The wheel has already let go of them; put them back for the next tick
+        db.rollback()
+        for transfer_id in expired:
+            transfer_wheel.schedule(transfer_id, now or datetime.utcnow())
+        raise
+    return result.rowcount
+
+
+# Re-arm the wheel from the table after a restart
+def load_pending_transfers(db: Session) -> int:
+    pending = db.query(WalletTransfer.transfer_id, WalletTransfer.expires_at).filter(
+        WalletTransfer.transfer_status == PaymentStatus.pending.value
+    )
+    count = 0
+    for transfer_id, expires_at in pending:
+        transfer_wheel.schedule(transfer_id, expires_at)
+        count += 1
+    return count
+
+
+def start_expiry_worker(session_factory, interval: float = 1.0) -> threading.Thread:
+    def run():
+        while True:
+            db = session_factory()
+            try:
+                expire_wallet_transfers(db)
+            except Exception:
+                logger.exception("Wallet transfer expiry failed")
+            finally:
+                db.close()
+            time.sleep(interval)
+
+    db = session_factory()
+    try:
+        load_pending_transfers(db)
+    finally:
+        db.close()
+    worker = threading.Thread(target=run, name="wallet-transfer-expiry", daemon=True)
+    worker.start()
+    return worker
@@ -0,0 +1,373 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from nuAPI.models import Wallet
+from nuAPI.money import from_minor, to_minor
+from nuAPI.transfers import TransferError, transfer_funds
+
+# Aggregators drop a session after a couple of minutes of silence
+SESSION_TTL = 180.0
+# Set to a file path to share sessions between worker processes on one host
+USSD_SESSION_DB = None
+# Hops are only taken from the aggregator: with a secret, each request body
+# must carry its HMAC-SHA256 (hex) in SIGNATURE_HEADER; with an allow-list,
+# it must come from one of those addresses; with both, both. Unless set here
+# they are read from NUAPI_USSD_SECRET and NUAPI_USSD_ALLOWED_IPS (comma
+# separated). With neither, every hop is refused.
+USSD_SECRET: Optional[bytes] = None
+USSD_ALLOWED_IPS: Optional[Set[str]] = None
+SIGNATURE_HEADER = "X-Ussd-Signature"
+# Numbers without an international prefix are taken to be in this country
+COUNTRY_CODE = "234"
+NATIONAL_NUMBER_LENGTH = 10
+MAX_PIN_FAILURES = 3  # wrong PINs before the wallet is locked until a new PIN is set
+PIN_SCRYPT_N = 2 ** 14
+
+Action = Callable[[Session, str, Dict[str, str]], str]
+
+
+class UssdError(Exception):
+    pass
+
+
+class CompiledNode(NamedTuple):
+    prompt: str
+    options: Dict[str, int]  # choice -> node id
+    field: Optional[str]  # free-text input stored under this name
+    next: Optional[int]  # node after a free-text input
+    action: Optional[str]  # terminal: run this action
+    end: Optional[str]  # terminal: static END text
+
+
+class UssdMenu:
+    # A declarative menu tree flattened once into a list of nodes addressed
+    # by index, so a hop is a couple of list/dict lookups.
+    def __init__(self, tree: Dict[str, Any], actions: Dict[str, Action]):
+        self.nodes: List[CompiledNode] = []
+        self.actions = actions
+        self.root = self._compile(tree)
+
+    def _compile(self, spec: Dict[str, Any]) -> int:
+        node_id = len(self.nodes)
+        self.nodes.append(None)
+        if "action" in spec and spec["action"] not in self.actions:
+            raise ValueError(f"Unknown USSD action {spec['action']}")
+        options = {choice: self._compile(child) for choice, child in spec.get("options", {}).items()}
+        following = self._compile(spec["next"]) if "next" in spec else None
+        prompt = spec.get("prompt", "")
+        if options:
+            prompt = "\n".join([prompt] + [f"{choice}. {child['label']}" for choice, child in spec["options"].items()])
+        self.nodes[node_id] = CompiledNode(prompt, options, spec.get("input"), following, spec.get("action"), spec.get("end"))
+        return node_id
+
+
+class UssdSession:
+    __slots__ = ("node", "consumed", "data", "expires")
+
+    def __init__(self, node: int, consumed: int, data: Dict[str, str], expires: float):
+        self.node = node
+        self.consumed = consumed  # length of the aggregator text already handled
+        self.data = data
+        self.expires = expires
+
+
+class SessionStore:
+    # Sessions kept in touch order; with one TTL that is also expiry order,
+    # so eviction only ever looks at the oldest entries.
+    def __init__(self, ttl: float = SESSION_TTL, max_sessions: int = 1_000_000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, UssdSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[UssdSession]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.expires < time.monotonic():
+                return None
+            return session
+
+    def put(self, session_id: str, session: UssdSession):
+        now = time.monotonic()
+        session.expires = now + self.ttl
+        with self._lock:
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            while self._sessions:
+                oldest = next(iter(self._sessions.values()))
+                if oldest.expires >= now and len(self._sessions) <= self.max_sessions:
+                    break
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SqliteSessionStore:
+    # Local shared backend so several workers on one host see the same sessions
+    def __init__(self, path: str, ttl: float = SESSION_TTL, purge_interval: float = 1.0):
+        self.ttl = ttl
+        self.path = path
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS ussd_sessions (session_id TEXT PRIMARY KEY, node INTEGER, consumed INTEGER, data TEXT, expires REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_ussd_sessions_expires ON ussd_sessions (expires)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, isolation_level=None)
+            # Session state is disposable, so skip the fsync on every hop
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+        return connection
+
+    def get(self, session_id: str) -> Optional[UssdSession]:
+        row = self._connection().execute(
+            "SELECT node, consumed, data, expires FROM ussd_sessions WHERE session_id = ? AND expires >= ?",
+            (session_id, time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        return UssdSession(row[0], row[1], json.loads(row[2]), row[3])
+
+    def put(self, session_id: str, session: UssdSession):
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO ussd_sessions VALUES (?, ?, ?, ?, ?)",
+            (session_id, session.node, session.consumed, json.dumps(session.data), now + self.ttl),
+        )
+        if now >= self._next_purge:
+            self._next_purge = now + self.purge_interval
+            connection.execute("DELETE FROM ussd_sessions WHERE expires < ?", (now,))
+
+    def delete(self, session_id: str):
+        self._connection().execute("DELETE FROM ussd_sessions WHERE session_id = ?", (session_id,))
+
+
+def session_store(path: Optional[str] = USSD_SESSION_DB):
+    return SqliteSessionStore(path) if path else SessionStore()
+
+
+class UssdEngine:
+    def __init__(self, menu: UssdMenu, store=None, session_factory=None):
+        self.menu = menu
+        self.store = store or SessionStore()
+        self.session_factory = session_factory
+
+    def _step(self, node_id: int, value: str, data: Dict[str, str]) -> Tuple[int, Optional[str]]:
+        node = self.menu.nodes[node_id]
+        if node.options:
+            choice = node.options.get(value)
+            if choice is None:
+                return node_id, "Invalid choice."
+            return choice, None
+        if node.field is not None:
+            data[node.field] = value
+            return node.next, None
+        return node_id, None
+
+    def _render(self, node_id: int, phone_number: str, data: Dict[str, str]) -> Tuple[str, bool]:
+        node = self.menu.nodes[node_id]
+        if node.action is not None:
+            db = self.session_factory() if self.session_factory else None
+            try:
+                return self.menu.actions[node.action](db, phone_number, data), True
+            finally:
+                if db is not None:
+                    db.close()
+        if node.end is not None:
+            return node.end, True
+        return node.prompt, False
+
+    # Handle one hop; text is the aggregator's cumulative "*"-joined input
+    def handle(self, session_id: str, phone_number: str, text: str) -> str:
+        session = self.store.get(session_id)
+        if session is None or len(text) < session.consumed:
+            session = UssdSession(self.menu.root, 0, {}, 0.0)
+        # Only the input added since the previous hop is parsed
+        pending = text[session.consumed:]
+        if session.consumed and pending.startswith("*"):
+            pending = pending[1:]
+        error = None
+        if pending:
+            for value in pending.split("*"):
+                session.node, error = self._step(session.node, value, session.data)
+        session.consumed = len(text)
+
+        message, finished = self._render(session.node, phone_number, session.data)
+        if finished:
+            self.store.delete(session_id)
+            return f"END {message}"
+        self.store.put(session_id, session)
+        return f"CON {error}\n{message}" if error else f"CON {message}"
+
+
+def authorise_aggregator(body: bytes, signature: Optional[str], client_ip: Optional[str]):
+    secret = USSD_SECRET or os.environ.get("NUAPI_USSD_SECRET", "").encode() or None
+    allowed = USSD_ALLOWED_IPS
+    if allowed is None:
+        allowed = {ip.strip() for ip in os.environ.get("NUAPI_USSD_ALLOWED_IPS", "").split(",") if ip.strip()}
+    if secret is None and not allowed:
+        raise UssdError("USSD aggregator is not configured: set NUAPI_USSD_SECRET or NUAPI_USSD_ALLOWED_IPS")
+    if secret is not None:
+        expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        if not signature or not hmac.compare_digest(expected, signature.strip().lower()):
+            raise UssdError("Bad aggregator signature")
+    if allowed and client_ip not in allowed:
+        raise UssdError("Aggregator address not allowed")
+
+
+# Digits only, with the country code: "+234 803 123 4567", "08031234567"
+# and "2348031234567" are all "2348031234567"; None if not a phone number
+def normalise_msisdn(number: str, country_code: str = COUNTRY_CODE) -> Optional[str]:
+    digits = re.sub(r"[\s()-]", "", number or "")
+    if digits.startswith("+"):
+        digits = digits[1:]
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif digits.startswith("0"):
+        digits = country_code + digits[1:]
+    elif len(digits) == NATIONAL_NUMBER_LENGTH:
+        digits = country_code + digits
+    if not digits.isdigit() or not 8 <= len(digits) <= 15:
+        return None
+    return digits
+
+
+def hash_pin(pin: str) -> str:
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(pin.encode(), salt=salt, n=PIN_SCRYPT_N, r=8, p=1)
+    return f"{salt.hex()}:{digest.hex()}"
+
+
+def _pin_matches(pin: str, pin_hash: str) -> bool:
+    salt, digest = pin_hash.split(":")
+    return hmac.compare_digest(hashlib.scrypt(pin.encode(), salt=bytes.fromhex(salt), n=PIN_SCRYPT_N, r=8, p=1).hex(), digest)
+
+
+# Link a wallet to the phone number USSD sessions come from and set its PIN,
+# which also lifts a lockout
+def link_wallet(db: Session, wallet: Wallet, msisdn: str, pin: str) -> Wallet:
+    taken = db.query(Wallet.wallet_id).filter(Wallet.wallet_msisdn == msisdn, Wallet.wallet_id != wallet.wallet_id).first()
+    if taken is not None:
+        raise UssdError("Phone number is linked to another wallet")
+    wallet.wallet_msisdn = msisdn
+    wallet.wallet_pin_hash = hash_pin(pin)
+    wallet.wallet_pin_failures = 0
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise UssdError("Phone number is linked to another wallet")
+    db.refresh(wallet)
+    return wallet
+
+
+def _wallet_for(db: Session, phone_number: str):
+    msisdn = normalise_msisdn(phone_number)
+    if msisdn is None:
+        return None
+    return db.query(Wallet).filter(Wallet.wallet_msisdn == msisdn).one_or_none()
+
+
+# An attempt is counted before the PIN is compared, so concurrent guesses
+# cannot get past MAX_PIN_FAILURES; a right PIN clears the count
+def _check_pin(db: Session, wallet: Wallet, pin: str) -> Optional[str]:
+    if wallet.wallet_pin_hash is None:
+        return "Set a wallet PIN in the app first."
+    pin_hash, wallet_id = wallet.wallet_pin_hash, wallet.wallet_id
+    claimed = db.execute(
+        update(Wallet)
+        .where(Wallet.wallet_id == wallet_id, Wallet.wallet_pin_failures < MAX_PIN_FAILURES)
+        .values(wallet_pin_failures=Wallet.wallet_pin_failures + 1)
+    ).rowcount
+    db.commit()
+    if not claimed:
+        return "Wallet locked after too many wrong PINs. Set a new PIN in the app."
+    if not _pin_matches(pin, pin_hash):
+        return "Wrong PIN."
+    db.execute(update(Wallet).where(Wallet.wallet_id == wallet_id).values(wallet_pin_failures=0))
+    db.commit()
+    return None
+
+
+def check_balance(db: Session, phone_number: str, data: Dict[str, str]) -> str:
+    wallet = _wallet_for(db, phone_number)
+    if wallet is None:
+        return "No wallet is linked to this number."
+    error = _check_pin(db, wallet, data.get("pin", ""))
+    if error:
+        return error
+    currency = wallet.wallet_currency or "NGN"
+    return f"Your balance is {currency} {from_minor(to_minor(Decimal(wallet.wallet_balance), currency), currency)}"
+
+
+def send_money(db: Session, phone_number: str, data: Dict[str, str]) -> str:
+    try:
+        amount = Decimal(data["amount"])
+    except (InvalidOperation, KeyError):
+        return "Invalid amount."
+    if not amount.is_finite() or amount <= 0:
+        return "Invalid amount."
+    source = _wallet_for(db, phone_number)
+    destination = _wallet_for(db, data.get("recipient", ""))
+    if source is None or destination is None:
+        return "Wallet not found."
+    error = _check_pin(db, source, data.get("pin", ""))
+    if error:
+        return error
+    try:
+        transfer_funds(db, source.wallet_id, destination.wallet_id, amount, source.wallet_currency or "NGN")
+    except TransferError as e:
+        return f"Transfer failed: {e}."
+    return f"Sent {amount} to {data['recipient']}."
+
+
+DEFAULT_MENU = {
+    "prompt": "Welcome to PlayerOne Finance",
+    "options": {
+        "1": {"label": "Check balance", "prompt": "Enter your wallet PIN", "input": "pin", "next": {"action": "check_balance"}},
+        "2": {
+            "label": "Send money",
+            "prompt": "Enter recipient phone number",
+            "input": "recipient",
+            "next": {
+                "prompt": "Enter amount",
+                "input": "amount",
+                "next": {
+                    "prompt": "Confirm transfer",
+                    "options": {
+                        # Asked last, so the PIN is used in the hop it arrives in and never kept in a session
+                        "1": {"label": "Confirm", "prompt": "Enter your wallet PIN", "input": "pin", "next": {"action": "send_money"}},
+                        "2": {"label": "Cancel", "end": "Transfer cancelled."},
+                    },
+                },
+            },
+        },
+    },
+}
+
+DEFAULT_ACTIONS: Dict[str, Action] = {
+    "check_balance": check_balance,
+    "send_money": send_money,
+}
@@ -0,0 +1,300 @@
+import argparse
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from concurrent.futures import Executor
+from datetime import datetime
+from itertools import repeat
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy import MetaData, Table, bindparam, inspect, select, update
+from sqlalchemy.orm import Session
+
+from nuAPI.models import CardVault
+
+# 32-byte AES key; the vault refuses to run without it. Unless set here it
+# is read on first use, base64-encoded, from the NUAPI_VAULT_KEY environment
+# variable or else from the file VAULT_KEY_FILE (or NUAPI_VAULT_KEY_FILE)
+# names. python -m nuAPI.vault new-key prints a fresh one.
+VAULT_KEY: Optional[bytes] = None
+VAULT_KEY_FILE: Optional[str] = None
+# Tokens start with 9, which no card scheme issues under, fail the Luhn check
+# and keep the PAN's length and last four digits
+TOKEN_PREFIX = "9"
+# Batches smaller than this are encrypted inline; the pool only pays off above it
+PARALLEL_THRESHOLD = 20_000
+
+_NONCE_SIZE = 12
+
+# (scheme, BIN prefixes); the longest matching prefix wins
+CARD_SCHEMES = [
+    ("verve", ("5060", "5061", "5078", "5079", "6500")),
+    ("amex", ("34", "37")),
+    ("discover", ("6011", "644", "645", "646", "647", "648", "649", "65")),
+    ("mastercard", ("51", "52", "53", "54", "55", "2221", "2222", "2223", "2224", "2225", "2226", "2227", "2228", "2229", "223", "224", "225", "226", "227", "228", "229", "23", "24", "25", "26", "270", "271", "2720")),
+    ("visa", ("4",)),
+]
+_SCHEME_BY_PREFIX = {prefix: scheme for scheme, prefixes in CARD_SCHEMES for prefix in prefixes}
+_PREFIX_LENGTHS = sorted({len(prefix) for prefix in _SCHEME_BY_PREFIX}, reverse=True)
+
+
+class VaultError(Exception):
+    pass
+
+
+def load_vault_key() -> Optional[bytes]:
+    global VAULT_KEY
+    if VAULT_KEY is None:
+        encoded = os.environ.get("NUAPI_VAULT_KEY")
+        path = VAULT_KEY_FILE or os.environ.get("NUAPI_VAULT_KEY_FILE")
+        if not encoded and path:
+            with open(path) as f:
+                encoded = f.read().strip()
+        if encoded:
+            try:
+                key = base64.b64decode(encoded, validate=True)
+            except binascii.Error:
+                raise VaultError("VAULT_KEY is not valid base64") from None
+            if len(key) != 32:
+                raise VaultError("VAULT_KEY must be 32 bytes")
+            VAULT_KEY = key
+    return VAULT_KEY
+
+
+def card_scheme(bin_or_pan: str) -> str:
+    for length in _PREFIX_LENGTHS:
+        scheme = _SCHEME_BY_PREFIX.get(bin_or_pan[:length])
+        if scheme is not None:
+            return scheme
+    return "unknown"
+
+
+# Each digit doubled with its digits summed, so a Luhn check is two sums over slices
+_DOUBLED = str.maketrans("0123456789", "0246813579")
+
+
+def luhn_valid(number: str) -> bool:
+    return (sum(map(int, number[-1::-2])) + sum(map(int, number[-2::-2].translate(_DOUBLED)))) % 10 == 0
+
+
+# Tokens fail the Luhn check, so a stored number that passes it is a PAN
+def is_pan(number: str) -> bool:
+    return number.isdigit() and 12 <= len(number) <= 19 and luhn_valid(number)
+
+
+def new_token(pan: str, entropy: Optional[bytes] = None) -> str:
+    width = len(pan) - len(TOKEN_PREFIX) - 4
+    entropy = entropy or secrets.token_bytes(8)
+    while True:
+        token = TOKEN_PREFIX + str(int.from_bytes(entropy, "big") % 10 ** width).zfill(width) + pan[-4:]
+        if not luhn_valid(token):
+            return token
+        entropy = secrets.token_bytes(8)
+
+
+def _keys(master: bytes) -> Tuple[bytes, bytes]:
+    # Separate keys for encryption and for the lookup digest
+    return (
+        hmac.new(master, b"card-vault:encrypt", hashlib.sha256).digest(),
+        hmac.new(master, b"card-vault:lookup", hashlib.sha256).digest(),
+    )
+
+
+# Runs in the worker processes, so it only takes and returns plain values.
+# Returns (token, nonce + ciphertext, scheme) per PAN.
+def seal_batch(pans: Sequence[str], key: bytes) -> List[Tuple[str, bytes, str]]:
+    aead = AESGCM(key)
+    # One read from the OS random source for every nonce and token in the batch
+    entropy = os.urandom(len(pans) * (_NONCE_SIZE + 8))
+    out = []
+    for n, pan in enumerate(pans):
+        offset = n * (_NONCE_SIZE + 8)
+        nonce = entropy[offset:offset + _NONCE_SIZE]
+        token = new_token(pan, entropy[offset + _NONCE_SIZE:offset + _NONCE_SIZE + 8])
+        out.append((token, nonce + aead.encrypt(nonce, pan.encode(), None), card_scheme(pan)))
+    return out
+
+
+def decrypt_batch(ciphertexts: Sequence[bytes], key: bytes) -> List[str]:
+    aead = AESGCM(key)
+    return [aead.decrypt(blob[:_NONCE_SIZE], blob[_NONCE_SIZE:], None).decode() for blob in ciphertexts]
+
+
+class TokenVault:
+    # PANs live only in card_vault, encrypted with AES-GCM. A keyed digest of
+    # the PAN is indexed so the same card always maps to the same token
+    # without decrypting anything.
+    def __init__(self, key: Optional[bytes] = None, executor: Optional[Executor] = None, workers: int = 1):
+        self._key = key
+        # (master, encryption key, lookup key), derived on first use
+        self._derived: Optional[Tuple[bytes, bytes, bytes]] = None
+        self.executor = executor
+        self.workers = workers
+
+    # The encryption and lookup keys. With no key configured nothing is
+    # vaulted: a random one would lose every PAN on restart.
+    def require_key(self) -> Tuple[bytes, bytes]:
+        master = self._key or load_vault_key()
+        if not master:
+            raise VaultError("VAULT_KEY is not configured: set NUAPI_VAULT_KEY or NUAPI_VAULT_KEY_FILE")
+        if self._derived is None or self._derived[0] != master:
+            self._derived = (master, *_keys(master))
+        return self._derived[1], self._derived[2]
+
+    def _digest(self, pan: str) -> str:
+        return hmac.new(self.require_key()[1], pan.encode(), hashlib.sha256).hexdigest()
+
+    def _seal(self, pans: List[str]) -> List[Tuple[str, bytes, str]]:
+        key = self.require_key()[0]
+        if self.executor is None or len(pans) < PARALLEL_THRESHOLD:
+            return seal_batch(pans, key)
+        size = -(-len(pans) // self.workers)
+        parts = self.executor.map(seal_batch, [pans[i:i + size] for i in range(0, len(pans), size)], repeat(key))
+        return [sealed for part in parts for sealed in part]
+
+    # Tokens for many PANs in one round trip per 500 existing cards and one insert
+    def tokenise_many(self, db: Session, pans: Sequence[str]) -> List[str]:
+        for pan in pans:
+            if not is_pan(pan):
+                raise VaultError("Invalid card number")
+        digests = [self._digest(pan) for pan in pans]
+        tokens: Dict[str, str] = {}
+        unique = list(dict.fromkeys(digests))
+        for start in range(0, len(unique), 500):
+            tokens.update(db.query(CardVault.pan_digest, CardVault.token).filter(CardVault.pan_digest.in_(unique[start:start + 500])))
+
+        new = {}
+        for pan, digest in zip(pans, digests):
+            if digest not in tokens and digest not in new:
+                new[digest] = pan
+        if new:
+            now = datetime.utcnow()
+            rows = []
+            issued = set()
+            for (digest, pan), (token, ciphertext, scheme) in zip(new.items(), self._seal(list(new.values()))):
+                while token in issued:
+                    token = new_token(pan)
+                issued.add(token)
+                tokens[digest] = token
+                rows.append({
+                    "token": token,
+                    "pan_digest": digest,
+                    "pan_ciphertext": ciphertext,
+                    "bin": pan[:6],
+                    "last4": pan[-4:],
+                    "scheme": scheme,
+                    "created_at": now,
+                })
+            db.execute(CardVault.__table__.insert(), rows)
+        return [tokens[digest] for digest in digests]
+
+    def tokenise(self, db: Session, pan: str) -> str:
+        return self.tokenise_many(db, [pan])[0]
+
+    # PANs for many tokens with one indexed lookup per 500; only for the charge path
+    def detokenise_many(self, db: Session, tokens: Sequence[str]) -> List[str]:
+        unique = list(dict.fromkeys(tokens))
+        found: Dict[str, bytes] = {}
+        for start in range(0, len(unique), 500):
+            found.update(db.query(CardVault.token, CardVault.pan_ciphertext).filter(CardVault.token.in_(unique[start:start + 500])))
+        missing = [token for token in unique if token not in found]
+        if missing:
+            raise VaultError(f"Unknown card token {missing[0]}")
+        try:
+            pans = dict(zip(found, decrypt_batch(list(found.values()), self.require_key()[0])))
+        except InvalidTag:
+            raise VaultError("Card vault entry does not decrypt; VAULT_KEY differs from the one it was sealed with")
+        return [pans[token] for token in tokens]
+
+    def detokenise(self, db: Session, token: str) -> str:
+        return self.detokenise_many(db, [token])[0]
+
+    # BIN and scheme of a token, for routing, without decrypting the PAN
+    def card_info(self, db: Session, token: str) -> Optional[Tuple[str, str, str]]:
+        row = db.query(CardVault.bin, CardVault.last4, CardVault.scheme).filter(CardVault.token == token).first()
+        return tuple(row) if row else None
+
+
+card_vault = TokenVault()
+
+# Old tables that may still hold PANs and CVVs: the per-channel cards table,
+# or the copy nuAPI.instruments migrate keeps of it
+LEGACY_CARD_TABLES = ("cards", "cards_legacy")
+
+
+# Swaps each (key, PAN) row's number for its token, a transaction per batch
+def _tokenise_rows(engine, vault: TokenVault, key, number, rows: List[Tuple], batch_size: int) -> int:
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        with engine.begin() as connection:
+            with Session(bind=connection) as db:
+                tokens = vault.tokenise_many(db, [pan for _, pan in batch])
+            connection.execute(
+                update(key.table).where(key == bindparam("row_key")).values({number: bindparam("token")}),
+                [{"row_key": row_key, "token": token} for (row_key, _), token in zip(batch, tokens)],
+            )
+    return len(rows)
+
+
+# Card numbers stored before the vault existed are replaced by tokens, and
+# CVVs, which must not be kept at all, are cleared. One transaction per batch,
+# and tokens are skipped, so a re-run picks up where a failed one stopped.
+def tokenise_stored_cards(engine, vault: Optional[TokenVault] = None, batch_size: int = 1000, log=print) -> Dict[str, int]:
+    from nuAPI.models import PaymentInstrument
+
+    vault = vault or card_vault
+    vault.require_key()
+    done = {}
+    instruments = PaymentInstrument.__table__
+    with engine.connect() as connection:
+        tables = set(inspect(connection).get_table_names())
+        rows = []
+        if instruments.name in tables:
+            rows = [tuple(row) for row in connection.execute(select(instruments.c.id, instruments.c.number).where(instruments.c.channel == "card"))
+                    if is_pan(row.number)]
+    done[instruments.name] = _tokenise_rows(engine, vault, instruments.c.id, instruments.c.number, rows, batch_size)
+
+    for name in LEGACY_CARD_TABLES:
+        if name not in tables:
+            continue
+        with engine.connect() as connection:
+            legacy = Table(name, MetaData(), autoload_with=connection)
+            cleared = None if legacy.c.card_cvv.nullable else ""
+            # Every CVV goes, whether or not its number is a token yet
+            connection.execute(update(legacy).where(legacy.c.card_cvv != "").values(card_cvv=cleared))
+            connection.commit()
+            rows = [tuple(row) for row in connection.execute(select(legacy.c.card_id, legacy.c.card_number)) if is_pan(row.card_number)]
+        done[name] = _tokenise_rows(engine, vault, legacy.c.card_id, legacy.c.card_number, rows, batch_size)
+    for name, count in done.items():
+        log(f"{name}: {count:,} card numbers tokenised")
+    return done
+
+
+#   python -m nuAPI.vault backfill
+def main():
+    from nuAPI.database import engine
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser("backfill")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+    commands.add_parser("new-key")
+    args = parser.parse_args()
+
+    if args.command == "new-key":
+        print(base64.b64encode(AESGCM.generate_key(bit_length=256)).decode())
+        return
+
+    t = time.perf_counter()
+    done = tokenise_stored_cards(engine, batch_size=args.batch_size)
+    print(f"{sum(done.values()):,} card numbers tokenised in {time.perf_counter() - t:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
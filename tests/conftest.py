@@ -0,0 +1,51 @@
+# Each test gets its own SQLite file under tmp_path, and the app its own
+# database in a temporary directory, so nothing here touches ./test.db.
+#
+#   python -m pytest tests
+import base64
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Read when nuAPI.database is first imported; nuAPI.main builds its schema there
+APP_DIR = tempfile.mkdtemp()
+os.environ["NUAPI_DATABASE_URL"] = "sqlite:///" + os.path.join(APP_DIR, "api.db")
+
+import nuAPI.changes  # noqa: F401  change_seq and tombstones on every flush
+from nuAPI.models import Base
+
+
+def sqlite_engine(path):
+    return create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = sqlite_engine(tmp_path / "api.db")
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session_factory(engine):
+    return sessionmaker(bind=engine, autoflush=False)
+
+
+# The app, started once for the whole run with its secrets from the environment
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("NUAPI_VAULT_KEY", base64.b64encode(os.urandom(32)).decode())
+        patch.setenv("NUAPI_OTP_SECRET", base64.b64encode(os.urandom(32)).decode())
+        from nuAPI.main import app
+
+        # Snapshots and the like go under the working directory
+        patch.chdir(APP_DIR)
+        with TestClient(app) as client:
+            yield client
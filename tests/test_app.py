@@ -0,0 +1,40 @@
+import base64
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from nuAPI import vault
+from nuAPI.vault import VaultError, load_vault_key
+
+
+def test_boots_with_the_vault_key_from_the_environment(client):
+    assert client.get("/").status_code == 200
+    assert len(vault.VAULT_KEY) == 32
+
+
+def test_refuses_to_start_without_a_vault_key(client, monkeypatch):
+    monkeypatch.delenv("NUAPI_VAULT_KEY", raising=False)
+    monkeypatch.delenv("NUAPI_VAULT_KEY_FILE", raising=False)
+    monkeypatch.setattr(vault, "VAULT_KEY", None)
+    with pytest.raises(VaultError, match="not configured"):
+        with TestClient(client.app):
+            pass
+
+
+def test_vault_key_from_a_file(tmp_path, monkeypatch):
+    key = os.urandom(32)
+    path = tmp_path / "vault.key"
+    path.write_text(base64.b64encode(key).decode() + "\n")
+    monkeypatch.delenv("NUAPI_VAULT_KEY", raising=False)
+    monkeypatch.setenv("NUAPI_VAULT_KEY_FILE", str(path))
+    monkeypatch.setattr(vault, "VAULT_KEY", None)
+    assert load_vault_key() == key
+
+
+@pytest.mark.parametrize("value", ["not base64!", base64.b64encode(b"short").decode()])
+def test_bad_vault_key_is_refused(monkeypatch, value):
+    monkeypatch.setenv("NUAPI_VAULT_KEY", value)
+    monkeypatch.setattr(vault, "VAULT_KEY", None)
+    with pytest.raises(VaultError):
+        load_vault_key()
@@ -0,0 +1,193 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from nuAPI.events import EVENT_RETENTION, EventSink, OutboxRelay, SubscriberSink
+from nuAPI.models import ConsumerOffset, PaymentEvent
+
+
+class FailingSink(EventSink):
+    def __init__(self):
+        self.failing = True
+        self.delivered = []
+
+    def deliver(self, events):
+        if self.failing:
+            raise RuntimeError("sink down")
+        self.delivered.extend(event["seq"] for event in events)
+
+
+def add_events(session_factory, count: int, created_at=None):
+    db = session_factory()
+    db.add_all(
+        PaymentEvent(event_type="payment.created", payment_id=f"payment-{n}", user_id="user", payload={},
+                     created_at=created_at or datetime.utcnow())
+        for n in range(count)
+    )
+    db.commit()
+    db.close()
+
+
+# By sink name; a sink that is not shared has one row per process
+def offsets(session_factory, relay):
+    names = {consumer: name for name, consumer in relay.consumers.items()}
+    db = session_factory()
+    try:
+        return {names.get(consumer, consumer): last_seq for consumer, last_seq in db.query(ConsumerOffset.consumer, ConsumerOffset.last_seq)}
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def subscribers():
+    sink = SubscriberSink()
+    sink.seen = []
+    sink.subscribe(lambda event: sink.seen.append(event["seq"]))
+    return sink
+
+
+def test_delivers_in_order_and_advances_the_offset(session_factory, subscribers):
+    relay = OutboxRelay(session_factory, {"subscribers": subscribers}, batch_size=2)
+    add_events(session_factory, 5)
+    while relay.relay_once():
+        pass
+    assert subscribers.seen == [1, 2, 3, 4, 5]
+    assert offsets(session_factory, relay) == {"subscribers": 5}
+
+
+def test_failing_sink_holds_its_offset_only(session_factory, subscribers):
+    failing = FailingSink()
+    relay = OutboxRelay(session_factory, {"subscribers": subscribers, "failing": failing}, retry_backoff=0)
+    add_events(session_factory, 3)
+    relay.relay_once()
+    assert subscribers.seen == [1, 2, 3]
+    assert offsets(session_factory, relay) == {"subscribers": 3, "failing": 0}
+
+    failing.failing = False
+    relay.relay_once()
+    assert failing.delivered == [1, 2, 3]
+    assert offsets(session_factory, relay) == {"subscribers": 3, "failing": 3}
+
+
+def test_failing_sink_waits_out_its_backoff(session_factory):
+    failing = FailingSink()
+    relay = OutboxRelay(session_factory, {"failing": failing}, retry_backoff=60)
+    add_events(session_factory, 1)
+    relay.relay_once()
+    failing.failing = False
+    assert relay.relay_once() == 0
+    assert failing.delivered == []
+
+
+# A gap younger than GAP_TIMEOUT may be a transaction still committing
+def test_waits_for_a_recent_gap(session_factory, subscribers):
+    add_events(session_factory, 3)
+    db = session_factory()
+    db.query(PaymentEvent).filter(PaymentEvent.seq == 2).delete()
+    db.commit()
+    db.close()
+    relay = OutboxRelay(session_factory, {"subscribers": subscribers})
+    relay.relay_once()
+    assert subscribers.seen == [1]
+
+    db = session_factory()
+    db.query(PaymentEvent).update({PaymentEvent.created_at: datetime.utcnow() - timedelta(minutes=1)})
+    db.commit()
+    db.close()
+    relay.relay_once()
+    assert subscribers.seen == [1, 3]
+
+
+def test_prune_keeps_undelivered_and_recent_events(session_factory, subscribers):
+    failing = FailingSink()
+    relay = OutboxRelay(session_factory, {"subscribers": subscribers, "failing": failing}, retry_backoff=0)
+    add_events(session_factory, 4, datetime.utcnow() - EVENT_RETENTION - timedelta(days=1))
+    relay.relay_once()
+    failing.failing = False
+    db = session_factory()
+    assert relay.prune(db) == 0  # the failing sink has had none of them
+    db.close()
+
+    relay.relay_once()
+    add_events(session_factory, 1)
+    db = session_factory()
+    assert relay.prune(db) == 4
+    assert [event.seq for event in db.query(PaymentEvent)] == [5]
+    db.close()
+
+
+# Pruning can empty the table; new events must still get seqs above every
+# consumer's offset or they would never be delivered
+def test_seqs_stay_monotonic_after_the_table_is_emptied(session_factory, subscribers):
+    relay = OutboxRelay(session_factory, {"subscribers": subscribers})
+    add_events(session_factory, 3, datetime.utcnow() - EVENT_RETENTION - timedelta(days=1))
+    relay.relay_once()
+    db = session_factory()
+    assert relay.prune(db) == 3
+    db.close()
+
+    add_events(session_factory, 1)
+    relay.relay_once()
+    assert subscribers.seen == [1, 2, 3, 4]
+    assert offsets(session_factory, relay) == {"subscribers": 4}
+
+
+# Every process has its own subscribers, so each relay's copy gets every
+# event and neither moves the other's offset
+def test_each_process_gets_every_event(session_factory, monkeypatch):
+    sinks = []
+    for pid in (101, 102):
+        monkeypatch.setattr("nuAPI.events.os.getpid", lambda pid=pid: pid)
+        sink = SubscriberSink()
+        sink.seen = []
+        sink.subscribe(lambda event, sink=sink: sink.seen.append(event["seq"]))
+        sinks.append((OutboxRelay(session_factory, {"subscribers": sink}), sink))
+        sinks[-1][0].relay_once()  # both running before any event
+    add_events(session_factory, 3)
+    for relay, _ in sinks:
+        relay.relay_once()
+    add_events(session_factory, 1)
+    sinks[1][0].relay_once()
+    assert [sink.seen for _, sink in sinks] == [[1, 2, 3], [1, 2, 3, 4]]
+    assert sorted(offsets(session_factory, sinks[0][0]).values()) == [3, 4]
+
+    # A process started later picks up from the furthest of them
+    monkeypatch.setattr("nuAPI.events.os.getpid", lambda: 103)
+    late = SubscriberSink()
+    late.seen = []
+    late.subscribe(lambda event: late.seen.append(event["seq"]))
+    relay = OutboxRelay(session_factory, {"subscribers": late})
+    add_events(session_factory, 1)
+    relay.relay_once()
+    assert late.seen == [5]
+
+
+# Another process delivering to a shared sink commits further while this
+# one is mid-batch; this one's commit must not move the offset back
+def test_offset_never_moves_back(session_factory):
+    class RacedSink(EventSink):
+        def deliver(self, events):
+            db = session_factory()
+            db.query(ConsumerOffset).update({ConsumerOffset.last_seq: 3})
+            db.commit()
+            db.close()
+
+    relay = OutboxRelay(session_factory, {"log": RacedSink()}, batch_size=1)
+    add_events(session_factory, 3)
+    relay.relay_once()
+    assert offsets(session_factory, relay) == {"log": 3}
+
+
+def test_prune_drops_processes_long_gone(session_factory, subscribers):
+    add_events(session_factory, 2, datetime.utcnow() - EVENT_RETENTION - timedelta(days=1))
+    db = session_factory()
+    db.add(ConsumerOffset(consumer="subscribers@gone:1", last_seq=0, updated_at=datetime.utcnow() - EVENT_RETENTION - timedelta(days=1)))
+    db.add(ConsumerOffset(consumer="subscribers@alive:1", last_seq=1, updated_at=datetime.utcnow()))
+    db.commit()
+    db.close()
+    relay = OutboxRelay(session_factory, {"subscribers": subscribers})
+    relay.relay_once()
+    db = session_factory()
+    assert relay.prune(db) == 1  # held back by the live process only
+    db.close()
+    assert offsets(session_factory, relay) == {"subscribers": 2, "subscribers@alive:1": 1}
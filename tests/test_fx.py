@@ -0,0 +1,72 @@
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+from fractions import Fraction
+
+import pytest
+
+from nuAPI.fx import RateCache, RateNotFound, convert_amounts, record_rate
+from nuAPI.models import FxRate
+
+T0 = datetime(2024, 3, 1)
+
+
+def test_rates_as_of_inverse_and_cross():
+    cache = RateCache()
+    cache.add("USD", "NGN", Decimal("1500"), T0 + timedelta(hours=2))
+    cache.add("USD", "NGN", Decimal("1400"), T0)  # added out of order
+    cache.add("USD", "KES", Decimal("130"), T0)
+    assert cache.rate("USD", "NGN", T0 + timedelta(hours=1)) == 1400
+    assert cache.rate("USD", "NGN", T0 + timedelta(hours=3)) == 1500
+    assert cache.rate("NGN", "USD", T0 + timedelta(hours=1)) == Fraction(1, 1400)
+    assert cache.rate("KES", "NGN", T0 + timedelta(hours=3)) == Fraction(1500, 130)
+    with pytest.raises(RateNotFound):
+        cache.rate("USD", "NGN", T0 - timedelta(seconds=1))
+    with pytest.raises(RateNotFound):
+        cache.rate("EUR", "NGN", T0)
+
+
+# Readers running while rates are added only ever see whole versions: the
+# newest rate as of a time is always one that was added for that time
+def test_reads_during_adds_see_whole_versions():
+    cache = RateCache()
+    cache.add("USD", "NGN", Decimal(1), T0)
+    versions = 2000
+    errors = []
+
+    def write():
+        for n in range(1, versions):
+            cache.add("USD", "NGN", Decimal(n + 1), T0 + timedelta(seconds=n))
+
+    def read():
+        for _ in range(versions):
+            for n in (0, versions // 2, versions - 1):
+                try:
+                    rate = cache.rate("USD", "NGN", T0 + timedelta(seconds=n))
+                except Exception as e:
+                    errors.append(e)
+                    return
+                if rate > n + 1:
+                    errors.append(AssertionError(f"rate {rate} as of second {n}"))
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert cache.rate("USD", "NGN", T0 + timedelta(seconds=versions)) == versions
+
+
+def test_recorded_rates_reload_and_convert(session_factory, monkeypatch):
+    cache = RateCache()
+    monkeypatch.setattr("nuAPI.fx.rate_cache", cache)
+    db = session_factory()
+    record_rate(db, "USD", "NGN", Decimal("1500"), T0)
+    assert db.query(FxRate).count() == 1
+    reloaded = RateCache()
+    reloaded.load(db)
+    db.close()
+    assert reloaded.rate("USD", "NGN", T0) == cache.rate("USD", "NGN", T0) == 1500
+    assert convert_amounts([Decimal("10.00"), Decimal("0.01")], "USD", "NGN", T0) == [Decimal("15000.00"), Decimal("15.00")]
+    assert convert_amounts([Decimal("1000.00")], "NGN", "USD", T0) == [Decimal("0.67")]
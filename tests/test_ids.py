@@ -0,0 +1,68 @@
+from uuid import UUID
+
+from sqlalchemy import text
+
+from nuAPI.ids import id_time_ms, migrate_ids, new_id, uuid7
+from nuAPI.models import Base, Wallet
+
+
+def insert_text_wallets(engine, ids):
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO wallets (wallet_id, user_id, wallet_name, wallet_number, wallet_status, wallet_date, wallet_balance, wallet_pin_failures) "
+            "VALUES (:id, 'user', 'main', '0000000000', 'active', CURRENT_TIMESTAMP, 0, 0)"
+        ), [{"id": wallet_id} for wallet_id in ids])
+
+
+def stored_types(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT typeof(wallet_id) FROM wallets ORDER BY rowid")).scalars().all()
+
+
+def test_uuid7_is_time_ordered():
+    ids = [new_id() for _ in range(1000)]
+    assert ids == sorted(ids)
+    assert UUID(ids[0]).version == 7
+    assert id_time_ms(ids[0]) <= id_time_ms(ids[-1])
+
+
+def test_migrate_converts_text_ids(engine, session_factory):
+    ids = [str(uuid7()) for _ in range(5)]
+    insert_text_wallets(engine, ids)
+    # Text ids do not match lookups by the 16-byte key until migrated
+    db = session_factory()
+    assert db.get(Wallet, ids[0]) is None
+    db.close()
+
+    converted = migrate_ids(engine, Base.metadata, batch_size=2, log=lambda line: None)
+    assert converted["wallets.wallet_id"] == 5
+    assert stored_types(engine) == ["blob"] * 5
+    db = session_factory()
+    assert [wallet.wallet_id for wallet in db.query(Wallet).order_by(Wallet.wallet_id)] == sorted(ids)
+    assert db.get(Wallet, ids[3]).wallet_id == ids[3]
+    db.close()
+
+
+def test_migrate_leaves_non_uuids_and_reruns_clean(engine):
+    insert_text_wallets(engine, [str(uuid7()), "legacy-1", str(uuid7())])
+    lines = []
+    assert migrate_ids(engine, Base.metadata, log=lines.append)["wallets.wallet_id"] == 2
+    assert lines == ["wallets.wallet_id: 2 converted, 1 not UUIDs left as text"]
+    assert stored_types(engine) == ["blob", "text", "blob"]
+    assert migrate_ids(engine, Base.metadata, vacuum=True, log=lines.append)["wallets.wallet_id"] == 0
+    assert stored_types(engine) == ["blob", "text", "blob"]
+
+
+def test_rows_written_after_migration_read_back(engine, session_factory):
+    insert_text_wallets(engine, [str(uuid7())])
+    migrate_ids(engine, Base.metadata, log=lambda line: None)
+    db = session_factory()
+    wallet = Wallet(user_id="user", wallet_name="main", wallet_number="1", wallet_status="active")
+    db.add(wallet)
+    db.commit()
+    wallet_id = wallet.wallet_id
+    db.close()
+    db = session_factory()
+    assert db.get(Wallet, wallet_id) is not None
+    assert db.query(Wallet).filter(Wallet.wallet_id == "not-a-uuid").count() == 0
+    db.close()
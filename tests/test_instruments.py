@@ -0,0 +1,119 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+import nuAPI.instruments
+from nuAPI.ids import uuid7
+from nuAPI.instruments import LEGACY_TABLES, legacy_columns, migrate_instruments, user_instruments
+from nuAPI.models import Bank, Card
+
+
+def legacy_ddl(name: str, cls) -> str:
+    columns = [f"{column} {'BLOB PRIMARY KEY' if target == 'id' else 'DATETIME' if target == 'date' else 'VARCHAR'}"
+               for column, target in legacy_columns(cls)]
+    return f"CREATE TABLE {name} ({', '.join(columns)})"
+
+
+# A database from before payment_instruments, with every old table
+@pytest.fixture
+def legacy_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        for name, cls in LEGACY_TABLES.items():
+            connection.execute(text(legacy_ddl(name, cls)))
+    yield engine
+    engine.dispose()
+
+
+def legacy_id() -> bytes:
+    return uuid7().bytes
+
+
+def test_migrate_moves_rows_and_keeps_old_tables(legacy_engine):
+    ids = [uuid7() for _ in range(3)]
+    with legacy_engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO cards (card_id, user_id, card_number, card_name, card_expiry, card_cvv, card_type, card_status, card_date, card_message) "
+            "VALUES (:id, 'user-1', 'tok_1', 'A N Other', '12/27', NULL, 'visa', 'active', :date, NULL)"
+        ), [{"id": ids[0].bytes, "date": datetime(2024, 1, 1)}])
+        connection.execute(text(
+            "INSERT INTO banks (bank_id, user_id, bank_name, bank_branch, bank_account, bank_status, bank_date, bank_message) "
+            "VALUES (:id, 'user-1', 'GTB', 'Lekki', '0123456789', 'active', :date, NULL)"
+        ), [{"id": str(id_), "date": datetime(2024, 2, 1)} for id_ in ids[1:]])
+
+    moved = migrate_instruments(legacy_engine, batch_size=1, log=lambda line: None)
+    assert moved["cards"] == 1 and moved["banks"] == 2
+    assert sum(moved.values()) == 3
+
+    tables, views = set(inspect(legacy_engine).get_table_names()), set(inspect(legacy_engine).get_view_names())
+    assert {"cards_legacy", "banks_legacy", "payment_instruments"} <= tables
+    assert set(LEGACY_TABLES) <= views
+
+    db = sessionmaker(bind=legacy_engine)()
+    card = db.query(Card).one()
+    assert (card.card_id, card.card_number, card.card_name, card.card_type) == (str(ids[0]), "tok_1", "A N Other", "visa")
+    assert sorted(bank.bank_id for bank in db.query(Bank)) == sorted(str(id_) for id_ in ids[1:])
+    assert [instrument.channel for instrument in user_instruments(db, "user-1")] == ["bank", "bank", "card"]
+    db.close()
+
+    # The old names still read and write, through the views
+    with legacy_engine.begin() as connection:
+        assert connection.execute(text("SELECT bank_name FROM banks WHERE bank_id = :id"), {"id": ids[1].bytes}).scalar() == "GTB"
+        connection.execute(text(
+            "INSERT INTO cards (card_id, user_id, card_number, card_name, card_status) VALUES (:id, 'user-2', 'tok_2', 'B', 'active')"
+        ), {"id": legacy_id()})
+        assert connection.execute(text("SELECT count(*) FROM payment_instruments WHERE channel = 'card'")).scalar() == 2
+
+
+def test_non_uuid_ids_are_reissued(legacy_engine):
+    with legacy_engine.begin() as connection:
+        connection.execute(text("INSERT INTO ussd (ussd_id, user_id, ussd_number, ussd_status) VALUES ('legacy-7', 'user-1', '*737#', 'active')"))
+    lines = []
+    assert migrate_instruments(legacy_engine, log=lines.append)["ussd"] == 1
+    assert any("1 given new ids" in line for line in lines)
+    with legacy_engine.connect() as connection:
+        (instrument_id,) = connection.execute(text("SELECT id FROM payment_instruments")).scalars().all()
+    assert instrument_id != b"legacy-7"
+
+
+def test_rerun_moves_nothing_twice(legacy_engine):
+    with legacy_engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO cards (card_id, user_id, card_number, card_status) VALUES (:id, 'user-1', 'tok_1', 'active')"
+        ), {"id": legacy_id()})
+    migrate_instruments(legacy_engine, log=lambda line: None)
+    assert migrate_instruments(legacy_engine, log=lambda line: None) == {}
+    with legacy_engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM payment_instruments")).scalar() == 1
+
+
+# A failed table rolls back alone; the re-run picks up from there
+def test_failed_table_is_retried(legacy_engine, monkeypatch):
+    with legacy_engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO cards (card_id, user_id, card_number, card_status) VALUES (:id, 'user-1', 'tok_1', 'active')"
+        ), {"id": legacy_id()})
+        connection.execute(text(
+            "INSERT INTO banks (bank_id, user_id, bank_account, bank_status) VALUES (:id, 'user-1', '0123456789', 'active')"
+        ), {"id": legacy_id()})
+
+    real = nuAPI.instruments._legacy_rows
+
+    def failing(rows, cls):
+        if cls is Bank:
+            raise RuntimeError("interrupted")
+        return real(rows, cls)
+
+    monkeypatch.setattr(nuAPI.instruments, "_legacy_rows", failing)
+    with pytest.raises(RuntimeError):
+        migrate_instruments(legacy_engine, log=lambda line: None)
+    tables = set(inspect(legacy_engine).get_table_names())
+    assert "cards_legacy" in tables and "banks" in tables
+
+    monkeypatch.setattr(nuAPI.instruments, "_legacy_rows", real)
+    moved = migrate_instruments(legacy_engine, log=lambda line: None)
+    assert "cards" not in moved and moved["banks"] == 1
+    with legacy_engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM payment_instruments")).scalar() == 2
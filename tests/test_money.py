@@ -0,0 +1,60 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+from pydantic import TypeAdapter
+
+from nuAPI.models import PaymentPlanInstalment
+from nuAPI.money import CurrencyMismatch, Money
+from nuAPI.schemas import InstalmentResponse
+
+
+def test_arithmetic_and_comparisons():
+    assert Money(150, "NGN") + Money(50, "NGN") == Money(200, "NGN")
+    assert Money(150, "NGN") > Money(50, "NGN") >= Money(50, "NGN")
+    with pytest.raises(CurrencyMismatch):
+        Money(1, "NGN") < Money(1, "USD")
+    # Not Money: a TypeError, as for any unorderable pair
+    with pytest.raises(TypeError):
+        Money(1, "NGN") < 5
+    with pytest.raises(TypeError):
+        Money(1, "NGN") + 5
+    assert Money(1, "NGN") != 1
+
+
+def test_serialises_as_decimal_amounts():
+    adapter = TypeAdapter(Money)
+    money = adapter.validate_python({"amount": "1500.50", "currency": "NGN"})
+    assert money == Money(150050, "NGN")
+    assert adapter.dump_json(money) == b'{"amount":"1500.50","currency":"NGN"}'
+    with pytest.raises(ValueError):
+        adapter.validate_python({"amount": "1.005", "currency": "NGN"})
+
+    # Response amounts take Money and keep the Decimal wire format
+    response = InstalmentResponse(sequence=1, due_date=date(2024, 3, 1), amount=money)
+    assert response.amount == Decimal("1500.50")
+    assert response.model_dump_json() == '{"sequence":1,"due_date":"2024-03-01","amount":"1500.50"}'
+
+
+def test_columns_read_back_as_money(session_factory):
+    db = session_factory()
+    db.add(PaymentPlanInstalment(paymentplan_id="plan", sequence=1, due_date=date(2024, 3, 1), money=Money(333, "NGN"), status="pending"))
+    db.commit()
+    db.expunge_all()
+    instalment = db.query(PaymentPlanInstalment).one()
+    assert (instalment.amount, instalment.currency) == (333, "NGN")
+    assert instalment.money == Money(333, "NGN")
+    assert db.query(PaymentPlanInstalment).filter(PaymentPlanInstalment.money == Money(333, "NGN")).count() == 1
+    db.close()
+
+
+def test_split_and_plan_responses_keep_decimal_amounts(client):
+    shares = [{"beneficiary_id": "0190a1b2-0000-7000-8000-00000000000%d" % n, "percentage": percentage} for n, percentage in enumerate(["50", "25", "25"])]
+    split = client.post("/split-payments/", json={"amount": "100.01", "currency": "NGN", "payment_method": "card", "shares": shares})
+    assert split.status_code == 200, split.json()
+    assert sorted(allocation["amount"] for allocation in split.json()["allocations"]) == ["25.00", "25.00", "50.01"]
+
+    plan = client.post("/payment-plans/", json={"amount": "100.00", "currency": "NGN", "instalment_count": 3, "frequency": "monthly",
+                                               "start_date": "2024-03-01", "payment_method": "card"})
+    assert plan.status_code == 200
+    assert [instalment["amount"] for instalment in plan.json()["instalments"]] == ["33.34", "33.33", "33.33"]
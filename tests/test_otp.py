@@ -0,0 +1,177 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI import otp
+from nuAPI.ids import uuid7
+from nuAPI.migrations import upgrade
+from nuAPI.models import OtpAttempt, OtpCode, SmsOutbox, SmsStatus
+from nuAPI.notifications import REDACTED_MESSAGE, NotificationDispatcher, enqueue_sms
+from nuAPI.otp import MAX_SENDS, MAX_VERIFY_ATTEMPTS, OtpError, OtpLocked, OtpStore, load_otp_secret
+
+SECRET = b"s" * 32
+PHONE = "+2348000000001"
+
+
+def wrong(code: str) -> str:
+    return str((int(code) + 1) % 10 ** len(code)).zfill(len(code))
+
+
+# Two API workers: separate memory, one database
+@pytest.fixture
+def workers():
+    return OtpStore(SECRET), OtpStore(SECRET)
+
+
+def test_memory_store_verifies_once():
+    store = OtpStore(SECRET)
+    code, _ = store.issue(PHONE)
+    assert not store.verify(PHONE, wrong(code))
+    assert store.verify(PHONE, code)
+    assert not store.verify(PHONE, code)
+
+
+def test_memory_store_locks_after_failures_and_rejects_expired_codes():
+    store = OtpStore(SECRET, ttl=10)
+    now = time.time()
+    code, _ = store.issue(PHONE, now=now)
+    assert not store.verify(PHONE, code, now=now + 11)
+    for _ in range(MAX_VERIFY_ATTEMPTS - 1):
+        store.verify(PHONE, wrong(code), now=now + 12)
+    with pytest.raises(OtpLocked):
+        store.verify(PHONE, code, now=now + 13)
+
+
+def test_code_sent_by_one_worker_verifies_on_another_once(session_factory, workers):
+    first, second = workers
+    db = session_factory()
+    code, _ = first.issue(PHONE, db)
+    db.commit()
+    assert db.get(OtpCode, PHONE).code_hash != code
+    assert second.verify(PHONE, code, db)
+    # Used up everywhere, including on the worker that still holds it in memory
+    assert not first.verify(PHONE, code, db)
+    assert not second.verify(PHONE, code, db)
+    db.close()
+
+
+def test_failures_on_every_worker_count_towards_one_lockout(session_factory, workers):
+    db = session_factory()
+    code, _ = workers[0].issue(PHONE, db)
+    db.commit()
+    for attempt in range(MAX_VERIFY_ATTEMPTS):
+        assert not workers[attempt % 2].verify(PHONE, wrong(code), db)
+    for worker in workers:
+        with pytest.raises(OtpLocked):
+            worker.verify(PHONE, code, db)
+    # A third worker that has seen none of it is locked out too
+    with pytest.raises(OtpLocked):
+        OtpStore(SECRET).verify(PHONE, code, db)
+    db.close()
+
+
+def test_sends_on_every_worker_count_towards_one_limit(session_factory, workers):
+    db = session_factory()
+    for n in range(MAX_SENDS):
+        workers[n % 2].issue(PHONE, db)
+        db.commit()
+    with pytest.raises(OtpLocked):
+        OtpStore(SECRET).issue(PHONE, db)
+    db.close()
+
+
+def test_success_clears_failures_and_purge_drops_used_codes(session_factory, workers):
+    db = session_factory()
+    code, _ = workers[0].issue(PHONE, db)
+    db.commit()
+    workers[1].verify(PHONE, wrong(code), db)
+    assert workers[0].verify(PHONE, code, db)
+    assert db.query(OtpAttempt).filter(OtpAttempt.kind == "failure").count() == 0
+    assert workers[0].purge(db, time.time() + otp.ATTEMPT_WINDOW + 1) == 2  # the used code and the send
+    assert db.query(OtpCode).count() == db.query(OtpAttempt).count() == 0
+    db.close()
+
+
+def test_secret_from_environment_or_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(otp, "OTP_SECRET", None)
+    monkeypatch.delenv("NUAPI_OTP_SECRET", raising=False)
+    path = tmp_path / "otp.secret"
+    path.write_text("f" * 40 + "\n")
+    monkeypatch.setenv("NUAPI_OTP_SECRET_FILE", str(path))
+    assert load_otp_secret() == b"f" * 40
+
+    monkeypatch.setattr(otp, "OTP_SECRET", None)
+    monkeypatch.setenv("NUAPI_OTP_SECRET", "too short")
+    with pytest.raises(OtpError):
+        load_otp_secret()
+
+
+def test_store_without_a_secret_refuses(monkeypatch):
+    monkeypatch.setattr(otp, "OTP_SECRET", None)
+    monkeypatch.delenv("NUAPI_OTP_SECRET", raising=False)
+    monkeypatch.delenv("NUAPI_OTP_SECRET_FILE", raising=False)
+    with pytest.raises(OtpError, match="not configured"):
+        OtpStore().issue(PHONE)
+
+
+class Provider:
+    batch_size = 100
+
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    async def send_batch(self, messages):
+        self.sent.extend(messages)
+        return [(None, self.error) if self.error else ("provider-1", None) for _ in messages]
+
+
+@pytest.mark.parametrize("error, status", [(None, SmsStatus.sent.value), ("unreachable", SmsStatus.failed.value)])
+def test_codes_are_redacted_from_the_outbox_once_dispatched(session_factory, monkeypatch, error, status):
+    monkeypatch.setattr("nuAPI.notifications.MAX_ATTEMPTS", 1)
+    db = session_factory()
+    code = enqueue_sms(db, "PlayerOne: your verification code is 123456.", recipient=PHONE, sensitive=True)
+    receipt = enqueue_sms(db, "PlayerOne: payment received.", recipient="+2348000000002")
+    db.commit()
+    code, receipt = code.id, receipt.id
+    provider = Provider(error)
+    asyncio.run(NotificationDispatcher(session_factory, provider).dispatch_once())
+    assert (PHONE, "PlayerOne: your verification code is 123456.") in provider.sent
+    db.expire_all()
+    assert (db.get(SmsOutbox, code).status, db.get(SmsOutbox, code).message) == (status, REDACTED_MESSAGE)
+    assert db.get(SmsOutbox, receipt).message == "PlayerOne: payment received."
+    db.close()
+
+
+def test_send_and_verify_through_the_api(client):
+    from nuAPI.database import SessionLocal
+
+    phone = "+2348000000099"
+    assert client.post("/2fa/send", json={"phone_number": phone}).status_code == 200
+    db = SessionLocal()
+    sms = db.query(SmsOutbox).filter(SmsOutbox.recipient == phone).one()
+    assert sms.sensitive
+    code = sms.message.rsplit(" ", 1)[1].rstrip(".")
+    db.close()
+    assert client.post("/2fa/verify", json={"phone_number": phone, "code": wrong(code)}).status_code == 400
+    assert client.post("/2fa/verify", json={"phone_number": phone, "code": code}).status_code == 200
+    assert client.post("/2fa/verify", json={"phone_number": phone, "code": code}).status_code == 400
+
+
+def test_migration_redacts_codes_already_sent(engine):
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE sms_outbox DROP COLUMN sensitive"))
+        connection.execute(text(
+            "INSERT INTO sms_outbox (id, recipient, message, status, attempts, next_attempt_at, created_at) "
+            "VALUES (:id, :phone, 'PlayerOne: your verification code is 123456.', :status, 0, :now, :now)"
+        ), [{"id": uuid7().bytes, "phone": PHONE, "status": status, "now": datetime.utcnow()}
+            for status in (SmsStatus.sent.value, SmsStatus.pending.value)])
+    assert "sms_outbox.sensitive" in upgrade(engine, log=lambda line: None)
+    db = sessionmaker(bind=engine)()
+    rows = dict(db.query(SmsOutbox.status, SmsOutbox.message).filter(SmsOutbox.sensitive.is_(True)))
+    assert rows == {SmsStatus.sent.value: REDACTED_MESSAGE, SmsStatus.pending.value: "PlayerOne: your verification code is 123456."}
+    db.close()
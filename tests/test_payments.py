@@ -0,0 +1,64 @@
+from uuid import UUID, uuid4
+
+import nuAPI.dedup
+from nuAPI.dedup import FingerprintIndex
+from nuAPI.sharding import payment_slot, user_slot
+
+
+def card_payment(**fields) -> dict:
+    return dict({"user_id": str(uuid4()), "amount": "25.00", "currency": "NGN", "customer_name": "A N Other", "card_number": "4111111111111111",
+                 "card_expiry": "12/29", "cvv": "123", "status": "pending"}, **fields)
+
+
+# The id a create returns is the one every other call takes
+def test_returned_id_reads_updates_and_deletes(client):
+    request = card_payment()
+    created = client.post("/card-payments/", json=request)
+    assert created.status_code == 200
+    payment_id = created.json()["card_payment_id"]
+    assert payment_slot(payment_id) == user_slot(request["user_id"])
+
+    read = client.get(f"/card-payments/{payment_id}")
+    assert read.status_code == 200 and read.json()["card_payment_id"] == payment_id
+    updated = client.put(f"/card-payments/{payment_id}", json=dict(request, status="confirmed"))
+    assert updated.status_code == 200 and updated.json()["card_payment_id"] == payment_id
+    assert client.get(f"/card-payments/{payment_id}").json()["status"] == "confirmed"
+    assert client.delete(f"/card-payments/{payment_id}").status_code == 200
+    assert client.get(f"/card-payments/{payment_id}").status_code == 404
+
+
+# Every card response carries the same fields, the vault token included
+def test_card_responses_match(client):
+    request = card_payment()
+    created = client.post("/card-payments/", json=request).json()
+    payment_id, token = created["card_payment_id"], created["card_token"]
+    assert token is not None
+    read = client.get(f"/card-payments/{payment_id}").json()
+    updated = client.put(f"/card-payments/{payment_id}", json=dict(request, status="confirmed")).json()
+    deleted = client.delete(f"/card-payments/{payment_id}").json()
+    for body in (read, updated, deleted):
+        assert set(body) == set(created)
+        assert (body["card_payment_id"], body["card_token"]) == (payment_id, token)
+
+
+def test_unknown_ids_are_not_found(client):
+    assert client.get(f"/card-payments/{uuid4()}").status_code == 404
+    assert client.get("/card-payments/not-an-id").status_code == 404
+    assert client.put(f"/card-payments/{UUID(int=0)}", json=card_payment()).status_code == 404
+
+
+# A double tap is refused with the id of the payment it repeats
+def test_double_tap_is_a_conflict(client, monkeypatch):
+    request = card_payment()
+    first = client.post("/card-payments/", json=request).json()["card_payment_id"]
+    repeat = client.post("/card-payments/", json=request)
+    assert repeat.status_code == 409
+    assert repeat.json()["detail"] == f"Duplicate of payment {first}"
+    assert client.post("/card-payments/", json=dict(request, amount="26.00")).status_code == 200
+
+    # Another worker's payment, seen only in the database
+    monkeypatch.setattr(nuAPI.dedup, "duplicate_index", FingerprintIndex())
+    monkeypatch.setattr(nuAPI.dedup, "DUPLICATE_BACKEND", "database")
+    repeat = client.post("/card-payments/", json=request)
+    assert repeat.status_code == 409
+    assert repeat.json()["detail"] == f"Duplicate of payment {first}"
@@ -0,0 +1,95 @@
+import threading
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from nuAPI.auth import create_access_token
+from nuAPI.ratelimit import MERCHANT_CLAIM, LocalBackend, RateLimiter, RateLimitMiddleware, SqliteBackend
+
+T0 = 1_700_000_000.0
+LIMITS = {"user": (1.0, 2), "merchant": (10.0, 20), "ip": (100.0, 100)}
+
+
+def scope(path="/payments/", ip="10.0.0.1", token=None):
+    headers = [(b"authorization", f"Bearer {token}".encode())] if token else []
+    return {"type": "http", "path": path, "client": (ip, 1234), "headers": headers}
+
+
+def test_burst_then_refill():
+    limiter = RateLimiter(LocalBackend(), limits=LIMITS, route_limits={})
+    token = create_access_token({"sub": "user-1"})
+    assert [limiter.check(scope(token=token), T0) for _ in range(3)] == [0.0, 0.0, 1.0]
+    # Another user behind the same IP has their own bucket
+    assert limiter.check(scope(token=create_access_token({"sub": "user-2"})), T0) == 0.0
+    assert limiter.check(scope(token=token), T0 + 1.0) == 0.0
+
+
+def test_refused_requests_charge_no_bucket():
+    limiter = RateLimiter(LocalBackend(), limits=LIMITS, route_limits={})
+    token = create_access_token({"sub": "user-1", MERCHANT_CLAIM: "merchant-1"})
+    for _ in range(2):
+        limiter.check(scope(token=token), T0)
+    for _ in range(50):
+        assert limiter.check(scope(token=token), T0) > 0
+    # The merchant bucket was not drawn down by the refused calls
+    other = create_access_token({"sub": "user-2", MERCHANT_CLAIM: "merchant-1"})
+    assert [limiter.check(scope(token=other), T0) for _ in range(2)] == [0.0, 0.0]
+
+
+def test_unverified_tokens_fall_back_to_the_ip():
+    limiter = RateLimiter(LocalBackend(), limits={"user": (1.0, 1), "ip": (1.0, 3)}, route_limits={})
+    assert [limiter.check(scope(token="forged"), T0) for _ in range(4)] == [0.0, 0.0, 0.0, 1.0]
+
+
+def test_routes_have_their_own_budgets():
+    limiter = RateLimiter(LocalBackend(), limits=LIMITS, route_limits={"/2fa": {"ip": (1.0, 1)}})
+    assert limiter.check(scope("/2fa/verify"), T0) == 0.0
+    assert limiter.check(scope("/2fa/verify"), T0) == 1.0
+    assert limiter.check(scope("/payments/"), T0) == 0.0
+
+
+# Past max_buckets the least recently used bucket goes, not the table's bound
+def test_local_table_stays_bounded():
+    backend = LocalBackend(max_buckets=8)
+    busy = ("busy", 1.0, 1.0)
+    for n in range(100):
+        backend.take([busy], T0 + n / 1000)
+        backend.take([(f"caller-{n}", 1.0, 1.0)], T0 + n / 1000)
+        assert len(backend) <= 8
+    assert len(backend.full_at) <= 8
+    # Kept in use throughout, so still empty: not reset by the evictions
+    assert backend.take([busy], T0 + 0.1) > 0
+
+
+def test_sqlite_buckets_are_shared(tmp_path):
+    path = str(tmp_path / "buckets.db")
+    first, second = SqliteBackend(path), SqliteBackend(path)
+    bucket = ("user:*:user-1", 1.0, 2.0)
+    assert first.take([bucket], T0) == 0.0
+    assert second.take([bucket], T0) == 0.0
+    assert first.take([bucket], T0) == 1.0
+
+
+def test_middleware_answers_429_off_the_event_loop(tmp_path):
+    app = FastAPI()
+    threads = []
+    backend = SqliteBackend(str(tmp_path / "buckets.db"))
+    take = backend.take
+
+    def recording_take(buckets, now):
+        threads.append(threading.current_thread())
+        return take(buckets, now)
+
+    backend.take = recording_take
+
+    @app.get("/ping")
+    def ping():
+        return {"ok": True}
+
+    app.add_middleware(RateLimitMiddleware, limiter=RateLimiter(backend, limits={"ip": (0.5, 2)}, route_limits={}))
+    with TestClient(app) as client:
+        assert [client.get("/ping").status_code for _ in range(3)] == [200, 200, 429]
+        refused = client.get("/ping")
+        assert refused.json() == {"detail": "Too many requests"}
+        assert refused.headers["Retry-After"] == "2"
+    assert threading.main_thread() not in threads
@@ -0,0 +1,111 @@
+import csv
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import nuAPI.sharding
+from nuAPI.models import Base, Payments, PaymentStatus, ReconciliationResult, ShardSlotRange, Transaction
+from nuAPI.reconciliation import reconcile_settlement_file
+from nuAPI.sharding import ShardRouter, new_payment_id, shard_engine, user_slot
+
+DAY = date(2024, 3, 1)
+AT = datetime(2024, 3, 1, 12)
+STRATEGIES = {"hash": 10 ** 9, "sort_merge": 0}
+
+
+def payment(reference: str, amount: str, user_id: str = "user-1", **fields) -> dict:
+    slot = user_slot(user_id)
+    payment_id = new_payment_id(slot)
+    return dict({"id": payment_id, "payment_id": payment_id, "shard_slot": slot, "user_id": user_id, "amount": Decimal(amount), "currency": "NGN",
+                 "payment_status": PaymentStatus.confirmed, "payment_reference": "PR-" + reference, "transaction_reference": reference,
+                 "timestamp": AT}, **fields)
+
+
+def settlement(tmp_path, rows) -> str:
+    path = tmp_path / "settlement.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["reference", "amount", "currency"])
+        writer.writerows(rows)
+    return str(path)
+
+
+def outcome(db, run) -> set:
+    return {(row.reference, row.status.value, row.our_amount, row.their_amount)
+            for row in db.query(ReconciliationResult).filter(ReconciliationResult.run_id == run.run_id)}
+
+
+# References whose order differs by case and accent, as a database
+# collation other than code point order would sort them
+@pytest.fixture
+def ours(session_factory):
+    db = session_factory()
+    db.execute(Payments.__table__.insert(), [
+        payment("b-100", "10.00"), payment("B-200", "20.00"), payment("é-300", "30.00"), payment("a-400", "40.00"), payment("Z-500", "50.00"),
+        payment("c-600", "60.00", timestamp=datetime(2024, 3, 2)),  # another day
+    ])
+    db.add(Transaction(amount=Decimal("70.00"), currency="NGN", date=AT, payment_reference="É-700", payment_method="card",
+                       payment_gateway_response="ok", status="ok"))
+    db.commit()
+    db.close()
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_settlement_file_is_matched(session_factory, ours, tmp_path, strategy):
+    path = settlement(tmp_path, [
+        ("b-100", "10.00", "NGN"),
+        ("PR-B-200", "20.00", "NGN"),  # quoted by the payment reference
+        ("é-300", "31.00", "NGN"),
+        ("é-300", "30.00", "NGN"),  # later line for the same entry
+        ("É-700", "70.00", "NGN"),
+        ("x-999", "5.00", "NGN"),
+        ("c-600", "60.00", "NGN"),  # ours, but not that day
+    ])
+    db = session_factory()
+    run = reconcile_settlement_file(db, path, DAY, "test", max_index_entries=STRATEGIES[strategy], store_matched=True)
+    assert run.strategy == strategy
+    assert run.counts == {"matched": 3, "amount_mismatch": 1, "missing_ours": 2, "missing_theirs": 2, "duplicate": 1}
+    assert outcome(db, run) == {
+        ("b-100", "matched", 1000, 1000),
+        ("PR-B-200", "matched", 2000, 2000),
+        ("é-300", "amount_mismatch", 3000, 3100),
+        ("é-300", "duplicate", 3000, 3000),
+        ("É-700", "matched", 7000, 7000),
+        ("x-999", "missing_ours", None, 500),
+        ("c-600", "missing_ours", None, 6000),
+        ("a-400", "missing_theirs", 4000, None),
+        ("Z-500", "missing_theirs", 5000, None),
+    }
+    db.close()
+
+
+# Payments on every shard count, each once even when a copy is left on a
+# shard its slot has moved off
+def test_payments_on_shards_are_matched(session_factory, tmp_path, monkeypatch):
+    directory = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'directory.db'}"))
+    Base.metadata.create_all(bind=directory.kw["bind"], tables=[ShardSlotRange.__table__])
+    router = ShardRouter(directory, [sessionmaker(bind=shard_engine(f"sqlite:///{tmp_path / f'shard{n}.db'}")) for n in range(2)])
+    router.load_map()
+    monkeypatch.setattr(nuAPI.sharding, "shard_router", router)
+
+    users = {shard: next(f"user-{n}" for n in range(10_000) if router.shard_for_slot(user_slot(f"user-{n}")) == shard) for shard in range(2)}
+    rows = {shard: payment(f"ref-{shard}", "10.00", users[shard]) for shard in range(2)}
+    for shard in range(2):
+        db = router.session(shard)
+        db.execute(Payments.__table__.insert(), [rows[shard]])
+        db.commit()
+        db.close()
+    db = router.session(1)
+    db.execute(Payments.__table__.insert(), [rows[0]])  # left over from a move
+    db.commit()
+    db.close()
+
+    path = settlement(tmp_path, [("ref-0", "10.00", "NGN"), ("ref-1", "10.00", "NGN")])
+    for max_index_entries in STRATEGIES.values():
+        db = session_factory()
+        run = reconcile_settlement_file(db, path, DAY, "test", max_index_entries=max_index_entries)
+        assert run.counts == {"matched": 2, "amount_mismatch": 0, "missing_ours": 0, "missing_theirs": 0, "duplicate": 0}
+        db.close()
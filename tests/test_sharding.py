@@ -0,0 +1,180 @@
+import random
+from decimal import Decimal
+from uuid import UUID
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from nuAPI.changes import change_sources, next_cursor, parse_cursor, _read
+from nuAPI.ids import new_id
+from nuAPI.migrations import upgrade
+from nuAPI.models import Base, Payments, PaymentStatus, ShardSlotRange
+from nuAPI.sharding import (
+    SLOTS, ShardRouter, ShardingError, _set_range, move_slots, new_payment_id, payment_slot, shard_engine, user_slot,
+)
+
+
+def new_payment(user_id: str) -> dict:
+    slot = user_slot(user_id)
+    return {"id": new_payment_id(slot), "shard_slot": slot, "user_id": user_id, "amount": Decimal(random.randint(100, 100_000)),
+            "currency": "NGN", "payment_status": PaymentStatus.pending, "payment_id": new_payment_id(slot),
+            "payment_reference": new_payment_id(slot), "transaction_reference": new_payment_id(slot)}
+
+
+# Two shards holding the whole slot space, and an empty third to move to
+@pytest.fixture
+def router(tmp_path):
+    directory_engine = create_engine(f"sqlite:///{tmp_path / 'primary.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=directory_engine, tables=[ShardSlotRange.__table__])
+    factories = [sessionmaker(bind=shard_engine(f"sqlite:///{tmp_path / f'shard{n}.db'}")) for n in range(3)]
+    router = ShardRouter(sessionmaker(bind=directory_engine), factories[:2])
+    router.load_map()
+    router.shard_factories = factories
+    return router
+
+
+def load(router, payments: int, users: int = 200):
+    rows = [new_payment(f"user-{random.randrange(users)}") for _ in range(payments)]
+    for shard in range(2):
+        db = router.session(shard)
+        db.execute(Payments.__table__.insert(), [row for row in rows if router.shard_for_slot(row["shard_slot"]) == shard])
+        db.commit()
+        db.close()
+    return rows
+
+
+def payments_on(router, shard: int, first: int = 0, last: int = 4095) -> dict:
+    db = router.session(shard)
+    try:
+        return {payment.id: payment.amount for payment in db.query(Payments).filter(Payments.shard_slot.between(first, last))}
+    finally:
+        db.close()
+
+
+def test_move_copies_every_row_once(router):
+    rows = load(router, 2000)
+    first, last, source, _ = router.map.ranges[0]
+    moving = {row["id"] for row in rows if first <= row["shard_slot"] <= last}
+    copied = move_slots(router, first, last, 2, batch_size=64, grace=0, log=lambda line: None)
+    assert copied == len(moving)
+    assert set(payments_on(router, 2)) == moving
+    assert payments_on(router, source, first, last) == {}
+    assert all(router.shard_for_slot(slot) == 2 for slot in range(first, last + 1))
+    assert sum(len(payments_on(router, shard)) for shard in range(3)) == len(rows)
+
+
+# Writes landing between passes: an update, a delete and a new payment on
+# the source must all be on the target once the move is done
+def test_move_carries_writes_made_during_it(router):
+    rows = load(router, 500)
+    first, last, source, _ = router.map.ranges[0]
+    in_range = [row for row in rows if first <= row["shard_slot"] <= last]
+    updated, deleted = in_range[0]["id"], in_range[1]["id"]
+    added = new_payment(next(f"late-{n}" for n in range(10_000) if first <= user_slot(f"late-{n}") <= last))
+    writes = iter([True])
+
+    def write_once(line):
+        if not next(writes, False):
+            return
+        db = router.session(source)
+        db.get(Payments, updated).amount = Decimal("1.23")
+        db.delete(db.get(Payments, deleted))
+        db.add(Payments(**added))
+        db.commit()
+        db.close()
+
+    move_slots(router, first, last, 2, batch_size=64, grace=0, log=write_once)
+    moved = payments_on(router, 2)
+    assert moved[updated] == Decimal("1.23")
+    assert deleted not in moved
+    assert added["id"] in moved
+    assert set(moved) == {row["id"] for row in in_range} - {deleted} | {added["id"]}
+    assert payments_on(router, source, first, last) == {}
+
+
+def test_payment_ids_carry_their_slot():
+    ids = [new_payment_id(slot) for slot in (0, 1, 2048, SLOTS - 1)]
+    assert [payment_slot(payment_id) for payment_id in ids] == [0, 1, 2048, SLOTS - 1]
+    assert {UUID(payment_id).version for payment_id in ids} == {8}
+    # Ids from before end in random digits, which name no slot
+    assert payment_slot(new_id()) is None
+    assert payment_slot("not-an-id") is None
+
+
+def test_locate_routes_by_id_without_a_query(router, monkeypatch):
+    rows = load(router, 20)
+    monkeypatch.setattr(router, "scatter", lambda fn: pytest.fail("scattered"))
+    for row in rows:
+        assert router.locate_payment(row["payment_id"]) == (router.shard_for_slot(row["shard_slot"]), row["shard_slot"])
+    assert router.locate_payment("not-an-id") == (None, None)
+
+
+# Ids minted before they carried a slot, and any id in a range being moved,
+# are looked for on every shard
+def test_locate_scatters_for_old_ids_and_moving_ranges(router):
+    old = dict(new_payment("old-user"), payment_id=new_id())
+    new = new_payment(next(f"user-{n}" for n in range(10_000) if router.shard_for_slot(user_slot(f"user-{n}")) == 1))
+    for row in (old, new):
+        db = router.session(router.shard_for_slot(row["shard_slot"]))
+        db.add(Payments(**row))
+        db.commit()
+        db.close()
+    assert router.locate_payment(old["payment_id"]) == (router.shard_for_slot(old["shard_slot"]), old["shard_slot"])
+    assert router.locate_payment(new_id()) == (None, None)
+
+    first, last, _, _ = router.map.ranges[1]
+    _set_range(router.directory_factory, first, last, 2, "frozen")
+    router.load_map()
+    assert router.locate_payment(new["payment_id"]) == (1, new["shard_slot"])
+
+
+def test_move_refuses_a_range_spanning_shards(router):
+    load(router, 10)
+    first, _, _, _ = router.map.ranges[0]
+    _, last, _, _ = router.map.ranges[1]
+    with pytest.raises(ShardingError):
+        move_slots(router, first, last, 2, log=lambda line: None)
+
+
+# Each shard numbers its changes on its own, so the cursor keeps a position
+# per shard and a page cut on one never skips or repeats the other's
+def test_changes_read_every_shard_with_its_own_cursor(router):
+    for shard in range(2):
+        db = router.session(shard)
+        for n in range(3):
+            user = next(f"user-{shard}-{n}-{k}" for k in range(10_000) if router.shard_for_slot(user_slot(f"user-{shard}-{n}-{k}")) == shard)
+            db.add(Payments(**new_payment(user)))
+        db.commit()
+        db.close()
+    sources = change_sources(["payments"], router.shard_factories[0], router.shard_factories[:2])
+    cursor = parse_cursor("0", list(sources))
+    assert set(cursor) == {"payments@0", "payments@1"}
+    seen = []
+    while True:
+        changes = _read(sources, cursor, 2)
+        if not changes:
+            break
+        seen.extend(change["id"] for change in changes)
+        cursor = next_cursor(cursor, changes)
+    assert len(seen) == len(set(seen)) == 6
+
+
+def test_migration_adds_and_backfills_shard_slot(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_payments_shard_slot"))
+        connection.execute(text("ALTER TABLE payments DROP COLUMN shard_slot"))
+    users = [f"user-{n}" for n in range(50)]
+    with engine.begin() as connection:
+        connection.execute(Payments.__table__.insert(), [
+            {key: value for key, value in new_payment(user).items() if key != "shard_slot"} for user in users
+        ])
+
+    assert upgrade(engine, log=lambda line: None) == ["payments.shard_slot"]
+    with engine.connect() as connection:
+        slots = dict(connection.execute(text("SELECT user_id, shard_slot FROM payments")).all())
+    assert slots == {user: user_slot(user) for user in users}
+    assert "ix_payments_shard_slot" in {index["name"] for index in inspect(engine).get_indexes("payments")}
+    assert upgrade(engine, log=lambda line: None) == []
@@ -0,0 +1,163 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from nuAPI.ids import new_id
+from nuAPI.models import PaymentStatus, Wallet, WalletTransfer
+from nuAPI.transfers import (TimerWheel, TransferError, create_wallet_transfer, execute_wallet_transfer, expire_wallet_transfers,
+                             transfer_funds)
+
+
+@pytest.fixture
+def wallets(session_factory):
+    db = session_factory()
+    ids = [new_id(), new_id()]
+    db.add_all(
+        Wallet(wallet_id=wallet_id, user_id=f"user-{n}", wallet_name="main", wallet_number=f"{n:010d}", wallet_status="active",
+               wallet_balance=Decimal("100"), wallet_currency="NGN")
+        for n, wallet_id in enumerate(ids)
+    )
+    db.commit()
+    db.close()
+    return ids
+
+
+@pytest.fixture(autouse=True)
+def wheel(monkeypatch):
+    wheel = TimerWheel()
+    monkeypatch.setattr("nuAPI.transfers.transfer_wheel", wheel)
+    return wheel
+
+
+def balances(session_factory, ids):
+    db = session_factory()
+    try:
+        return [db.query(Wallet.wallet_balance).filter(Wallet.wallet_id == wallet_id).scalar() for wallet_id in ids]
+    finally:
+        db.close()
+
+
+def test_transfer_moves_funds(session_factory, wallets):
+    db = session_factory()
+    transfer = transfer_funds(db, wallets[0], wallets[1], Decimal("30.25"), "NGN")
+    assert transfer.transfer_status == PaymentStatus.confirmed.value
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("69.75"), Decimal("130.25")]
+
+
+def test_insufficient_funds_moves_nothing(session_factory, wallets):
+    db = session_factory()
+    with pytest.raises(TransferError, match="Insufficient funds"):
+        transfer_funds(db, wallets[0], wallets[1], Decimal("100.01"), "NGN")
+    assert db.query(WalletTransfer).count() == 0
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("100"), Decimal("100")]
+
+
+# The credit runs first when the destination sorts first; a failed debit
+# must still roll it back
+def test_failed_debit_rolls_back_the_credit(session_factory, wallets):
+    source, destination = sorted(wallets, reverse=True)
+    db = session_factory()
+    with pytest.raises(TransferError):
+        transfer_funds(db, source, destination, Decimal("500"), "NGN")
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("100"), Decimal("100")]
+
+
+def test_missing_destination_moves_nothing(session_factory, wallets):
+    db = session_factory()
+    with pytest.raises(TransferError, match="Wallet not found"):
+        transfer_funds(db, wallets[0], new_id(), Decimal("10"), "NGN")
+    assert db.query(WalletTransfer).count() == 0
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("100"), Decimal("100")]
+
+
+@pytest.mark.parametrize("source, amount", [(0, Decimal("10")), (1, Decimal("0")), (1, Decimal("-5"))])
+def test_rejects_bad_transfers(session_factory, wallets, source, amount):
+    db = session_factory()
+    with pytest.raises(TransferError):
+        transfer_funds(db, wallets[source], wallets[0], amount, "NGN")
+    db.close()
+
+
+def test_pending_transfer_executes_once(session_factory, wallets):
+    db = session_factory()
+    transfer = create_wallet_transfer(db, wallets[0], wallets[1], Decimal("40"), "NGN")
+    assert balances(session_factory, wallets) == [Decimal("100"), Decimal("100")]
+    execute_wallet_transfer(db, transfer.transfer_id)
+    with pytest.raises(TransferError, match="not pending"):
+        execute_wallet_transfer(db, transfer.transfer_id)
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("60"), Decimal("140")]
+
+
+def test_failed_execution_leaves_the_transfer_pending(session_factory, wallets):
+    db = session_factory()
+    transfer = create_wallet_transfer(db, wallets[0], wallets[1], Decimal("150"), "NGN")
+    with pytest.raises(TransferError, match="Insufficient funds"):
+        execute_wallet_transfer(db, transfer.transfer_id)
+    db.expire_all()
+    assert db.get(WalletTransfer, transfer.transfer_id).transfer_status == PaymentStatus.pending.value
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("100"), Decimal("100")]
+
+
+def test_currency_mismatch_is_refused(session_factory, wallets):
+    db = session_factory()
+    with pytest.raises(TransferError, match="Currency"):
+        create_wallet_transfer(db, wallets[0], wallets[1], Decimal("10"), "USD")
+    with pytest.raises(TransferError, match="Currency"):
+        transfer_funds(db, wallets[0], wallets[1], Decimal("10"), "USD")
+    assert db.query(WalletTransfer).count() == 0
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("100"), Decimal("100")]
+
+
+# Wallet ids are stored in the same 16-byte form as Wallet.wallet_id
+def test_transfer_wallet_ids_match_wallets(session_factory, wallets):
+    db = session_factory()
+    transfer = transfer_funds(db, wallets[0], wallets[1], Decimal("1"), "NGN")
+    transfer_id = transfer.transfer_id
+    db.close()
+    db = session_factory()
+    source = db.query(Wallet).join(WalletTransfer, WalletTransfer.source_wallet_id == Wallet.wallet_id).filter(
+        WalletTransfer.transfer_id == transfer_id
+    ).one()
+    assert source.wallet_id == wallets[0]
+    db.close()
+
+
+def test_expired_transfer_is_cancelled_and_cannot_execute(session_factory, wallets):
+    db = session_factory()
+    transfer = create_wallet_transfer(db, wallets[0], wallets[1], Decimal("10"), "NGN", timeout=timedelta(seconds=2))
+    assert expire_wallet_transfers(db, datetime.utcnow() + timedelta(seconds=5)) == 1
+    db.expire_all()
+    assert db.get(WalletTransfer, transfer.transfer_id).transfer_status == PaymentStatus.cancelled.value
+    with pytest.raises(TransferError):
+        execute_wallet_transfer(db, transfer.transfer_id)
+    db.close()
+    assert balances(session_factory, wallets) == [Decimal("100"), Decimal("100")]
+
+
+def test_executed_transfer_is_not_expired(session_factory, wallets, wheel):
+    db = session_factory()
+    transfer = create_wallet_transfer(db, wallets[0], wallets[1], Decimal("10"), "NGN", timeout=timedelta(seconds=2))
+    execute_wallet_transfer(db, transfer.transfer_id)
+    assert len(wheel) == 0
+    assert expire_wallet_transfers(db, datetime.utcnow() + timedelta(seconds=5)) == 0
+    db.close()
+
+
+def test_timer_wheel_fires_after_several_revolutions():
+    start = datetime(2024, 1, 1)
+    wheel = TimerWheel(tick=timedelta(seconds=1), slots=8, start=start)
+    wheel.schedule("late", start + timedelta(seconds=20))
+    wheel.schedule("cancelled", start + timedelta(seconds=3))
+    wheel.cancel("cancelled")
+    assert wheel.advance(start + timedelta(seconds=19)) == []
+    assert wheel.advance(start + timedelta(seconds=20)) == ["late"]
+    assert len(wheel) == 0
+
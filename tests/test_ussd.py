@@ -0,0 +1,165 @@
+import hashlib
+import hmac
+import json
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from nuAPI.auth import create_access_token
+from nuAPI.migrations import upgrade
+from nuAPI.models import Base, Wallet
+from nuAPI.ussd import (
+    DEFAULT_ACTIONS, DEFAULT_MENU, MAX_PIN_FAILURES, SIGNATURE_HEADER, SessionStore, UssdEngine, UssdMenu, hash_pin, normalise_msisdn,
+)
+
+ALICE, BOB = "+2348031234567", "+2348039876543"
+
+
+def add_wallet(db, msisdn, pin="1234", balance="100", user_id="user-1"):
+    wallet = Wallet(user_id=user_id, wallet_name="main", wallet_number=msisdn[-10:], wallet_status="active", wallet_balance=Decimal(balance),
+                    wallet_currency="NGN", wallet_msisdn=normalise_msisdn(msisdn), wallet_pin_hash=hash_pin(pin) if pin else None)
+    db.add(wallet)
+    db.commit()
+    return wallet.wallet_id
+
+
+@pytest.fixture
+def ussd(session_factory):
+    db = session_factory()
+    wallets = {ALICE: add_wallet(db, ALICE), BOB: add_wallet(db, BOB, balance="0")}
+    db.close()
+    return UssdEngine(UssdMenu(DEFAULT_MENU, DEFAULT_ACTIONS), SessionStore(), session_factory), wallets
+
+
+def balances(session_factory, wallets):
+    db = session_factory()
+    try:
+        return {phone: db.get(Wallet, wallet_id).wallet_balance for phone, wallet_id in wallets.items()}
+    finally:
+        db.close()
+
+
+# Each hop resends everything typed so far, as aggregators do
+def dial(engine, phone, *inputs, session_id="s1"):
+    replies = [engine.handle(session_id, phone, "")]
+    for n in range(1, len(inputs) + 1):
+        replies.append(engine.handle(session_id, phone, "*".join(inputs[:n])))
+    return replies[-1]
+
+
+def test_normalise_msisdn():
+    assert {normalise_msisdn(number) for number in ("+234 803 123 4567", "08031234567", "2348031234567", "8031234567")} == {"2348031234567"}
+    assert normalise_msisdn("+448031234567") == "448031234567"
+    assert normalise_msisdn("not a number") is None
+
+
+def test_send_money_needs_the_pin(ussd, session_factory):
+    engine, wallets = ussd
+    assert dial(engine, ALICE, "2", "08039876543", "40", "1") == "CON Enter your wallet PIN"
+    assert dial(engine, ALICE, "2", "08039876543", "40", "1", "1234") == "END Sent 40 to 08039876543."
+    assert balances(session_factory, wallets) == {ALICE: Decimal("60"), BOB: Decimal("40")}
+
+    assert dial(engine, ALICE, "2", BOB, "40", "1", "9999", session_id="s2") == "END Wrong PIN."
+    assert balances(session_factory, wallets) == {ALICE: Decimal("60"), BOB: Decimal("40")}
+
+
+def test_wrong_pins_lock_the_wallet(ussd, session_factory):
+    engine, wallets = ussd
+    for n in range(MAX_PIN_FAILURES):
+        assert dial(engine, ALICE, "1", "0000", session_id=f"s{n}") == "END Wrong PIN."
+    # Locked now, even for the right PIN
+    assert dial(engine, ALICE, "1", "1234", session_id="last").startswith("END Wallet locked")
+    assert dial(engine, ALICE, "2", BOB, "10", "1", "1234", session_id="send").startswith("END Wallet locked")
+    assert balances(session_factory, wallets)[ALICE] == Decimal("100")
+
+
+def test_a_right_pin_clears_failures(ussd):
+    engine, _ = ussd
+    for n in range(MAX_PIN_FAILURES - 1):
+        dial(engine, ALICE, "1", "0000", session_id=f"s{n}")
+    assert dial(engine, ALICE, "1", "1234", session_id="ok") == "END Your balance is NGN 100.00"
+    assert dial(engine, ALICE, "1", "0000", session_id="again") == "END Wrong PIN."
+    assert dial(engine, ALICE, "1", "1234", session_id="still") == "END Your balance is NGN 100.00"
+
+
+# The old lookup matched the last ten digits, so a caller abroad with the
+# same national digits reached a Nigerian wallet
+def test_only_the_full_number_matches(ussd, session_factory):
+    engine, wallets = ussd
+    assert dial(engine, "+448031234567", "1", "1234") == "END No wallet is linked to this number."
+    assert dial(engine, ALICE, "2", "+448039876543", "10", "1", "1234") == "END Wallet not found."
+    assert balances(session_factory, wallets)[ALICE] == Decimal("100")
+
+
+def test_no_pin_set(session_factory):
+    db = session_factory()
+    add_wallet(db, ALICE, pin=None)
+    db.close()
+    engine = UssdEngine(UssdMenu(DEFAULT_MENU, DEFAULT_ACTIONS), SessionStore(), session_factory)
+    assert dial(engine, ALICE, "1", "1234") == "END Set a wallet PIN in the app first."
+
+
+def test_migration_fills_numbers_held_by_one_wallet(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_wallets_wallet_msisdn"))
+        for column in ("wallet_msisdn", "wallet_pin_hash", "wallet_pin_failures"):
+            connection.execute(text(f"ALTER TABLE wallets DROP COLUMN {column}"))
+    with engine.begin() as connection:
+        for n, number in enumerate(["8031234567", "8039876543", "8039876543", "12"]):
+            connection.execute(text(
+                "INSERT INTO wallets (wallet_id, user_id, wallet_name, wallet_number, wallet_status, wallet_date, wallet_balance) "
+                "VALUES (:id, 'user', 'main', :number, 'active', CURRENT_TIMESTAMP, 0)"
+            ), {"id": bytes([n]) * 16, "number": number})
+
+    assert upgrade(engine, log=lambda line: None) == ["wallets.wallet_msisdn", "wallets.wallet_pin_hash", "wallets.wallet_pin_failures"]
+    with engine.connect() as connection:
+        numbers = connection.execute(text("SELECT wallet_number, wallet_msisdn FROM wallets ORDER BY wallet_id")).all()
+    assert numbers == [("8031234567", "2348031234567"), ("8039876543", None), ("8039876543", None), ("12", None)]
+
+
+def signed(body: dict, secret: str):
+    content = json.dumps(body).encode()
+    return content, {SIGNATURE_HEADER: hmac.new(secret.encode(), content, hashlib.sha256).hexdigest(), "Content-Type": "application/json"}
+
+
+def test_hops_need_the_aggregator(client, monkeypatch):
+    hop = {"session_id": "api-1", "phone_number": ALICE, "text": ""}
+    monkeypatch.delenv("NUAPI_USSD_SECRET", raising=False)
+    monkeypatch.delenv("NUAPI_USSD_ALLOWED_IPS", raising=False)
+    assert client.post("/ussd/", json=hop).status_code == 403
+
+    monkeypatch.setenv("NUAPI_USSD_SECRET", "aggregator-secret")
+    content, headers = signed(hop, "aggregator-secret")
+    response = client.post("/ussd/", content=content, headers=headers)
+    assert response.status_code == 200 and response.text.startswith("CON Welcome")
+    content, headers = signed(hop, "someone-else")
+    assert client.post("/ussd/", content=content, headers=headers).status_code == 403
+    assert client.post("/ussd/", json=hop).status_code == 403
+
+    monkeypatch.delenv("NUAPI_USSD_SECRET")
+    monkeypatch.setenv("NUAPI_USSD_ALLOWED_IPS", "10.0.0.1")
+    assert client.post("/ussd/", json=hop).status_code == 403
+    monkeypatch.setenv("NUAPI_USSD_ALLOWED_IPS", "10.0.0.1, testclient")
+    assert client.post("/ussd/", json=hop).status_code == 200
+
+
+def test_owner_links_a_number_once(client):
+    from nuAPI.database import SessionLocal
+
+    db = SessionLocal()
+    owner, other = "0190a1b2-0000-7000-8000-000000000001", "0190a1b2-0000-7000-8000-000000000002"
+    mine = add_wallet(db, "+2348070000001", pin=None, user_id=owner)
+    theirs = add_wallet(db, "+2348070000002", pin=None, user_id=other)
+    db.close()
+    auth = {"Authorization": "Bearer " + create_access_token({"sub": owner})}
+
+    response = client.put(f"/wallets/{mine}/ussd", json={"phone_number": "08070000003", "pin": "4321"}, headers=auth)
+    assert response.status_code == 200
+    assert response.json() == {"wallet_id": mine, "wallet_msisdn": "2348070000003"}
+    assert client.put(f"/wallets/{theirs}/ussd", json={"phone_number": "08070000004", "pin": "4321"}, headers=auth).status_code == 404
+    assert client.put(f"/wallets/{mine}/ussd", json={"phone_number": "+2348070000002", "pin": "4321"}, headers=auth).status_code == 409
+    assert client.put(f"/wallets/{mine}/ussd", json={"phone_number": "08070000003", "pin": "12"}, headers=auth).status_code == 422
+    assert client.put(f"/wallets/{mine}/ussd", json={"phone_number": "08070000003", "pin": "4321"}).status_code == 401
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+from sqlalchemy import select
+
+import nuAPI.vault
+from nuAPI.models import CardVault, PaymentInstrument, Payments
+from nuAPI.vault import TokenVault, VaultError, is_pan, luhn_valid, tokenise_stored_cards
+
+VISA, VERVE = "4111111111111111", "5061040000000000009"
+
+
+@pytest.fixture
+def vault():
+    return TokenVault(key=os.urandom(32))
+
+
+def test_tokens_stand_in_for_the_pan(session_factory, vault):
+    db = session_factory()
+    token = vault.tokenise(db, VISA)
+    assert token != VISA and len(token) == len(VISA) and token.endswith(VISA[-4:])
+    assert not luhn_valid(token) and not is_pan(token)
+    # The same card always gets the same token, and a batch shares one lookup
+    assert vault.tokenise_many(db, [VERVE, VISA, VERVE]) == [vault.tokenise(db, VERVE), token, vault.tokenise(db, VERVE)]
+    db.commit()
+
+    assert db.query(CardVault).count() == 2
+    assert all(VISA.encode() not in row.pan_ciphertext for row in db.query(CardVault))
+    assert vault.card_info(db, token) == ("411111", "1111", "visa")
+    assert vault.card_info(db, vault.tokenise(db, VERVE))[2] == "verve"
+    assert vault.detokenise_many(db, [token, token]) == [VISA, VISA]
+    db.close()
+
+
+def test_refuses_bad_input_and_the_wrong_key(session_factory, vault):
+    db = session_factory()
+    with pytest.raises(VaultError):
+        vault.tokenise(db, "4111111111111112")  # fails Luhn
+    token = vault.tokenise(db, VISA)
+    with pytest.raises(VaultError):
+        vault.detokenise(db, "9000000000001111")
+    with pytest.raises(VaultError):
+        TokenVault(key=os.urandom(32)).detokenise(db, token)
+    db.close()
+
+
+def test_nothing_is_vaulted_without_a_key(session_factory, monkeypatch):
+    monkeypatch.setattr(nuAPI.vault, "VAULT_KEY", None)
+    monkeypatch.setattr(nuAPI.vault, "VAULT_KEY_FILE", None)
+    monkeypatch.delenv("NUAPI_VAULT_KEY", raising=False)
+    monkeypatch.delenv("NUAPI_VAULT_KEY_FILE", raising=False)
+    db = session_factory()
+    with pytest.raises(VaultError):
+        TokenVault().tokenise(db, VISA)
+    assert db.query(CardVault).count() == 0
+    db.close()
+
+
+def test_stored_cards_are_tokenised(engine, session_factory, vault):
+    db = session_factory()
+    db.add_all([PaymentInstrument(channel="card", user_id="user", number=VISA, status="active"),
+                PaymentInstrument(channel="bank", user_id="user", number="0123456789", status="active")])
+    db.commit()
+    db.close()
+
+    assert tokenise_stored_cards(engine, vault, log=lambda line: None) == {"payment_instruments": 1}
+    with engine.connect() as connection:
+        numbers = dict(connection.execute(select(PaymentInstrument.channel, PaymentInstrument.number)).all())
+    assert numbers["bank"] == "0123456789"
+    db = session_factory()
+    assert vault.detokenise(db, numbers["card"]) == VISA
+    db.close()
+    # Tokens are not numbers to tokenise again
+    assert tokenise_stored_cards(engine, vault, log=lambda line: None) == {"payment_instruments": 0}
+
+
+def test_card_payments_keep_only_the_token(client):
+    from nuAPI.database import SessionLocal
+
+    request = {"user_id": "0190a1b2-0000-7000-8000-0000000000aa", "amount": "12.00", "currency": "NGN", "customer_name": "A N Other",
+               "card_number": VISA, "card_expiry": "12/29", "cvv": "123", "status": "pending"}
+    created = client.post("/card-payments/", json=request)
+    assert created.status_code == 200
+    token = created.json()["card_token"]
+    db = SessionLocal()
+    payment = db.query(Payments).filter(Payments.payment_id == created.json()["card_payment_id"]).one()
+    assert payment.card_token == token and VISA not in str(vars(payment))
+    db.close()
+
+    # Later payments can quote the token instead of the number
+    again = dict(request, amount="13.00", card_number=None, card_token=token)
+    assert client.post("/card-payments/", json=again).json()["card_token"] == token
+    assert client.post("/card-payments/", json=dict(again, card_token="9000000000001111")).status_code == 400
+    assert client.post("/card-payments/", json=dict(request, card_number="4111111111111112")).status_code == 400